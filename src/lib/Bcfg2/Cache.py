@@ -1,14 +1,535 @@
-""" An implementation of a simple memory-backed cache. Right now this
-doesn't provide many features, but more (time-based expiration, etc.)
-can be added as necessary. """
+""" A thread-safe, memory-backed cache with optional limits on the
+number of entries and their estimated size in bytes, least recently
+used eviction, and per-entry expiration times.
 
+Caches are normally created with :func:`get_cache`, which reads the
+limits of a named cache from the ``[caching]`` section of
+``bcfg2.conf``:
 
-class Cache(dict):
-    """ an implementation of a simple memory-backed cache """
+.. code-block:: ini
+
+    [caching]
+    metadata_max_entries = 50000
+    config_max_bytes = 268435456
+    deps_ttl = 3600
+
+The hits, misses, evictions, and expirations of named caches are
+counted, and reported along with :attr:`Bcfg2.Statistics.stats` when
+the statistics are read; see :func:`get_counters`. """
+
+import sys
+import time
+import logging
+import weakref
+import threading
+import Bcfg2.Statistics
+
+LOGGER = logging.getLogger(__name__)
+
+#: The counters in :attr:`Cache.stats` that are reported by
+#: :func:`get_counters`
+COUNTERS = ["hits", "misses", "evictions", "expirations"]
+
+#: A dict of weak reference to a named :class:`Cache` -> tuple of
+#: (<cache name>, <:attr:`Cache.stats` of the cache>)
+_NAMED = dict()
+
+#: A list of the weak references in :attr:`_NAMED` whose caches have
+#: been garbage collected
+_DEAD = []
+
+#: A dict of cache name -> dict of counter -> the total of that
+#: counter of all caches with that name that no longer exist
+_RETIRED = dict()
+
+_LOCK = threading.Lock()
+
+# indexes into the list that holds each cache entry.  entries are
+# kept in a circular doubly-linked list in order of use, so that the
+# least recently used entry can be found and any entry can be moved
+# to the front without searching.
+PREV, NEXT, KEY, VALUE, EXPIRES, SIZE = range(6)
+
+
+def estimate_size(obj):
+    """ Estimate the size, in bytes, of an object and everything it
+    refers to.  Objects that are referred to more than once are only
+    counted once.
+
+    :param obj: The object to get the size of
+    :type obj: any
+    :returns: int
+    """
+    if not hasattr(sys, "getsizeof"):
+        # python 2.5 and earlier; everything is the same size
+        return 1
+    seen = set()
+    pending = [obj]
+    total = 0
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            pending.extend(obj.keys())
+            pending.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            pending.extend(obj)
+        if hasattr(obj, "__dict__"):
+            pending.append(obj.__dict__)
+        for attr in getattr(obj.__class__, "__slots__", []):
+            if attr not in ["__dict__", "__weakref__"] and hasattr(obj, attr):
+                pending.append(getattr(obj, attr))
+    return total
+
+
+class Cache(object):
+    """ A thread-safe, memory-backed cache.  It behaves mostly like a
+    dict, but:
+
+    * If :attr:`max_entries` or :attr:`max_bytes` is set, the least
+      recently used entries are evicted when the cache grows beyond
+      them.
+    * If :attr:`ttl` is set, or an entry is added with :func:`set`
+      and a ``ttl``, the entry expires that many seconds after it was
+      added.
+    * In addition to expiring items by key, items can be expired by
+      the data they depend on; see :func:`add_dependency` and
+      :func:`expire_dependents`.
+
+    Iterating over the cache, or calling :func:`keys`, :func:`values`
+    or :func:`items`, works on a copy of the cache, so other threads
+    can change the cache meanwhile. """
+
+    # pylint: disable=R0913
+    def __init__(self, name=None, max_entries=None, max_bytes=None, ttl=None,
+                 sizeof=estimate_size):
+        """
+        :param name: The name of the cache, used to report its
+                     counters.  The counters of caches without a name
+                     are not reported.
+        :type name: string
+        :param max_entries: The maximum number of entries in the cache,
+                            or None for no limit
+        :type max_entries: int
+        :param max_bytes: The maximum estimated size of all entries in
+                          the cache, or None for no limit
+        :type max_bytes: int
+        :param ttl: The default number of seconds after which an entry
+                    expires, or None if entries do not expire
+        :type ttl: float
+        :param sizeof: A function that estimates the size, in bytes,
+                       of a cached value.  It is only used if
+                       ``max_bytes`` is set.
+        :type sizeof: callable
+        """
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+
+        #: A dict of key -> entry.  Each entry is a list of [<previous
+        #: entry>, <next entry>, <key>, <value>, <expiry time or
+        #: None>, <size>].
+        self.entries = dict()
+
+        #: The head of the list of entries; ``root[NEXT]`` is the
+        #: most recently used entry and ``root[PREV]`` the least
+        #: recently used.
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None, None, 0]
+
+        #: The estimated size of all entries in the cache
+        self.bytes = 0
+
+        #: A dict of dependency -> set of the keys of all items that
+        #: depend on it.
+        self.dependents = dict()
+
+        #: A dict of key -> set of the dependencies of the item
+        self.dependencies = dict()
+
+        #: A counter that is incremented every time anything is
+        #: expired from the cache.  Callers that build an item over
+        #: a period of time can compare the serial from before and
+        #: after to find out whether the data they used may have
+        #: been expired in the meantime.
+        self.serial = 0
+
+        #: Counters of cache activity; see :func:`get_stats`
+        self.stats = dict(hits=0, misses=0, evictions=0, expirations=0)
+        self.lock = threading.RLock()
+        if name is not None:
+            _register(self)
+    # pylint: enable=R0913
+
+    def _link(self, entry):
+        """ Add an entry to the front of the list of entries.  Must be
+        called with :attr:`lock` held. """
+        first = self.root[NEXT]
+        entry[PREV] = self.root
+        entry[NEXT] = first
+        first[PREV] = entry
+        self.root[NEXT] = entry
+
+    def _unlink(self, entry):
+        """ Remove an entry from the list of entries.  Must be called
+        with :attr:`lock` held. """
+        entry[PREV][NEXT] = entry[NEXT]
+        entry[NEXT][PREV] = entry[PREV]
+
+    def _remove(self, key):
+        """ Remove an entry from the cache.  Must be called with
+        :attr:`lock` held. """
+        entry = self.entries.pop(key)
+        self._unlink(entry)
+        self.bytes -= entry[SIZE]
+        for dependency in self.dependencies.pop(key, []):
+            keys = self.dependents.get(dependency)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.dependents[dependency]
+        return entry
+
+    def _lookup(self, key):
+        """ Get the entry for a key, or None if it is not in the
+        cache or has expired, without counting a hit or miss.  Must be
+        called with :attr:`lock` held. """
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[EXPIRES] is not None and entry[EXPIRES] <= time.time():
+            self._remove(key)
+            self.stats['expirations'] += 1
+            return None
+        return entry
+
+    def _over_limit(self):
+        """ Whether the cache is larger than :attr:`max_entries` or
+        :attr:`max_bytes` """
+        if (self.max_entries is not None and
+            len(self.entries) > self.max_entries):
+            return True
+        return self.max_bytes is not None and self.bytes > self.max_bytes
+
+    def _evict(self):
+        """ Evict the least recently used entries until the cache is
+        within its limits.  Must be called with :attr:`lock` held.
+        Returns the number of entries evicted. """
+        evicted = 0
+        while self.entries and self._over_limit():
+            self._remove(self.root[PREV][KEY])
+            evicted += 1
+        self.stats['evictions'] += evicted
+        return evicted
+
+    def get(self, key, default=None):
+        """ Get an item from the cache, or ``default`` if it is not
+        in the cache or has expired. """
+        self.lock.acquire()
+        try:
+            entry = self._lookup(key)
+            if entry is None:
+                self.stats['misses'] += 1
+            else:
+                self.stats['hits'] += 1
+                self._unlink(entry)
+                self._link(entry)
+        finally:
+            self.lock.release()
+        if entry is None:
+            return default
+        return entry[VALUE]
+
+    def __getitem__(self, key):
+        # use a unique default so that cached None values are found
+        rv = self.get(key, self._missing)
+        if rv is self._missing:
+            raise KeyError(key)
+        return rv
+
+    _missing = object()
+
+    def set(self, key, value, ttl=None):
+        """ Add an item to the cache, replacing any item with the same
+        key.
+
+        :param key: The key of the item
+        :type key: any hashable
+        :param value: The item to cache
+        :type value: any
+        :param ttl: The number of seconds after which the item
+                    expires.  Defaults to :attr:`ttl`.
+        :type ttl: float
+        """
+        if ttl is None:
+            ttl = self.ttl
+        if ttl is None:
+            expires = None
+        else:
+            expires = time.time() + ttl
+        if self.max_bytes is not None:
+            size = self.sizeof(value)
+        else:
+            size = 0
+        self.lock.acquire()
+        try:
+            if key in self.entries:
+                # the item is replaced, but the items that depend on
+                # the same data still depend on it
+                entry = self.entries[key]
+                self._unlink(entry)
+                self.bytes -= entry[SIZE]
+                entry[VALUE] = value
+                entry[EXPIRES] = expires
+                entry[SIZE] = size
+            else:
+                entry = [None, None, key, value, expires, size]
+                self.entries[key] = entry
+            self._link(entry)
+            self.bytes += size
+            self._evict()
+        finally:
+            self.lock.release()
+
+    __setitem__ = set
+
+    def __delitem__(self, key):
+        self.lock.acquire()
+        try:
+            if self._lookup(key) is None:
+                raise KeyError(key)
+            self._remove(key)
+        finally:
+            self.lock.release()
+
+    def pop(self, key, *default):
+        """ Remove an item from the cache and return it.  If it is not
+        in the cache, return ``default`` if it is given, or raise
+        :exc:`KeyError`. """
+        self.lock.acquire()
+        try:
+            entry = self._lookup(key)
+            if entry is not None:
+                self._remove(key)
+                return entry[VALUE]
+        finally:
+            self.lock.release()
+        if default:
+            return default[0]
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        self.lock.acquire()
+        try:
+            return self._lookup(key) is not None
+        finally:
+            self.lock.release()
+
+    has_key = __contains__
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __nonzero__(self):
+        return True
+
+    __bool__ = __nonzero__
+
+    def items(self):
+        """ Get a list of (<key>, <item>) tuples of all items in the
+        cache that have not expired, from most to least recently
+        used. """
+        now = time.time()
+        rv = []
+        self.lock.acquire()
+        try:
+            entry = self.root[NEXT]
+            while entry is not self.root:
+                if entry[EXPIRES] is None or entry[EXPIRES] > now:
+                    rv.append((entry[KEY], entry[VALUE]))
+                entry = entry[NEXT]
+        finally:
+            self.lock.release()
+        return rv
+
+    def keys(self):
+        """ Get a list of the keys of all items in the cache that have
+        not expired """
+        return [k for k, _ in self.items()]
+
+    def values(self):
+        """ Get a list of all items in the cache that have not
+        expired """
+        return [v for _, v in self.items()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def clear(self):
+        """ Remove all items from the cache """
+        self.lock.acquire()
+        try:
+            self.entries.clear()
+            self.root[:] = [self.root, self.root, None, None, None, 0]
+            self.bytes = 0
+            self.dependents.clear()
+            self.dependencies.clear()
+        finally:
+            self.lock.release()
+
+    def add_dependency(self, key, dependency):
+        """ record that the item with the given key depends on the
+        given dependency, which can be any hashable object """
+        self.lock.acquire()
+        try:
+            try:
+                self.dependents[dependency].add(key)
+            except KeyError:
+                self.dependents[dependency] = set([key])
+            try:
+                self.dependencies[key].add(dependency)
+            except KeyError:
+                self.dependencies[key] = set([dependency])
+        finally:
+            self.lock.release()
 
     def expire(self, key=None):
         """ expire all items, or a specific item, from the cache """
-        if key is None:
-            self.clear()
-        elif key in self:
-            del self[key]
+        self.lock.acquire()
+        try:
+            self.serial += 1
+            if key is None:
+                self.clear()
+            elif key in self.entries:
+                self._remove(key)
+        finally:
+            self.lock.release()
+
+    def expire_dependents(self, dependency):
+        """ expire all items that depend on the given dependency,
+        returning the list of keys that were expired """
+        self.lock.acquire()
+        try:
+            self.serial += 1
+            rv = []
+            for key in list(self.dependents.get(dependency, [])):
+                if key in self.entries:
+                    self._remove(key)
+                    rv.append(key)
+            self.dependents.pop(dependency, None)
+            return rv
+        finally:
+            self.lock.release()
+
+    def get_stats(self):
+        """ Get counters of cache activity: ``hits``, ``misses``,
+        ``evictions`` (items removed to keep the cache within its
+        limits), ``expirations`` (items found to have expired),
+        ``size`` (the number of items in the cache), and ``bytes``
+        (the estimated size of the items in the cache, if
+        :attr:`max_bytes` is set).
+
+        :returns: dict of string -> int
+        """
+        self.lock.acquire()
+        try:
+            rv = dict(self.stats)
+            rv['size'] = len(self.entries)
+            rv['bytes'] = self.bytes
+            return rv
+        finally:
+            self.lock.release()
+
+    def __repr__(self):
+        return "%s(%s, %d items)" % (self.__class__.__name__, self.name,
+                                     len(self.entries))
+
+
+def _register(cache):
+    """ Add a named cache to the caches whose counters are reported
+    by :func:`get_counters` """
+    ref = weakref.ref(cache, _DEAD.append)
+    _LOCK.acquire()
+    try:
+        # retire the counters of caches that no longer exist here,
+        # too, so that they do not pile up if nothing ever reads them
+        _retire()
+        _NAMED[ref] = (cache.name, cache.stats)
+    finally:
+        _LOCK.release()
+
+
+def _retire():
+    """ Add the counters of caches that have been garbage collected
+    to :attr:`_RETIRED` and forget them.  The caller must hold
+    :attr:`_LOCK`. """
+    while _DEAD:
+        name, counters = _NAMED.pop(_DEAD.pop(), (None, None))
+        if name is None:
+            continue
+        totals = _RETIRED.setdefault(name, dict())
+        for counter in COUNTERS:
+            totals[counter] = totals.get(counter, 0) + counters[counter]
+
+
+def get_counters():
+    """ Get the total hits, misses, evictions, and expirations of all
+    named caches, including those that no longer exist.  Caches with
+    the same name are counted together.
+
+    :returns: dict of ``Cache:<name>:<counter>`` -> int
+    """
+    totals = dict()
+    _LOCK.acquire()
+    try:
+        _retire()
+        for name, counters in list(_RETIRED.items()) + \
+                list(_NAMED.values()):
+            for counter in COUNTERS:
+                key = "Cache:%s:%s" % (name, counter)
+                totals[key] = totals.get(key, 0) + counters[counter]
+    finally:
+        _LOCK.release()
+    return totals
+
+
+Bcfg2.Statistics.stats.add_counters(get_counters)
+
+
+def get_cache(name, cfp, max_entries=None, max_bytes=None, ttl=None):
+    """ Create a named :class:`Cache`, with the limits given by the
+    ``<name>_max_entries``, ``<name>_max_bytes``, and ``<name>_ttl``
+    options in the ``[caching]`` section of ``bcfg2.conf``.  A limit
+    of 0 means no limit.
+
+    :param name: The name of the cache
+    :type name: string
+    :param cfp: The parsed ``bcfg2.conf``
+    :type cfp: Bcfg2.Options.ConfigParser
+    :param max_entries: The default maximum number of entries
+    :type max_entries: int
+    :param max_bytes: The default maximum size of the cache in bytes
+    :type max_bytes: int
+    :param ttl: The default number of seconds after which entries
+                expire
+    :type ttl: float
+    :returns: :class:`Cache`
+    """
+    limits = dict(max_entries=max_entries, max_bytes=max_bytes, ttl=ttl)
+    for opt, cook in [("max_entries", int), ("max_bytes", int),
+                      ("ttl", float)]:
+        val = cfp.get("caching", "%s_%s" % (name, opt), default="")
+        if val:
+            try:
+                limits[opt] = cook(val)
+            except ValueError:
+                LOGGER.error("Invalid caching %s_%s %s, using the default" %
+                             (name, opt, val))
+        if not limits[opt]:
+            limits[opt] = None
+    return Cache(name=name, **limits)
@@ -131,16 +131,22 @@ class Client(object):
                 allowedServerCNs=self.setup['serverCN'],
                 timeout=self.setup['timeout'],
                 retries=int(self.setup['retries']),
-                delay=int(self.setup['retry_delay']))
+                delay=int(self.setup['retry_delay']),
+                compress_threshold=self.setup['compression_threshold'],
+                compress_level=self.setup['compression_level'])
         return self._proxy
 
-    def run_probes(self, times=None):
-        """ run probes and upload probe data """
+    def run_probes(self, times=None, probes=None):
+        """ run probes and upload probe data.  ``probes`` is the
+        probe XML returned by the server, if it has already been
+        downloaded.  Returns True if any probes were run. """
         if times is None:
             times = dict()
 
         try:
-            probes = Bcfg2.Client.XML.XML(str(self.proxy.GetProbes()))
+            if probes is None:
+                probes = self.proxy.GetProbes()
+            probes = Bcfg2.Client.XML.XML(str(probes))
         except (Bcfg2.Proxy.ProxyError,
                 Bcfg2.Proxy.CertificateError,
                 socket.gaierror,
@@ -170,6 +176,64 @@ class Client(object):
                 self.fatal_error("Failed to upload probe data: %s" % err)
 
         times['probe_upload'] = time.time()
+        return len(probes.findall(".//probe")) > 0
+
+    def start_run(self):
+        """ Assert the client profile, declare the client version,
+        and download probes and the decision list from the server in
+        a single call.  Returns the server's response, or None if the
+        server is too old to support it. """
+        if self.setup['decision'] in ['whitelist', 'blacklist']:
+            decision_mode = self.setup['decision']
+        else:
+            decision_mode = ''
+        try:
+            rv = self.proxy.StartClientRun(__version__,
+                                           self.setup['profile'] or '',
+                                           decision_mode)
+            if not rv['version']:
+                self.logger.error("Failed to declare version")
+            return rv
+        except xmlrpclib.Fault:
+            err = sys.exc_info()[1]
+            if Bcfg2.Proxy.method_not_found(err):
+                self.logger.debug("Server does not support StartClientRun, "
+                                  "falling back to individual calls")
+                return None
+            self.fatal_error("Failed to start client run: %s" % err)
+        except (Bcfg2.Proxy.ProxyError,
+                Bcfg2.Proxy.CertificateError,
+                socket.gaierror,
+                socket.error):
+            err = sys.exc_info()[1]
+            self.fatal_error("Failed to start client run: %s" % err)
+
+    def _start_run_compat(self):
+        """ Assert the client profile and declare the client version
+        with individual calls, for servers that do not support
+        :func:`start_run` """
+        if self.setup['profile']:
+            try:
+                self.proxy.AssertProfile(self.setup['profile'])
+            except Bcfg2.Proxy.ProxyError:
+                err = sys.exc_info()[1]
+                self.fatal_error("Failed to set client profile: %s" % err)
+
+        try:
+            self.proxy.DeclareVersion(__version__)
+        except xmlrpclib.Fault:
+            err = sys.exc_info()[1]
+            if Bcfg2.Proxy.method_not_found(err):
+                self.logger.debug("Server does not support declaring "
+                                  "client version")
+            else:
+                self.logger.error("Failed to declare version: %s" % err)
+        except (Bcfg2.Proxy.ProxyError,
+                Bcfg2.Proxy.CertificateError,
+                socket.gaierror,
+                socket.error):
+            err = sys.exc_info()[1]
+            self.logger.error("Failed to declare version: %s" % err)
 
     def get_config(self, times=None):
         """ load the configuration, either from the cached
@@ -188,42 +252,29 @@ class Client(object):
                                  % (self.setup['file']))
         else:
             # retrieve config from server
-            if self.setup['profile']:
-                try:
-                    self.proxy.AssertProfile(self.setup['profile'])
-                except Bcfg2.Proxy.ProxyError:
-                    err = sys.exc_info()[1]
-                    self.fatal_error("Failed to set client profile: %s" % err)
-
-            try:
-                self.proxy.DeclareVersion(__version__)
-            except xmlrpclib.Fault:
-                err = sys.exc_info()[1]
-                if (err.faultCode == xmlrpclib.METHOD_NOT_FOUND or
-                    (err.faultCode == 7 and
-                     err.faultString.startswith("Unknown method"))):
-                    self.logger.debug("Server does not support declaring "
-                                      "client version")
-                else:
-                    self.logger.error("Failed to declare version: %s" % err)
-            except (Bcfg2.Proxy.ProxyError,
-                    Bcfg2.Proxy.CertificateError,
-                    socket.gaierror,
-                    socket.error):
-                err = sys.exc_info()[1]
-                self.logger.error("Failed to declare version: %s" % err)
-
-            self.run_probes(times=times)
+            start = self.start_run()
+            if start is None:
+                self._start_run_compat()
+                ran_probes = self.run_probes(times=times)
+            else:
+                ran_probes = self.run_probes(times=times,
+                                             probes=start['probes'])
 
             if self.setup['decision'] in ['whitelist', 'blacklist']:
-                try:
-                    self.setup['decision_list'] = \
-                        self.proxy.GetDecisionList(self.setup['decision'])
-                    self.logger.info("Got decision list from server:")
-                    self.logger.info(self.setup['decision_list'])
-                except Bcfg2.Proxy.ProxyError:
-                    err = sys.exc_info()[1]
-                    self.fatal_error("Failed to get decision list: %s" % err)
+                if start is not None and not ran_probes:
+                    # no probe data was sent, so the decision list we
+                    # got at the start of the run is still current
+                    self.setup['decision_list'] = start['decisions']
+                else:
+                    try:
+                        self.setup['decision_list'] = \
+                            self.proxy.GetDecisionList(self.setup['decision'])
+                    except Bcfg2.Proxy.ProxyError:
+                        err = sys.exc_info()[1]
+                        self.fatal_error("Failed to get decision list: %s" %
+                                         err)
+                self.logger.info("Got decision list from server:")
+                self.logger.info(self.setup['decision_list'])
 
             try:
                 rawconfig = self.proxy.GetConfig().encode('UTF-8')
@@ -337,13 +337,13 @@ def get_bool(val):
 def get_size(value):
     """ Given a number of bytes in a human-readable format (e.g.,
     '512m', '2g'), get the absolute number of bytes as an integer """
-    if value == -1:
-        return value
+    if value == -1 or value == "-1":
+        return -1
     mat = re.match("(\d+)([KkMmGg])?", value)
     if not mat:
         raise ValueError("Not a valid size", value)
     rvalue = int(mat.group(1))
-    mult = mat.group(2).lower()
+    mult = (mat.group(2) or '').lower()
     if mult == 'k':
         return rvalue * 1024
     elif mult == 'm':
@@ -562,6 +562,38 @@ SERVER_BACKEND = \
     Option('Server Backend',
            default='best',
            cf=('server', 'backend'))
+SERVER_CHILDREN = \
+    Option('Spawn this number of children for the multiprocessing core '
+           '(0 spawns one child per CPU)',
+           default=0,
+           cmd='--children',
+           odesc='<children>',
+           cf=('server', 'children'),
+           cook=int,
+           long_arg=True)
+SERVER_BIND_THREADS = \
+    Option('Number of threads to use to bind the entries of a client '
+           'configuration in parallel',
+           default=1,
+           cf=('server', 'bind_threads'),
+           cook=int)
+SERVER_WORKERS = \
+    Option('Number of worker threads that handle client connections (0 '
+           'starts a thread per connection)',
+           default=0,
+           cf=('server', 'workers'),
+           cook=int)
+SERVER_QUEUE_SIZE = \
+    Option('Number of connections that can wait for a worker thread',
+           default=0,
+           cf=('server', 'queue_size'),
+           cook=int)
+SERVER_KEEPALIVE_TIMEOUT = \
+    Option('Seconds to keep idle client connections open (0 disables '
+           'persistent connections)',
+           default=10.0,
+           cf=('server', 'keepalive_timeout'),
+           cook=float)
 SERVER_DAEMON_USER = \
     Option('User to run the server daemon as',
            default=0,
@@ -639,6 +671,16 @@ DJANGO_WEB_PREFIX = \
            default=None,
            cf=('reporting', 'web_prefix'),
            deprecated_cf=('statistics', 'web_prefix'),)
+DJANGO_CACHE_MAX_ENTRIES = \
+    Option('Maximum number of entries in the reporting cache',
+           default=300,
+           cf=('caching', 'reporting_max_entries'),
+           cook=int)
+DJANGO_CACHE_TTL = \
+    Option('Number of seconds after which reporting cache entries expire',
+           default=300,
+           cf=('caching', 'reporting_ttl'),
+           cook=int)
 
 # Reporting options
 REPORTING_FILE_LIMIT = \
@@ -780,6 +822,17 @@ CLIENT_SERVICE_MODE = \
            default='default',
            cmd='-s',
            odesc='<default|disabled|build>')
+COMPRESSION_THRESHOLD = \
+    Option('Compress XML-RPC messages larger than this size (-1 disables '
+           'compression)',
+           default=get_size('64k'),
+           cf=('communication', 'compression_threshold'),
+           cook=get_size)
+COMPRESSION_LEVEL = \
+    Option('zlib compression level for XML-RPC messages',
+           default=6,
+           cf=('communication', 'compression_level'),
+           cook=int)
 CLIENT_TIMEOUT = \
     Option('Set the client XML-RPC timeout',
            default=90,
@@ -1117,6 +1170,13 @@ SERVER_COMMON_OPTIONS = dict(repo=SERVER_REPOSITORY,
                              protocol=SERVER_PROTOCOL,
                              web_configfile=WEB_CFILE,
                              backend=SERVER_BACKEND,
+                             children=SERVER_CHILDREN,
+                             bind_threads=SERVER_BIND_THREADS,
+                             keepalive_timeout=SERVER_KEEPALIVE_TIMEOUT,
+                             workers=SERVER_WORKERS,
+                             queue_size=SERVER_QUEUE_SIZE,
+                             compression_threshold=COMPRESSION_THRESHOLD,
+                             compression_level=COMPRESSION_LEVEL,
                              vcs_root=SERVER_VCS_ROOT)
 
 CRYPT_OPTIONS = dict(encrypt=ENCRYPT,
@@ -1194,6 +1254,8 @@ CLIENT_COMMON_OPTIONS = \
          ca=CLIENT_CA,
          serverCN=CLIENT_SCNS,
          timeout=CLIENT_TIMEOUT,
+         compression_threshold=COMPRESSION_THRESHOLD,
+         compression_level=COMPRESSION_LEVEL,
          decision_list=CLIENT_DECISION_LIST,
          probe_exit=CLIENT_EXIT_ON_PROBE_FAILURE)
 CLIENT_COMMON_OPTIONS.update(DRIVER_OPTIONS)
@@ -1209,7 +1271,9 @@ DATABASE_COMMON_OPTIONS = dict(web_configfile=WEB_CFILE,
                                db_port=DB_PORT,
                                time_zone=DJANGO_TIME_ZONE,
                                django_debug=DJANGO_DEBUG,
-                               web_prefix=DJANGO_WEB_PREFIX)
+                               web_prefix=DJANGO_WEB_PREFIX,
+                               cache_max_entries=DJANGO_CACHE_MAX_ENTRIES,
+                               cache_ttl=DJANGO_CACHE_TTL)
 
 REPORTING_COMMON_OPTIONS = dict(reporting_file_limit=REPORTING_FILE_LIMIT,
                                 reporting_transport=REPORTING_TRANSPORT)
@@ -18,6 +18,9 @@ except ImportError:
 
 import sys
 import time
+import zlib
+import errno
+import random
 
 # Compatibility imports
 from Bcfg2.Compat import httplib, xmlrpclib, urlparse, quote_plus
@@ -30,6 +33,133 @@ __all__ = ["ComponentProxy",
            "SSLHTTPConnection",
            "XMLRPCTransport"]
 
+#: The XML-RPC fault code the server returns when it is too busy to
+#: handle a call.  Clients should back off and try again later.
+SERVER_BUSY = 503
+
+#: The HTTP Content-Encodings that can be used to compress XML-RPC
+#: requests and responses, in order of preference
+ENCODINGS = ['gzip', 'deflate']
+
+
+def compress(data, encoding, level=6):
+    """ Compress data with the given HTTP Content-Encoding.
+
+    :param data: The data to compress
+    :type data: bytes
+    :param encoding: The encoding to use; one of :attr:`ENCODINGS`
+    :type encoding: string
+    :param level: The zlib compression level, 1-9
+    :type level: int
+    :returns: bytes
+    """
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(level, zlib.DEFLATED,
+                                      16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+    elif encoding == 'deflate':
+        return zlib.compress(data, level)
+    raise ValueError("Unsupported Content-Encoding %s" % encoding)
+
+
+class DecompressedSizeError(ValueError):
+    """ Raised by :func:`decompress` when the decompressed data would
+    be larger than the given limit """
+    pass
+
+
+def _decompress(data, wbits, max_length):
+    """ Decompress zlib data, but stop and raise
+    :exc:`DecompressedSizeError` if the result would be larger than
+    ``max_length`` bytes. """
+    if not max_length:
+        return zlib.decompress(data, wbits)
+    decompressor = zlib.decompressobj(wbits)
+    rv = decompressor.decompress(data, max_length + 1)
+    if len(rv) <= max_length:
+        rv += decompressor.flush()
+    if len(rv) > max_length:
+        raise DecompressedSizeError("Decompressed data is larger than %s "
+                                    "bytes" % max_length)
+    return rv
+
+
+def decompress(data, encoding, max_length=0):
+    """ Decompress data that was compressed with the given HTTP
+    Content-Encoding.
+
+    :param data: The data to decompress
+    :type data: bytes
+    :param encoding: The encoding of the data; one of
+                     :attr:`ENCODINGS` or ``identity``
+    :type encoding: string
+    :param max_length: The largest size, in bytes, of the
+                       decompressed data, or 0 for no limit
+    :type max_length: int
+    :returns: bytes
+    :raises: :exc:`DecompressedSizeError` if the decompressed data
+             would be larger than ``max_length``
+    """
+    if not encoding or encoding == 'identity':
+        return data
+    elif encoding == 'gzip':
+        return _decompress(data, 16 + zlib.MAX_WBITS, max_length)
+    elif encoding == 'deflate':
+        try:
+            return _decompress(data, zlib.MAX_WBITS, max_length)
+        except zlib.error:
+            # some implementations send raw deflate data without the
+            # zlib header
+            return _decompress(data, -zlib.MAX_WBITS, max_length)
+    raise ValueError("Unsupported Content-Encoding %s" % encoding)
+
+
+def get_encoding(accept_encoding):
+    """ Pick the preferred supported encoding from the value of an
+    HTTP ``Accept-Encoding`` header.
+
+    :param accept_encoding: The value of the header
+    :type accept_encoding: string
+    :returns: string - one of :attr:`ENCODINGS`, or None if none of
+              them are acceptable
+    """
+    if not accept_encoding:
+        return None
+    accepted = []
+    for item in accept_encoding.split(","):
+        params = item.strip().split(";")
+        coding = params[0].strip().lower()
+        quality = 1.0
+        for param in params[1:]:
+            param = param.strip()
+            if param.startswith("q="):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    pass
+        if quality > 0:
+            accepted.append(coding)
+    for encoding in ENCODINGS:
+        if encoding in accepted:
+            return encoding
+    return None
+
+
+def method_not_found(fault):
+    """ Determine whether or not an XML-RPC fault indicates that the
+    server does not support the method that was called.  Current
+    servers return a ``METHOD_NOT_FOUND`` fault, but older builtin
+    servers return an ``Unknown method`` fault with a different code,
+    and CherryPy servers return a ``... is not supported`` fault.
+
+    :param fault: The fault returned by the server
+    :type fault: xmlrpclib.Fault
+    :returns: bool
+    """
+    return (fault.faultCode == xmlrpclib.METHOD_NOT_FOUND or
+            str(fault.faultString).startswith("Unknown method") or
+            "is not supported" in str(fault.faultString))
+
 
 class ProxyError(Exception):
     """ ProxyError provides a consistent reporting interface to
@@ -73,6 +203,7 @@ class RetryMethod(xmlrpclib._Method):
             else:
                 final = False
             msg = None
+            delay = self.retry_delay
             try:
                 return _orig_Method.__call__(self, *args)
             except xmlrpclib.ProtocolError:
@@ -81,6 +212,16 @@ class RetryMethod(xmlrpclib._Method):
                     (err.errcode, err.errmsg)
             except xmlrpclib.Fault:
                 msg = sys.exc_info()[1]
+                if method_not_found(msg):
+                    # retrying won't make the method appear, and
+                    # callers need the fault to fall back to methods
+                    # that older servers support
+                    raise
+                elif msg.faultCode == SERVER_BUSY:
+                    # back off exponentially, with some jitter so that
+                    # rejected clients don't all come back at once
+                    delay = self.retry_delay * 2 ** retry + \
+                        random.uniform(0, self.retry_delay)
             except socket.error:
                 err = sys.exc_info()[1]
                 if hasattr(err, 'errno') and err.errno == 336265218:
@@ -109,7 +250,7 @@ class RetryMethod(xmlrpclib._Method):
                     raise ProxyError(msg)
                 else:
                     self.log.info(msg)
-                    time.sleep(self.retry_delay)
+                    time.sleep(delay)
 
 xmlrpclib._Method = RetryMethod
 
@@ -121,6 +262,12 @@ class SSLHTTPConnection(httplib.HTTPConnection):
 
     logger = logging.getLogger('Bcfg2.Proxy.SSLHTTPConnection')
 
+    #: TLS sessions negotiated with each (host, port), which are
+    #: resumed by later connections to the same server to avoid a
+    #: full handshake.  The ssl module does not expose TLS sessions,
+    #: so this is only used with M2Crypto.
+    ssl_sessions = dict()
+
     def __init__(self, host, port=None, strict=None, timeout=90, key=None,
                  cert=None, ca=None, scns=None, protocol='xmlrpc/ssl'):
         """Initializes the `httplib.HTTPConnection` object and stores security
@@ -270,17 +417,22 @@ class SSLHTTPConnection(httplib.HTTPConnection):
                 hostname = self.host
         else:
             hostname = self.host
+        session = self.ssl_sessions.get((hostname, self.port))
+        if session is not None:
+            self.sock.set_session(session)
         try:
             self.sock.connect((hostname, self.port))
             # automatically checks cert matches host
         except M2Crypto.SSL.Checker.WrongHost:
             wr = sys.exc_info()[1]
             raise CertificateError(wr)
+        self.ssl_sessions[(hostname, self.port)] = self.sock.get_session()
 
 
 class XMLRPCTransport(xmlrpclib.Transport):
     def __init__(self, key=None, cert=None, ca=None,
-                 scns=None, use_datetime=0, timeout=90):
+                 scns=None, use_datetime=0, timeout=90,
+                 compress_threshold=-1, compress_level=6):
         if hasattr(xmlrpclib.Transport, '__init__'):
             xmlrpclib.Transport.__init__(self, use_datetime)
         self.key = key
@@ -289,52 +441,163 @@ class XMLRPCTransport(xmlrpclib.Transport):
         self.scns = scns
         self.timeout = timeout
 
+        #: Requests larger than this many bytes are compressed, if
+        #: the server has said that it accepts compressed requests.
+        #: If this is negative, compression is disabled altogether,
+        #: both for requests and responses.
+        self.compress_threshold = compress_threshold
+
+        #: The zlib compression level used to compress requests
+        self.compress_level = compress_level
+
+        #: The encoding used to compress requests.  This is None
+        #: until a response from the server has advertised support
+        #: for compressed requests; older servers never do, so they
+        #: are never sent a compressed request.
+        self.request_encoding = None
+
+        #: A tuple of (host, connection) for the persistent connection
+        #: to the server, which is reused for all requests until the
+        #: server closes it.
+        self._connection = (None, None)
+
     def make_connection(self, host):
-        host, self._extra_headers = self.get_host_info(host)[0:2]
-        return SSLHTTPConnection(host,
+        if self._connection[1] is not None and self._connection[0] == host:
+            return self._connection[1]
+        self.close()
+        chost, self._extra_headers = self.get_host_info(host)[0:2]
+        conn = SSLHTTPConnection(chost,
                                  key=self.key,
                                  cert=self.cert,
                                  ca=self.ca,
                                  scns=self.scns,
                                  timeout=self.timeout)
+        self._connection = (host, conn)
+        return conn
+
+    def close(self):
+        """ Close the persistent connection to the server, if one is
+        open. """
+        conn = self._connection[1]
+        self._connection = (None, None)
+        if conn is not None:
+            conn.close()
 
     def request(self, host, handler, request_body, verbose=0):
-        """Send request to server and return response."""
+        """Send request to server and return response.
+
+        The server may close a persistent connection while it is
+        idle.  If sending a request on a reused connection fails
+        with a broken pipe or a reset connection, or if the server
+        closes the connection without sending a status line, the
+        request is sent once more on a new connection.  Other errors,
+        including timeouts, are never retried, since the server may
+        already be processing the request."""
+        reused = self._connection[1] is not None and \
+            self._connection[0] == host
         try:
             conn = self.send_request(host, handler, request_body, False)
+        except (socket.error, SSL_ERROR, httplib.HTTPException):
+            err = sys.exc_info()[1]
+            self.close()
+            if reused and getattr(err, 'errno', None) in [errno.EPIPE,
+                                                          errno.ECONNRESET]:
+                return self.request(host, handler, request_body, verbose)
+            raise ProxyError(xmlrpclib.ProtocolError(host + handler,
+                                                     408,
+                                                     str(err),
+                                                     self._extra_headers))
+        try:
             response = conn.getresponse()
             errcode = response.status
             errmsg = response.reason
             headers = response.msg
-        except (socket.error, SSL_ERROR):
+        except (socket.error, SSL_ERROR, httplib.HTTPException):
             err = sys.exc_info()[1]
+            self.close()
+            if reused and isinstance(err, httplib.BadStatusLine):
+                return self.request(host, handler, request_body, verbose)
             raise ProxyError(xmlrpclib.ProtocolError(host + handler,
                                                      408,
                                                      str(err),
                                                      self._extra_headers))
 
         if errcode != 200:
+            self.close()
             raise ProxyError(xmlrpclib.ProtocolError(host + handler,
                                                      errcode,
                                                      errmsg,
                                                      headers))
 
         self.verbose = verbose
-        return self.parse_response(response)
-
-    if sys.hexversion < 0x03000000:
-        def send_request(self, host, handler, request_body, debug):
-            """ send_request() changed significantly in py3k."""
-            conn = self.make_connection(host)
-            xmlrpclib.Transport.send_request(self, conn, handler, request_body)
+        if self.compress_threshold >= 0:
+            self.request_encoding = \
+                get_encoding(response.getheader("Accept-Encoding"))
+        try:
+            body = decompress(response.read(),
+                              response.getheader("Content-Encoding"))
+        except (socket.error, SSL_ERROR, httplib.HTTPException):
+            err = sys.exc_info()[1]
+            self.close()
+            raise ProxyError(xmlrpclib.ProtocolError(host + handler,
+                                                     408,
+                                                     str(err),
+                                                     self._extra_headers))
+        except (ValueError, zlib.error):
+            err = sys.exc_info()[1]
+            self.close()
+            raise ProxyError(xmlrpclib.ProtocolError(host + handler,
+                                                     errcode,
+                                                     "Bad response body: %s" %
+                                                     err,
+                                                     headers))
+        if response.will_close:
+            self.close()
+        parser, unmarshaller = self.getparser()
+        parser.feed(body)
+        parser.close()
+        return unmarshaller.close()
+
+    def send_request(self, host, handler, request_body, debug):
+        """ send_request() changed significantly in py3k, and we need
+        control over the Accept-Encoding header, so we override it
+        entirely """
+        conn = self.make_connection(host)
+        conn.putrequest("POST", handler, skip_accept_encoding=True)
+        if sys.hexversion >= 0x03000000:
+            self.send_headers(conn,
+                              self._extra_headers +
+                              [("User-Agent", self.user_agent)])
+        else:
             self.send_host(conn, host)
             self.send_user_agent(conn)
-            self.send_content(conn, request_body)
-            return conn
+        self.send_content(conn, request_body)
+        return conn
+
+    def send_content(self, connection, request_body):
+        """ Send the request body, compressed if the server accepts
+        compressed requests and the body is large enough """
+        if sys.hexversion >= 0x03000000 and not isinstance(request_body,
+                                                           bytes):
+            request_body = request_body.encode('utf-8')
+        if self.compress_threshold >= 0:
+            connection.putheader("Accept-Encoding", ", ".join(ENCODINGS))
+            if (self.request_encoding and
+                len(request_body) > self.compress_threshold):
+                request_body = compress(request_body, self.request_encoding,
+                                        self.compress_level)
+                connection.putheader("Content-Encoding",
+                                     self.request_encoding)
+        connection.putheader("Content-Type", "text/xml")
+        connection.putheader("Content-Length", str(len(request_body)))
+        connection.endheaders()
+        if request_body:
+            connection.send(request_body)
 
 
 def ComponentProxy(url, user=None, password=None, key=None, cert=None, ca=None,
-                   allowedServerCNs=None, timeout=90, retries=3, delay=1):
+                   allowedServerCNs=None, timeout=90, retries=3, delay=1,
+                   compress_threshold=-1, compress_level=6):
 
     """Constructs proxies to components.
 
@@ -354,5 +617,7 @@ def ComponentProxy(url, user=None, password=None, key=None, cert=None, ca=None,
     else:
         newurl = url
     ssl_trans = XMLRPCTransport(key, cert, ca,
-                                allowedServerCNs, timeout=float(timeout))
+                                allowedServerCNs, timeout=float(timeout),
+                                compress_threshold=compress_threshold,
+                                compress_level=compress_level)
     return xmlrpclib.ServerProxy(newurl, allow_none=True, transport=ssl_trans)
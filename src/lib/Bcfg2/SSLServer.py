@@ -11,8 +11,11 @@ import logging
 import ssl
 import threading
 import time
+import Bcfg2.Statistics
 from Bcfg2.Compat import xmlrpclib, SimpleXMLRPCServer, SocketServer, \
-    b64decode
+    b64decode, Queue, Full
+from Bcfg2.Proxy import ENCODINGS, SERVER_BUSY, DecompressedSizeError, \
+    compress, decompress, get_encoding
 
 
 class XMLRPCDispatcher(SimpleXMLRPCServer.SimpleXMLRPCDispatcher):
@@ -35,9 +38,12 @@ class XMLRPCDispatcher(SimpleXMLRPCServer.SimpleXMLRPCDispatcher):
     def _marshaled_dispatch(self, address, data):
         params, method = xmlrpclib.loads(data)
         try:
-            if '.' not in method:
-                params = (address, ) + params
-            response = self.instance._dispatch(method, params, self.funcs)
+            if method == 'system.multicall':
+                response = self._multicall(address, *params)
+            else:
+                if '.' not in method:
+                    params = (address, ) + params
+                response = self._dispatch_call(method, params)
             # py3k compatibility
             if type(response) not in [bool, str, list, dict]:
                 response = (response.decode('utf-8'), )
@@ -59,6 +65,53 @@ class XMLRPCDispatcher(SimpleXMLRPCServer.SimpleXMLRPCDispatcher):
                 allow_none=self.allow_none, encoding=self.encoding)
         return raw_response
 
+    def _dispatch_call(self, method, params):
+        """ Dispatch a single call to the registered instance.
+
+        :param method: The name of the method to call
+        :type method: string
+        :param params: The parameters to call the method with
+        :type params: tuple
+        :returns: The return value of the method
+        """
+        return self.instance._dispatch(method, params, self.funcs)
+
+    def _multicall(self, address, calls):
+        """ Handle a ``system.multicall`` request, which lets a client
+        make several calls in a single round trip.  The calls are
+        dispatched in order, as if they had been made separately.
+
+        :param address: The address of the client
+        :type address: tuple
+        :param calls: A list of dicts, each with a ``methodName`` and
+                      a list of ``params``
+        :type calls: list
+        :returns: list - For each call, either a single-item list
+                  containing the return value, or a fault dict
+        """
+        results = []
+        for call in calls:
+            try:
+                method = call['methodName']
+                params = tuple(call['params'])
+                if method == 'system.multicall':
+                    raise xmlrpclib.Fault(xmlrpclib.INVALID_METHOD_PARAMS,
+                                          "Recursive system.multicall "
+                                          "forbidden")
+                if '.' not in method:
+                    params = (address, ) + params
+                results.append([self._dispatch_call(method, params)])
+            except xmlrpclib.Fault:
+                fault = sys.exc_info()[1]
+                results.append({'faultCode': fault.faultCode,
+                                'faultString': fault.faultString})
+            except:  # pylint: disable=W0702
+                etype, err = sys.exc_info()[:2]
+                self.logger.error("Unexpected handler error", exc_info=1)
+                results.append({'faultCode': 1,
+                                'faultString': "%s:%s" % (etype, err)})
+        return results
+
 
 class SSLServer(SocketServer.TCPServer, object):
     """ TCP server supporting SSL encryption. """
@@ -147,16 +200,34 @@ class SSLServer(SocketServer.TCPServer, object):
             self.logger.error("Unknown protocol %s" % (protocol))
             raise Exception("unknown protocol %s" % protocol)
 
+        #: A single SSL context shared by all connections, if the ssl
+        #: module supports it (Python 2.7.9+ and 3.2+).  Sharing the
+        #: context means that the key and certificates are only loaded
+        #: once, and that clients can resume TLS sessions from the
+        #: context's session cache instead of doing a full handshake
+        #: for every connection.
+        self.ssl_context = None
+        if hasattr(ssl, "SSLContext"):
+            self.ssl_context = ssl.SSLContext(self.ssl_protocol)
+            if certfile:
+                self.ssl_context.load_cert_chain(certfile, keyfile)
+            if ca:
+                self.ssl_context.load_verify_locations(ca)
+            self.ssl_context.verify_mode = self.mode
+
     def get_request(self):
         (sock, sockinfo) = self.socket.accept()
         sock.settimeout(self.timeout)  # pylint: disable=E1101
-        sslsock = ssl.wrap_socket(sock,
-                                  server_side=True,
-                                  certfile=self.certfile,
-                                  keyfile=self.keyfile,
-                                  cert_reqs=self.mode,
-                                  ca_certs=self.ca,
-                                  ssl_version=self.ssl_protocol)
+        if self.ssl_context is not None:
+            sslsock = self.ssl_context.wrap_socket(sock, server_side=True)
+        else:
+            sslsock = ssl.wrap_socket(sock,
+                                      server_side=True,
+                                      certfile=self.certfile,
+                                      keyfile=self.keyfile,
+                                      cert_reqs=self.mode,
+                                      ca_certs=self.ca,
+                                      ssl_version=self.ssl_protocol)
         return sslsock, sockinfo
 
     def close_request(self, request):
@@ -185,6 +256,26 @@ class XMLRPCRequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
 
     logger = logging.getLogger("Bcfg2.SSLServer.XMLRPCRequestHandler")
 
+    #: Responses larger than this many bytes are compressed if the
+    #: client accepts compressed responses.  If this is negative,
+    #: compression is disabled altogether, both for requests and
+    #: responses.
+    compress_threshold = -1
+
+    #: The zlib compression level used to compress responses
+    compress_level = 6
+
+    #: The largest size, in bytes, that a compressed request may
+    #: have once it is decompressed.  Larger requests are rejected
+    #: with HTTP 413, so that a small compressed request cannot make
+    #: the server allocate arbitrary amounts of memory.
+    max_decompressed_size = 100 * 1024 * 1024
+
+    #: How long, in seconds, to wait for another request on an idle
+    #: HTTP/1.1 persistent connection.  Persistent connections are
+    #: only used if :attr:`protocol_version` is ``HTTP/1.1``.
+    keepalive_timeout = 0
+
     def authenticate(self):
         try:
             header = self.headers['Authorization']
@@ -225,8 +316,67 @@ class XMLRPCRequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
             return False
         return True
 
+    def handle(self):
+        """ Handle requests on the connection.  If the client supports
+        persistent connections, keep handling requests until it closes
+        the connection or is idle for :attr:`keepalive_timeout`
+        seconds. """
+        self.close_connection = 1
+        self.handle_one_request()
+        while not self.close_connection and self._wait_for_request():
+            try:
+                self.handle_one_request()
+            except (socket.error, ssl.SSLError):
+                # the client dropped the idle connection
+                break
+
+    def _wait_for_request(self):
+        """ Wait up to :attr:`keepalive_timeout` seconds for the
+        client to send another request on a persistent connection.
+
+        :returns: bool - True if there is data to read
+        """
+        if self.connection.pending():
+            return True
+        end = time.time() + self.keepalive_timeout
+        while not self.server.busy():
+            remaining = end - time.time()
+            if remaining <= 0:
+                return False
+            try:
+                if select.select([self.connection], [], [],
+                                 min(remaining, 0.5))[0]:
+                    return True
+            except select.error:
+                return False
+        # give up the worker to other connections that are waiting
+        # for one
+        return False
+
+    def do_GET(self):
+        """ Serve statistics in the Prometheus text format at
+        ``/metrics``.  All other paths are not found. """
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404, self.responses[404][0])
+            return
+        body = Bcfg2.Statistics.stats.prometheus()
+        if sys.hexversion >= 0x03000000:
+            body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-type", "text/plain; version=0.0.4")
+        self.send_header("Content-length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
     ### need to override do_POST here
     def do_POST(self):
+        encoding = self.headers.get("Content-Encoding", "identity").lower()
+        if encoding != "identity" and (self.compress_threshold < 0 or
+                                       encoding not in ENCODINGS):
+            self.logger.error("Unsupported Content-Encoding %s from %s" %
+                              (encoding, self.client_address[0]))
+            self.send_error(415, self.responses[415][0])
+            return
         try:
             max_chunk_size = 10 * 1024 * 1024
             size_remaining = int(self.headers["content-length"])
@@ -238,16 +388,43 @@ class XMLRPCRequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
                     print("got select timeout")
                     raise
                 chunk_size = min(size_remaining, max_chunk_size)
-                L.append(self.rfile.read(chunk_size).decode('utf-8'))
+                L.append(self.rfile.read(chunk_size))
+                if not L[-1]:
+                    raise socket.error("Connection closed reading request")
                 size_remaining -= len(L[-1])
-            data = ''.join(L)
+            if L:
+                data = L[0][:0].join(L)
+            else:
+                data = ''
+            try:
+                data = decompress(data, encoding,
+                                  self.max_decompressed_size)
+            except DecompressedSizeError:
+                self.logger.error("Request from %s is larger than %s bytes "
+                                  "when decompressed" %
+                                  (self.client_address[0],
+                                   self.max_decompressed_size))
+                self.send_error(413, self.responses[413][0])
+                return
+            data = data.decode('utf-8')
             response = self.server._marshaled_dispatch(self.client_address,
                                                        data)
             if sys.hexversion >= 0x03000000:
                 response = response.encode('utf-8')
+            response_encoding = None
+            if self.compress_threshold >= 0:
+                response_encoding = \
+                    get_encoding(self.headers.get("Accept-Encoding"))
+                if (response_encoding and
+                    len(response) > self.compress_threshold):
+                    response = compress(response, response_encoding,
+                                        self.compress_level)
+                else:
+                    response_encoding = None
         except:  # pylint: disable=W0702
             try:
                 self.send_response(500)
+                self.send_header("Content-length", "0")
                 self.end_headers()
             except:
                 (etype, msg) = sys.exc_info()[:2]
@@ -260,6 +437,11 @@ class XMLRPCRequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
                 self.send_response(200)
                 self.send_header("Content-type", "text/xml")
                 self.send_header("Content-length", str(len(response)))
+                if self.compress_threshold >= 0:
+                    # advertise that we accept compressed requests
+                    self.send_header("Accept-Encoding", ", ".join(ENCODINGS))
+                if response_encoding:
+                    self.send_header("Content-Encoding", response_encoding)
                 self.end_headers()
                 failcount = 0
                 while True:
@@ -278,6 +460,7 @@ class XMLRPCRequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
                         raise
             except socket.error:
                 err = sys.exc_info()[1]
+                self.close_connection = 1
                 if err[0] == 32:
                     self.logger.warning("Connection dropped from %s" %
                                         self.client_address[0])
@@ -289,10 +472,12 @@ class XMLRPCRequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
                                         "%s" % (self.client_address[0], err))
             except ssl.SSLError:
                 err = sys.exc_info()[1]
+                self.close_connection = 1
                 self.logger.warning("SSLError handling client %s: %s" %
                                     (self.client_address[0], err))
             except:
                 etype, err = sys.exc_info()[:2]
+                self.close_connection = 1
                 self.logger.error("Unknown error sending response to %s: "
                                   "%s (%s)" %
                                   (self.client_address[0], err,
@@ -312,12 +497,44 @@ class XMLRPCRequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
 
 class XMLRPCServer(SocketServer.ThreadingMixIn, SSLServer,
                    XMLRPCDispatcher, object):
-    """ Component XMLRPCServer. """
+    """ Component XMLRPCServer.
+
+    By default, each connection is handled in a new thread.  If
+    ``workers`` is set, connections are instead queued and handled by
+    a fixed pool of worker threads.  In that case:
+
+    * If the queue is full, new connections are answered with a
+      :attr:`Bcfg2.Proxy.SERVER_BUSY` fault, which tells clients to
+      back off and try again later.
+    * While connections are waiting for a worker, calls to
+      :attr:`expensive_methods` may only occupy some of the workers
+      at once, so that cheap calls are handled promptly.  Further
+      expensive calls wait for one of those workers, up to
+      :attr:`expensive_wait` seconds; only if too many are already
+      waiting, or the wait times out, do they get a
+      :attr:`Bcfg2.Proxy.SERVER_BUSY` fault.
+    """
+
+    #: Methods that are expensive to run.  When a worker pool is in
+    #: use and connections are waiting for a worker, a quarter of the
+    #: workers, and at least one, are reserved for other methods if
+    #: there are at least two workers.
+    expensive_methods = ['GetConfig', 'RecvStats']
+
+    #: How long, in seconds, an expensive call waits for a worker
+    #: before it gets a :attr:`Bcfg2.Proxy.SERVER_BUSY` fault
+    expensive_wait = 60
+
+    #: How long, in seconds, the main thread spends trying to send
+    #: the busy response on a rejected connection
+    reject_timeout = 1
 
     def __init__(self, listen_all, server_address, RequestHandlerClass=None,
                  keyfile=None, certfile=None, ca=None, protocol='xmlrpc/ssl',
                  timeout=10, logRequests=False,
-                 register=True, allow_none=True, encoding=None):
+                 register=True, allow_none=True, encoding=None,
+                 compress_threshold=-1, compress_level=6,
+                 keepalive_timeout=0, workers=0, queue_size=0):
         """
         :param listen_all: Listen on all interfaces
         :type listen_all: bool
@@ -336,6 +553,26 @@ class XMLRPCServer(SocketServer.ThreadingMixIn, SSLServer,
         :param allow_none: Allow None values in XML-RPC
         :type allow_non: bool
         :param encoding: Encoding to use for XML-RPC
+        :param compress_threshold: Compress responses larger than
+                                   this many bytes, if the client
+                                   accepts it.  If this is negative,
+                                   compression is disabled.
+        :type compress_threshold: int
+        :param compress_level: zlib compression level for responses
+        :type compress_level: int
+        :param keepalive_timeout: Keep idle HTTP/1.1 connections open
+                                  for this many seconds waiting for
+                                  another request.  If this is 0,
+                                  persistent connections are disabled.
+        :type keepalive_timeout: float
+        :param workers: The number of worker threads that handle
+                        connections.  If this is 0, a new thread is
+                        started for each connection.
+        :type workers: int
+        :param queue_size: The number of connections that can wait
+                           for a worker.  If this is 0, four times the
+                           number of workers is used.
+        :type queue_size: int
         """
 
         XMLRPCDispatcher.__init__(self, allow_none, encoding)
@@ -346,6 +583,11 @@ class XMLRPCServer(SocketServer.ThreadingMixIn, SSLServer,
                 """A subclassed request handler to prevent
                 class-attribute conflicts."""
             # pylint: enable=E0102
+        RequestHandlerClass.compress_threshold = compress_threshold
+        RequestHandlerClass.compress_level = compress_level
+        RequestHandlerClass.keepalive_timeout = keepalive_timeout
+        if keepalive_timeout > 0:
+            RequestHandlerClass.protocol_version = "HTTP/1.1"
 
         SSLServer.__init__(self,
                            listen_all,
@@ -364,6 +606,52 @@ class XMLRPCServer(SocketServer.ThreadingMixIn, SSLServer,
         self.logger.info("service available at %s" % self.url)
         self.timeout = timeout
 
+        #: The number of worker threads that handle connections, or
+        #: 0 to start a new thread for each connection
+        self.workers = workers
+
+        #: The queue of connections waiting for a worker
+        self.request_queue = None
+        if self.workers:
+            if queue_size <= 0:
+                queue_size = 4 * self.workers
+            self.request_queue = Queue(queue_size)
+
+        #: The number of expensive calls that may run at once while
+        #: connections are waiting for a worker.  This is always at
+        #: least one, so that expensive calls can run at all.
+        self.max_expensive = max(1, self.workers - max(1, self.workers // 4))
+
+        #: The number of expensive calls that may wait for one of the
+        #: :attr:`max_expensive` workers.  Waiting calls hold a worker,
+        #: so at least one reserved worker is left for cheap calls if
+        #: there are enough workers.
+        self.max_expensive_waiting = max(1, self.workers -
+                                         self.max_expensive - 1)
+
+        #: The worker threads
+        self.worker_threads = []
+        self._expensive = 0
+        self._expensive_waiting = 0
+        self._expensive_cond = threading.Condition(threading.Lock())
+
+        #: The complete HTTP response sent on connections that are
+        #: rejected because the queue is full
+        body = xmlrpclib.dumps(
+            xmlrpclib.Fault(SERVER_BUSY,
+                            "Server is too busy, try again later"),
+            methodresponse=1, allow_none=self.allow_none,
+            encoding=self.encoding)
+        if sys.hexversion >= 0x03000000:
+            body = body.encode('utf-8')
+        headers = ("HTTP/1.0 200 OK\r\n"
+                   "Content-type: text/xml\r\n"
+                   "Content-length: %d\r\n"
+                   "Connection: close\r\n\r\n" % len(body))
+        if sys.hexversion >= 0x03000000:
+            headers = headers.encode('utf-8')
+        self._busy_response = headers + body
+
     def _tasks_thread(self):
         try:
             while self.serve:
@@ -411,11 +699,143 @@ class XMLRPCServer(SocketServer.ThreadingMixIn, SSLServer,
                     self.register_function(fn, name=xmname)
         self.logger.info("serving %s at %s" % (name, self.url))
 
+    def process_request(self, request, client_address):
+        """ Hand a new connection to a worker thread, or to a new
+        thread if no worker pool is in use. """
+        if not self.workers:
+            SocketServer.ThreadingMixIn.process_request(self, request,
+                                                        client_address)
+            return
+        try:
+            self.request_queue.put_nowait((time.time(), request,
+                                           client_address))
+        except Full:
+            self._reject_request(request, client_address)
+        else:
+            Bcfg2.Statistics.stats.add_value("XMLRPCServer:queue_depth",
+                                             self.request_queue.qsize())
+
+    def _reject_request(self, request, client_address):
+        """ Handle a connection that cannot be queued by sending a
+        canned :attr:`Bcfg2.Proxy.SERVER_BUSY` fault and closing it.
+        This runs in the main thread, so the request itself is never
+        read; a client that is still sending a large request may see
+        the connection reset instead of the fault, which it also
+        retries. """
+        self.logger.warning("Request queue is full, rejecting connection "
+                            "from %s" % client_address[0])
+        Bcfg2.Statistics.stats.add_value("XMLRPCServer:busy", 1)
+        try:
+            request.settimeout(self.reject_timeout)
+            request.sendall(self._busy_response)
+        except (socket.error, ssl.SSLError):
+            err = sys.exc_info()[1]
+            self.logger.debug("Error sending busy response to %s: %s" %
+                              (client_address[0], err))
+        try:
+            # skip the TLS shutdown in close_request(), which could
+            # wait on the client
+            request.close()
+        except:  # pylint: disable=W0702
+            pass
+
+    def _worker(self):
+        """ The main loop of a worker thread """
+        while True:
+            item = self.request_queue.get()
+            if item is None:
+                break
+            queued, request, client_address = item
+            Bcfg2.Statistics.stats.add_value("XMLRPCServer:queue_wait",
+                                             time.time() - queued)
+            self.process_request_thread(request, client_address)
+
+    def busy(self):
+        """ Determine whether or not there are connections waiting
+        for a worker thread.
+
+        :returns: bool
+        """
+        return (self.request_queue is not None and
+                not self.request_queue.empty())
+
+    def _busy_fault(self, method):
+        """ Get a fault telling the client to back off and try again
+        later. """
+        Bcfg2.Statistics.stats.add_value("XMLRPCServer:busy", 1)
+        return xmlrpclib.Fault(SERVER_BUSY,
+                               "Server is too busy to handle %s, try again "
+                               "later" % method)
+
+    def _acquire_expensive(self, method):
+        """ Wait until an expensive call may run.  Expensive calls run
+        right away if fewer than :attr:`max_expensive` are running or
+        no connections are waiting for a worker; otherwise they wait
+        for one of the running calls to finish.
+
+        :param method: The name of the method being called
+        :type method: string
+        :raises: :exc:`xmlrpclib.Fault` with
+                 :attr:`Bcfg2.Proxy.SERVER_BUSY` if too many calls are
+                 already waiting, or the wait times out
+        """
+        self._expensive_cond.acquire()
+        try:
+            if self._expensive < self.max_expensive or not self.busy():
+                self._expensive += 1
+                return
+            if self._expensive_waiting >= self.max_expensive_waiting:
+                raise self._busy_fault(method)
+            self._expensive_waiting += 1
+            start = time.time()
+            try:
+                while self._expensive >= self.max_expensive and self.busy():
+                    remaining = start + self.expensive_wait - time.time()
+                    if remaining <= 0:
+                        raise self._busy_fault(method)
+                    # connections leaving the queue don't notify us,
+                    # so check again periodically
+                    self._expensive_cond.wait(min(remaining, 0.5))
+            finally:
+                self._expensive_waiting -= 1
+            Bcfg2.Statistics.stats.add_value("XMLRPCServer:expensive_wait",
+                                             time.time() - start)
+            self._expensive += 1
+        finally:
+            self._expensive_cond.release()
+
+    def _release_expensive(self):
+        """ Record that an expensive call has finished, and wake up a
+        call that is waiting to run """
+        self._expensive_cond.acquire()
+        try:
+            self._expensive -= 1
+            self._expensive_cond.notify()
+        finally:
+            self._expensive_cond.release()
+
+    def _dispatch_call(self, method, params):
+        if not self.workers or method not in self.expensive_methods:
+            return XMLRPCDispatcher._dispatch_call(self, method, params)
+
+        self._acquire_expensive(method)
+        try:
+            return XMLRPCDispatcher._dispatch_call(self, method, params)
+        finally:
+            self._release_expensive()
+    _dispatch_call.__doc__ = XMLRPCDispatcher._dispatch_call.__doc__
+
     def serve_forever(self):
         """Serve single requests until (self.serve == False)."""
         self.serve = True
         self.task_thread = threading.Thread(target=self._tasks_thread)
         self.task_thread.start()
+        for num in range(self.workers):
+            worker = threading.Thread(target=self._worker,
+                                      name="XMLRPCServer-worker-%d" % num)
+            worker.setDaemon(True)
+            worker.start()
+            self.worker_threads.append(worker)
         self.logger.info("serve_forever() [start]")
         signal.signal(signal.SIGINT, self._handle_shutdown_signal)
         signal.signal(signal.SIGTERM, self._handle_shutdown_signal)
@@ -432,6 +852,14 @@ class XMLRPCServer(SocketServer.ThreadingMixIn, SSLServer,
                     self.logger.error("Got unexpected error in handle_request",
                                       exc_info=1)
         finally:
+            for _ in self.worker_threads:
+                try:
+                    self.request_queue.put_nowait(None)
+                except Full:
+                    # the workers are daemon threads, so they will not
+                    # keep the server from exiting
+                    break
+            self.worker_threads = []
             self.logger.info("serve_forever() [stop]")
 
     def shutdown(self):
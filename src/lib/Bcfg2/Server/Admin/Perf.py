@@ -4,13 +4,17 @@ import sys
 import Bcfg2.Options
 import Bcfg2.Proxy
 import Bcfg2.Server.Admin
+from Bcfg2.Compat import xmlrpclib
 
 
 class Perf(Bcfg2.Server.Admin.Mode):
     """ Get performance data from server """
+    __usage__ = ("[<window>]\n\n"
+                 "     %-25s%s\n" %
+                 ("<window>", "only show calls from the last <window> "
+                  "seconds (60, 300, or 900)"))
 
     def __call__(self, args):
-        output = [('Name', 'Min', 'Max', 'Mean', 'Count')]
         optinfo = {
             'ca': Bcfg2.Options.CLIENT_CA,
             'certificate': Bcfg2.Options.CLIENT_CERT,
@@ -29,10 +33,60 @@ class Perf(Bcfg2.Server.Admin.Mode):
                                            cert=setup['certificate'],
                                            ca=setup['ca'],
                                            timeout=setup['timeout'])
-        data = proxy.get_statistics()
-        for key in sorted(data.keys()):
-            output.append((key, ) +
-                          tuple(["%.06f" % item
-                                 for item in data[key][:-1]] + \
-                                    [data[key][-1]]))
+        window = None
+        if args:
+            window = args[0]
+        try:
+            data = proxy.get_statistics(True)
+        except (xmlrpclib.Fault, Bcfg2.Proxy.ProxyError):
+            # older servers don't support detailed statistics
+            if window:
+                self.errExit("Server does not support sliding windows")
+            output = [('Name', 'Min', 'Max', 'Mean', 'Count')]
+            data = proxy.get_statistics()
+            for key in sorted(data.keys()):
+                output.append((key, ) +
+                              tuple(["%.06f" % item
+                                     for item in data[key][:-1]] + \
+                                        [data[key][-1]]))
+            self.print_table(output)
+            return
+
+        if window:
+            output = [('Name', 'Mean', 'p50', 'p90', 'p99', 'Count')]
+            for key in sorted(data.keys()):
+                try:
+                    stats = data[key]['windows'][window]
+                except KeyError:
+                    self.errExit("Unknown window %s; choose one of %s" %
+                                 (window,
+                                  ", ".join(data[key]['windows'].keys())))
+                if not stats['count']:
+                    continue
+                output.append((key, ) +
+                              tuple(["%.06f" % stats[item]
+                                     for item in ['mean', 'p50', 'p90',
+                                                  'p99']]) +
+                              (stats['count'], ))
+        else:
+            output = [('Name', 'Min', 'Max', 'Mean', 'p50', 'p90', 'p99',
+                       'Count')]
+            for key in sorted(data.keys()):
+                output.append((key, ) +
+                              tuple(["%.06f" % data[key][item]
+                                     for item in ['min', 'max', 'mean',
+                                                  'p50', 'p90', 'p99']]) +
+                              (data[key]['count'], ))
         self.print_table(output)
+
+        try:
+            counters = proxy.get_counters()
+        except (xmlrpclib.Fault, Bcfg2.Proxy.ProxyError):
+            # older servers don't report counters
+            return
+        if counters:
+            print("")
+            output = [('Counter', 'Value')]
+            for key in sorted(counters.keys()):
+                output.append((key, counters[key]))
+            self.print_table(output)
@@ -105,7 +105,15 @@ class Core(BaseCore):
                                        register=False,
                                        timeout=1,
                                        ca=self.setup['ca'],
-                                       protocol=self.setup['protocol'])
+                                       protocol=self.setup['protocol'],
+                                       compress_threshold=self.setup[
+                                           'compression_threshold'],
+                                       compress_level=self.setup[
+                                           'compression_level'],
+                                       keepalive_timeout=self.setup[
+                                           'keepalive_timeout'],
+                                       workers=self.setup['workers'],
+                                       queue_size=self.setup['queue_size'])
         except:  # pylint: disable=W0702
             err = sys.exc_info()[1]
             self.logger.error("Server startup failed: %s" % err)
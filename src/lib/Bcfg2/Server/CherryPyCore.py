@@ -85,12 +85,16 @@ class Core(BaseCore):
 
             handler = getattr(self, rpcmethod, None)
             if not handler or not getattr(handler, "exposed", False):
-                raise Exception('Method "%s" is not supported' % rpcmethod)
+                raise xmlrpclib.Fault(xmlrpclib.METHOD_NOT_FOUND,
+                                      'Method "%s" is not supported' %
+                                      rpcmethod)
         else:
             try:
                 handler = self.rmi[rpcmethod]
             except KeyError:
-                raise Exception('Method "%s" is not supported' % rpcmethod)
+                raise xmlrpclib.Fault(xmlrpclib.METHOD_NOT_FOUND,
+                                      'Method "%s" is not supported' %
+                                      rpcmethod)
 
         method_start = time.time()
         try:
@@ -4,6 +4,7 @@ implementations inherit from. """
 import os
 import sys
 import time
+import random
 import atexit
 import select
 import signal
@@ -14,11 +15,14 @@ import lxml.etree
 import Bcfg2.settings
 import Bcfg2.Server
 import Bcfg2.Logger
+import Bcfg2.Options
 import Bcfg2.Server.FileMonitor
-from Bcfg2.Cache import Cache
+from Bcfg2.Cache import get_cache
+from Bcfg2.Server.Resolver import Resolver
 import Bcfg2.Statistics
-from itertools import chain
-from Bcfg2.Compat import xmlrpclib  # pylint: disable=W0622
+import Bcfg2.Tracing
+from Bcfg2.Compat import xmlrpclib, md5, Queue, \
+    cPickle  # pylint: disable=W0622
 from Bcfg2.Server.Plugin import PluginInitError, PluginExecutionError, \
     track_statistics
 
@@ -66,6 +70,103 @@ def sort_xml(node, key=None):
     node[:] = sorted_children
 
 
+class ThreadPool(object):
+    """ A simple pool of worker threads that runs batches of jobs
+    and waits for each batch to complete.  The threads are started
+    lazily, on the first call to :func:`run`, so that a pool created
+    before the server daemonizes or forks still works. """
+
+    def __init__(self, size, name="ThreadPool"):
+        """
+        :param size: The number of worker threads
+        :type size: int
+        :param name: The prefix for the names of the worker threads
+        :type name: string
+        """
+        #: The number of worker threads
+        self.size = size
+
+        #: The prefix for the names of the worker threads
+        self.name = name
+
+        #: The queue of jobs waiting to be run
+        self.queue = Queue()
+
+        #: The worker threads
+        self.threads = []
+        self._lock = threading.Lock()
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def _start(self):
+        """ Start the worker threads, if they are not running """
+        self._lock.acquire()
+        try:
+            if not self.threads:
+                for num in range(self.size):
+                    thread = threading.Thread(name="%s-%d" % (self.name, num),
+                                              target=self._worker)
+                    thread.setDaemon(True)
+                    thread.start()
+                    self.threads.append(thread)
+        finally:
+            self._lock.release()
+
+    def _worker(self):
+        """ The main loop of a worker thread """
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            func, args, done = job
+            try:
+                try:
+                    func(*args)
+                except:  # pylint: disable=W0702
+                    self.logger.error("Unexpected error in %s" % self.name,
+                                      exc_info=1)
+            finally:
+                done()
+
+    def run(self, jobs):
+        """ Run a batch of jobs on the pool and wait for all of them
+        to finish.
+
+        :param jobs: The jobs to run
+        :type jobs: list of tuples of (<callable>, <tuple of args>)
+        :returns: None
+        """
+        if not jobs:
+            return
+        self._start()
+        remaining = [len(jobs)]
+        lock = threading.Lock()
+        finished = threading.Event()
+
+        def done():
+            """ Mark a single job as done """
+            lock.acquire()
+            try:
+                remaining[0] -= 1
+                if remaining[0] == 0:
+                    finished.set()
+            finally:
+                lock.release()
+
+        for func, args in jobs:
+            self.queue.put((func, args, done))
+        finished.wait()
+
+    def shutdown(self):
+        """ Stop all worker threads """
+        self._lock.acquire()
+        try:
+            for _ in self.threads:
+                self.queue.put(None)
+            self.threads = []
+        finally:
+            self._lock.release()
+
+
 class CoreInitError(Exception):
     """ Raised when the server core cannot be initialized. """
     pass
@@ -305,8 +406,64 @@ class BaseCore(object):
         self.lock = threading.Lock()
 
         #: A :class:`Bcfg2.Cache.Cache` object for caching client
-        #: metadata
-        self.metadata_cache = Cache()
+        #: metadata.  Its limits are set by the ``metadata_*``
+        #: options in the ``[caching]`` section of ``bcfg2.conf``.
+        self.metadata_cache = get_cache("metadata", self.setup.cfp,
+                                        max_entries=100000)
+
+        #: A :class:`Bcfg2.Cache.Cache` object for caching complete,
+        #: serialized client configurations.  Keys are client
+        #: hostnames; values are tuples of (<cache key>,
+        #: <serialized configuration>).  See
+        #: :attr:`config_cache_enabled`.  Its limits are set by the
+        #: ``config_*`` options in the ``[caching]`` section of
+        #: ``bcfg2.conf``.
+        self.config_cache = get_cache("config", self.setup.cfp,
+                                      max_bytes=256 * 1024 * 1024)
+
+        #: A dict of client hostname -> (<time of the start of the
+        #: client's last run>, <seconds between its last two runs>),
+        #: used to warm :attr:`metadata_cache` in the order clients
+        #: are expected to check in.  See :func:`_warm_metadata_cache`.
+        self.checkins = dict()
+
+        #: The :class:`threading.Thread` that loads the
+        #: :attr:`metadata_snapshot` and warms :attr:`metadata_cache`
+        #: after the server starts, or None
+        self.warmup_thread = None
+
+        #: Whether the :attr:`metadata_snapshot` has been loaded.  It
+        #: is only saved once it has, so that a server that is
+        #: stopped before it has finished starting, or a tool like
+        #: ``bcfg2-info`` that never loads it, does not replace it.
+        self.snapshot_loaded = False
+
+        #: A :class:`Bcfg2.Server.Resolver.Resolver` that caches DNS
+        #: lookups for the core and all plugins.  See
+        #: :func:`_get_resolver`.
+        self.resolver = self._get_resolver()
+
+        #: A dict of generation counters for the data served by each
+        #: plugin.  Keys are plugin names (or module names, for
+        #: objects that cannot be traced back to a plugin), and each
+        #: counter is incremented whenever a FAM event that cannot be
+        #: tied to individual entries is handled by an object
+        #: belonging to that plugin.  The counters are part of the
+        #: :attr:`config_cache` key.  See :func:`_invalidate_caches`.
+        self.generations = dict()
+
+        #: A :class:`ThreadPool` used to bind the entries of a client
+        #: configuration in parallel, or None if entries are bound
+        #: one at a time.  See :func:`BindStructures`.
+        self.bind_pool = None
+        if setup['bind_threads'] > 1:
+            self.bind_pool = ThreadPool(setup['bind_threads'],
+                                        name="BindThread")
+
+        #: Cache of the owner of each class of FAM event handler,
+        #: used by :func:`_invalidate_caches`
+        self._event_owners = dict()
+        self.fam.listeners.append(self._invalidate_caches)
 
     def plugins_by_type(self, base_cls):
         """ Return a list of loaded plugins that match the passed type.
@@ -347,6 +504,68 @@ class BaseCore(object):
                 continue
             self._update_vcs_revision()
 
+    def _invalidate_caches(self, event, obj):
+        """ Invalidate cached client configurations affected by a FAM
+        event.  This is registered as a listener on :attr:`fam`.
+
+        Events on files in :class:`Bcfg2.Server.Plugin.GroupSpool`
+        plugins (e.g., Cfg) only affect a single entry, so only the
+        cached configurations that contain that entry are expired.
+        All other events increment the :attr:`generations` counter of
+        the plugin that owns the object that handled the event, which
+        invalidates all cached configurations.
+
+        :param event: The event that was handled
+        :type event: Bcfg2.Server.FileMonitor.Event
+        :param obj: The object that handled the event
+        :type obj: object
+        """
+        dependency = None
+        if isinstance(obj, Bcfg2.Server.Plugin.GroupSpool):
+            dependency = self._get_spool_dependency(event, obj)
+        if dependency is not None:
+            expired = self.config_cache.expire_dependents(dependency)
+            if expired:
+                self.logger.debug("Expired cached configurations for %s "
+                                  "after change to %s:%s" %
+                                  (", ".join(expired), dependency[0],
+                                   dependency[1]))
+            return
+
+        cls = obj.__class__
+        if cls not in self._event_owners:
+            owner = cls.__module__
+            for plugin in self.plugins.values():
+                pmodule = plugin.__class__.__module__
+                if owner == pmodule or owner.startswith(pmodule + "."):
+                    owner = plugin.name
+                    break
+            self._event_owners[cls] = owner
+        owner = self._event_owners[cls]
+        self.generations[owner] = self.generations.get(owner, 0) + 1
+
+    def _get_spool_dependency(self, event, spool):
+        """ Get the entry affected by an event handled by a
+        :class:`Bcfg2.Server.Plugin.GroupSpool` plugin, as a tuple of
+        (<entry tag>, <entry name>).  Returns None if the event may
+        affect more than one entry (e.g., if a directory was created
+        or deleted).
+
+        :param event: The event that was handled
+        :type event: Bcfg2.Server.FileMonitor.Event
+        :param spool: The plugin that handled the event
+        :type spool: Bcfg2.Server.Plugin.GroupSpool
+        :returns: tuple or None
+        """
+        if event.filename.startswith('/') or event.code2str() == 'deleted':
+            return None
+        try:
+            if os.path.isdir(spool.event_path(event)):
+                return None
+            return (spool.entry_type, spool.event_id(event))
+        except KeyError:
+            return None
+
     @track_statistics()
     def _update_vcs_revision(self):
         """ Update the revision of the current configuration on-disk
@@ -407,10 +626,32 @@ class BaseCore(object):
         """ Perform plugin and FAM shutdown tasks. """
         if not self.terminate.isSet():
             self.terminate.set()
+            if self.metadata_snapshot and self.snapshot_loaded:
+                self._save_metadata_snapshot()
             self.fam.shutdown()
+            if self.bind_pool is not None:
+                self.bind_pool.shutdown()
             for plugin in list(self.plugins.values()):
                 plugin.shutdown()
 
+    def _get_resolver(self):
+        """ Create the :attr:`resolver`, configured by the
+        ``[resolver]`` section of ``bcfg2.conf`` """
+        kwargs = dict()
+        for opt, cook in [("ttl", float), ("negative_ttl", float),
+                          ("size", int), ("timeout", float)]:
+            val = self.setup.cfp.get("resolver", opt, default="")
+            if not val:
+                continue
+            try:
+                kwargs[opt] = cook(val)
+            except ValueError:
+                self.logger.error("Invalid resolver %s %s, using the "
+                                  "default" % (opt, val))
+        kwargs['refresh'] = self.setup.cfp.getboolean("resolver", "refresh",
+                                                      default=True)
+        return Resolver(**kwargs)
+
     @property
     def metadata_cache_mode(self):
         """ Get the client :attr:`metadata_cache` mode.  Options are
@@ -423,6 +664,124 @@ class BaseCore(object):
         else:
             return mode
 
+    @property
+    def metadata_warmup_threads(self):
+        """ The number of threads used to warm :attr:`metadata_cache`
+        after the server starts, or 0 if it is not warmed.  See
+        :func:`_warm_metadata_cache`. """
+        if self.metadata_cache_mode == 'off':
+            return 0
+        try:
+            return int(self.setup.cfp.get("caching", "warmup_threads",
+                                          default="2"))
+        except ValueError:
+            self.logger.error("Invalid caching warmup_threads, not warming "
+                              "the metadata cache")
+            return 0
+
+    @property
+    def metadata_snapshot(self):
+        """ The path to the on-disk snapshot of
+        :attr:`metadata_cache`, or None if it is not saved.  See
+        :func:`_save_metadata_snapshot`. """
+        return self.setup.cfp.get("caching", "metadata_snapshot",
+                                  default=None)
+
+    @property
+    def config_cache_enabled(self):
+        """ Whether or not complete client configurations are
+        cached in :attr:`config_cache`.  See :ref:`server-caching`
+        for more details. """
+        return self.setup.cfp.getboolean("caching", "client_config",
+                                         default=False)
+
+    @property
+    def trace_clients(self):
+        """ The clients whose every run is traced.  See
+        :mod:`Bcfg2.Tracing`. """
+        return Bcfg2.Options.list_split(
+            self.setup.cfp.get("tracing", "clients", default=""))
+
+    @property
+    def trace_sample_rate(self):
+        """ The fraction of client runs, between 0 and 1, that are
+        traced in addition to the runs of :attr:`trace_clients`. """
+        try:
+            return float(self.setup.cfp.get("tracing", "sample_rate",
+                                            default="0"))
+        except ValueError:
+            self.logger.error("Invalid tracing sample_rate, not sampling "
+                              "client runs")
+            return 0.0
+
+    @property
+    def trace_directory(self):
+        """ The directory that client run traces are written to """
+        return self.setup.cfp.get("tracing", "directory",
+                                  default="/var/log/bcfg2/traces")
+
+    def _trace_client_run(self, client):
+        """ Decide whether or not to trace a run of the given
+        client.
+
+        :param client: The hostname of the client
+        :type client: string
+        :returns: bool
+        """
+        if not Bcfg2.Tracing.HAS_JSON:
+            return False
+        if client in self.trace_clients:
+            return True
+        rate = self.trace_sample_rate
+        return rate > 0 and random.random() < rate
+
+    def _write_trace(self, client, trace):
+        """ Write a client run trace to :attr:`trace_directory`.
+
+        :param client: The hostname of the client
+        :type client: string
+        :param trace: The trace to write
+        :type trace: Bcfg2.Tracing.Trace
+        """
+        tracedir = self.trace_directory
+        path = os.path.join(tracedir, "%s-%s.json" %
+                            (client, int(trace.start * 1000)))
+        try:
+            if not os.path.exists(tracedir):
+                os.makedirs(tracedir)
+            trace.write(path)
+            self.logger.info("Wrote trace of %s client run to %s" %
+                             (client, path))
+        except (IOError, OSError):
+            err = sys.exc_info()[1]
+            self.logger.error("Failed to write trace of %s client run to "
+                              "%s: %s" % (client, path, err))
+
+    def _config_cache_key(self, metadata):
+        """ Get the key used to look up a client's configuration in
+        :attr:`config_cache`.  The key is made up of a fingerprint of
+        the client metadata (including a hash of the data provided by
+        Connector plugins), the current repository revision, and the
+        plugin :attr:`generations`.
+
+        :param metadata: The client metadata
+        :type metadata: Bcfg2.Server.Plugins.Metadata.ClientMetadata
+        :returns: tuple
+        """
+        cdata = [(name, getattr(metadata, name, None))
+                 for name in sorted(metadata.connectors)]
+        return (metadata.profile,
+                tuple(sorted(metadata.groups)),
+                tuple(sorted(metadata.bundles)),
+                tuple(sorted(metadata.aliases)),
+                tuple(sorted(metadata.addresses)),
+                tuple(sorted(metadata.categories.items())),
+                metadata.uuid,
+                metadata.version,
+                md5(repr(cdata).encode('utf-8')).hexdigest(),
+                self.revision,
+                tuple(sorted(self.generations.items())))
+
     def client_run_hook(self, hook, metadata):
         """ Invoke hooks from
         :class:`Bcfg2.Server.Plugin.interfaces.ClientRunHooks` plugins
@@ -442,6 +801,8 @@ class BaseCore(object):
         try:
             for plugin in \
                     self.plugins_by_type(Bcfg2.Server.Plugin.ClientRunHooks):
+                span = Bcfg2.Tracing.begin("%s:%s" % (plugin.name, hook),
+                                           "hook")
                 try:
                     getattr(plugin, hook)(metadata)
                 except AttributeError:
@@ -452,6 +813,7 @@ class BaseCore(object):
                     err = sys.exc_info()[1]
                     self.logger.error("%s: Error invoking hook %s: %s" %
                                       (plugin, hook, err))
+                Bcfg2.Tracing.end(span)
         finally:
             Bcfg2.Statistics.stats.add_value("%s:client_run_hook:%s" %
                                              (self.__class__.__name__, hook),
@@ -473,6 +835,8 @@ class BaseCore(object):
         """
         for plugin in \
                 self.plugins_by_type(Bcfg2.Server.Plugin.StructureValidator):
+            span = Bcfg2.Tracing.begin("%s:validate_structures" % plugin.name,
+                                       "validate")
             try:
                 plugin.validate_structures(metadata, data)
             except Bcfg2.Server.Plugin.ValidationError:
@@ -483,6 +847,7 @@ class BaseCore(object):
             except:
                 self.logger.error("Plugin %s: unexpected structure validation "
                                   "failure" % plugin.name, exc_info=1)
+            Bcfg2.Tracing.end(span)
 
     @track_statistics()
     def validate_goals(self, metadata, data):
@@ -498,6 +863,8 @@ class BaseCore(object):
         :type data: list of lxml.etree._Element objects
         """
         for plugin in self.plugins_by_type(Bcfg2.Server.Plugin.GoalValidator):
+            span = Bcfg2.Tracing.begin("%s:validate_goals" % plugin.name,
+                                       "validate")
             try:
                 plugin.validate_goals(metadata, data)
             except Bcfg2.Server.Plugin.ValidationError:
@@ -508,6 +875,7 @@ class BaseCore(object):
             except:
                 self.logger.error("Plugin %s: unexpected goal validation "
                                   "failure" % plugin.name, exc_info=1)
+            Bcfg2.Tracing.end(span)
 
     @track_statistics()
     def GetStructures(self, metadata):
@@ -517,8 +885,14 @@ class BaseCore(object):
         :type metadata: Bcfg2.Server.Plugins.Metadata.ClientMetadata
         :returns: list of :class:`lxml.etree._Element` objects
         """
-        structures = list(chain(*[struct.BuildStructures(metadata)
-                                  for struct in self.structures]))
+        structures = []
+        for struct in self.structures:
+            span = Bcfg2.Tracing.begin("%s:BuildStructures" % struct.name,
+                                       "structure")
+            try:
+                structures.extend(struct.BuildStructures(metadata))
+            finally:
+                Bcfg2.Tracing.end(span)
         sbundles = [b.get('name') for b in structures if b.tag == 'Bundle']
         missing = [b for b in metadata.bundles if b not in sbundles]
         if missing:
@@ -539,6 +913,24 @@ class BaseCore(object):
                        structures to. Modified in-place.
         :type config: lxml.etree._Element
         """
+        if self.bind_pool is not None:
+            # bind all entries from all structures on the bind pool.
+            # entries are bound in place, so the order of the
+            # configuration is not affected
+            jobs = []
+            for astruct in structures:
+                for entry in self._get_unbound_entries(astruct):
+                    jobs.append((Bcfg2.Tracing.wrap(self._bind_entry),
+                                 (entry, metadata)))
+            start = time.time()
+            self.bind_pool.run(jobs)
+            Bcfg2.Statistics.stats.add_value("%s:BindStructures" %
+                                             self.__class__.__name__,
+                                             time.time() - start)
+            for astruct in structures:
+                config.append(astruct)
+            return
+
         for astruct in structures:
             try:
                 self.BindStructure(astruct, metadata)
@@ -555,22 +947,50 @@ class BaseCore(object):
         :param metadata: Client metadata to bind structure for
         :type metadata: Bcfg2.Server.Plugins.Metadata.ClientMetadata
         """
+        for entry in self._get_unbound_entries(structure):
+            self._bind_entry(entry, metadata)
+
+    def _get_unbound_entries(self, structure):
+        """ Get the entries in a structure that need to be bound.
+        Entries that are already bound (i.e., whose tag starts with
+        ``Bound``) are renamed in place and skipped.
+
+        :param structure: The structure to get entries from
+        :type structures: lxml.etree._Element
+        :returns: list of lxml.etree._Element objects
+        """
+        rv = []
         for entry in structure.getchildren():
             if entry.tag.startswith("Bound"):
                 entry.tag = entry.tag[5:]
-                continue
-            try:
-                self.Bind(entry, metadata)
-            except:
-                exc = sys.exc_info()[1]
-                if 'failure' not in entry.attrib:
-                    entry.set('failure', 'bind error: %s' % exc)
-                if isinstance(exc, PluginExecutionError):
-                    msg = "Failed to bind entry"
-                else:
-                    msg = "Unexpected failure binding entry"
-                self.logger.error("%s %s:%s: %s" %
-                                  (msg, entry.tag, entry.get('name'), exc))
+            else:
+                rv.append(entry)
+        return rv
+
+    def _bind_entry(self, entry, metadata):
+        """ Bind a single entry with :func:`Bind`, setting the
+        ``failure`` attribute on the entry if binding fails.
+
+        :param entry: The entry to bind.  Modified in-place.
+        :type entry: lxml.etree._Element
+        :param metadata: Client metadata to bind entry for
+        :type metadata: Bcfg2.Server.Plugins.Metadata.ClientMetadata
+        """
+        span = Bcfg2.Tracing.begin("%s:%s" % (entry.tag, entry.get('name')),
+                                   "bind")
+        try:
+            self.Bind(entry, metadata)
+        except:
+            exc = sys.exc_info()[1]
+            if 'failure' not in entry.attrib:
+                entry.set('failure', 'bind error: %s' % exc)
+            if isinstance(exc, PluginExecutionError):
+                msg = "Failed to bind entry"
+            else:
+                msg = "Unexpected failure binding entry"
+            self.logger.error("%s %s:%s: %s" %
+                              (msg, entry.tag, entry.get('name'), exc))
+        Bcfg2.Tracing.end(span)
 
     def Bind(self, entry, metadata):
         """ Bind a single entry using the appropriate generator.
@@ -602,8 +1022,12 @@ class BaseCore(object):
         glist = [gen for gen in self.generators if
                  entry.get('name') in gen.Entries.get(entry.tag, {})]
         if len(glist) == 1:
-            return glist[0].Entries[entry.tag][entry.get('name')](entry,
-                                                                  metadata)
+            span = Bcfg2.Tracing.begin("%s:Bind" % glist[0].name, "generator")
+            try:
+                return glist[0].Entries[entry.tag][entry.get('name')](entry,
+                                                                      metadata)
+            finally:
+                Bcfg2.Tracing.end(span)
         elif len(glist) > 1:
             generators = ", ".join([gen.name for gen in glist])
             self.logger.error("%s %s served by multiple generators: %s" %
@@ -612,7 +1036,12 @@ class BaseCore(object):
                   gen.HandlesEntry(entry, metadata)]
         try:
             if len(g2list) == 1:
-                return g2list[0].HandleEntry(entry, metadata)
+                span = Bcfg2.Tracing.begin("%s:HandleEntry" % g2list[0].name,
+                                           "generator")
+                try:
+                    return g2list[0].HandleEntry(entry, metadata)
+                finally:
+                    Bcfg2.Tracing.end(span)
             entry.set('failure', 'no matching generator')
             raise PluginExecutionError("No matching generator: %s:%s" %
                                        (entry.tag, entry.get('name')))
@@ -623,7 +1052,32 @@ class BaseCore(object):
                                              time.time() - start)
 
     def BuildConfiguration(self, client):
-        """ Build the complete configuration for a client.
+        """ Build the complete configuration for a client.  If the run
+        is traced (see :attr:`trace_clients` and
+        :attr:`trace_sample_rate`), the trace is written to
+        :attr:`trace_directory` afterwards.
+
+        :param client: The hostname of the client to build the
+                       configuration for
+        :type client: string
+        :returns: :class:`lxml.etree._Element` - A complete Bcfg2
+                  configuration document """
+        if not self._trace_client_run(client):
+            return self._build_configuration(client)
+        trace = Bcfg2.Tracing.start("BuildConfiguration:%s" % client)
+        span = Bcfg2.Tracing.begin("%s:BuildConfiguration" %
+                                   self.__class__.__name__, "call",
+                                   dict(client=client))
+        try:
+            return self._build_configuration(client)
+        finally:
+            Bcfg2.Tracing.end(span)
+            Bcfg2.Tracing.stop()
+            self._write_trace(client, trace)
+
+    def _build_configuration(self, client):
+        """ Build the complete configuration for a client.  This does
+        the actual work of :func:`BuildConfiguration`.
 
         :param client: The hostname of the client to build the
                        configuration for
@@ -642,6 +1096,23 @@ class BaseCore(object):
 
         self.client_run_hook("start_client_run", meta)
 
+        cache_key = None
+        if self.config_cache_enabled:
+            cache_serial = self.config_cache.serial
+            cache_key = self._config_cache_key(meta)
+            cached = self.config_cache.get(client, None)
+            if cached is not None and cached[0] == cache_key:
+                config = lxml.etree.XML(cached[1],
+                                        parser=Bcfg2.Server.XMLParser)
+                self.client_run_hook("end_client_run", meta)
+                Bcfg2.Statistics.stats.add_value(
+                    "%s:BuildConfiguration:cache_hit" %
+                    self.__class__.__name__,
+                    time.time() - start)
+                self.logger.info("Served cached config for %s in %.03f "
+                                 "seconds" % (client, time.time() - start))
+                return config
+
         try:
             structures = self.GetStructures(meta)
         except:
@@ -669,12 +1140,54 @@ class BaseCore(object):
 
         self.client_run_hook("end_client_run", meta)
 
+        span = Bcfg2.Tracing.begin("sort_xml", "call")
         sort_xml(config, key=lambda e: e.get('name'))
+        Bcfg2.Tracing.end(span)
+
+        if cache_key is not None:
+            self._cache_config(client, config, cache_key, cache_serial)
+            Bcfg2.Statistics.stats.add_value(
+                "%s:BuildConfiguration:cache_miss" % self.__class__.__name__,
+                time.time() - start)
 
         self.logger.info("Generated config for %s in %.03f seconds" %
                          (client, time.time() - start))
         return config
 
+    def _cache_config(self, client, config, key, serial):
+        """ Store a client configuration in :attr:`config_cache`,
+        along with the entries it depends on.  The configuration is
+        not cached if anything was expired from the cache while it
+        was being built, since it may contain stale data.
+
+        :param client: The hostname of the client
+        :type client: string
+        :param config: The complete client configuration
+        :type config: lxml.etree._Element
+        :param key: The cache key for the configuration, as returned
+                    by :func:`_config_cache_key`
+        :type key: tuple
+        :param serial: The :attr:`Bcfg2.Cache.Cache.serial` of
+                       :attr:`config_cache` when the configuration
+                       build started
+        :type serial: int
+        """
+        data = lxml.etree.tostring(config)
+        self.lock.acquire()
+        try:
+            if self.config_cache.serial != serial:
+                self.logger.debug("Not caching config for %s, cache was "
+                                  "expired while building it" % client)
+                return
+            for struct in config:
+                for entry in struct:
+                    self.config_cache.add_dependency(client,
+                                                     (entry.tag,
+                                                      entry.get('name')))
+            self.config_cache[client] = (key, data)
+        finally:
+            self.lock.release()
+
     def HandleEvent(self, event):
         """ Handle a change in the Bcfg2 config file.
 
@@ -686,8 +1199,20 @@ class BaseCore(object):
             return
         if event.code2str() == 'deleted':
             return
+        oldconfig = self._get_config_data()
         self.setup.reparse()
-        self.metadata_cache.expire()
+        if self._get_config_data() != oldconfig:
+            self.metadata_cache.expire()
+
+    def _get_config_data(self):
+        """ Get the raw contents of bcfg2.conf, in order to
+        determine whether it actually changed on a FAM event.
+
+        :returns: dict of <section> -> list of (<option>, <value>)
+        """
+        cfp = self.setup.cfp
+        return dict((section, sorted(cfp.items(section, raw=True)))
+                    for section in cfp.sections())
 
     def run(self):
         """ Run the server core. This calls :func:`_daemonize`,
@@ -725,12 +1250,223 @@ class BaseCore(object):
 
             for plug in self.plugins_by_type(Bcfg2.Server.Plugin.Threaded):
                 plug.start_threads()
+
+            if self.metadata_warmup_threads or self.metadata_snapshot:
+                self.warmup_thread = \
+                    threading.Thread(name="MetadataWarmup",
+                                     target=self._warm_metadata_cache)
+                self.warmup_thread.setDaemon(True)
+                self.warmup_thread.start()
         except:
             self.shutdown()
             raise
 
         self._block()
 
+    def _wait_for_load(self):
+        """ Block until the file monitor thread has handled all of
+        the events produced by the initial repository load. """
+        while not self.terminate.isSet():
+            self.lock.acquire()
+            try:
+                if self.fam.started and not self.fam.pending():
+                    return
+            finally:
+                self.lock.release()
+            self.terminate.wait(0.5)
+
+    def _record_checkin(self, client):
+        """ Record the start of a client run in :attr:`checkins` """
+        now = time.time()
+        last = self.checkins.get(client)
+        if last is None:
+            self.checkins[client] = (now, None)
+        else:
+            self.checkins[client] = (now, now - last[0])
+
+    def _get_warmup_order(self, clients):
+        """ Sort clients in the order they are expected to check in
+        next, based on :attr:`checkins`.  Clients that have no
+        recorded check-ins go last. """
+        now = time.time()
+
+        def expected(client):
+            """ Get the time a client is expected to check in next """
+            last, interval = self.checkins.get(client, (None, None))
+            if last is None:
+                return (1, 0)
+            if interval is None:
+                return (0, last)
+            nextrun = last + interval
+            while nextrun < now:
+                nextrun += interval
+            return (0, nextrun)
+
+        return sorted(clients, key=expected)
+
+    def _warm_metadata_cache(self):
+        """ Fill :attr:`metadata_cache` with the metadata of all
+        clients once the repository has been loaded.  Metadata is
+        restored from the :attr:`metadata_snapshot` if it is still
+        valid; all other clients are built on a pool of
+        :attr:`metadata_warmup_threads` threads, in the order they are
+        expected to check in.  If there are no warm-up threads, only
+        the snapshot is loaded. """
+        self._wait_for_load()
+        if self.terminate.isSet():
+            return
+        start = time.time()
+        self._update_vcs_revision()
+        self._load_metadata_snapshot()
+        self.snapshot_loaded = True
+        if not self.metadata_warmup_threads:
+            return
+
+        clients = [c for c in self.metadata.list_clients()
+                   if c not in self.metadata_cache]
+        clients = self._get_warmup_order(clients)
+        pool = ThreadPool(self.metadata_warmup_threads,
+                          name="MetadataWarmup")
+
+        def warm(client):
+            """ Build and cache the metadata for a single client """
+            if client in self.metadata_cache:
+                return
+            try:
+                self.build_metadata(client)
+            except:  # pylint: disable=W0702
+                self.logger.debug("Failed to build metadata for %s: %s" %
+                                  (client, sys.exc_info()[1]))
+
+        # run the jobs in small batches, so that shutdown isn't held
+        # up by a long warm-up
+        batch = pool.size * 4
+        try:
+            for i in range(0, len(clients), batch):
+                if self.terminate.isSet():
+                    return
+                pool.run([(warm, (c,)) for c in clients[i:i + batch]])
+        finally:
+            pool.shutdown()
+        self.logger.info("Warmed metadata cache for %d clients in %.03f "
+                         "seconds" % (len(self.metadata_cache),
+                                      time.time() - start))
+
+    def _get_snapshot_stamps(self):
+        """ Get the data that a :attr:`metadata_snapshot` is valid
+        for: the repository revision and the modification times of
+        the files of the Metadata and Connector plugins.
+
+        :returns: tuple of (<revision>, <dict of path -> mtime>)
+        """
+        mtimes = dict()
+        plugins = [self.metadata] + self.connectors
+        for plugin in plugins:
+            for root, _, files in os.walk(plugin.data):
+                for fname in files:
+                    path = os.path.join(root, fname)
+                    try:
+                        mtimes[path] = os.stat(path).st_mtime
+                    except OSError:
+                        pass
+        return (self.revision, mtimes)
+
+    def _save_metadata_snapshot(self):
+        """ Save :attr:`metadata_cache` and :attr:`checkins` to the
+        :attr:`metadata_snapshot`.  Connector data that cannot be
+        pickled is left out of the snapshot, and fetched from the
+        connector again when the snapshot is loaded. """
+        path = self.metadata_snapshot
+        if not path or not hasattr(self, 'metadata'):
+            return
+        conns = [c.name for c in self.connectors]
+        clients = dict()
+        for client, imd in list(self.metadata_cache.items()):
+            state = imd.__getstate__()
+            conndata = dict()
+            missing = []
+            for name in conns:
+                if name not in state:
+                    continue
+                try:
+                    conndata[name] = cPickle.dumps(state.pop(name), 2)
+                except:  # pylint: disable=W0702
+                    missing.append(name)
+            try:
+                clients[client] = cPickle.dumps(
+                    (imd.__class__, state, conndata, missing), 2)
+            except:  # pylint: disable=W0702
+                self.logger.debug("Not saving metadata for %s in snapshot: "
+                                  "%s" % (client, sys.exc_info()[1]))
+        revision, mtimes = self._get_snapshot_stamps()
+        data = dict(revision=revision, mtimes=mtimes, clients=clients,
+                    checkins=self.checkins)
+        tmpfile = "%s.new" % path
+        try:
+            fileobj = open(tmpfile, "wb")
+            try:
+                cPickle.dump(data, fileobj, 2)
+            finally:
+                fileobj.close()
+            os.rename(tmpfile, path)
+            self.logger.info("Saved metadata for %d clients to %s" %
+                             (len(clients), path))
+        except (IOError, OSError):
+            self.logger.error("Failed to save metadata snapshot to %s: %s" %
+                              (path, sys.exc_info()[1]))
+
+    def _load_metadata_snapshot(self):
+        """ Load :attr:`checkins` from the :attr:`metadata_snapshot`,
+        and load the metadata in it into :attr:`metadata_cache` if
+        the repository revision and the files of the Metadata and
+        Connector plugins have not changed since it was saved. """
+        path = self.metadata_snapshot
+        if not path or not os.path.exists(path):
+            return
+        try:
+            fileobj = open(path, "rb")
+            try:
+                data = cPickle.load(fileobj)
+            finally:
+                fileobj.close()
+        except:  # pylint: disable=W0702
+            self.logger.error("Failed to load metadata snapshot from %s: %s"
+                              % (path, sys.exc_info()[1]))
+            return
+        for client, checkin in data['checkins'].items():
+            if client not in self.checkins:
+                self.checkins[client] = checkin
+        if self.metadata_cache_mode == 'off':
+            # the metadata cache is not used
+            return
+        if (data['revision'], data['mtimes']) != self._get_snapshot_stamps():
+            self.logger.info("Metadata snapshot %s is out of date, "
+                             "ignoring it" % path)
+            return
+
+        conns = dict([(c.name, c) for c in self.connectors])
+        for client, record in data['clients'].items():
+            try:
+                cls, state, conndata, missing = cPickle.loads(record)
+                imd = cls.__new__(cls)
+                for name, pickled in conndata.items():
+                    state[name] = cPickle.loads(pickled)
+                imd.__setstate__(state)
+                imd.query = self.metadata.query
+                for name in missing:
+                    if name in conns:
+                        self.metadata.merge_additional_data(
+                            imd, name, conns[name].get_additional_data(imd))
+            except:  # pylint: disable=W0702
+                self.logger.debug("Failed to load metadata for %s from "
+                                  "snapshot: %s" % (client,
+                                                    sys.exc_info()[1]))
+                continue
+            if client not in self.metadata_cache:
+                self.metadata_cache[client] = imd
+        self.logger.info("Loaded metadata for %d clients from %s" %
+                         (len(data['clients']), path))
+
     def _daemonize(self):
         """ Daemonize the server and write the pidfile.  This must be
         overridden by a core implementation. """
@@ -787,14 +1523,26 @@ class BaseCore(object):
         if not imd:
             imd = self.metadata.get_initial_metadata(client_name)
             for conn in self.connectors:
-                grps = conn.get_additional_groups(imd)
+                span = Bcfg2.Tracing.begin("%s:get_additional_groups" %
+                                           conn.name, "connector")
+                try:
+                    grps = conn.get_additional_groups(imd)
+                finally:
+                    Bcfg2.Tracing.end(span)
                 self.metadata.merge_additional_groups(imd, grps)
             for conn in self.connectors:
-                data = conn.get_additional_data(imd)
+                span = Bcfg2.Tracing.begin("%s:get_additional_data" %
+                                           conn.name, "connector")
+                try:
+                    data = conn.get_additional_data(imd)
+                finally:
+                    Bcfg2.Tracing.end(span)
                 self.metadata.merge_additional_data(imd, conn.name, data)
             imd.query.by_name = self.build_metadata
             if self.metadata_cache_mode in ['cautious', 'aggressive']:
                 self.metadata_cache[client_name] = imd
+            if hasattr(self.metadata, "update_client_index"):
+                self.metadata.update_client_index(client_name, imd)
         return imd
 
     def process_statistics(self, client_name, statistics):
@@ -847,6 +1595,9 @@ class BaseCore(object):
         try:
             client = self.metadata.resolve_client(address,
                                                   cleanup_cache=cleanup_cache)
+            if cleanup_cache:
+                # cleanup_cache is set at the start of each client run
+                self._record_checkin(client)
             if metadata:
                 meta = self.build_metadata(client)
             else:
@@ -1039,6 +1790,82 @@ class BaseCore(object):
                            (client, err))
         return True
 
+    @exposed
+    def StartClientRun(self, address, version, profile='',
+                       decision_mode=''):
+        """ Start a client run with a single call.  This is
+        equivalent to calling :func:`AssertProfile` (if a profile is
+        given), :func:`DeclareVersion`, :func:`GetProbes`, and
+        :func:`GetDecisionList` (if a decision mode is given), but the
+        client is only resolved and its metadata only built once.
+
+        Note that the decision list is determined before the client
+        has sent any probe data, so clients that run probes should
+        fetch the decision list again after sending probe data.
+
+        :param address: Client (address, hostname) pair
+        :type address: tuple
+        :param version: The client's declared version
+        :type version: string
+        :param profile: The profile to assert for the client, or an
+                        empty string to leave it unchanged
+        :type profile: string
+        :param decision_mode: The decision list mode
+                              (``whitelist`` or ``blacklist``), or an
+                              empty string to skip getting the
+                              decision list
+        :type decision_mode: string
+        :returns: dict - A dict with the keys ``version`` (True if
+                  the client version was recorded), ``probes`` (a
+                  string containing the XML tree describing probes
+                  for this client), and, if a decision mode was
+                  given, ``decisions`` (a list of decision tuples)
+        :raises: :exc:`xmlrpclib.Fault`
+        """
+        client = self.resolve_client(address, cleanup_cache=True,
+                                     metadata=False)[0]
+        rv = dict()
+        try:
+            if profile:
+                self.metadata.set_profile(client, profile, address)
+        except (Bcfg2.Server.Plugin.MetadataConsistencyError,
+                Bcfg2.Server.Plugin.MetadataRuntimeError):
+            err = sys.exc_info()[1]
+            self.critical_error("Unable to assert profile for %s: %s" %
+                                (client, err))
+        try:
+            self.metadata.set_version(client, version)
+            rv['version'] = True
+        except (Bcfg2.Server.Plugin.MetadataConsistencyError,
+                Bcfg2.Server.Plugin.MetadataRuntimeError):
+            err = sys.exc_info()[1]
+            self.logger.error("Unable to set version for %s: %s" %
+                              (client, err))
+            rv['version'] = False
+
+        try:
+            metadata = self.build_metadata(client)
+        except (Bcfg2.Server.Plugin.MetadataConsistencyError,
+                Bcfg2.Server.Plugin.MetadataRuntimeError):
+            err = sys.exc_info()[1]
+            self.critical_error("Client metadata resolution error for %s: "
+                                "%s" % (client, err))
+        probes = lxml.etree.Element('probes')
+        try:
+            for plugin in self.plugins_by_type(Bcfg2.Server.Plugin.Probing):
+                for probe in plugin.GetProbes(metadata):
+                    probes.append(probe)
+        except:
+            err = sys.exc_info()[1]
+            self.critical_error("Error determining probes for %s: %s" %
+                                (client, err))
+        rv['probes'] = lxml.etree.tostring(
+            probes, xml_declaration=False).decode('UTF-8')
+
+        if decision_mode:
+            rv['decisions'] = self.GetDecisions(metadata, decision_mode)
+        return rv
+
     @exposed
     def GetConfig(self, address):
         """ Build config for a client by calling
@@ -1114,14 +1941,29 @@ class BaseCore(object):
         return self._database_available
 
     @exposed
-    def get_statistics(self, _):
+    def get_statistics(self, _, detail=False):
         """ Get current statistics about component execution from
         :attr:`Bcfg2.Statistics.stats`.
 
+        :param detail: Include percentiles and sliding windows
+        :type detail: bool
         :returns: dict - The statistics data as returned by
-                  :func:`Bcfg2.Statistics.Statistics.display` """
+                  :func:`Bcfg2.Statistics.Statistics.display`, or by
+                  :func:`Bcfg2.Statistics.Statistics.display_detail`
+                  if ``detail`` is True """
+        if detail:
+            return Bcfg2.Statistics.stats.display_detail()
         return Bcfg2.Statistics.stats.display()
 
+    @exposed
+    def get_counters(self, _):
+        """ Get the current values of counters, such as cache hits and
+        misses, from :attr:`Bcfg2.Statistics.stats`.
+
+        :returns: dict - The counters as returned by
+                  :func:`Bcfg2.Statistics.Statistics.get_counters` """
+        return Bcfg2.Statistics.stats.get_counters()
+
     @exposed
     def toggle_debug(self, address):
         """ Toggle debug status of the FAM and all plugins
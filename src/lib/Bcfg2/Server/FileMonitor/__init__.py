@@ -150,6 +150,13 @@ class FileMonitor(Debuggable):
         #: Whether or not the FAM has been started.  See :func:`start`.
         self.started = False
 
+        #: List of callables that are notified of every event after
+        #: it has been dispatched, unless the object that handled it
+        #: returned False from ``HandleEvent()`` to say that it
+        #: ignored the event.  Each is called with the event and the
+        #: object that handled it.  See :func:`handle_one_event`.
+        self.listeners = []
+
     def __str__(self):
         return "%s: %s" % (__name__, self.__class__.__name__)
 
@@ -229,12 +236,23 @@ class FileMonitor(Debuggable):
         self.debug_log("Dispatching event %s %s to obj %s" %
                        (event.code2str(), event.filename,
                         self.handles[event.requestID]))
+        obj = self.handles[event.requestID]
         try:
-            self.handles[event.requestID].HandleEvent(event)
+            if obj.HandleEvent(event) is False:
+                # the handler ignored the event, so no data changed
+                return
         except:  # pylint: disable=W0702
             err = sys.exc_info()[1]
             LOGGER.error("Error in handling of event %s for %s: %s" %
                          (event.code2str(), event.filename, err))
+        for listener in self.listeners:
+            try:
+                listener(event, obj)
+            except:  # pylint: disable=W0702
+                err = sys.exc_info()[1]
+                LOGGER.error("Error notifying %s of event %s for %s: %s" %
+                             (listener, event.code2str(), event.filename,
+                              err))
 
     def handle_event_set(self, lock=None):
         """ Handle all pending events.
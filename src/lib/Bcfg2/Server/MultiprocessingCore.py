@@ -0,0 +1,335 @@
+""" The multiprocessing server core is a pre-forking reimplementation
+of the :mod:`Bcfg2.Server.BuiltinCore`.  The parent process loads the
+repository once, then forks a number of child processes that all
+accept connections on the same listening socket.  Because the
+children are forked after the repository has been loaded, they share
+the parent's memory copy-on-write and do not have to parse the
+repository themselves.
+
+Only the parent process watches the filesystem.  Every event it
+handles is forwarded to the children, which dispatch it to their own
+copies of the plugin objects, so all processes stay in sync with the
+repository.
+
+Probe data is not kept in sync by file monitor events; a child that
+receives probe data from a client reports the client to the parent,
+which tells every other child to reload that client's probe data
+(see :func:`Bcfg2.Server.Plugin.interfaces.Probing.load_client_data`)
+and to expire the caches that depend on it.  This happens
+asynchronously, so a request that reaches another child immediately
+after probe data was received may still see the previous data.
+
+This core requires the Python :mod:`multiprocessing` library, and
+thus Python 2.6+.
+"""
+
+import signal
+import threading
+import multiprocessing
+import Bcfg2.Server.Plugin
+import Bcfg2.Server.FileMonitor
+from Bcfg2.Compat import Empty
+from Bcfg2.Server.Core import CoreInitError, exposed
+from Bcfg2.Server.FileMonitor import FileMonitor
+from Bcfg2.Server.BuiltinCore import Core as BuiltinCore
+
+
+class Core(BuiltinCore):
+    """ A multiprocessing core that forks
+    :attr:`children` worker processes once the repository has been
+    loaded.  The parent process handles no client requests itself; it
+    only watches the filesystem and supervises the children. """
+
+    #: How long to wait, in seconds, for a child process to shut
+    #: down cleanly before it is killed.
+    shutdown_timeout = 10.0
+
+    #: How often, in seconds, the parent process checks on its
+    #: children.
+    poll_interval = 1.0
+
+    def __init__(self, setup):
+        BuiltinCore.__init__(self, setup)
+
+        famclass = Bcfg2.Server.FileMonitor.available.get('fam')
+        if famclass is not None and isinstance(self.fam, famclass):
+            raise CoreInitError("The multiprocessing core does not support "
+                                "the fam file monitor; use inotify or "
+                                "gamin instead")
+
+        #: The number of child processes to fork
+        self.children = self.setup['children']
+        if not self.children:
+            self.children = multiprocessing.cpu_count()
+
+        #: A list of :class:`multiprocessing.Process` objects, one per
+        #: child
+        self.child_processes = []
+
+        #: A list of :class:`multiprocessing.Queue` objects, one per
+        #: child, used to forward file monitor events and clients
+        #: with new probe data to the children.  Each item is a tuple
+        #: whose first element is either ``"event"`` or ``"client"``.
+        self.event_queues = []
+
+        #: A :class:`multiprocessing.Queue` shared by all children,
+        #: used to report clients that sent probe data to the parent
+        #: as ``(<child number>, <hostname>)`` tuples
+        self.client_queue = None
+
+        #: The number of this child process, or None in the parent
+        self.child_number = None
+
+        #: Monitor handle IDs assigned while handling the current
+        #: event in the parent.  These are forwarded along with the
+        #: event so that the children register new monitors under the
+        #: same handle IDs the parent uses.
+        self._monitor_ids = []
+    __init__.__doc__ = BuiltinCore.__init__.__doc__
+
+    def _block(self):
+        """ Wait for the initial repository load to finish, fork the
+        children, and supervise them until the server is shut
+        down. """
+        self._wait_for_load()
+        if self.warmup_thread is not None:
+            # warm the metadata cache before forking, so that every
+            # child inherits it
+            self.warmup_thread.join()
+
+        # fork with the FAM lock held so that no child inherits plugin
+        # data that is only half updated
+        self.lock.acquire()
+        try:
+            self._intercept_events()
+            self.client_queue = multiprocessing.Queue()
+            for cnum in range(self.children):
+                self._spawn_child(cnum)
+        finally:
+            self.lock.release()
+        self.logger.info("%s forked %d children" % (self.name,
+                                                    self.children))
+        relay_thread = threading.Thread(target=self._relay_client_updates,
+                                        name="%s-client-relay" % self.name)
+        relay_thread.daemon = True
+        relay_thread.start()
+
+        signal.signal(signal.SIGINT, self._handle_shutdown_signal)
+        signal.signal(signal.SIGTERM, self._handle_shutdown_signal)
+        try:
+            while not self.terminate.isSet():
+                self.terminate.wait(self.poll_interval)
+                alive = [c for c in self.child_processes if c.is_alive()]
+                if len(alive) != len(self.child_processes):
+                    for child in self.child_processes:
+                        if not child.is_alive():
+                            self.logger.error("Child %s exited with code %s"
+                                              % (child.name, child.exitcode))
+                    self.child_processes = alive
+                if not alive:
+                    self.logger.error("All children have exited, shutting "
+                                      "down")
+                    break
+        finally:
+            self._stop_children()
+            self.server.server_close()
+            self.context.close()
+        self.shutdown()
+
+    def _handle_shutdown_signal(self, *_):
+        """ Signal handler used by the parent process to shut the
+        server down. """
+        self.terminate.set()
+
+    def _intercept_events(self):
+        """ Wrap the parent's file monitor so that every event it
+        handles, along with the handle IDs of any monitors created
+        while handling it, is forwarded to the children. """
+        add_monitor = self.fam.AddMonitor
+        handle_one_event = self.fam.handle_one_event
+
+        def AddMonitor(path, obj, handleID=None):  # pylint: disable=C0103
+            """ Record the handle ID of the new monitor """
+            rv = add_monitor(path, obj, handleID)
+            self._monitor_ids.append(rv)
+            return rv
+
+        def handle_event(event):
+            """ Handle an event and forward it to the children """
+            self._monitor_ids = []
+            handle_one_event(event)
+            for queue in self.event_queues:
+                queue.put(("event", event, self._monitor_ids))
+
+        self.fam.AddMonitor = AddMonitor
+        self.fam.handle_one_event = handle_event
+
+    def _spawn_child(self, cnum):
+        """ Fork a single child process.
+
+        :param cnum: The number of the child
+        :type cnum: int
+        """
+        queue = multiprocessing.Queue()
+        child = multiprocessing.Process(target=self._child_run,
+                                        args=(queue, cnum),
+                                        name="%s-child-%d" % (self.name,
+                                                              cnum))
+        child.daemon = True
+        self.event_queues.append(queue)
+        self.child_processes.append(child)
+        child.start()
+
+    def _stop_children(self):
+        """ Terminate all children and wait for them to exit """
+        for child in self.child_processes:
+            if child.is_alive():
+                child.terminate()
+        for child in self.child_processes:
+            child.join(self.shutdown_timeout)
+            if child.is_alive():
+                self.logger.error("Child %s did not exit in %s seconds" %
+                                  (child.name, self.shutdown_timeout))
+        self.child_processes = []
+
+    def _child_run(self, queue, cnum):
+        """ The main loop of a child process.  This runs in the
+        child, and serves client requests on the shared socket until
+        the child is terminated.
+
+        :param queue: The queue from which file monitor events
+                      forwarded by the parent are read
+        :type queue: multiprocessing.Queue
+        :param cnum: The number of the child
+        :type cnum: int
+        """
+        # the child inherited the lock held by the parent at fork
+        # time
+        self.lock.release()
+        self.child_number = cnum
+        self._follow_events()
+        # only the parent saves the metadata snapshot
+        self.snapshot_loaded = False
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+        for plug in self.plugins_by_type(Bcfg2.Server.Plugin.Threaded):
+            plug.start_threads()
+
+        event_thread = threading.Thread(target=self._child_event_thread,
+                                        args=(queue,))
+        event_thread.start()
+        try:
+            self.server.serve_forever()
+        finally:
+            self.terminate.set()
+            event_thread.join()
+            self.shutdown()
+
+    def _follow_events(self):
+        """ Turn the file monitor inherited from the parent into one
+        that only dispatches events forwarded by the parent.  The
+        child must never read from the file monitor connection it
+        shares with the parent. """
+        self.child_processes = []
+        self.event_queues = []
+        fam = self.fam
+        fam.events = []
+        # drop the event forwarding wrapper installed by the parent
+        del fam.handle_one_event
+
+        def AddMonitor(path, obj, handleID=None):  # pylint: disable=C0103
+            """ Register a monitor under the handle ID the parent
+            assigned to it """
+            if self._monitor_ids:
+                handleID = self._monitor_ids.pop(0)
+            elif handleID is None:
+                handleID = path
+            if obj is not None:
+                fam.handles[handleID] = obj
+            return handleID
+
+        def shutdown():
+            """ Shut down the file monitor without touching any
+            threads or connections owned by the parent """
+            FileMonitor.shutdown(fam)
+
+        fam.AddMonitor = AddMonitor
+        fam.shutdown = shutdown
+
+    def _child_event_thread(self, queue):
+        """ Dispatch file monitor events and probe data updates
+        forwarded by the parent.  This runs in a thread in each
+        child.
+
+        :param queue: The queue from which events are read
+        :type queue: multiprocessing.Queue
+        """
+        while not self.terminate.isSet():
+            try:
+                message = queue.get(True, self.poll_interval)
+            except Empty:
+                continue
+            except (EOFError, IOError):
+                break
+            self.lock.acquire()
+            try:
+                if message[0] == "client":
+                    self._reload_client(message[1])
+                else:
+                    self._monitor_ids = list(message[2])
+                    self.fam.handle_one_event(message[1])
+                    self._monitor_ids = []
+            finally:
+                self.lock.release()
+            if queue.empty():
+                self._update_vcs_revision()
+
+    def _relay_client_updates(self):
+        """ Read clients that sent probe data from
+        :attr:`client_queue`, reload their probe data in the parent,
+        and forward them to every child except the one that received
+        the data.  This runs in a thread in the parent. """
+        while not self.terminate.isSet():
+            try:
+                cnum, client = self.client_queue.get(True,
+                                                     self.poll_interval)
+            except Empty:
+                continue
+            except (EOFError, IOError):
+                break
+            self.lock.acquire()
+            try:
+                self._reload_client(client)
+            finally:
+                self.lock.release()
+            for i in range(len(self.event_queues)):
+                if i != cnum:
+                    self.event_queues[i].put(("client", client))
+
+    def _reload_client(self, client):
+        """ Reload the probe data of a client that was received by
+        another process, and expire all cached data for the client.
+
+        :param client: The hostname of the client
+        :type client: string
+        """
+        for plugin in self.plugins_by_type(Bcfg2.Server.Plugin.Probing):
+            try:
+                plugin.load_client_data(client)
+            except:  # pylint: disable=W0702
+                self.logger.error("%s: Failed to reload probe data for %s" %
+                                  (plugin.name, client), exc_info=1)
+        self.metadata_cache.expire(client)
+        self.config_cache.expire(client)
+        if hasattr(self.metadata, "expire_client_index"):
+            self.metadata.expire_client_index(client)
+
+    @exposed
+    def RecvProbeData(self, address, probedata):
+        rv = BuiltinCore.RecvProbeData(self, address, probedata)
+        if self.child_number is not None:
+            client = self.resolve_client(address, metadata=False)[0]
+            self.client_queue.put((self.child_number, client))
+        return rv
+    RecvProbeData.__doc__ = BuiltinCore.RecvProbeData.__doc__
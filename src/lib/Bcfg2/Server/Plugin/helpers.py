@@ -11,6 +11,8 @@ import lxml.etree
 import Bcfg2.Server
 import Bcfg2.Options
 import Bcfg2.Statistics
+import Bcfg2.Tracing
+from Bcfg2.Cache import Cache
 from Bcfg2.Compat import CmpMixin, wraps
 from Bcfg2.Server.Plugin.base import Debuggable, Plugin
 from Bcfg2.Server.Plugin.interfaces import Generator
@@ -84,7 +86,8 @@ def bind_info(entry, metadata, infoxml=None, default=DEFAULT_FILE_METADATA):
 class track_statistics(object):  # pylint: disable=C0103
     """ Decorator that tracks execution time for the given
     :class:`Plugin` method with :mod:`Bcfg2.Statistics` for reporting
-    via ``bcfg2-admin perf`` """
+    via ``bcfg2-admin perf``, and records it as a span in the current
+    :mod:`Bcfg2.Tracing` trace, if any """
 
     def __init__(self, name=None):
         """
@@ -106,11 +109,13 @@ class track_statistics(object):  # pylint: disable=C0103
             """ The decorated function """
             name = "%s:%s" % (obj.__class__.__name__, self.name)
 
+            span = Bcfg2.Tracing.begin(name, "call")
             start = time.time()
             try:
                 return func(obj, *args, **kwargs)
             finally:
                 Bcfg2.Statistics.stats.add_value(name, time.time() - start)
+                Bcfg2.Tracing.end(span)
 
         return inner
 
@@ -567,6 +572,31 @@ class XMLFileBacked(FileBacked):
         return "%s at %s" % (self.__class__.__name__, self.name)
 
 
+class _StructFileMatcher(object):
+    """ The compiled form of a
+    :class:`Bcfg2.Server.Plugin.helpers.StructFile`, built by
+    :func:`Bcfg2.Server.Plugin.helpers.StructFile._get_matcher`. """
+
+    def __init__(self, xdata, tree, groups, clients, cache):
+        #: The xdata the file was compiled from
+        self.xdata = xdata
+
+        #: The list of compiled entries; see
+        #: :func:`Bcfg2.Server.Plugin.helpers.StructFile._compile`
+        self.tree = tree
+
+        #: A frozenset of the groups named in the file
+        self.groups = groups
+
+        #: A frozenset of the clients named in the file
+        self.clients = clients
+
+        #: A :class:`Bcfg2.Cache.Cache` of results of matching the
+        #: file, keyed by the group membership signature of the
+        #: client
+        self.cache = cache
+
+
 class StructFile(XMLFileBacked):
     """ StructFiles are XML files that contain a set of structure file
     formatting logic for handling ``<Group>`` and ``<Client>``
@@ -577,6 +607,95 @@ class StructFile(XMLFileBacked):
     #: the file being cached
     __identifier__ = None
 
+    #: The maximum number of distinct results of :func:`Match` and
+    #: :func:`XMLMatch` that are cached
+    match_cache_size = 256
+
+    def __init__(self, filename, fam=None, should_monitor=False):
+        XMLFileBacked.__init__(self, filename, fam=fam,
+                               should_monitor=should_monitor)
+        #: The :class:`_StructFileMatcher` built by
+        #: :func:`_get_matcher`
+        self._matcher = None
+    __init__.__doc__ = XMLFileBacked.__init__.__doc__
+
+    def _compile(self, item):
+        """ Compile an element into a node of a predicate tree.  Nodes
+        are tuples of (``Group``, <name>, <negate>, <children>),
+        (``Client``, <name>, <negate>, <children>), or (None, <copy of
+        the element without its children>, <children>).  Returns None
+        for comments. """
+        if isinstance(item, lxml.etree._Comment):  # pylint: disable=W0212
+            return None
+        children = []
+        for child in item.iterchildren():
+            node = self._compile(child)
+            if node is not None:
+                children.append(node)
+        if item.tag == 'Group' or item.tag == 'Client':
+            return (item.tag, item.get('name'),
+                    item.get('negate', 'false').lower() == 'true', children)
+        template = copy.deepcopy(item)
+        for child in template.iterchildren():
+            template.remove(child)
+        return (None, template, children)
+
+    def _get_matcher(self):
+        """ Get the compiled form of the file, compiling it if it has
+        not been compiled since it was last loaded """
+        matcher = self._matcher
+        if matcher is None or matcher.xdata is not self.xdata:
+            groups = set()
+            clients = set()
+            elements = list(self.entries)
+            if self.xdata is not None:
+                elements.append(self.xdata)
+            for element in elements:
+                for item in element.iter("Group", "Client"):
+                    if item.tag == 'Group':
+                        groups.add(item.get('name'))
+                    else:
+                        clients.add(item.get('name'))
+            tree = []
+            for child in self.entries:
+                node = self._compile(child)
+                if node is not None:
+                    tree.append(node)
+            matcher = _StructFileMatcher(
+                self.xdata, tree, frozenset(groups), frozenset(clients),
+                Cache(name="structfile", max_entries=self.match_cache_size))
+            self._matcher = matcher
+        return matcher
+
+    def _get_match_key(self, matcher, metadata):
+        """ Get the key that results of :func:`Match` and
+        :func:`XMLMatch` are cached under.  The results only depend on
+        which of the groups named in the file the client is a member
+        of, and on the client name only if it is named in the file,
+        so clients with equivalent group memberships share results.
+        """
+        groups = frozenset([g for g in matcher.groups
+                            if g in metadata.groups])
+        if metadata.hostname in matcher.clients:
+            return (groups, metadata.hostname)
+        return (groups, None)
+
+    def _evaluate(self, nodes, metadata):
+        """ Get the elements that match the metadata from a list of
+        compiled nodes """
+        rv = []
+        for node in nodes:
+            if node[0] is None:
+                element = copy.copy(node[1])
+                element.extend(self._evaluate(node[2], metadata))
+                rv.append(element)
+            elif node[0] == 'Group':
+                if node[2] != (node[1] in metadata.groups):
+                    rv.extend(self._evaluate(node[3], metadata))
+            elif node[2] != (node[1] == metadata.hostname):
+                rv.extend(self._evaluate(node[3], metadata))
+        return rv
+
     def _include_element(self, item, metadata):
         """ determine if an XML element matches the metadata """
         if isinstance(item, lxml.etree._Comment):  # pylint: disable=W0212
@@ -618,13 +737,22 @@ class StructFile(XMLFileBacked):
         Match() (and *not* their descendents) should be considered to
         match the metadata.
 
+        The file is compiled into a tree of ``<Group>`` and
+        ``<Client>`` predicates the first time it is matched, and
+        results are cached for all clients that are members of the
+        same groups named in the file.  Each call returns a new copy
+        of the cached result, so the caller may modify it.
+
         :param metadata: Client metadata to match against.
         :type metadata: Bcfg2.Server.Plugins.Metadata.ClientMetadata
         :returns: list of lxml.etree._Element objects """
-        rv = []
-        for child in self.entries:
-            rv.extend(self._match(child, metadata))
-        return rv
+        matcher = self._get_matcher()
+        key = ("Match", self._get_match_key(matcher, metadata))
+        rv = matcher.cache.get(key)
+        if rv is None:
+            rv = self._evaluate(matcher.tree, metadata)
+            matcher.cache[key] = rv
+        return [copy.deepcopy(el) for el in rv]
 
     def _xml_match(self, item, metadata):
         """ recursive helper for XMLMatch """
@@ -653,15 +781,22 @@ class StructFile(XMLFileBacked):
         ancestors match the metadata given.  Unlike :func:`Match`, the
         document returned by XMLMatch will only contain matching data.
         All ``<Group>`` and ``<Client>`` tags will have been stripped
-        out.
+        out.  Like :func:`Match`, results are cached for clients with
+        equivalent group memberships, and each call returns a new
+        copy.
 
         :param metadata: Client metadata to match against.
         :type metadata: Bcfg2.Server.Plugins.Metadata.ClientMetadata
         :returns: lxml.etree._Element """
-        rv = copy.deepcopy(self.xdata)
-        for child in rv.iterchildren():
-            self._xml_match(child, metadata)
-        return rv
+        matcher = self._get_matcher()
+        key = ("XMLMatch", self._get_match_key(matcher, metadata))
+        rv = matcher.cache.get(key)
+        if rv is None:
+            rv = copy.deepcopy(self.xdata)
+            for child in rv.iterchildren():
+                self._xml_match(child, metadata)
+            matcher.cache[key] = rv
+        return copy.deepcopy(rv)
 
 
 class INode(object):
@@ -766,6 +901,10 @@ class XMLSrc(XMLFileBacked):
     __cacheobj__ = dict
     __priority_required__ = True
 
+    #: The maximum number of distinct group membership signatures
+    #: whose matching entries are cached
+    match_cache_size = 256
+
     def __init__(self, filename, fam=None, should_monitor=False):
         XMLFileBacked.__init__(self, filename, fam, should_monitor)
         self.items = {}
@@ -773,6 +912,17 @@ class XMLSrc(XMLFileBacked):
         self.pnode = None
         self.priority = -1
 
+        #: The groups and clients named in the file.  The entries
+        #: that match a client only depend on these, so they are used
+        #: to build the keys of :attr:`match_cache`.
+        self.groups = frozenset()
+        self.clients = frozenset()
+
+        #: A cache of the entries matched by :func:`Cache`, keyed by
+        #: the group membership signature of the client
+        self.match_cache = Cache(name="xmlsrc",
+                                 max_entries=self.match_cache_size)
+
     def HandleEvent(self, _=None):
         """Read file upon update."""
         try:
@@ -791,6 +941,11 @@ class XMLSrc(XMLFileBacked):
             raise PluginExecutionError(msg)
         self.pnode = self.__node__(xdata, self.items)
         self.cache = None
+        self.match_cache.expire()
+        self.groups = frozenset([el.get("name")
+                                 for el in xdata.iter("Group")])
+        self.clients = frozenset([el.get("name")
+                                  for el in xdata.iter("Client")])
         try:
             self.priority = int(xdata.get('priority'))
         except (ValueError, TypeError):
@@ -802,17 +957,31 @@ class XMLSrc(XMLFileBacked):
 
         del xdata, data
 
+    def _get_match_key(self, metadata):
+        """ Get the key that the entries matched for a client are
+        cached under.  Clients that are members of the same groups
+        named in the file, and that are not themselves named in the
+        file, match the same entries. """
+        groups = frozenset([g for g in self.groups if g in metadata.groups])
+        if metadata.hostname in self.clients:
+            return (groups, metadata.hostname)
+        return (groups, None)
+
     def Cache(self, metadata):
         """Build a package dict for a given host."""
         if self.cache is None or self.cache[0] != metadata:
-            cache = (metadata, self.__cacheobj__())
             if self.pnode is None:
                 LOGGER.error("Cache method called early for %s; "
                              "forcing data load" % self.name)
                 self.HandleEvent()
                 return
-            self.pnode.Match(metadata, cache[1])
-            self.cache = cache
+            key = self._get_match_key(metadata)
+            data = self.match_cache.get(key)
+            if data is None:
+                data = self.__cacheobj__()
+                self.pnode.Match(metadata, data)
+                self.match_cache[key] = data
+            self.cache = (metadata, data)
 
     def __str__(self):
         return str(self.items)
@@ -856,12 +1025,17 @@ class PrioDir(Plugin, Generator, XMLDirectoryBacked):
     def __init__(self, core, datastore):
         Plugin.__init__(self, core, datastore)
         Generator.__init__(self)
+
+        #: A dict of (<tag>, <name>) -> list of the sources that
+        #: contain the entry, sorted by descending priority
+        self.index = {}
         XMLDirectoryBacked.__init__(self, self.data, self.core.fam)
     __init__.__doc__ = Plugin.__init__.__doc__
 
     def HandleEvent(self, event):
         XMLDirectoryBacked.HandleEvent(self, event)
         self.Entries = {}
+        self.index = {}
         for src in list(self.entries.values()):
             for itype, children in list(src.items.items()):
                 for child in children:
@@ -869,8 +1043,50 @@ class PrioDir(Plugin, Generator, XMLDirectoryBacked):
                         self.Entries[itype][child] = self.BindEntry
                     except KeyError:
                         self.Entries[itype] = {child: self.BindEntry}
+        self._update_index()
     HandleEvent.__doc__ = XMLDirectoryBacked.HandleEvent.__doc__
 
+    def _update_index(self):
+        """ Rebuild :attr:`index` from the entries in all sources.
+        This must be called whenever a source changes. """
+        self.index = {}
+        for src in list(self.entries.values()):
+            for itype, children in list(src.items.items()):
+                for child in children:
+                    srcs = self.index.setdefault((itype, child), [])
+                    if src not in srcs:
+                        srcs.append(src)
+        for srcs in self.index.values():
+            srcs.sort(key=lambda s: int(s.priority), reverse=True)
+
+    def _index_key(self, entry):
+        """ Get the key that the sources for the given entry are
+        stored under in :attr:`index`.
+
+        :param entry: The entry to get the key for
+        :type entry: lxml.etree._Element
+        :returns: tuple of (<tag>, <name>)
+        """
+        return (entry.tag, entry.get('name'))
+
+    def _strict_matching(self, entry):  # pylint: disable=W0613
+        """ Whether or not :func:`_matches` does strict matching for
+        the given entry.  If so, the sources for the entry can be
+        looked up by name in :attr:`index`; otherwise every source
+        must be searched.  By default this is true unless
+        :func:`_matches` is overridden.
+
+        :param entry: The entry to find a match for
+        :type entry: lxml.etree._Element
+        :returns: bool
+        """
+        if '_matches' in self.__dict__:
+            return False
+        for cls in self.__class__.__mro__:
+            if '_matches' in cls.__dict__:
+                return cls is PrioDir
+        return False
+
     def _matches(self, entry, metadata, rules):  # pylint: disable=W0613
         """ Whether or not a given entry has a matching entry in this
         PrioDir.  By default this does strict matching (i.e., the
@@ -920,14 +1136,29 @@ class PrioDir(Plugin, Generator, XMLDirectoryBacked):
         :returns: dict of <attr name>:<attr value>
         :raises: :class:`Bcfg2.Server.Plugin.exceptions.PluginExecutionError`
         """
-        for src in self.entries.values():
-            src.Cache(metadata)
-
-        matching = [src for src in list(self.entries.values())
-                    if (src.cache and
-                        entry.tag in src.cache[1] and
-                        self._matches(entry, metadata,
-                                      src.cache[1][entry.tag]))]
+        strict = self._strict_matching(entry)
+        if strict:
+            # only the sources that contain the entry need to be
+            # searched, from the highest priority down to the first
+            # priority that has a match
+            matching = []
+            for src in self.index.get(self._index_key(entry), []):
+                if matching and int(src.priority) < int(matching[0].priority):
+                    break
+                src.Cache(metadata)
+                if (src.cache and
+                    entry.tag in src.cache[1] and
+                    entry.get('name') in src.cache[1][entry.tag]):
+                    matching.append(src)
+        else:
+            for src in self.entries.values():
+                src.Cache(metadata)
+
+            matching = [src for src in list(self.entries.values())
+                        if (src.cache and
+                            entry.tag in src.cache[1] and
+                            self._matches(entry, metadata,
+                                          src.cache[1][entry.tag]))]
         if len(matching) == 0:
             raise PluginExecutionError("No matching source for entry when "
                                        "retrieving attributes for %s(%s)" %
@@ -946,13 +1177,16 @@ class PrioDir(Plugin, Generator, XMLDirectoryBacked):
                 raise PluginExecutionError(msg)
             index = prio.index(max(prio))
 
-        for rname in list(matching[index].cache[1][entry.tag].keys()):
-            if self._matches(entry, metadata, [rname]):
-                data = matching[index].cache[1][entry.tag][rname]
-                break
-        else:
-            # Fall back on __getitem__. Required if override used
+        if strict:
             data = matching[index].cache[1][entry.tag][entry.get('name')]
+        else:
+            for rname in list(matching[index].cache[1][entry.tag].keys()):
+                if self._matches(entry, metadata, [rname]):
+                    data = matching[index].cache[1][entry.tag][rname]
+                    break
+            else:
+                # Fall back on __getitem__. Required if override used
+                data = matching[index].cache[1][entry.tag][entry.get('name')]
         if '__text__' in data:
             entry.text = data['__text__']
         if '__children__' in data:
@@ -1090,6 +1324,85 @@ class SpecificData(object):
             LOGGER.error("Failed to read file %s" % self.name)
 
 
+class _EntryDict(dict):
+    """ A dict of the entries in an
+    :class:`Bcfg2.Server.Plugin.helpers.EntrySet` that keeps a serial
+    number, which is incremented whenever the dict is modified, so
+    that indexes built from the entries can tell when they are
+    stale. """
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.serial = 0
+
+    def __setitem__(self, key, value):
+        self.serial += 1
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self.serial += 1
+        dict.__delitem__(self, key)
+
+    def clear(self):
+        self.serial += 1
+        dict.clear(self)
+
+    def pop(self, *args):
+        self.serial += 1
+        return dict.pop(self, *args)
+
+
+class _SpecificityIndex(object):
+    """ An index of the entries in an
+    :class:`Bcfg2.Server.Plugin.helpers.EntrySet` by specificity,
+    built by :func:`Bcfg2.Server.Plugin.helpers.EntrySet._index_entries`.
+    """
+
+    def __init__(self, ranks, defaults, hosts, groups):
+        #: A dict of ``id(<entry>)`` -> rank, where entries with
+        #: lower ranks are more specific, and equally specific
+        #: entries have the same rank
+        self.ranks = ranks
+
+        #: A list of the entries that apply to all clients
+        self.defaults = defaults
+
+        #: A dict of <hostname> -> list of host-specific entries
+        self.hosts = hosts
+
+        #: A dict of <group> -> list of group-specific entries
+        self.groups = groups
+
+
+class _EntrySetIndex(object):
+    """ The index of the entries in an
+    :class:`Bcfg2.Server.Plugin.helpers.EntrySet` built by
+    :func:`Bcfg2.Server.Plugin.helpers.EntrySet._get_index`. """
+
+    def __init__(self, serial, specificity, cache):
+        #: The serial number of the entries the index was built from
+        self.serial = serial
+
+        #: The :class:`_SpecificityIndex` of the entries
+        self.specificity = specificity
+
+        #: A :class:`Bcfg2.Cache.Cache` of the matching entries,
+        #: keyed by group membership signature
+        self.cache = cache
+
+    def popitem(self):
+        self.serial += 1
+        return dict.popitem(self)
+
+    def setdefault(self, key, default=None):
+        self.serial += 1
+        return dict.setdefault(self, key, default)
+
+    def update(self, *args, **kwargs):
+        self.serial += 1
+        dict.update(self, *args, **kwargs)
+
+
 class EntrySet(Debuggable):
     """ EntrySets deal with a collection of host- and group-specific
     files (e.g., :class:`Bcfg2.Server.Plugin.helpers.SpecificData`
@@ -1111,6 +1424,10 @@ class EntrySet(Debuggable):
     #: considered a plain string and filenames must match exactly.
     basename_is_regex = False
 
+    #: The maximum number of distinct group membership signatures
+    #: whose matching entries are cached
+    match_cache_size = 128
+
     def __init__(self, basename, path, entry_type, encoding):
         """
         :param basename: The filename or regular expression that files
@@ -1155,7 +1472,7 @@ class EntrySet(Debuggable):
         Debuggable.__init__(self, name=basename)
         self.path = path
         self.entry_type = entry_type
-        self.entries = {}
+        self._entries = _EntryDict()
         self.metadata = DEFAULT_FILE_METADATA.copy()
         self.infoxml = None
         self.encoding = encoding
@@ -1175,6 +1492,108 @@ class EntrySet(Debuggable):
         #: be overridden on a per-entry basis in :func:`entry_init`.
         self.specific = re.compile(pattern)
 
+        #: The index built by :func:`_get_index`
+        self._index = None
+
+    def _get_entries(self):
+        """ Get the dict of entries in this EntrySet """
+        return self._entries
+
+    def _set_entries(self, entries):
+        """ Replace the dict of entries in this EntrySet """
+        if not isinstance(entries, _EntryDict):
+            entries = _EntryDict(entries)
+        self._entries = entries
+        self._index = None
+
+    #: A dict of filename -> ``entry_type`` object for all of the
+    #: files in this EntrySet.
+    entries = property(_get_entries, _set_entries)
+
+    def _get_index(self):
+        """ Get an index of the entries in this EntrySet by
+        specificity, which is rebuilt whenever the entries change.
+
+        :returns: :class:`_EntrySetIndex` or None if the entries
+                  cannot be indexed
+        """
+        index = self._index
+        if index is not None and index.serial == self._entries.serial:
+            return index
+
+        specificity = self._index_entries(list(self._entries.values()))
+        if specificity is None:
+            self._index = None
+            return None
+        index = _EntrySetIndex(self._entries.serial, specificity,
+                               Cache(max_entries=self.match_cache_size))
+        self._index = index
+        return index
+
+    def _index_entries(self, entries):
+        """ Index the given entries by specificity.  If any entry
+        does not have a
+        :class:`Bcfg2.Server.Plugin.helpers.Specificity` object, the
+        entries cannot be indexed, and None is returned.
+
+        :param entries: The entries to index
+        :type entries: list of ``entry_type`` objects
+        :returns: :class:`_SpecificityIndex` or None
+        """
+        for entry in entries:
+            if not isinstance(getattr(entry, "specific", None), Specificity):
+                return None
+
+        entries = sorted(entries, key=operator.attrgetter("specific"))
+        ranks = dict()
+        defaults = []
+        hosts = dict()
+        groups = dict()
+        rank = 0
+        for i in range(len(entries)):
+            entry = entries[i]
+            if i and entries[i - 1].specific != entry.specific:
+                rank += 1
+            ranks[id(entry)] = rank
+            if entry.specific.all:
+                defaults.append(entry)
+            if entry.specific.hostname:
+                hosts.setdefault(entry.specific.hostname, []).append(entry)
+            if entry.specific.group:
+                groups.setdefault(entry.specific.group, []).append(entry)
+        return _SpecificityIndex(ranks, defaults, hosts, groups)
+
+    def _get_signature(self, metadata, specificity):
+        """ Get the group membership signature of a client: the
+        groups it is a member of that have group-specific entries in
+        the given :class:`_SpecificityIndex`, and its hostname if it
+        has host-specific entries.  Clients with the same signature
+        match the same entries. """
+        cgroups = frozenset([g for g in metadata.groups
+                             if g in specificity.groups])
+        if metadata.hostname in specificity.hosts:
+            return (cgroups, metadata.hostname)
+        return (cgroups, None)
+
+    def _lookup(self, metadata, specificity):
+        """ Get the entries that match the given client from a
+        :class:`_SpecificityIndex` built by :func:`_index_entries`,
+        sorted from most to least specific. """
+        rv = []
+        seen = set()
+        candidates = list(specificity.hosts.get(metadata.hostname, []))
+        for group in metadata.groups:
+            if group in specificity.groups:
+                candidates.extend(specificity.groups[group])
+        candidates.extend(specificity.defaults)
+        for item in candidates:
+            if id(item) not in seen:
+                seen.add(id(item))
+                rv.append(item)
+        ranks = specificity.ranks
+        rv.sort(key=lambda i: ranks[id(i)])
+        return rv
+
     def get_matching(self, metadata):
         """ Get a list of all entries that apply to the given client.
         This gets all matching entries; for example, there could be an
@@ -1188,8 +1607,34 @@ class EntrySet(Debuggable):
         :returns: list -- all matching ``entry_type`` objects (see the
                   constructor docs for more details)
         """
-        return [item for item in list(self.entries.values())
-                if item.specific.matches(metadata)]
+        index = self._get_index()
+        if index is None:
+            return [item for item in list(self.entries.values())
+                    if item.specific.matches(metadata)]
+
+        key = self._get_signature(metadata, index.specificity)
+        rv = index.cache.get(key)
+        if rv is None:
+            rv = self._lookup(metadata, index.specificity)
+            index.cache[key] = rv
+        return list(rv)
+
+    def _sort_matching(self, matching):
+        """ Sort a list of entries in place from most to least
+        specific.  Entries in this EntrySet are sorted by their
+        precomputed rank; otherwise, their
+        :class:`Bcfg2.Server.Plugin.helpers.Specificity` objects are
+        compared. """
+        index = self._get_index()
+        if index is not None:
+            ranks = index.specificity.ranks
+            for item in matching:
+                if id(item) not in ranks:
+                    break
+            else:
+                matching.sort(key=lambda i: ranks[id(i)])
+                return
+        matching.sort(key=operator.attrgetter("specific"))
 
     def best_matching(self, metadata, matching=None):
         """ Return the single most specific matching entry from the
@@ -1212,7 +1657,7 @@ class EntrySet(Debuggable):
             matching = self.get_matching(metadata)
 
         if matching:
-            matching.sort(key=operator.attrgetter("specific"))
+            self._sort_matching(matching)
             return matching[0]
         else:
             raise PluginExecutionError("No matching entries available for %s "
@@ -280,6 +280,19 @@ class Probing(object):
         """
         raise NotImplementedError
 
+    def load_client_data(self, hostname):
+        """ Reload the probe data stored for the given client.  This
+        is called when the data was received by another server
+        process, e.g., by another child of the
+        :mod:`Bcfg2.Server.MultiprocessingCore`.  The default
+        implementation does nothing.
+
+        :param hostname: The hostname of the client
+        :type hostname: string
+        :return: None
+        """
+        pass
+
 
 class Statistics(Plugin):
     """ Statistics plugins handle statistics for clients.  In general,
@@ -28,8 +28,8 @@ class BundleFile(Bcfg2.Server.Plugin.StructFile):
         """ get the XML data that applies to the given client """
         bundlename = os.path.splitext(os.path.basename(self.name))[0]
         bundle = lxml.etree.Element('Bundle', name=bundlename)
-        for item in self.Match(metadata):
-            bundle.append(copy.copy(item))
+        # Match() returns new copies, so they can be used as-is
+        bundle.extend(self.Match(metadata))
         return bundle
 
 
@@ -3,7 +3,7 @@
 :ref:`server-plugins-generators-cfg` files. """
 
 from Bcfg2.Server.Plugin import PluginExecutionError
-from Bcfg2.Server.Plugins.Cfg import CfgGenerator, SETUP
+from Bcfg2.Server.Plugins.Cfg import CfgGenerator, CfgRenderCache, SETUP
 
 try:
     from Cheetah.Template import Template
@@ -31,15 +31,22 @@ class CfgCheetahGenerator(CfgGenerator):
         CfgGenerator.__init__(self, fname, spec, encoding)
         if not HAS_CHEETAH:
             raise PluginExecutionError("Cheetah is not available")
+        self.render_cache = CfgRenderCache(self.name)
     __init__.__doc__ = CfgGenerator.__init__.__doc__
 
     def get_data(self, entry, metadata):
-        template = Template(self.data.decode(self.encoding),
-                            compilerSettings=self.settings)
-        template.metadata = metadata
-        template.name = entry.get('realname', entry.get('name'))
-        template.path = entry.get('realname', entry.get('name'))
-        template.source_path = self.name
-        template.repo = SETUP['repo']
-        return template.respond()
+        fname = entry.get('realname', entry.get('name'))
+
+        def render(metadata):
+            """ Render the template for the given metadata """
+            template = Template(self.data.decode(self.encoding),
+                                compilerSettings=self.settings)
+            template.metadata = metadata
+            template.name = fname
+            template.path = fname
+            template.source_path = self.name
+            template.repo = SETUP['repo']
+            return template.respond()
+
+        return self.render_cache.render(render, self.data, fname, metadata)
     get_data.__doc__ = CfgGenerator.get_data.__doc__
@@ -6,7 +6,7 @@ import re
 import sys
 import traceback
 from Bcfg2.Server.Plugin import PluginExecutionError
-from Bcfg2.Server.Plugins.Cfg import CfgGenerator, SETUP
+from Bcfg2.Server.Plugins.Cfg import CfgGenerator, CfgRenderCache, SETUP
 
 try:
     import genshi.core
@@ -98,6 +98,7 @@ class CfgGenshiGenerator(CfgGenerator):
             raise PluginExecutionError("Genshi is not available")
         self.template = None
         self.loader = self.__loader_cls__(max_cache_size=0)
+        self.render_cache = CfgRenderCache(self.name)
     __init__.__doc__ = CfgGenerator.__init__.__doc__
 
     def get_data(self, entry, metadata):
@@ -106,18 +107,24 @@ class CfgGenshiGenerator(CfgGenerator):
                                        self.name)
 
         fname = entry.get('realname', entry.get('name'))
-        stream = \
-            self.template.generate(name=fname,
-                                   metadata=metadata,
-                                   path=self.name,
-                                   source_path=self.name,
-                                   repo=SETUP['repo']).filter(removecomment)
-        try:
+
+        def render(metadata):
+            """ Render the template for the given metadata """
+            stream = self.template.generate(
+                name=fname,
+                metadata=metadata,
+                path=self.name,
+                source_path=self.name,
+                repo=SETUP['repo']).filter(removecomment)
             try:
                 return stream.render('text', encoding=self.encoding,
                                      strip_whitespace=False)
             except TypeError:
                 return stream.render('text', encoding=self.encoding)
+
+        try:
+            return self.render_cache.render(render, self.data, fname,
+                                            metadata)
         except UndefinedError:
             # a failure in a genshi expression _other_ than %{ python ... %}
             err = sys.exc_info()[1]
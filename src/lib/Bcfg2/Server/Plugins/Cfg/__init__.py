@@ -4,18 +4,23 @@ import re
 import os
 import sys
 import stat
+import types
 import errno
+import logging
 import operator
 import lxml.etree
 import Bcfg2.Options
 import Bcfg2.Server.Plugin
 import Bcfg2.Server.Lint
+from Bcfg2.Cache import Cache, get_cache
 from Bcfg2.Server.Plugin import PluginExecutionError
 # pylint: disable=W0622
 from Bcfg2.Compat import u_str, unicode, b64encode, walk_packages, \
-    any, oct_mode
+    any, oct_mode, long
 # pylint: enable=W0622
 
+LOGGER = logging.getLogger(__name__)
+
 #: SETUP contains a reference to the
 #: :class:`Bcfg2.Options.OptionParser` created by the Bcfg2 core for
 #: parsing command-line and config file options.
@@ -35,6 +40,13 @@ SETUP = None
 #: facility for passing it otherwise.
 CFG = None
 
+#: RENDER_CACHE is the :class:`Bcfg2.Cache.Cache` that holds the
+#: output of Cfg templates, shared by all
+#: :class:`Bcfg2.Server.Plugins.Cfg.CfgRenderCache` objects.  It is
+#: created by :class:`Bcfg2.Server.Plugins.Cfg.Cfg` if the render
+#: cache is enabled, and is None otherwise.
+RENDER_CACHE = None
+
 
 class CfgBaseFileMatcher(Bcfg2.Server.Plugin.SpecificData,
                          Bcfg2.Server.Plugin.Debuggable):
@@ -200,6 +212,310 @@ class CfgGenerator(CfgBaseFileMatcher):
         return self.data
 
 
+class _Unrecordable(Exception):
+    """ Raised when a value read by a template cannot be recorded as a
+    dependency of its output """
+    pass
+
+
+def _fingerprint(value):
+    """ Get a hashable representation of a value read from client
+    metadata, which compares equal for values that render the same.
+
+    :raises: :exc:`_Unrecordable` if the value has no such
+             representation
+    """
+    if value is None or isinstance(value, (str, unicode, int, long, float)):
+        return value
+    elif isinstance(value, (set, frozenset)):
+        return frozenset([_fingerprint(v) for v in value])
+    elif isinstance(value, (list, tuple)):
+        return (value.__class__.__name__,
+                tuple([_fingerprint(v) for v in value]))
+    elif isinstance(value, dict):
+        return ('dict', frozenset([(_fingerprint(k), _fingerprint(v))
+                                   for k, v in value.items()]))
+    elif lxml.etree.iselement(value):
+        return ('xml', lxml.etree.tostring(value))
+    elif isinstance(value, Bcfg2.Server.Plugin.FileBacked):
+        # e.g., Properties files, which only depend on their contents
+        return ('file', value.name, value.data)
+    raise _Unrecordable(value)
+
+
+class _AccessLog(object):
+    """ The values read from client metadata while a template was
+    rendered, as a list of (<path>, <fingerprint>) tuples.  A path is
+    a tuple of steps from the metadata object to the value; see
+    :func:`_evaluate_path`. """
+
+    def __init__(self):
+        self.accesses = []
+        self.paths = set()
+
+        #: Whether or not everything the template read could be
+        #: recorded
+        self.recordable = True
+
+    def record(self, path, value):
+        """ Record that the value at the given path was read """
+        if path in self.paths:
+            return
+        try:
+            fingerprint = _fingerprint(value)
+            hash(path)
+        except (_Unrecordable, TypeError):
+            self.recordable = False
+            return
+        self.paths.add(path)
+        self.accesses.append((path, fingerprint))
+
+
+def _evaluate_path(metadata, path):
+    """ Get the fingerprint of the value at the given path from client
+    metadata.  Each step of a path is one of:
+
+    * ``('attr', <name>)``: get an attribute
+    * ``('getitem', <key>)``: get an item
+    * ``('contains', <item>)``: test for membership
+    * ``('call', <args>)``: call the object with the given args
+    * ``('read', )``: use the whole object
+
+    Exceptions raised while following the path are part of its
+    value. """
+    obj = metadata
+    try:
+        for step in path:
+            if step[0] == 'attr':
+                obj = getattr(obj, step[1])
+            elif step[0] == 'getitem':
+                obj = obj[step[1]]
+            elif step[0] == 'contains':
+                obj = step[1] in obj
+            elif step[0] == 'call':
+                obj = obj(*step[1])
+    except Exception:  # pylint: disable=W0703
+        obj = ('raise', sys.exc_info()[0].__name__)
+    try:
+        return _fingerprint(obj)
+    except _Unrecordable:
+        # a value that cannot match anything that was recorded
+        return object()
+
+
+class MetadataRecorder(object):
+    """ A proxy for client metadata (or any value read from it) that
+    records every value a template reads in an :class:`_AccessLog`,
+    so that the template's output can be reused for other clients
+    whose metadata has the same values.  Dicts and sets are proxied in
+    turn, so a template that only checks ``"foo" in metadata.groups``
+    only depends on whether the client is in group ``foo``; any other
+    use of a proxied object depends on the whole object. """
+
+    def __init__(self, obj, path, log):
+        self._recorder_obj = obj
+        self._recorder_path = path
+        self._recorder_log = log
+
+    def _recorder_wrap(self, path, value):
+        """ Return a value read from the proxied object, recording it
+        or proxying it as appropriate """
+        if isinstance(value, (dict, set, frozenset)):
+            return MetadataRecorder(value, path, self._recorder_log)
+        elif isinstance(value, (types.FunctionType, types.MethodType,
+                                types.BuiltinFunctionType)):
+            log = self._recorder_log
+
+            def recorded_call(*args, **kwargs):
+                """ Call the function and record the result """
+                try:
+                    rv = value(*args, **kwargs)
+                except:
+                    log.recordable = False
+                    raise
+                if kwargs:
+                    log.recordable = False
+                else:
+                    log.record(path + (('call', args),), rv)
+                return rv
+            return recorded_call
+        self._recorder_log.record(path, value)
+        return value
+
+    def _recorder_read(self):
+        """ Record that the whole proxied object was read and return
+        it """
+        self._recorder_log.record(self._recorder_path + (('read',),),
+                                  self._recorder_obj)
+        return self._recorder_obj
+
+    def __getattr__(self, name):
+        if name.startswith("_recorder_"):
+            # not yet initialized, e.g., while being copied
+            raise AttributeError(name)
+        path = self._recorder_path + (('attr', name),)
+        try:
+            value = getattr(self._recorder_obj, name)
+        except AttributeError:
+            self._recorder_log.record(path, ('raise', 'AttributeError'))
+            raise
+        return self._recorder_wrap(path, value)
+
+    def __getitem__(self, key):
+        path = self._recorder_path + (('getitem', key),)
+        try:
+            value = self._recorder_obj[key]
+        except (KeyError, IndexError, TypeError):
+            self._recorder_log.record(path,
+                                      ('raise', sys.exc_info()[0].__name__))
+            raise
+        return self._recorder_wrap(path, value)
+
+    def __contains__(self, item):
+        rv = item in self._recorder_obj
+        self._recorder_log.record(self._recorder_path +
+                                  (('contains', item),), rv)
+        return rv
+
+    def __iter__(self):
+        return iter(self._recorder_read())
+
+    def __len__(self):
+        return len(self._recorder_read())
+
+    def __nonzero__(self):
+        return bool(self._recorder_read())
+    __bool__ = __nonzero__
+
+    def __str__(self):
+        return str(self._recorder_read())
+
+    def __repr__(self):
+        return repr(self._recorder_read())
+
+
+def _recorder_delegate(name):
+    """ Create a method of :class:`MetadataRecorder` that reads the
+    whole proxied object and calls its method of the same name """
+    def inner(self, *args):
+        return getattr(self._recorder_read(), name)(*args)
+    inner.__name__ = name
+    return inner
+
+for _method in ['__and__', '__rand__', '__or__', '__ror__', '__sub__',
+                '__rsub__', '__xor__', '__rxor__', '__eq__', '__ne__',
+                '__lt__', '__le__', '__gt__', '__ge__', '__cmp__']:
+    setattr(MetadataRecorder, _method, _recorder_delegate(_method))
+del _method
+
+
+class CfgRenderCache(object):
+    """ Cache the output of a Cfg template, so that it is only
+    rendered once for all clients whose metadata is the same as far
+    as the template is concerned.
+
+    The first time a template is rendered for a client, it is given a
+    :class:`MetadataRecorder` in place of the client metadata, which
+    records every value the template reads.  The output is stored in
+    :attr:`RENDER_CACHE`, keyed by the template's mtime and the values
+    it read.  For subsequent clients, the same values are looked up
+    in their metadata, and if a cached output exists for them, it is
+    used instead of rendering the template.
+
+    Templates that read anything that cannot be recorded (e.g.,
+    ``metadata.query``) are not cached, nor are templates that contain
+    the string :attr:`nocache`, which should be used in templates
+    that produce different output for the same metadata (e.g., that
+    read other files or the time). """
+
+    #: Templates that contain this string are never cached
+    nocache = "bcfg2:nocache"
+
+    #: The maximum number of distinct sets of values read by a single
+    #: template that are looked up for each client
+    max_paths = 32
+
+    def __init__(self, name):
+        """
+        :param name: The full path to the template
+        :type name: string
+        """
+        self.name = name
+        self.mtime = None
+
+        #: The data of the template when it was last checked; the
+        #: cache is reset when this changes
+        self.source = None
+
+        #: Whether or not the output of the template can be cached
+        self.enabled = True
+
+        #: A list of the distinct tuples of paths that the template
+        #: has read
+        self.paths = []
+
+    def reset(self, data):
+        """ Reset the cache after the template has changed """
+        self.source = data
+        self.paths = []
+        try:
+            self.mtime = os.stat(self.name).st_mtime
+        except OSError:
+            self.mtime = None
+        try:
+            self.enabled = self.nocache not in data
+        except TypeError:
+            # data is bytes, not text
+            self.enabled = self.nocache.encode() not in data
+        if RENDER_CACHE is not None:
+            RENDER_CACHE.expire_dependents(self.name)
+
+    def render(self, render, data, fname, metadata):
+        """ Get the output of the template for the given client,
+        either from the cache or by rendering it.
+
+        :param render: A function that renders the template for the
+                       metadata object it is called with
+        :type render: callable
+        :param data: The current data of the template
+        :type data: string
+        :param fname: The name of the entry being rendered
+        :type fname: string
+        :param metadata: The client metadata to render the template for
+        :type metadata: Bcfg2.Server.Plugins.Metadata.ClientMetadata
+        :returns: The output of ``render``
+        """
+        if data is not self.source:
+            self.reset(data)
+        cache = RENDER_CACHE
+        if cache is None or not self.enabled:
+            return render(metadata)
+
+        for paths in self.paths:
+            values = tuple([_evaluate_path(metadata, p) for p in paths])
+            rv = cache.get((self.name, self.mtime, fname, paths, values))
+            if rv is not None:
+                return rv
+
+        log = _AccessLog()
+        rv = render(MetadataRecorder(metadata, (), log))
+        if not log.recordable:
+            LOGGER.debug("Cfg: Not caching output of %s, which reads "
+                         "values that cannot be recorded" % self.name)
+            self.enabled = False
+            return rv
+        paths = tuple([a[0] for a in log.accesses])
+        values = tuple([a[1] for a in log.accesses])
+        if paths not in self.paths:
+            self.paths.append(paths)
+            if len(self.paths) > self.max_paths:
+                self.paths.pop(0)
+        key = (self.name, self.mtime, fname, paths, values)
+        cache.add_dependency(key, self.name)
+        cache[key] = rv
+        return rv
+
+
 class CfgFilter(CfgBaseFileMatcher):
     """ CfgFilters modify the initial content of a file after it has
     been generated by a :class:`Bcfg2.Server.Plugins.Cfg.CfgGenerator`. """
@@ -449,6 +765,39 @@ class CfgDefaultInfo(CfgInfo):
 DEFAULT_INFO = CfgDefaultInfo(Bcfg2.Server.Plugin.DEFAULT_FILE_METADATA)
 
 
+class _HandlerIndex(object):
+    """ The index of the handlers in a :class:`CfgEntrySet` built by
+    :func:`CfgEntrySet._get_handler_index`. """
+
+    def __init__(self, serial, nonspecific, specific, specificity, cache):
+        #: The serial number of the entries the index was built from
+        self.serial = serial
+
+        #: A list of the non-specific handlers
+        self.nonspecific = nonspecific
+
+        #: A list of the specific handlers
+        self.specific = specific
+
+        #: The index of the specific handlers by specificity, as
+        #: returned by
+        #: :func:`Bcfg2.Server.Plugin.helpers.EntrySet._index_entries`.
+        #: It is used to get the group membership signatures of
+        #: clients and to sort handlers.
+        self.specificity = specificity
+
+        #: A dict of <handler type> -> (<list of non-specific
+        #: handlers of that type>, <index of the specific handlers of
+        #: that type by specificity>), filled in as handler types are
+        #: requested
+        self.by_type = dict()
+
+        #: A :class:`Bcfg2.Cache.Cache` of the handlers returned by
+        #: :func:`CfgEntrySet.get_handlers`, keyed by handler type
+        #: and group membership signature
+        self.cache = cache
+
+
 class CfgEntrySet(Bcfg2.Server.Plugin.EntrySet,
                   Bcfg2.Server.Plugin.Debuggable):
     """ Handle a collection of host- and group-specific Cfg files with
@@ -460,6 +809,9 @@ class CfgEntrySet(Bcfg2.Server.Plugin.EntrySet,
         Bcfg2.Server.Plugin.Debuggable.__init__(self)
         self.specific = None
         self._handlers = None
+
+        #: The index built by :func:`_get_handler_index`
+        self._handler_index = None
     __init__.__doc__ = Bcfg2.Server.Plugin.EntrySet.__doc__
 
     def set_debug(self, debug):
@@ -635,12 +987,69 @@ class CfgEntrySet(Bcfg2.Server.Plugin.EntrySet,
         :type handler_type: type
         :returns: list of Cfg handler classes
         """
-        rv = []
+        index = self._get_handler_index()
+        if index is None:
+            rv = []
+            for ent in self.entries.values():
+                if (isinstance(ent, handler_type) and
+                    (not ent.__specific__ or ent.specific.matches(metadata))):
+                    rv.append(ent)
+            return rv
+
+        key = (handler_type,
+               self._get_signature(metadata, index.specificity))
+        rv = index.cache.get(key)
+        if rv is None:
+            if handler_type not in index.by_type:
+                index.by_type[handler_type] = \
+                    ([ent for ent in index.nonspecific
+                      if isinstance(ent, handler_type)],
+                     self._index_entries([ent for ent in index.specific
+                                          if isinstance(ent, handler_type)]))
+            nonspecific, specificity = index.by_type[handler_type]
+            rv = nonspecific + self._lookup(metadata, specificity)
+            index.cache[key] = rv
+        return list(rv)
+
+    def _get_handler_index(self):
+        """ Get an index of the handlers in this CfgEntrySet, which is
+        rebuilt whenever the handlers change.
+
+        :returns: :class:`_HandlerIndex` or None if the handlers
+                  cannot be indexed
+        """
+        index = self._handler_index
+        if index is not None and index.serial == self.entries.serial:
+            return index
+
+        nonspecific = []
+        specific = []
         for ent in self.entries.values():
-            if (isinstance(ent, handler_type) and
-                (not ent.__specific__ or ent.specific.matches(metadata))):
-                rv.append(ent)
-        return rv
+            if ent.__specific__:
+                specific.append(ent)
+            else:
+                nonspecific.append(ent)
+        specificity = self._index_entries(specific)
+        if specificity is None:
+            self._handler_index = None
+            return None
+        index = _HandlerIndex(self.entries.serial, nonspecific, specific,
+                              specificity,
+                              Cache(max_entries=self.match_cache_size))
+        self._handler_index = index
+        return index
+
+    def _sort_matching(self, matching):
+        index = self._get_handler_index()
+        if index is not None:
+            ranks = index.specificity.ranks
+            for item in matching:
+                if id(item) not in ranks:
+                    break
+            else:
+                matching.sort(key=lambda i: ranks[id(i)])
+                return
+        Bcfg2.Server.Plugin.EntrySet._sort_matching(self, matching)
 
     def bind_info_to_entry(self, entry, metadata):
         """ Bind entry metadata to the entry with the best CfgInfo
@@ -842,6 +1251,13 @@ class Cfg(Bcfg2.Server.Plugin.GroupSpool,
         if 'validate' not in SETUP:
             SETUP.add_option('validate', Bcfg2.Options.CFG_VALIDATION)
             SETUP.reparse()
+
+        global RENDER_CACHE  # pylint: disable=W0603
+        if SETUP.cfp.getboolean("cfg", "render_cache", default=False):
+            RENDER_CACHE = get_cache("cfg_render", SETUP.cfp,
+                                     max_bytes=64 * 1024 * 1024)
+        else:
+            RENDER_CACHE = None
     __init__.__doc__ = Bcfg2.Server.Plugin.GroupSpool.__init__.__doc__
 
     def has_generator(self, entry, metadata):
@@ -3,6 +3,7 @@
 import lxml.etree
 
 import Bcfg2.Server.Plugin
+from Bcfg2.Cache import get_cache
 
 
 class DNode(Bcfg2.Server.Plugin.INode):
@@ -37,12 +38,15 @@ class Deps(Bcfg2.Server.Plugin.PrioDir,
     sort_order = 750
 
     def __init__(self, core, datastore):
+        # a cache of (<entries>, <groups>) -> <prerequisites>.  its
+        # limits are set by the deps_* options in the [caching]
+        # section of bcfg2.conf.
+        self.cache = get_cache("deps", core.setup.cfp, max_entries=10000)
         Bcfg2.Server.Plugin.PrioDir.__init__(self, core, datastore)
         Bcfg2.Server.Plugin.StructureValidator.__init__(self)
-        self.cache = {}
 
     def HandleEvent(self, event):
-        self.cache = {}
+        self.cache.expire()
         Bcfg2.Server.Plugin.PrioDir.HandleEvent(self, event)
 
     def validate_structures(self, metadata, structures):
@@ -65,9 +69,8 @@ class Deps(Bcfg2.Server.Plugin.PrioDir,
         gdata = tuple(gdata)
 
         # Check to see if we have cached the prereqs already
-        if (entries, gdata) in self.cache:
-            prereqs = self.cache[(entries, gdata)]
-        else:
+        prereqs = self.cache.get((entries, gdata))
+        if prereqs is None:
             prereqs = self.calculate_prereqs(metadata, entries)
             self.cache[(entries, gdata)] = prereqs
 
@@ -102,9 +102,15 @@ class PatternFile(Bcfg2.Server.Plugin.XMLFileBacked):
 
     def Index(self):
         Bcfg2.Server.Plugin.XMLFileBacked.Index(self)
+        # get the groups that the old patterns assign to each client
+        # with cached metadata, so that we can only expire the
+        # clients whose groups have changed
+        cached = dict()
         if (self.core and
             self.core.metadata_cache_mode in ['cautious', 'aggressive']):
-            self.core.metadata_cache.expire()
+            for key, metadata in list(self.core.metadata_cache.items()):
+                cached[key] = (metadata.hostname,
+                               self.process_patterns(metadata.hostname))
         self.patterns = []
         for entry in self.xdata.xpath('//GroupPattern'):
             try:
@@ -119,6 +125,9 @@ class PatternFile(Bcfg2.Server.Plugin.XMLFileBacked):
                 self.logger.error("GroupPatterns: Failed to initialize "
                                   "pattern %s: %s" % (entry.text,
                                                       sys.exc_info()[1]))
+        for key, (hostname, groups) in cached.items():
+            if self.process_patterns(hostname) != groups:
+                self.core.metadata_cache.expire(key)
 
     def process_patterns(self, hostname):
         """ return a list of groups that should be added to the given
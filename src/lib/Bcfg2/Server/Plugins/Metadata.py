@@ -8,18 +8,22 @@ import time
 import copy
 import errno
 import fcntl
+import heapq
 import socket
 import logging
+import threading
+import weakref
 import lxml.etree
 import Bcfg2.Server
 import Bcfg2.Server.Lint
 import Bcfg2.Server.Plugin
 import Bcfg2.Server.FileMonitor
-from Bcfg2.Compat import MutableMapping, all, wraps  # pylint: disable=W0622
+from Bcfg2.Compat import MutableMapping, wraps
 from Bcfg2.version import Bcfg2VersionInfo
 
 try:
-    from django.db import models
+    from django.db import models, transaction, DatabaseError
+    from django.db.models import F
     HAS_DJANGO = True
 except ImportError:
     HAS_DJANGO = False
@@ -43,54 +47,434 @@ if HAS_DJANGO:
         hostname = models.CharField(max_length=255, primary_key=True)
         version = models.CharField(max_length=31, null=True)
 
+    class MetadataGenerationModel(models.Model,
+                                  Bcfg2.Server.Plugin.PluginDatabaseModel):
+        """ django model for a counter that is incremented whenever
+        client records are changed, so that server processes that
+        share the database know when to reload them """
+        name = models.CharField(max_length=31, primary_key=True)
+        generation = models.IntegerField(default=0)
+
     class ClientVersions(MutableMapping,
                          Bcfg2.Server.Plugin.DatabaseBacked):
         """ dict-like object to make it easier to access client bcfg2
-        versions from the database """
+        versions from the database.
+
+        All client records are loaded into memory at once, and reads
+        are served from memory.  If :attr:`write_behind` is set,
+        changes are kept in memory until :func:`flush` writes them in
+        a single transaction; otherwise they are written immediately.
+        Every write increments a generation counter in the database,
+        and the in-memory copy is reloaded when another process has
+        changed it, which is checked at most once every
+        :attr:`check_interval` seconds. """
+
+        #: The name of the generation counter in
+        #: :class:`MetadataGenerationModel`
+        generation_name = "versions"
+
+        #: The number of clients to write in a single query
+        batch_size = 500
+
+        def __init__(self, core, datastore):
+            Bcfg2.Server.Plugin.DatabaseBacked.__init__(self, core,
+                                                        datastore)
+            #: How often, in seconds, to check whether another
+            #: process has changed client records
+            self.check_interval = 10.0
+
+            #: Whether changes are written by :func:`flush` rather
+            #: than immediately
+            self.write_behind = False
+
+            #: dict of hostname -> version of all clients
+            self.versions = dict()
 
-        def __getitem__(self, key):
+            #: dict of hostname -> version of changes that have not
+            #: yet been written to the database
+            self.dirty = dict()
+
+            self.generation = None
+            self.checked = 0
+            self.lock = threading.RLock()
+            self.load()
+
+        def _get_generation(self):
+            """ Get the current generation counter from the database,
+            or None if it cannot be read """
             try:
-                return MetadataClientModel.objects.get(hostname=key).version
-            except MetadataClientModel.DoesNotExist:
-                raise KeyError(key)
+                return MetadataGenerationModel.objects.get(
+                    name=self.generation_name).generation
+            except MetadataGenerationModel.DoesNotExist:
+                return 0
+            except DatabaseError:
+                return None
 
         @Bcfg2.Server.Plugin.DatabaseBacked.get_db_lock
-        def __setitem__(self, key, value):
-            client, created = \
-                MetadataClientModel.objects.get_or_create(hostname=key)
-            if created or client.version != value:
-                client.version = value
-                client.save()
+        def _bump_generation(self):
+            """ Increment the generation counter in the database, and
+            remember the new generation unless another process has
+            changed it too """
+            old = self._get_generation()
+            try:
+                if not MetadataGenerationModel.objects.filter(
+                        name=self.generation_name).update(
+                        generation=F('generation') + 1):
+                    MetadataGenerationModel.objects.create(
+                        name=self.generation_name, generation=1)
+            except DatabaseError:
+                self.logger.warning("Metadata: Failed to update client "
+                                    "generation counter, other server "
+                                    "processes may not see changes: %s "
+                                    "(try running bcfg2-admin syncdb)" %
+                                    sys.exc_info()[1])
+                return
+            new = self._get_generation()
+            self.lock.acquire()
+            try:
+                if old is not None and old == self.generation:
+                    self.generation = new
+                else:
+                    # someone else changed the records in the
+                    # meantime, so reload at the next check
+                    self.generation = None
+                    self.checked = 0
+            finally:
+                self.lock.release()
+
+        def load(self):
+            """ Load all client records from the database """
+            generation = self._get_generation()
+            versions = dict()
+            for hostname, version in \
+                    MetadataClientModel.objects.values_list("hostname",
+                                                            "version"):
+                versions[hostname] = version
+            self.lock.acquire()
+            try:
+                versions.update(self.dirty)
+                self.versions = versions
+                self.generation = generation
+                self.checked = time.time()
+            finally:
+                self.lock.release()
+
+        def _check(self):
+            """ Reload client records if another process has changed
+            them since they were loaded """
+            now = time.time()
+            self.lock.acquire()
+            try:
+                if now - self.checked < self.check_interval:
+                    return
+                self.checked = now
+            finally:
+                self.lock.release()
+            generation = self._get_generation()
+            if generation is None or generation != self.generation:
+                self.load()
 
         @Bcfg2.Server.Plugin.DatabaseBacked.get_db_lock
+        @transaction.commit_on_success
+        def _write(self, changes):
+            """ Write the given dict of hostname -> version to the
+            database in a single transaction """
+            hostnames = list(changes.keys())
+            existing = set()
+            for i in range(0, len(hostnames), self.batch_size):
+                existing.update(MetadataClientModel.objects.filter(
+                    hostname__in=hostnames[i:i + self.batch_size]
+                ).values_list("hostname", flat=True))
+            by_version = dict()
+            for hostname, version in changes.items():
+                if hostname in existing:
+                    by_version.setdefault(version, []).append(hostname)
+                else:
+                    MetadataClientModel.objects.create(hostname=hostname,
+                                                       version=version)
+            for version, clients in by_version.items():
+                for i in range(0, len(clients), self.batch_size):
+                    MetadataClientModel.objects.filter(
+                        hostname__in=clients[i:i + self.batch_size]
+                    ).update(version=version)
+
+        def flush(self):
+            """ Write all pending changes to the database """
+            self.lock.acquire()
+            try:
+                changes = self.dirty
+                self.dirty = dict()
+            finally:
+                self.lock.release()
+            if not changes:
+                return
+            try:
+                self._write(changes)
+            except:
+                # keep the changes that have not been superseded, so
+                # they are written at the next flush
+                self.lock.acquire()
+                try:
+                    for hostname, version in changes.items():
+                        if hostname not in self.dirty:
+                            self.dirty[hostname] = version
+                finally:
+                    self.lock.release()
+                raise
+            self._bump_generation()
+
+        def add(self, hostname):
+            """ Record that a client was added to the database by
+            someone other than this object """
+            self.lock.acquire()
+            try:
+                if hostname not in self.versions:
+                    self.versions[hostname] = None
+            finally:
+                self.lock.release()
+            self._bump_generation()
+
+        def discard(self, hostname):
+            """ Record that a client was removed from the database by
+            someone other than this object """
+            self.lock.acquire()
+            try:
+                self.versions.pop(hostname, None)
+                self.dirty.pop(hostname, None)
+            finally:
+                self.lock.release()
+            self._bump_generation()
+
+        def __getitem__(self, key):
+            self._check()
+            return self.versions[key]
+
+        def __setitem__(self, key, value):
+            self._check()
+            self.lock.acquire()
+            try:
+                if key in self.versions and self.versions[key] == value:
+                    return
+                self.versions[key] = value
+                self.dirty[key] = value
+            finally:
+                self.lock.release()
+            if not self.write_behind:
+                self.flush()
+
         def __delitem__(self, key):
             # UserDict didn't require __delitem__, but MutableMapping
             # does.  we don't want deleting a client version record to
             # delete the client, so we just set the version to None,
             # which is kinda like deleting it, but not really.
-            try:
-                client = MetadataClientModel.objects.get(hostname=key)
-            except MetadataClientModel.DoesNotExist:
+            if key not in self:
                 raise KeyError(key)
-            client.version = None
-            client.save()
+            self[key] = None
 
         def __len__(self):
-            return MetadataClientModel.objects.count()
+            self._check()
+            return len(self.versions)
 
         def __iter__(self):
-            for client in MetadataClientModel.objects.all():
-                yield client.hostname
+            return iter(self.keys())
 
         def keys(self):
-            return [c.hostname for c in MetadataClientModel.objects.all()]
+            self._check()
+            return list(self.versions.keys())
 
         def __contains__(self, key):
+            self._check()
+            return key in self.versions
+
+
+class MetadataJournal(object):
+    """ An append-only journal of changes to a metadata file (i.e.,
+    ``clients.xml``) that have not yet been written to the file.
+
+    Each change is applied to the in-memory data of the
+    :class:`XMLMetadataConfig` object immediately, and recorded as a
+    single line of XML in ``<file>.journal``.  :func:`flush` then
+    applies every journaled change to the file itself in a single
+    write, and empties the journal.  If the server exits before the
+    journal is flushed, the journal is replayed whenever the file is
+    loaded, and written out at the next flush.
+
+    The journal is locked with :func:`fcntl.lockf` as well as a thread
+    lock, so processes that share a repository (e.g., the children of
+    the multiprocessing core) can share a journal. """
+
+    def __init__(self, config):
+        """
+        :param config: The metadata file to journal changes to
+        :type config: XMLMetadataConfig
+        """
+        self.config = config
+        self.path = os.path.join(config.basedir, "%s.journal" %
+                                 config.basefile)
+        self.logger = config.logger
+        self.lock = threading.Lock()
+
+    def _acquire(self):
+        """ Acquire the thread lock and the file lock on the journal,
+        and return the open journal file """
+        self.lock.acquire()
+        try:
+            jfile = open(self.path, "a+")
+        except IOError:
+            self.lock.release()
+            err = sys.exc_info()[1]
+            msg = "Metadata: Failed to open %s: %s" % (self.path, err)
+            self.logger.error(msg)
+            raise Bcfg2.Server.Plugin.MetadataRuntimeError(msg)
+        fcntl.lockf(jfile.fileno(), fcntl.LOCK_EX)
+        return jfile
+
+    def _release(self, jfile):
+        """ Release the locks acquired by :func:`_acquire` """
+        try:
+            jfile.close()
+        finally:
+            self.lock.release()
+
+    def _read(self, jfile):
+        """ Read all records from the open journal file """
+        rv = []
+        jfile.seek(0)
+        for line in jfile.readlines():
+            line = line.strip()
+            if not line:
+                continue
             try:
-                MetadataClientModel.objects.get(hostname=key)
-                return True
-            except MetadataClientModel.DoesNotExist:
-                return False
+                rv.append(lxml.etree.XML(line, parser=Bcfg2.Server.XMLParser))
+            except lxml.etree.XMLSyntaxError:
+                # most likely a partial record written by a server
+                # that crashed
+                self.logger.warning("Metadata: Ignoring malformed record in "
+                                    "%s: %s" % (self.path, line))
+        return rv
+
+    def read(self):
+        """ Get all records in the journal.
+
+        :returns: list of lxml.etree._Element objects
+        """
+        jfile = self._acquire()
+        try:
+            return self._read(jfile)
+        finally:
+            self._release(jfile)
+
+    def apply(self, record, trees):
+        """ Apply a journal record to the first of the given XML
+        trees that contains the element it changes.  New elements
+        are added to the first tree.
+
+        :param record: The record to apply
+        :type record: lxml.etree._Element
+        :param trees: The trees to apply the record to
+        :type trees: list of lxml.etree._ElementTree
+        :returns: The tree that was changed, or None
+        """
+        element = record[0]
+        xpath = './/%s[@name="%s"]' % (element.tag, element.get("name"))
+        for tree in trees:
+            nodes = tree.xpath(xpath)
+            if not nodes:
+                continue
+            if record.tag == "Update":
+                for key, val in element.attrib.items():
+                    nodes[0].set(key, val)
+            elif record.tag == "Remove":
+                nodes[0].getparent().remove(nodes[0])
+            else:
+                # already added
+                return None
+            return tree
+        if record.tag == "Add":
+            trees[0].getroot().append(copy.deepcopy(element))
+            return trees[0]
+        return None
+
+    def record(self, action, element):
+        """ Journal a change, and apply it to the in-memory data.
+
+        :param action: The change to make: ``Add``, ``Update``, or
+                       ``Remove``
+        :type action: string
+        :param element: An element with the tag and name of the
+                        element to change.  For ``Add`` and
+                        ``Update``, its attributes are set on the
+                        element in the file.
+        :type element: lxml.etree._Element
+        """
+        record = lxml.etree.Element(action)
+        record.append(copy.deepcopy(element))
+        line = lxml.etree.tostring(record,
+                                   xml_declaration=False).decode('UTF-8')
+        jfile = self._acquire()
+        try:
+            jfile.write(line + "\n")
+            jfile.flush()
+            os.fsync(jfile.fileno())
+            self._apply_in_memory([record])
+        finally:
+            self._release(jfile)
+
+    def _apply_in_memory(self, records):
+        """ Apply records to the base data and the XIncluded data of
+        the journaled file """
+        for record in records:
+            if self.config.basedata is not None:
+                self.apply(record, [self.config.basedata])
+            if (self.config.data is not None and
+                self.config.data is not self.config.basedata):
+                self.apply(record, [self.config.data])
+
+    def replay(self):
+        """ Apply all journaled changes to the in-memory data.  This
+        is called whenever the journaled file is loaded. """
+        records = self.read()
+        if records:
+            self.logger.info("Metadata: Replaying %s changes from %s" %
+                             (len(records), self.path))
+            self._apply_in_memory(records)
+
+    def flush(self):
+        """ Write all journaled changes to the journaled file and
+        any files it XIncludes, and empty the journal.  Each file is
+        written at most once.  If the changes cannot be written, they
+        are kept in the journal. """
+        jfile = self._acquire()
+        try:
+            records = self._read(jfile)
+            if not records:
+                return
+            fnames = [os.path.join(self.config.basedir,
+                                   self.config.basefile)]
+            fnames.extend(self.config.extras)
+            trees = []
+            for fname in fnames:
+                try:
+                    trees.append(lxml.etree.parse(
+                        fname, parser=Bcfg2.Server.XMLParser))
+                except (IOError, lxml.etree.XMLSyntaxError):
+                    err = sys.exc_info()[1]
+                    self.logger.error("Metadata: Failed to parse %s, not "
+                                      "flushing %s: %s" % (fname, self.path,
+                                                           err))
+                    return
+            changed = set()
+            for record in records:
+                tree = self.apply(record, trees)
+                if tree is not None:
+                    changed.add(trees.index(tree))
+            for idx in sorted(changed):
+                self.config.write_xml(fnames[idx], trees[idx])
+            jfile.truncate(0)
+            self.logger.info("Metadata: Wrote %s changes from %s" %
+                             (len(records), self.path))
+        finally:
+            self._release(jfile)
 
 
 class XMLMetadataConfig(Bcfg2.Server.Plugin.XMLFileBacked):
@@ -115,6 +499,17 @@ class XMLMetadataConfig(Bcfg2.Server.Plugin.XMLFileBacked):
         self.pseudo_monitor = isinstance(metadata.core.fam,
                                          Bcfg2.Server.FileMonitor.Pseudo)
 
+        #: A :class:`MetadataJournal` that changes to this file are
+        #: recorded in, or None if changes are written to the file
+        #: immediately
+        self.journal = None
+
+        #: A dict of <filename> -> stamp of the last version of each
+        #: file that was written by the server itself, so that events
+        #: caused by those writes can be ignored.  See
+        #: :func:`get_stamp`.
+        self.written = dict()
+
     def _get_xdata(self):
         """ getter for xdata property """
         if not self.data:
@@ -147,23 +542,40 @@ class XMLMetadataConfig(Bcfg2.Server.Plugin.XMLFileBacked):
             self.logger.error('Failed to parse %s' % self.basefile)
             return
         self.extras = []
-        self.basedata = copy.deepcopy(xdata)
         self._follow_xincludes(xdata=xdata)
         if self.extras:
+            self.basedata = copy.deepcopy(xdata)
             try:
                 xdata.xinclude()
             except lxml.etree.XIncludeError:
                 self.logger.error("Failed to process XInclude for file %s" %
                                   self.basefile)
+        else:
+            # without XIncludes, the base data and the full data are
+            # the same, so don't keep two copies of them
+            self.basedata = xdata
         self.data = xdata
+        if self.journal is not None:
+            self.journal.replay()
 
     def write(self):
         """Write changes to xml back to disk."""
         self.write_xml(os.path.join(self.basedir, self.basefile),
                        self.basedata)
 
+    def get_stamp(self, fname):
+        """ Get a stamp of the current version of a file that changes
+        whenever the file is changed, or None if the file does not
+        exist """
+        try:
+            stat = os.stat(fname)
+        except OSError:
+            return None
+        return (stat.st_ino, stat.st_size, stat.st_mtime)
+
     def write_xml(self, fname, xmltree):
         """Write changes to xml back to disk."""
+        path = fname
         tmpfile = "%s.new" % fname
         datafile = None
         fd = None
@@ -222,6 +634,7 @@ class XMLMetadataConfig(Bcfg2.Server.Plugin.XMLFileBacked):
                                                          sys.exc_info()[1])
             self.logger.error(msg)
             raise Bcfg2.Server.Plugin.MetadataRuntimeError(msg)
+        self.written[path] = self.get_stamp(path)
 
     def find_xml_for_xpath(self, xpath):
         """Find and load xml file containing the xpath query"""
@@ -263,12 +676,153 @@ class XMLMetadataConfig(Bcfg2.Server.Plugin.XMLFileBacked):
             return False
         if event.code2str() == 'endExist':
             return False
+        stamp = self.written.get(event.filename)
+        if stamp is not None and stamp == self.get_stamp(event.filename):
+            # the file was last written by the server itself, and
+            # the in-memory data was changed when it was written
+            self.logger.debug("Metadata: Ignoring event for %s, which "
+                              "was written by the server" % event.filename)
+            return False
         self.load_xml()
         return True
 
 
+class FrozenDict(dict):
+    """ An immutable, hashable dict, used for the categories of
+    :class:`ClientMetadata` objects so that they can be interned and
+    shared between clients. """
+    __slots__ = ['_hash', '__weakref__']
+
+    def __hash__(self):
+        try:
+            return self._hash
+        except AttributeError:
+            self._hash = hash(frozenset(self.items()))
+            return self._hash
+
+    def _immutable(self, *args, **kwargs):
+        """ Raise TypeError on any attempt to modify the dict """
+        raise TypeError("%s object is immutable" % self.__class__.__name__)
+
+    __setitem__ = __delitem__ = __ior__ = clear = pop = popitem = \
+        setdefault = update = _immutable
+
+    def __reduce__(self):
+        return (self.__class__, (dict(self),))
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__, dict.__repr__(self))
+
+
+class InternTable(object):
+    """ A thread-safe table of hash-consed immutable values.  Interning
+    a value returns the single shared instance that is equal to it,
+    so that clients with identical group memberships share a single
+    set of groups.  Values are only held weakly, so values that are no
+    longer used by any client are dropped from the table. """
+
+    def __init__(self):
+        self.table = weakref.WeakValueDictionary()
+        self.lock = threading.Lock()
+
+    def intern(self, value):
+        """ Get the shared instance of the given value.
+
+        :param value: The value to intern.  This must be hashable and
+                      support weak references, e.g., a frozenset or a
+                      :class:`FrozenDict`.
+        :returns: The shared instance that is equal to ``value``
+        """
+        self.lock.acquire()
+        try:
+            try:
+                return self.table[value]
+            except KeyError:
+                self.table[value] = value
+                return value
+        finally:
+            self.lock.release()
+
+    def intern_set(self, items):
+        """ Get the shared frozenset of the given items """
+        items = freeze_set(items)
+        if not items:
+            return items
+        return self.intern(items)
+
+    def intern_dict(self, items):
+        """ Get the shared :class:`FrozenDict` of the given dict """
+        if not isinstance(items, FrozenDict):
+            items = FrozenDict(items)
+        if not items:
+            return EMPTY_DICT
+        return self.intern(items)
+
+    def __len__(self):
+        return len(self.table)
+
+
+#: The shared empty set and dict used by all ClientMetadata objects
+EMPTY_SET = frozenset()
+EMPTY_DICT = FrozenDict()
+
+
+def freeze_set(items):
+    """ Get a frozenset of the given items, without interning it.
+    Empty sets are always shared. """
+    if not items:
+        return EMPTY_SET
+    if isinstance(items, frozenset):
+        return items
+    return frozenset(items)
+
+#: The table of interned sets and dicts used by all ClientMetadata
+#: objects
+INTERNED = InternTable()
+
+#: A cache of version string -> Bcfg2VersionInfo object.  Version
+#: strings are supplied by clients, so this is cleared whenever it
+#: grows past 1000 entries.
+_VERSION_INFO = dict()
+
+
+def get_version_info(version):
+    """ Get the (shared) :class:`Bcfg2.version.Bcfg2VersionInfo`
+    object for a client version string, or None if it cannot be
+    parsed """
+    try:
+        return _VERSION_INFO[version]
+    except KeyError:
+        pass
+    except TypeError:
+        return None
+    try:
+        rv = Bcfg2VersionInfo(version)
+    except (ValueError, AttributeError):
+        rv = None
+    if len(_VERSION_INFO) >= 1000:
+        _VERSION_INFO.clear()
+    _VERSION_INFO[version] = rv
+    return rv
+
+
 class ClientMetadata(object):
-    """This object contains client metadata."""
+    """This object contains client metadata.
+
+    To keep metadata for large numbers of clients small, the
+    ``groups``, ``bundles`` and ``categories`` of a client are
+    interned, immutable frozensets (and a :class:`FrozenDict`) that
+    are shared with every other client with the same values.  These,
+    and the ``aliases`` and ``addresses`` frozensets, cannot be
+    modified in place; assign a new set to change them, or use
+    :func:`copy` to get a cheap copy of the object that can be
+    changed without affecting the original.  Data from Connector
+    plugins is stored as additional attributes. """
+    __slots__ = ['hostname', 'profile', '_groups', '_bundles', '_aliases',
+                 '_addresses', '_categories', 'uuid', 'password',
+                 'connectors', 'version', 'version_info', 'query',
+                 '__dict__']
+
     # pylint: disable=R0913
     def __init__(self, client, profile, groups, bundles, aliases, addresses,
                  categories, uuid, password, version, query):
@@ -281,15 +835,92 @@ class ClientMetadata(object):
         self.categories = categories
         self.uuid = uuid
         self.password = password
-        self.connectors = []
+        self.connectors = ()
         self.version = version
-        try:
-            self.version_info = Bcfg2VersionInfo(version)
-        except (ValueError, AttributeError):
-            self.version_info = None
+        self.version_info = get_version_info(version)
         self.query = query
     # pylint: enable=R0913
 
+    def _get_groups(self):
+        """ Get the groups of the client """
+        return self._groups
+
+    def _set_groups(self, groups):
+        """ Set the groups of the client """
+        self._groups = INTERNED.intern_set(groups)
+
+    groups = property(_get_groups, _set_groups)
+
+    def _get_bundles(self):
+        """ Get the bundles of the client """
+        return self._bundles
+
+    def _set_bundles(self, bundles):
+        """ Set the bundles of the client """
+        self._bundles = INTERNED.intern_set(bundles)
+
+    bundles = property(_get_bundles, _set_bundles)
+
+    def _get_aliases(self):
+        """ Get the aliases of the client """
+        return self._aliases
+
+    def _set_aliases(self, aliases):
+        """ Set the aliases of the client """
+        self._aliases = freeze_set(aliases)
+
+    aliases = property(_get_aliases, _set_aliases)
+
+    def _get_addresses(self):
+        """ Get the addresses of the client """
+        return self._addresses
+
+    def _set_addresses(self, addresses):
+        """ Set the addresses of the client """
+        self._addresses = freeze_set(addresses)
+
+    addresses = property(_get_addresses, _set_addresses)
+
+    def _get_categories(self):
+        """ Get the dict of category -> group of the client """
+        return self._categories
+
+    def _set_categories(self, categories):
+        """ Set the dict of category -> group of the client """
+        self._categories = INTERNED.intern_dict(categories)
+
+    categories = property(_get_categories, _set_categories)
+
+    def copy(self):
+        """ Get a copy of this object.  The copy shares all sets and
+        Connector data with this object, so it is cheap to make, but
+        assigning new values to the attributes of the copy does not
+        change this object. """
+        rv = self.__class__.__new__(self.__class__)
+        for attr in self.__slots__:
+            if attr == '__dict__':
+                rv.__dict__.update(self.__dict__)
+            else:
+                setattr(rv, attr, getattr(self, attr))
+        return rv
+
+    def __getstate__(self):
+        """ Get the state of the object for pickling, without the
+        :class:`MetadataQuery` object, which must be set again after
+        unpickling """
+        state = self.__dict__.copy()
+        for attr in self.__slots__:
+            if attr not in ['__dict__', 'query', 'version_info']:
+                state[attr.lstrip('_')] = getattr(self, attr)
+        state['categories'] = dict(self.categories)
+        return state
+
+    def __setstate__(self, state):
+        for attr, val in state.items():
+            setattr(self, attr, val)
+        self.version_info = get_version_info(self.version)
+        self.query = None
+
     def inGroup(self, group):
         """Test to see if client is a member of group."""
         return group in self.groups
@@ -308,9 +939,10 @@ class MetadataQuery(object):
     objects to query metadata without being able to modify it """
 
     def __init__(self, by_name, get_clients, by_groups, by_profiles,
-                 all_groups, all_groups_in_category):
+                 all_groups, all_groups_in_category, snapshot=None):
         # resolver is set later
         self.by_name = by_name
+        self.snapshot = snapshot
         self.names_by_groups = self._warn_string(by_groups)
         self.names_by_profiles = self._warn_string(by_profiles)
         self.all_clients = get_clients
@@ -339,19 +971,333 @@ class MetadataQuery(object):
         groups """
         # don't need to decorate this with _warn_string because
         # names_by_groups is decorated
-        return [self.by_name(name) for name in self.names_by_groups(groups)]
+        return self._get_metadata(self.names_by_groups(groups))
 
     def by_profiles(self, profiles):
         """ get a list of ClientMetadata objects that are in any of
         the given profiles """
         # don't need to decorate this with _warn_string because
         # names_by_profiles is decorated
-        return [self.by_name(name)
-                for name in self.names_by_profiles(profiles)]
+        return self._get_metadata(self.names_by_profiles(profiles))
 
     def all(self):
         """ get a list of all ClientMetadata objects """
-        return [self.by_name(name) for name in self.all_clients()]
+        return self._get_metadata(self.all_clients())
+
+    def _get_metadata(self, names):
+        """ get ClientMetadata objects for the given client names,
+        from the fleet snapshot if one is available """
+        if self.snapshot is None:
+            return [self.by_name(name) for name in names]
+        snapshot = self.snapshot()
+        rv = []
+        for name in names:
+            try:
+                rv.append(snapshot[name])
+            except KeyError:
+                rv.append(self.by_name(name))
+        return rv
+
+
+class ClientIndex(object):
+    """ Fleet-wide inverted indexes of the final metadata of all
+    clients, i.e., metadata that includes groups and data from
+    Connector plugins.  Clients are indexed lazily, the first time
+    the index is queried after they were added or expired, so that
+    questions like "which clients are in this group?" don't require
+    building metadata for every client every time. """
+
+    def __init__(self, build_metadata, get_clients, get_stamp=None,
+                 get_enabled=None):
+        """
+        :param build_metadata: A function that builds the final
+                               metadata for a client, given its name
+        :type build_metadata: callable
+        :param get_clients: A function that returns a list of the
+                            names of all clients
+        :type get_clients: callable
+        :param get_stamp: A function that returns a stamp of the
+                          state of any other data that the metadata
+                          depends on.  The entire index is expired
+                          whenever the stamp changes.
+        :type get_stamp: callable
+        :param get_enabled: A function that returns whether or not
+                            the index should be kept.  If it returns
+                            False, nothing is indexed, and every query
+                            builds the metadata of all clients.
+        :type get_enabled: callable
+        """
+        self.build_metadata = build_metadata
+        self.get_clients = get_clients
+        self.get_stamp = get_stamp
+        self.get_enabled = get_enabled
+        self.stamp = None
+        self.lock = threading.Lock()
+
+        #: A counter that is incremented every time anything is
+        #: expired from the index, so that metadata that was being
+        #: built at the time is not indexed
+        self.serial = 0
+
+        #: The value of :attr:`serial` when the entire index was last
+        #: expired
+        self.cleared = 0
+
+        #: A dict of client name -> the value of :attr:`serial` when
+        #: that client was last expired
+        self.expired = dict()
+
+        #: A dict of client name ->
+        #: :class:`Bcfg2.Server.Plugins.Metadata.ClientMetadata`
+        self.metadata = dict()
+
+        #: Dicts of group, bundle, or profile name -> set of client
+        #: names
+        self.by_group = dict()
+        self.by_bundle = dict()
+        self.by_profile = dict()
+
+        #: A cached, read-only copy of :attr:`metadata` that is
+        #: complete for all clients, or None
+        self._snapshot = None
+
+    def expire(self, client=None):
+        """ Expire a single client, or all clients, from the index.
+        They will be reindexed the next time the index is queried.
+
+        :param client: The name of the client to expire, or None to
+                       expire all clients
+        :type client: string
+        """
+        self.lock.acquire()
+        try:
+            self.serial += 1
+            self._snapshot = None
+            if client is None:
+                self.cleared = self.serial
+                self.expired.clear()
+                self.metadata.clear()
+                self.by_group.clear()
+                self.by_bundle.clear()
+                self.by_profile.clear()
+            else:
+                self.expired[client] = self.serial
+                self._remove(client)
+        finally:
+            self.lock.release()
+
+    def update(self, client, metadata):
+        """ Update the entry of a client with metadata that has just
+        been built for it.  The entry is only replaced if the groups,
+        bundles, or profile of the client changed, so that the
+        snapshot is not discarded on every client run.  Clients that
+        are not indexed yet are left to be indexed lazily.
+
+        :param client: The name of the client
+        :type client: string
+        :param metadata: The newly built metadata of the client
+        :type metadata: Bcfg2.Server.Plugins.Metadata.ClientMetadata
+        """
+        if not self.enabled:
+            return
+        self.lock.acquire()
+        try:
+            old = self.metadata.get(client)
+            if (old is None or
+                (old.groups == metadata.groups and
+                 old.bundles == metadata.bundles and
+                 old.profile == metadata.profile)):
+                return
+            self.serial += 1
+            self.expired[client] = self.serial
+            self._snapshot = None
+            self._remove(client)
+            self._add(client, metadata)
+        finally:
+            self.lock.release()
+
+    def _is_stale(self, client, serial):
+        """ Whether or not a client has been expired since
+        :attr:`serial` had the given value.  The caller must hold
+        :attr:`lock`. """
+        return self.cleared > serial or self.expired.get(client, 0) > serial
+
+    def _get_enabled(self):
+        """ Whether or not the index is kept """
+        return self.get_enabled is None or self.get_enabled()
+    enabled = property(_get_enabled)
+
+    def _add(self, client, metadata):
+        """ Add a client to the index.  The caller must hold
+        :attr:`lock`. """
+        self.metadata[client] = metadata
+        for index, keys in [(self.by_group, metadata.groups),
+                            (self.by_bundle, metadata.bundles),
+                            (self.by_profile, [metadata.profile])]:
+            for key in keys:
+                try:
+                    index[key].add(client)
+                except KeyError:
+                    index[key] = set([client])
+
+    def _remove(self, client):
+        """ Remove a client from the index.  The caller must hold
+        :attr:`lock`. """
+        metadata = self.metadata.pop(client, None)
+        if metadata is None:
+            return
+        for index, keys in [(self.by_group, metadata.groups),
+                            (self.by_bundle, metadata.bundles),
+                            (self.by_profile, [metadata.profile])]:
+            for key in keys:
+                clients = index.get(key)
+                if clients is not None:
+                    clients.discard(client)
+                    if not clients:
+                        del index[key]
+
+    def snapshot(self):
+        """ Get the final metadata of all clients, indexing any
+        clients that are not yet indexed.  The return value is shared
+        between callers, and must not be modified.
+
+        :returns: dict of client name ->
+                  :class:`Bcfg2.Server.Plugins.Metadata.ClientMetadata`
+        """
+        if not self.enabled:
+            return dict([(client, self.build_metadata(client))
+                         for client in self.get_clients()])
+        if self.get_stamp is not None:
+            stamp = self.get_stamp()
+            if stamp != self.stamp:
+                self.expire()
+                self.stamp = stamp
+        snapshot = self._snapshot
+        if snapshot is not None:
+            return snapshot
+        clients = list(self.get_clients())
+        self.lock.acquire()
+        try:
+            serial = self.serial
+            missing = [c for c in clients if c not in self.metadata]
+            for client in set(self.metadata.keys()) - set(clients):
+                self._remove(client)
+        finally:
+            self.lock.release()
+
+        # metadata is built without holding the lock, since building
+        # it can query the index
+        built = dict()
+        for client in missing:
+            built[client] = self.build_metadata(client)
+
+        self.lock.acquire()
+        try:
+            stale = dict()
+            for client, metadata in built.items():
+                if self._is_stale(client, serial):
+                    # the client was expired while its metadata was
+                    # being built, so it may be stale.  it's good
+                    # enough for this caller, but don't index it.
+                    stale[client] = metadata
+                elif client not in self.metadata:
+                    self._add(client, metadata)
+            if not stale and self._snapshot is None:
+                for client in clients:
+                    if client not in self.metadata:
+                        break
+                else:
+                    self._snapshot = dict(self.metadata)
+            if self._snapshot is not None:
+                return self._snapshot
+            rv = dict(self.metadata)
+            rv.update(stale)
+            return rv
+        finally:
+            self.lock.release()
+
+    def _query(self, index, keys, match_all, match):
+        """ Get the names of clients that have all (or any) of the
+        given keys in the given inverted index.  If the index could
+        not be completed (see :func:`snapshot`), ``match`` is called
+        with each client's metadata instead. """
+        snapshot = self.snapshot()
+        self.lock.acquire()
+        try:
+            if snapshot is self._snapshot:
+                rv = None
+                for key in keys:
+                    clients = index.get(key, set())
+                    if rv is None:
+                        rv = set(clients)
+                    elif match_all:
+                        rv.intersection_update(clients)
+                    else:
+                        rv.update(clients)
+                if rv is None:
+                    if match_all:
+                        return list(snapshot.keys())
+                    return []
+                return list(rv)
+        finally:
+            self.lock.release()
+        return [name for name, metadata in snapshot.items()
+                if match(metadata)]
+
+    def get_clients_by_groups(self, groups):
+        """ Get the names of clients that are in all of the given
+        groups """
+        return self._query(self.by_group, groups, True,
+                           lambda md: md.groups.issuperset(groups))
+
+    def get_clients_by_bundles(self, bundles):
+        """ Get the names of clients that have all of the given
+        bundles """
+        return self._query(self.by_bundle, bundles, True,
+                           lambda md: md.bundles.issuperset(bundles))
+
+    def get_clients_by_profiles(self, profiles):
+        """ Get the names of clients that are in any of the given
+        profile groups """
+        return self._query(self.by_profile, profiles, False,
+                           lambda md: md.profile in profiles)
+
+
+class SessionCache(dict):
+    """ A dict of (<address>, <port>) -> (<timestamp>, <client>) for
+    clients that have authenticated recently, so that their client
+    name does not have to be resolved again for each call.  Entries
+    are also kept in a heap ordered by timestamp, so that expired
+    entries can be removed without scanning the whole cache. """
+
+    def __init__(self, ttl=90):
+        dict.__init__(self)
+
+        #: How long, in seconds, entries are valid for
+        self.ttl = ttl
+
+        #: A heap of (<timestamp>, <key>).  A heap item is stale if
+        #: the entry for the key no longer has that timestamp.
+        self.heap = []
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        if value[0] is not None:
+            heapq.heappush(self.heap, (value[0], key))
+
+    def clear(self):
+        dict.clear(self)
+        self.heap = []
+
+    def expire(self, now=None):
+        """ Remove all entries older than :attr:`ttl` """
+        if now is None:
+            now = time.time()
+        while self.heap and now - self.heap[0][0] > self.ttl:
+            stamp, key = heapq.heappop(self.heap)
+            entry = self.get(key)
+            if entry is not None and entry[0] == stamp:
+                del self[key]
 
 
 class MetadataGroup(tuple):
@@ -391,9 +1337,217 @@ class MetadataGroup(tuple):
         return hash(self.name)
 
 
+def _group_decl(group):
+    """ get the parts of a group that are declared in groups.xml, to
+    find out whether its declaration changed """
+    return (tuple(group.bundles), group.category, group.is_profile,
+            group.is_public)
+
+
+class MetadataGroupRule(object):
+    """ A compiled condition under which a client is added to (or, for
+    a negated Group tag, removed from) a group.  It is built from the
+    Group and Client tags that enclose a Group tag in ``groups.xml``,
+    and is called with the client name and its current set of groups
+    to check whether the client meets the condition. """
+
+    def __init__(self, group, element, position=0):
+        """
+        :param group: The group this rule adds clients to or removes
+                      clients from
+        :type group: MetadataGroup
+        :param element: The Group tag in ``groups.xml`` that this rule
+                        is built from
+        :type element: lxml.etree._Element
+        :param position: The position of this rule among the rules
+                         that add clients to groups (or remove them)
+        :type position: int
+        """
+        self.group = group
+
+        #: Whether this rule removes clients from the group rather than
+        #: adding them
+        self.negate = element.get('negate', 'false').lower() == 'true'
+
+        #: The position of this rule among the rules that add clients
+        #: to groups, or among those that remove them.  Each pass of
+        #: the fixpoint loop in :func:`Metadata._merge_groups`
+        #: evaluates rules in this order.
+        self.position = position
+        groups = set()
+        negated_groups = set()
+        clients = set()
+        negated_clients = set()
+        for parent in element.iterancestors():
+            negate = parent.get('negate', 'false').lower() == 'true'
+            if parent.tag == 'Group':
+                if negate:
+                    negated_groups.add(parent.get("name"))
+                else:
+                    groups.add(parent.get("name"))
+            elif parent.tag == 'Client':
+                if negate:
+                    negated_clients.add(parent.get("name"))
+                else:
+                    clients.add(parent.get("name"))
+
+        #: Groups the client must be a member of
+        self.groups = frozenset(groups)
+
+        #: Groups the client must not be a member of
+        self.negated_groups = frozenset(negated_groups)
+
+        #: Names the client must have.  If this contains more than one
+        #: name, no client can meet the condition.
+        self.clients = frozenset(clients)
+
+        #: Names the client must not have
+        self.negated_clients = frozenset(negated_clients)
+
+    def __call__(self, client, groups):
+        """ Check whether a client meets this condition.
+
+        :param client: The client name
+        :type client: string
+        :param groups: The groups the client is currently a member of
+        :type groups: set
+        :returns: bool
+        """
+        for name in self.clients:
+            if name != client:
+                return False
+        if client in self.negated_clients:
+            return False
+        if not self.groups.issubset(groups):
+            return False
+        for group in self.negated_groups:
+            if group in groups:
+                return False
+        return True
+
+    def __repr__(self):
+        return "%s %s (groups=%s, negated_groups=%s, clients=%s, " \
+            "negated_clients=%s)" % (self.__class__.__name__,
+                                     self.group.name, list(self.groups),
+                                     list(self.negated_groups),
+                                     list(self.clients),
+                                     list(self.negated_clients))
+
+
+class MetadataGroupRules(object):
+    """ The :class:`MetadataGroupRule` objects built from
+    ``groups.xml``, indexed by the changes to a client's groups that
+    could make each rule change them in turn.  This lets each pass of
+    the fixpoint loop in :func:`Metadata._merge_groups` skip the rules
+    whose outcome cannot have changed since they were last
+    evaluated. """
+
+    def __init__(self):
+        #: The rules that add clients to groups, in document order
+        self.add = []
+
+        #: The rules that remove clients from groups, i.e., negated
+        #: Group tags, in document order
+        self.remove = []
+
+        #: A dict of group name -> list of rules that might change a
+        #: client's groups once the client is added to that group
+        self.on_add = dict()
+
+        #: A dict of group name -> list of rules that might change a
+        #: client's groups once the client is removed from that group
+        self.on_remove = dict()
+
+        #: A dict of category -> list of rules that add clients to
+        #: groups in that category, which might match once the client
+        #: is removed from a group in the category
+        self.on_category = dict()
+
+        #: Rules that do not require membership in any group, which
+        #: must be evaluated for every client
+        self.untriggered = []
+
+        #: A dict of client name -> list of rules that do not require
+        #: membership in any group, but only match that client
+        self.by_client = dict()
+
+    def append(self, group, element):
+        """ Build a rule from a Group tag in ``groups.xml`` and add it
+        to the index.
+
+        :param group: The group the rule adds clients to or removes
+                      clients from
+        :type group: MetadataGroup
+        :param element: The Group tag to build the rule from
+        :type element: lxml.etree._Element
+        :returns: MetadataGroupRule
+        """
+        rule = MetadataGroupRule(group, element)
+        if rule.negate:
+            rules = self.remove
+        else:
+            rules = self.add
+        rule.position = len(rules)
+        rules.append(rule)
+        if len(rule.clients) > 1:
+            # no client can match this rule
+            return rule
+
+        for gname in rule.groups:
+            self._add_trigger(self.on_add, gname, rule)
+        for gname in rule.negated_groups:
+            self._add_trigger(self.on_remove, gname, rule)
+        if rule.negate:
+            self._add_trigger(self.on_add, group.name, rule)
+        else:
+            self._add_trigger(self.on_remove, group.name, rule)
+            if group.category:
+                self._add_trigger(self.on_category, group.category, rule)
+        if not rule.groups:
+            if rule.clients:
+                self._add_trigger(self.by_client, list(rule.clients)[0],
+                                  rule)
+            else:
+                self.untriggered.append(rule)
+        return rule
+
+    def _add_trigger(self, index, key, rule):
+        """ Add a rule to the list of rules in the given index """
+        try:
+            rules = index[key]
+        except KeyError:
+            index[key] = [rule]
+            return
+        if rules[-1] is not rule:
+            rules.append(rule)
+
+    def get(self, negate, position):
+        """ Get a rule by its position.
+
+        :param negate: Get one of the rules that remove clients from
+                       groups, instead of one that adds them
+        :type negate: bool
+        :param position: The position of the rule
+        :type position: int
+        :returns: MetadataGroupRule
+        """
+        if negate:
+            return self.remove[position]
+        return self.add[position]
+
+    def get_group_names(self):
+        """ Get the names of all groups that rules add clients to or
+        remove clients from.
+
+        :returns: set of strings
+        """
+        return set([rule.group.name for rule in self.add + self.remove])
+
+
 class Metadata(Bcfg2.Server.Plugin.Metadata,
                Bcfg2.Server.Plugin.Statistics,
-               Bcfg2.Server.Plugin.DatabaseBacked):
+               Bcfg2.Server.Plugin.DatabaseBacked,
+               Bcfg2.Server.Plugin.Threaded):
     """This class contains data for bcfg2 server metadata."""
     __author__ = 'bcfg-dev@mcs.anl.gov'
     sort_order = 500
@@ -406,6 +1560,22 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
         self.states = dict()
         self.extra = dict()
         self.handlers = dict()
+        #: How often, in seconds, changes to clients.xml or the
+        #: database are written when ``write_behind`` is enabled
+        self.flush_interval = 30.0
+        self.flush_thread = None
+        self.write_behind = core.setup.cfp.getboolean("metadata",
+                                                      "write_behind",
+                                                      default=False)
+        if self.write_behind:
+            try:
+                self.flush_interval = \
+                    float(core.setup.cfp.get("metadata", "flush_interval",
+                                             default="30"))
+            except ValueError:
+                self.logger.error("Metadata: flush_interval must be a "
+                                  "number, using the default of %s "
+                                  "seconds" % self.flush_interval)
         self.groups_xml = self._handle_file("groups.xml")
         if (self._use_db and
             os.path.exists(os.path.join(self.data, "clients.xml"))):
@@ -414,44 +1584,74 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
             self.clients_xml = self._handle_file("clients.xml")
         elif not self._use_db:
             self.clients_xml = self._handle_file("clients.xml")
+            if self.write_behind:
+                self.clients_xml.journal = MetadataJournal(self.clients_xml)
 
         # mapping of clientname -> authtype
         self.auth = dict()
-        # list of clients required to have non-global password
-        self.secure = []
-        # list of floating clients
-        self.floating = []
+        # set of clients required to have non-global password
+        self.secure = set()
+        # set of floating clients
+        self.floating = set()
         # mapping of clientname -> password
         self.passwords = {}
+        # mapping of address -> [clientnames]
         self.addresses = {}
+        # mapping of clientname -> set of addresses
         self.raddresses = {}
         # mapping of clientname -> [groups]
         self.clientgroups = {}
         # list of clients
         self.clients = []
+        # mapping of alias -> clientname
         self.aliases = {}
+        # mapping of clientname -> set of aliases
         self.raliases = {}
         # mapping of groupname -> MetadataGroup object
         self.groups = {}
-        # mappings of predicate -> MetadataGroup object
-        self.group_membership = dict()
-        self.negated_groups = dict()
+        # the rules from groups.xml, indexed for _merge_groups
+        self.group_rules = MetadataGroupRules()
         # mapping of hostname -> version string
         if self._use_db:
             self.versions = ClientVersions(core, datastore)
+            try:
+                self.versions.check_interval = \
+                    float(core.setup.cfp.get("metadata", "db_check_interval",
+                                             default="10"))
+            except ValueError:
+                self.logger.error("Metadata: db_check_interval must be a "
+                                  "number, using the default of %s "
+                                  "seconds" % self.versions.check_interval)
         else:
             self.versions = dict()
+        # mapping of uuid -> clientname
         self.uuid = {}
-        self.session_cache = {}
+        # mapping of clientname -> uuid
+        self.ruuid = {}
+        # mapping of clientname -> tuple of the data parsed from each
+        # of its records in clients.xml.  this is used to find the
+        # clients that changed when clients.xml is reloaded.
+        self.client_records = dict()
+        # the group rules parsed from groups.xml, used to find out
+        # whether the rules changed when groups.xml is reloaded
+        self.group_rule_signature = None
+        self.session_cache = SessionCache()
         self.default = None
         self.pdirty = False
         self.password = core.setup['password']
+        self.index = ClientIndex(
+            lambda c: self.core.build_metadata(c),
+            lambda: list(self.clients),
+            get_stamp=self._get_connector_generations,
+            get_enabled=lambda: (self.core.metadata_cache_mode in
+                                 ['cautious', 'aggressive']))
         self.query = MetadataQuery(core.build_metadata,
                                    lambda: list(self.clients),
                                    self.get_client_names_by_groups,
                                    self.get_client_names_by_profiles,
                                    self.get_all_group_names,
-                                   self.get_all_groups_in_category)
+                                   self.get_all_groups_in_category,
+                                   snapshot=self.index.snapshot)
 
     @classmethod
     def init_repo(cls, repo, **kwargs):
@@ -464,6 +1664,54 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
                 open(os.path.join(repo, cls.name, fname),
                      "w").write(kwargs[aname])
 
+    def start_threads(self):
+        if not self.write_behind:
+            return
+        if self._use_db:
+            self.versions.write_behind = True
+        elif self.clients_xml.journal is None:
+            return
+        self.flush_thread = \
+            threading.Thread(name="%sFlush" % self.__class__.__name__,
+                             target=self._flush_changes)
+        self.flush_thread.setDaemon(True)
+        self.flush_thread.start()
+
+    def _flush_changes(self):
+        """ Write changes from the clients.xml journal, or changed
+        client versions in the database, every :attr:`flush_interval`
+        seconds until the server shuts down """
+        terminate = self.core.terminate
+        while not terminate.isSet():
+            terminate.wait(self.flush_interval)
+            if terminate.isSet():
+                break
+            try:
+                self.flush()
+            except:  # pylint: disable=W0702
+                self.logger.error("Metadata: Failed to write client "
+                                  "changes: %s" % sys.exc_info()[1])
+
+    def flush(self):
+        """ Write all changes to client records that have not been
+        written yet, i.e., the clients.xml journal or client versions
+        in the database """
+        if self._use_db:
+            self.versions.flush()
+        elif self.clients_xml.journal is not None:
+            self.clients_xml.journal.flush()
+
+    def shutdown(self):
+        super(Metadata, self).shutdown()
+        try:
+            self.flush()
+        except Bcfg2.Server.Plugin.MetadataRuntimeError:
+            # already logged; the changes are kept in the journal
+            pass
+        except:  # pylint: disable=W0702
+            self.logger.error("Metadata: Failed to write client changes: %s"
+                              % sys.exc_info()[1])
+
     def _handle_file(self, fname):
         """ set up the necessary magic for handling a metadata file
         (clients.xml or groups.xml, e.g.) """
@@ -485,14 +1733,11 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
 
     def _search_xdata(self, tag, name, tree, alias=False):
         """ Generic method to find XML data (group, client, etc.) """
-        for node in tree.findall("//%s" % tag):
-            if node.get("name") == name:
-                return node
-            elif alias:
-                for child in node:
-                    if (child.tag == "Alias" and
-                        child.attrib["name"] == name):
-                        return node
+        nodes = tree.xpath("//%s[@name=$name]" % tag, name=name)
+        if not nodes and alias:
+            nodes = tree.xpath("//%s[Alias/@name=$name]" % tag, name=name)
+        if nodes:
+            return nodes[0]
         return None
 
     def search_group(self, group_name, tree):
@@ -514,12 +1759,18 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
             raise Bcfg2.Server.Plugin.MetadataConsistencyError("%s \"%s\" "
                                                                "already exists"
                                                                % (tag, name))
-        element = lxml.etree.SubElement(config.base_xdata.getroot(),
-                                        tag, name=name)
+        element = lxml.etree.Element(tag, name=name)
         if attribs:
             for key, val in list(attribs.items()):
                 element.set(key, val)
-        config.write()
+        if config.journal is not None:
+            config.journal.record("Add", element)
+        else:
+            config.base_xdata.getroot().append(element)
+            if config.xdata is not config.base_xdata:
+                config.xdata.getroot().append(copy.deepcopy(element))
+            config.write()
+        self._xdata_changed(config, tag, name)
         return element
 
     def add_group(self, group_name, attribs):
@@ -554,12 +1805,15 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
             except MetadataClientModel.DoesNotExist:
                 client = MetadataClientModel(hostname=client_name)
                 client.save()
+                self.versions.add(client_name)
             self.clients = self.list_clients()
             return client
         else:
             try:
-                return self._add_xdata(self.clients_xml, "Client", client_name,
-                                       attribs=attribs, alias=True)
+                rv = self._add_xdata(self.clients_xml, "Client", client_name,
+                                     attribs=attribs, alias=True)
+                self._update_client_identity(client_name, attribs)
+                return rv
             except Bcfg2.Server.Plugin.MetadataConsistencyError:
                 # already exists
                 err = sys.exc_info()[1]
@@ -573,15 +1827,23 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
         if node == None:
             self.logger.error("%s \"%s\" does not exist" % (tag, name))
             raise Bcfg2.Server.Plugin.MetadataConsistencyError
-        xdict = config.find_xml_for_xpath('.//%s[@name="%s"]' %
-                                          (tag, node.get('name')))
-        if not xdict:
-            self.logger.error("Unexpected error finding %s \"%s\"" %
-                              (tag, name))
-            raise Bcfg2.Server.Plugin.MetadataConsistencyError
-        for key, val in list(attribs.items()):
-            xdict['xquery'][0].set(key, val)
-        config.write_xml(xdict['filename'], xdict['xmltree'])
+        if config.journal is not None:
+            element = lxml.etree.Element(tag, name=node.get('name'))
+            for key, val in list(attribs.items()):
+                element.set(key, val)
+            config.journal.record("Update", element)
+        else:
+            xdict = config.find_xml_for_xpath('.//%s[@name="%s"]' %
+                                              (tag, node.get('name')))
+            if not xdict:
+                self.logger.error("Unexpected error finding %s \"%s\"" %
+                                  (tag, name))
+                raise Bcfg2.Server.Plugin.MetadataConsistencyError
+            for key, val in list(attribs.items()):
+                xdict['xquery'][0].set(key, val)
+                node.set(key, val)
+            config.write_xml(xdict['filename'], xdict['xmltree'])
+        self._xdata_changed(config, tag, node.get('name'))
 
     def update_group(self, group_name, attribs):
         """Update a groups attributes."""
@@ -602,13 +1864,17 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
             self.logger.error(msg)
             raise Bcfg2.Server.Plugin.PluginExecutionError(msg)
         else:
-            return self._update_xdata(self.clients_xml, "Client", client_name,
-                                      attribs, alias=True)
+            rv = self._update_xdata(self.clients_xml, "Client", client_name,
+                                    attribs, alias=True)
+            self._update_client_identity(self.aliases.get(client_name,
+                                                          client_name),
+                                         attribs)
+            return rv
 
     def list_clients(self):
         """ List all clients in client database """
         if self._use_db:
-            return set([c.hostname for c in MetadataClientModel.objects.all()])
+            return set(self.versions.keys())
         else:
             return self.clients
 
@@ -618,14 +1884,33 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
         if node == None:
             self.logger.error("%s \"%s\" does not exist" % (tag, name))
             raise Bcfg2.Server.Plugin.MetadataConsistencyError
-        xdict = config.find_xml_for_xpath('.//%s[@name="%s"]' %
-                                          (tag, node.get('name')))
-        if not xdict:
-            self.logger.error("Unexpected error finding %s \"%s\"" %
-                              (tag, name))
-            raise Bcfg2.Server.Plugin.MetadataConsistencyError
-        xdict['xquery'][0].getparent().remove(xdict['xquery'][0])
-        config.write_xml(xdict['filename'], xdict['xmltree'])
+        if config.journal is not None:
+            config.journal.record("Remove",
+                                  lxml.etree.Element(tag,
+                                                     name=node.get('name')))
+        else:
+            xdict = config.find_xml_for_xpath('.//%s[@name="%s"]' %
+                                              (tag, node.get('name')))
+            if not xdict:
+                self.logger.error("Unexpected error finding %s \"%s\"" %
+                                  (tag, name))
+                raise Bcfg2.Server.Plugin.MetadataConsistencyError
+            xdict['xquery'][0].getparent().remove(xdict['xquery'][0])
+            config.write_xml(xdict['filename'], xdict['xmltree'])
+            if node.getparent() is not None:
+                node.getparent().remove(node)
+        self._xdata_changed(config, tag, node.get('name'))
+
+    def _xdata_changed(self, config, tag, name):
+        """ Update the in-memory metadata after the server itself
+        changed an element of a metadata file.  Events caused by the
+        server's own writes are ignored, so this takes the place of
+        reloading the file. """
+        if config is getattr(self, "clients_xml", None):
+            if tag == "Client":
+                self._reload_clients([name])
+        elif config is self.groups_xml:
+            self._handle_groups_xml_event(None)
 
     def remove_group(self, group_name):
         """Remove a group."""
@@ -657,63 +1942,127 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
                 self.logger.warning(msg)
                 raise Bcfg2.Server.Plugin.MetadataConsistencyError(msg)
             client.delete()
+            self.versions.discard(client_name)
             self.clients = self.list_clients()
         else:
-            return self._remove_xdata(self.clients_xml, "Client", client_name)
+            return self._remove_xdata(self.clients_xml, "Client",
+                                      client_name)
 
-    def _handle_clients_xml_event(self, _):  # pylint: disable=R0912
+    def _handle_clients_xml_event(self, _):
         """ handle all events for clients.xml and files xincluded from
-        clients.xml """
-        xdata = self.clients_xml.xdata
-        self.clients = []
-        self.clientgroups = {}
-        self.aliases = {}
-        self.raliases = {}
-        self.secure = []
-        self.floating = []
-        self.addresses = {}
-        self.raddresses = {}
-        for client in xdata.findall('.//Client'):
+        clients.xml.  only the clients whose records changed since
+        clients.xml was last read are updated. """
+        records = dict()
+        order = []
+        for client in self.clients_xml.xdata.findall('.//Client'):
             clname = client.get('name').lower()
-            if 'address' in client.attrib:
-                caddr = client.get('address')
-                if caddr in self.addresses:
-                    self.addresses[caddr].append(clname)
-                else:
-                    self.addresses[caddr] = [clname]
-                if clname not in self.raddresses:
-                    self.raddresses[clname] = set()
-                self.raddresses[clname].add(caddr)
-            if 'auth' in client.attrib:
-                self.auth[client.get('name')] = client.get('auth',
-                                                           'cert+password')
-            if 'uuid' in client.attrib:
-                self.uuid[client.get('uuid')] = clname
-            if client.get('secure', 'false').lower() == 'true':
-                self.secure.append(clname)
-            if (client.get('location', 'fixed') == 'floating' or
-                client.get('floating', 'false').lower() == 'true'):
-                self.floating.append(clname)
-            if 'password' in client.attrib:
-                self.passwords[clname] = client.get('password')
-            if 'version' in client.attrib:
-                self.versions[clname] = client.get('version')
-
-            self.raliases[clname] = set()
-            for alias in client.findall('Alias'):
-                self.aliases.update({alias.get('name'): clname})
-                self.raliases[clname].add(alias.get('name'))
-                if 'address' not in alias.attrib:
-                    continue
-                if alias.get('address') in self.addresses:
-                    self.addresses[alias.get('address')].append(clname)
-                else:
-                    self.addresses[alias.get('address')] = [clname]
-                if clname not in self.raddresses:
-                    self.raddresses[clname] = set()
-                self.raddresses[clname].add(alias.get('address'))
-            self.clients.append(clname)
-            profile = client.get("profile")
+            if clname in records:
+                records[clname] += (self._get_client_record(client),)
+            else:
+                records[clname] = (self._get_client_record(client),)
+                order.append(clname)
+        names = set(self.client_records.keys())
+        names.update(records.keys())
+        changed = self._apply_client_records(records, names)
+        self.clients = order
+        self.states['clients.xml'] = True
+        if self._use_db:
+            self.clients = self.list_clients()
+        if changed:
+            self.debug_log("Metadata: %d clients changed in clients.xml" %
+                           len(changed))
+        return changed
+
+    def _reload_clients(self, clients):
+        """ update the given clients from the in-memory data of
+        clients.xml, e.g., after the server changed their records """
+        records = dict()
+        names = set()
+        for name in clients:
+            clname = name.lower()
+            names.add(clname)
+            for client in self.clients_xml.xdata.xpath("//Client[@name=$name]",
+                                                       name=name):
+                records[clname] = records.get(clname, ()) + \
+                    (self._get_client_record(client),)
+        changed = self._apply_client_records(records, names)
+        for clname in changed:
+            if clname in records and clname not in self.clients:
+                self.clients.append(clname)
+            elif clname not in records and clname in self.clients:
+                self.clients.remove(clname)
+        if self._use_db:
+            self.clients = self.list_clients()
+        return changed
+
+    def _get_client_record(self, client):
+        """ get a hashable representation of the data in a Client
+        tag in clients.xml """
+        return (tuple(sorted(client.attrib.items())),
+                tuple([(alias.get("name"), alias.get("address"))
+                       for alias in client.findall("Alias")]))
+
+    def _apply_client_records(self, records, names):
+        """ compare the given client records to the ones that were
+        last applied, and update the clients whose records changed.
+        expires the cached metadata of those clients and their
+        aliases.
+
+        :param records: dict of <client name> -> tuple of records, as
+                        returned by :func:`_get_client_record`
+        :type records: dict
+        :param names: The names of the clients to compare.  Clients
+                      in ``names`` but not ``records`` are removed.
+        :type names: set
+        :returns: list of the names of clients that changed
+        """
+        changed = [n for n in names
+                   if self.client_records.get(n) != records.get(n)]
+        if not changed:
+            return changed
+        expire = set(changed)
+        # remove all changed clients before adding any, so that
+        # aliases and addresses can move from one client to another
+        for clname in changed:
+            if clname in self.client_records:
+                expire.update(self.raliases.get(clname, []))
+                self._remove_client_record(clname)
+        for clname in changed:
+            if clname in records:
+                self._add_client_record(clname, records[clname])
+                expire.update(self.raliases.get(clname, []))
+        self._expire_clients(expire)
+        return changed
+
+    def _add_client_record(self, clname, records):
+        """ add the data from the records of a client in clients.xml
+        to the in-memory metadata """
+        self.client_records[clname] = records
+        self.raliases[clname] = set()
+        for attribs, aliases in records:
+            attribs = dict(attribs)
+            if 'address' in attribs:
+                self._add_client_address(clname, attribs['address'])
+            if 'auth' in attribs:
+                self.auth[attribs['name']] = attribs['auth']
+            if 'uuid' in attribs:
+                self._set_client_uuid(clname, attribs['uuid'])
+            if attribs.get('secure', 'false').lower() == 'true':
+                self.secure.add(clname)
+            if (attribs.get('location', 'fixed') == 'floating' or
+                attribs.get('floating', 'false').lower() == 'true'):
+                self.floating.add(clname)
+            if 'password' in attribs:
+                self.passwords[clname] = attribs['password']
+            if 'version' in attribs:
+                self.versions[clname] = attribs['version']
+
+            for alias, address in aliases:
+                self.aliases[alias] = clname
+                self.raliases[clname].add(alias)
+                if address is not None:
+                    self._add_client_address(clname, address)
+            profile = attribs.get("profile")
             if self.groups:  # check if we've parsed groups.xml yet
                 if profile not in self.groups:
                     self.logger.warning("Metadata: %s has nonexistent "
@@ -726,55 +2075,103 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
                 self.clientgroups[clname].append(profile)
             except KeyError:
                 self.clientgroups[clname] = [profile]
-        self.states['clients.xml'] = True
-        if self._use_db:
-            self.clients = self.list_clients()
 
-    def _handle_groups_xml_event(self, _):  # pylint: disable=R0912
-        """ re-read groups.xml on any event on it """
+    def _remove_client_record(self, clname):
+        """ remove the data from the records of a client in
+        clients.xml from the in-memory metadata """
+        for attribs, _ in self.client_records.pop(clname, ()):
+            attribs = dict(attribs)
+            if 'auth' in attribs:
+                self.auth.pop(attribs['name'], None)
+        self._remove_client_identity(clname)
+        self.clientgroups.pop(clname, None)
+        self.passwords.pop(clname, None)
+        if not self._use_db:
+            self.versions.pop(clname, None)
+
+    def _expire_clients(self, clients):
+        """ expire the given clients (or aliases) from the metadata
+        cache and the client index """
+        for key in list(self.core.metadata_cache.keys()):
+            if key in clients:
+                self.core.metadata_cache.expire(key)
+        for key in list(self.index.metadata.keys()):
+            if key in clients:
+                self.index.expire(key)
+
+    def _add_client_address(self, client, address):
+        """ record an address of a client in :attr:`addresses` and
+        :attr:`raddresses` """
+        try:
+            if client not in self.addresses[address]:
+                self.addresses[address].append(client)
+        except KeyError:
+            self.addresses[address] = [client]
+        try:
+            self.raddresses[client].add(address)
+        except KeyError:
+            self.raddresses[client] = set([address])
+
+    def _set_client_uuid(self, client, uuid):
+        """ record the uuid of a client in :attr:`uuid` and
+        :attr:`ruuid`, replacing any uuid it had before """
+        old = self.ruuid.get(client)
+        if old is not None and self.uuid.get(old) == client:
+            del self.uuid[old]
+        self.uuid[uuid] = client
+        self.ruuid[client] = uuid
+
+    def _remove_client_identity(self, client):
+        """ forget the uuid, addresses, and aliases of a client """
+        uuid = self.ruuid.pop(client, None)
+        if uuid is not None and self.uuid.get(uuid) == client:
+            del self.uuid[uuid]
+        for address in self.raddresses.pop(client, []):
+            clients = self.addresses.get(address, [])
+            if client in clients:
+                clients.remove(client)
+            if not clients:
+                self.addresses.pop(address, None)
+        for alias in self.raliases.pop(client, []):
+            if self.aliases.get(alias) == client:
+                del self.aliases[alias]
+        self.secure.discard(client)
+        self.floating.discard(client)
+
+    def _update_client_identity(self, client, attribs):
+        """ update the identity and authentication data for a client
+        whose entry in clients.xml was just written, so that they are
+        correct before clients.xml is re-read """
+        client = client.lower()
+        if 'uuid' in attribs:
+            self._set_client_uuid(client, attribs['uuid'])
+        if 'address' in attribs:
+            self._add_client_address(client, attribs['address'])
+        if 'auth' in attribs:
+            self.auth[client] = attribs['auth']
+        if 'password' in attribs:
+            self.passwords[client] = attribs['password']
+        if 'secure' in attribs:
+            if attribs['secure'].lower() == 'true':
+                self.secure.add(client)
+            else:
+                self.secure.discard(client)
+        if 'floating' in attribs:
+            if attribs['floating'].lower() == 'true':
+                self.floating.add(client)
+            else:
+                self.floating.discard(client)
+
+    def _handle_groups_xml_event(self, _):  # pylint: disable=R0912,R0914
+        """ re-read groups.xml on any event on it.  if only the
+        declarations of some groups changed, only the clients that are
+        members of those groups are expired from the caches; if the
+        rules that decide group membership changed, all clients are
+        expired. """
+        old_groups = self.groups
+        old_default = self.default
         self.groups = {}
 
-        # these three functions must be separate functions in order to
-        # ensure that the scope is right for the closures they return
-        def get_condition(element):
-            """ Return a predicate that returns True if a client meets
-            the condition specified in the given Group or Client
-            element """
-            negate = element.get('negate', 'false').lower() == 'true'
-            pname = element.get("name")
-            if element.tag == 'Group':
-                return lambda c, g, _: negate != (pname in g)
-            elif element.tag == 'Client':
-                return lambda c, g, _: negate != (pname == c)
-
-        def get_category_condition(category, gname):
-            """ get a predicate that returns False if a client is
-            already a member of a group in the given category, True
-            otherwise """
-            def in_cat(client, groups, categories):  # pylint: disable=W0613
-                """ return True if the client is already a member of a
-                group in the category given in the enclosing function,
-                False otherwise """
-                if category in categories:
-                    if (gname not in self.groups or
-                        client not in self.groups[gname].warned):
-                        self.logger.warning("%s: Group %s suppressed by "
-                                            "category %s; %s already a member "
-                                            "of %s" %
-                                            (self.name, gname, category,
-                                             client, categories[category]))
-                        if gname in self.groups:
-                            self.groups[gname].warned.append(client)
-                    return False
-                return True
-            return in_cat
-
-        def aggregate_conditions(conditions):
-            """ aggregate all conditions on a given group declaration
-            into a single predicate """
-            return lambda client, groups, cats: \
-                all(cond(client, groups, cats) for cond in conditions)
-
         # first, we get a list of all of the groups declared in the
         # file.  we do this in two stages because the old way of
         # parsing groups.xml didn't support nested groups; in the old
@@ -788,18 +2185,24 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
                 self.groups_xml.xdata.xpath("//Groups/Group//Group"):
             if grp.get("name") in self.groups:
                 continue
-            self.groups[grp.get("name")] = \
+            group = \
                 MetadataGroup(grp.get("name"),
                               bundles=[b.get("name")
                                        for b in grp.findall("Bundle")],
                               category=grp.get("category"),
                               is_profile=grp.get("profile", "false") == "true",
                               is_public=grp.get("public", "false") == "true")
+            old = old_groups.get(group.name)
+            if old is not None and _group_decl(old) == _group_decl(group):
+                # keep the old object, so that the clients we have
+                # already warned about are remembered
+                group = old
+            self.groups[group.name] = group
             if grp.get('default', 'false') == 'true':
                 self.default = grp.get('name')
 
-        self.group_membership = dict()
-        self.negated_groups = dict()
+        self.group_rules = MetadataGroupRules()
+        signature = []
 
         # confusing loop condition; the XPath query asks for all
         # elements under a Group tag under a Groups tag; that is
@@ -814,34 +2217,49 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
                 el.getchildren()):
                 continue
 
-            conditions = []
-            for parent in el.iterancestors():
-                cond = get_condition(parent)
-                if cond:
-                    conditions.append(cond)
-
             gname = el.get("name")
-            if el.get("negate", "false").lower() == "true":
-                self.negated_groups[aggregate_conditions(conditions)] = \
-                    self.groups[gname]
-            else:
-                if self.groups[gname].category:
-                    conditions.append(
-                        get_category_condition(self.groups[gname].category,
-                                               gname))
-
-                self.group_membership[aggregate_conditions(conditions)] = \
-                    self.groups[gname]
+            rule = self.group_rules.append(self.groups[gname], el)
+            signature.append((gname, rule.negate, rule.groups,
+                              rule.negated_groups, rule.clients,
+                              rule.negated_clients))
         self.states['groups.xml'] = True
 
+        if (signature != self.group_rule_signature or
+            self.default != old_default):
+            self.group_rule_signature = signature
+            self.core.metadata_cache.expire()
+            self.index.expire()
+        else:
+            changed = set()
+            for gname in set(old_groups.keys()) | set(self.groups.keys()):
+                if old_groups.get(gname) is not self.groups.get(gname):
+                    changed.add(gname)
+            if changed:
+                self._expire_groups(changed)
+
+    def _expire_groups(self, groups):
+        """ expire the clients that are members of any of the given
+        groups from the metadata cache and the client index """
+        for key, imd in list(self.core.metadata_cache.items()):
+            if not groups.isdisjoint(imd.groups):
+                self.core.metadata_cache.expire(key)
+        for key, imd in list(self.index.metadata.items()):
+            if not groups.isdisjoint(imd.groups):
+                self.index.expire(key)
+
     def HandleEvent(self, event):
-        """Handle update events for data files."""
+        """ Handle update events for data files.  Returns False if no
+        data file was reloaded, e.g., for events on files that are
+        not data files (like the clients.xml journal) or on files
+        that were last written by the server itself, so that they do
+        not invalidate cached configurations. """
+        changed = False
         for handles, event_handler in self.handlers.items():
             if handles(event):
-                # clear the entire cache when we get an event for any
-                # metadata file
-                self.core.metadata_cache.expire()
+                # the event handlers expire the cached metadata of
+                # the clients that were affected by the change
                 event_handler(event)
+                changed = True
 
         if False not in list(self.states.values()) and self.debug_flag:
             # check that all groups are real and complete. this is
@@ -857,6 +2275,7 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
                     if group not in self.groups:
                         self.debug_log("Group %s set as nonexistent group %s" %
                                        (gname, group))
+        return changed
 
     def set_profile(self, client, profile, addresspair):
         """Set group parameter for provided client."""
@@ -887,10 +2306,14 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
             self.logger.info("Changing %s profile from %s to %s" %
                              (client, profiles, profile))
             self.update_client(client, dict(profile=profile))
+            # update_client() normally updates the client's groups
+            # itself, so this must not assume that it has not
             if client in self.clientgroups:
                 for prof in profiles:
-                    self.clientgroups[client].remove(prof)
-                self.clientgroups[client].append(profile)
+                    if prof in self.clientgroups[client]:
+                        self.clientgroups[client].remove(prof)
+                if profile not in self.clientgroups[client]:
+                    self.clientgroups[client].append(profile)
             else:
                 self.clientgroups[client] = [profile]
         else:
@@ -906,9 +2329,11 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
                                          address=addresspair[0]))
                 else:
                     self.add_client(client, dict(profile=profile))
-                self.clients.append(client)
+                if client not in self.clients:
+                    self.clients.append(client)
                 self.clientgroups[client] = [profile]
-        if not self._use_db:
+        self.index.expire(client)
+        if not self._use_db and self.clients_xml.journal is None:
             self.clients_xml.write()
 
     def set_version(self, client, version):
@@ -919,7 +2344,8 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
                                  (client, version))
                 if not self._use_db:
                     self.update_client(client, dict(version=version))
-                    self.clients_xml.write()
+                    if self.clients_xml.journal is None:
+                        self.clients_xml.write()
                 self.versions[client] = version
         else:
             msg = "Cannot set version on non-existent client %s" % client
@@ -928,29 +2354,15 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
 
     def resolve_client(self, addresspair, cleanup_cache=False):
         """Lookup address locally or in DNS to get a hostname."""
+        if cleanup_cache:
+            # remove expired entries to avoid potentially infinite
+            # memory swell
+            self.session_cache.expire()
         if addresspair in self.session_cache:
-            # client _was_ cached, so there can be some expired
-            # entries. we need to clean them up to avoid potentially
-            # infinite memory swell
-            cache_ttl = 90
-            if cleanup_cache:
-                # remove entries for this client's IP address with
-                # _any_ port numbers - perhaps a priority queue could
-                # be faster?
-                curtime = time.time()
-                for addrpair in list(self.session_cache.keys()):
-                    if addresspair[0] == addrpair[0]:
-                        (stamp, _) = self.session_cache[addrpair]
-                        if curtime - stamp > cache_ttl:
-                            del self.session_cache[addrpair]
             # return the cached data
-            try:
-                stamp = self.session_cache[addresspair][0]
-                if time.time() - stamp < cache_ttl:
-                    return self.session_cache[addresspair][1]
-            except KeyError:
-                # we cleaned all cached data for this client in cleanup_cache
-                pass
+            stamp = self.session_cache[addresspair][0]
+            if time.time() - stamp < self.session_cache.ttl:
+                return self.session_cache[addresspair][1]
         address = addresspair[0]
         if address in self.addresses:
             if len(self.addresses[address]) != 1:
@@ -960,7 +2372,7 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
                 raise Bcfg2.Server.Plugin.MetadataConsistencyError(err)
             return self.addresses[address][0]
         try:
-            cname = socket.gethostbyaddr(address)[0].lower()
+            cname = self.core.resolver.gethostbyaddr(address)[0].lower()
             if cname in self.aliases:
                 return self.aliases[cname]
             return cname
@@ -973,28 +2385,91 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
     def _merge_groups(self, client, groups, categories=None):
         """ set group membership based on the contents of groups.xml
         and initial group membership of this client. Returns a tuple
-        of (allgroups, categories)"""
-        numgroups = -1  # force one initial pass
+        of (allgroups, categories)
+
+        The result is that of evaluating every rule in groups.xml, in
+        order, until the client's groups stop changing, where each
+        pass first evaluates the rules that add the client to groups,
+        and then those that remove it from groups.  Only the rules
+        that could change the client's groups are evaluated, though:
+        those that do not require any groups, and those whose inputs
+        have changed since they were last evaluated. """
         if categories is None:
             categories = dict()
-        while numgroups != len(groups):
+        rules = self.group_rules
+
+        # the positions of the rules to evaluate on the next pass,
+        # indexed by rule.negate
+        dirty = [set(), set()]
+        for rule in rules.untriggered + rules.by_client.get(client, []):
+            dirty[rule.negate].add(rule.position)
+        for gname in groups:
+            for rule in rules.on_add.get(gname, []):
+                dirty[rule.negate].add(rule.position)
+
+        numgroups = -1  # force one initial pass
+        while numgroups != len(groups) and (dirty[0] or dirty[1]):
             numgroups = len(groups)
-            for predicate, group in self.group_membership.items():
-                if group.name in groups:
-                    continue
-                if predicate(client, groups, categories):
-                    groups.add(group.name)
-                    if group.category:
-                        categories[group.category] = group.name
-            for predicate, group in self.negated_groups.items():
-                if group.name not in groups:
-                    continue
-                if predicate(client, groups, categories):
-                    groups.remove(group.name)
-                    if group.category:
-                        del categories[group.category]
+            for negate in [False, True]:
+                pending = list(dirty[negate])
+                dirty[negate] = set()
+                queued = set(pending)
+                heapq.heapify(pending)
+                while pending:
+                    position = heapq.heappop(pending)
+                    rule = rules.get(negate, position)
+                    if negate:
+                        triggered = self._remove_group(client, rule, groups,
+                                                       categories)
+                    else:
+                        triggered = self._add_group(client, rule, groups,
+                                                    categories)
+                    for trigger in triggered:
+                        if (trigger.negate == negate and
+                            trigger.position > position):
+                            # still to come on this pass
+                            if trigger.position not in queued:
+                                queued.add(trigger.position)
+                                heapq.heappush(pending, trigger.position)
+                        else:
+                            dirty[trigger.negate].add(trigger.position)
         return (groups, categories)
 
+    def _add_group(self, client, rule, groups, categories):
+        """ add the client to the group of a rule if it matches.
+        returns the list of rules that might change the client's
+        groups as a result """
+        group = rule.group
+        if group.name in groups or not rule(client, groups):
+            return []
+        if group.category and group.category in categories:
+            if client not in group.warned:
+                self.logger.warning("%s: Group %s suppressed by category %s; "
+                                    "%s already a member of %s" %
+                                    (self.name, group.name, group.category,
+                                     client, categories[group.category]))
+                group.warned.append(client)
+            return []
+        groups.add(group.name)
+        if group.category:
+            categories[group.category] = group.name
+        return self.group_rules.on_add.get(group.name, [])
+
+    def _remove_group(self, client, rule, groups, categories):
+        """ remove the client from the group of a negated rule if it
+        matches.  returns the list of rules that might change the
+        client's groups as a result """
+        group = rule.group
+        if group.name not in groups or not rule(client, groups):
+            return []
+        groups.remove(group.name)
+        triggered = self.group_rules.on_remove.get(group.name, [])
+        if group.category:
+            categories.pop(group.category, None)
+            triggered = triggered + \
+                self.group_rules.on_category.get(group.category, [])
+        return triggered
+
     def get_initial_metadata(self, client):  # pylint: disable=R0914,R0912
         """Return the metadata for a given client."""
         if False in list(self.states.values()):
@@ -1003,7 +2478,10 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
         client = client.lower()
 
         if client in self.core.metadata_cache:
-            return self.core.metadata_cache[client]
+            # the entry may be evicted before it is fetched
+            imd = self.core.metadata_cache.get(client)
+            if imd is not None:
+                return imd
 
         if client in self.aliases:
             client = self.aliases[client]
@@ -1071,12 +2549,7 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
             password = self.passwords[client]
         else:
             password = None
-        uuids = [item for item, value in list(self.uuid.items())
-                 if value == client]
-        if uuids:
-            uuid = uuids[0]
-        else:
-            uuid = None
+        uuid = self.ruuid.get(client)
         if not profile:
             # one last ditch attempt at setting the profile
             profiles = [g for g in groups
@@ -1095,8 +2568,7 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
         """ return a list of all group names """
         all_groups = set()
         all_groups.update(self.groups.keys())
-        all_groups.update([g.name for g in self.group_membership.values()])
-        all_groups.update([g.name for g in self.negated_groups.values()])
+        all_groups.update(self.group_rules.get_group_names())
         for grp in self.clientgroups.values():
             all_groups.update(grp)
         return all_groups
@@ -1108,46 +2580,72 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
 
     def get_client_names_by_profiles(self, profiles):
         """ return a list of names of clients in the given profile groups """
-        rv = []
-        for client in list(self.clients):
-            mdata = self.core.build_metadata(client)
-            if mdata.profile in profiles:
-                rv.append(client)
-        return rv
+        return self.index.get_clients_by_profiles(profiles)
 
     def get_client_names_by_groups(self, groups):
         """ return a list of names of clients in the given groups """
-        mdata = [self.core.build_metadata(client) for client in self.clients]
-        return [md.hostname for md in mdata if md.groups.issuperset(groups)]
+        return self.index.get_clients_by_groups(groups)
 
     def get_client_names_by_bundles(self, bundles):
         """ given a list of bundles, return a list of names of clients
         that use those bundles """
-        mdata = [self.core.build_metadata(client) for client in self.clients]
-        return [md.hostname for md in mdata if md.bundles.issuperset(bundles)]
+        return self.index.get_clients_by_bundles(bundles)
+
+    def expire_client_index(self, client=None):
+        """ Expire a client, or all clients, from the fleet-wide
+        index of final client metadata used by
+        :func:`get_client_names_by_groups` and friends.  Connector
+        plugins should call this when the groups they assign to a
+        client change. """
+        self.index.expire(client)
+
+    def update_client_index(self, client, imd):
+        """ Update the fleet-wide index with final client metadata
+        that has just been built.  The client is only reindexed if its
+        groups, bundles, or profile changed, so that data from
+        Connector plugins that don't notify us of changes is picked up
+        without discarding the index on every client run. """
+        self.index.update(client, imd)
+
+    def _get_connector_generations(self):
+        """ get the generation counters of all Connector plugins.
+        these change whenever the files those plugins read change,
+        which may change the groups they assign to clients """
+        generations = getattr(self.core, "generations", dict())
+        return tuple([generations.get(conn.name, 0)
+                      for conn in self.core.connectors])
 
     def merge_additional_groups(self, imd, groups):
+        # the sets in imd are interned and shared with other clients,
+        # so work on copies and assign them back when done
+        newgroups = set(imd.groups)
+        categories = dict(imd.categories)
         for group in groups:
-            if group in imd.groups:
+            if group in newgroups:
                 continue
             if group in self.groups and self.groups[group].category:
                 category = self.groups[group].category
-                if self.groups[group].category in imd.categories:
+                if self.groups[group].category in categories:
                     self.logger.warning("%s: Group %s suppressed by category "
                                         "%s; %s already a member of %s" %
                                         (self.name, group, category,
                                          imd.hostname,
-                                         imd.categories[category]))
+                                         categories[category]))
                     continue
-                imd.categories[category] = group
-            imd.groups.add(group)
-
-        self._merge_groups(imd.hostname, imd.groups,
-                           categories=imd.categories)
-
-        for group in imd.groups:
-            if group in self.groups:
-                imd.bundles.update(self.groups[group].bundles)
+                categories[category] = group
+            newgroups.add(group)
+
+        if len(newgroups) != len(imd.groups):
+            newgroups, categories = \
+                self._merge_groups(imd.hostname, newgroups,
+                                   categories=categories)
+            bundles = set(imd.bundles)
+            for group in newgroups:
+                if group in self.groups:
+                    bundles.update(self.groups[group].bundles)
+            imd.groups = newgroups
+            imd.categories = categories
+            imd.bundles = bundles
 
         if not imd.profile:
             # if the client still doesn't have a profile group after
@@ -1163,7 +2661,7 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
     def merge_additional_data(self, imd, source, data):
         if not hasattr(imd, source):
             setattr(imd, source, data)
-            imd.connectors.append(source)
+            imd.connectors = imd.connectors + (source,)
 
     def validate_client_address(self, client, addresspair):
         """Check address against client."""
@@ -1213,11 +2711,13 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
         else:
             id_method = 'uuid'
             # user maps to client
-            if user not in self.uuid:
+            try:
+                client = self.uuid[user]
+            except KeyError:
                 client = user
                 self.uuid[user] = user
-            else:
-                client = self.uuid[user]
+                if user not in self.ruuid:
+                    self.ruuid[user] = user
 
         # we have the client name
         self.debug_log("Authenticating client %s" % client)
@@ -9,6 +9,7 @@ import shutil
 import lxml.etree
 import Bcfg2.Logger
 import Bcfg2.Server.Plugin
+from Bcfg2.Cache import get_cache
 from Bcfg2.Compat import ConfigParser, urlopen, HTTPError
 from Bcfg2.Server.Plugins.Packages.Collection import Collection, \
     get_collection_class
@@ -99,8 +100,11 @@ class Packages(Bcfg2.Server.Plugin.Plugin,
         #: collection
         #: :attr:`Bcfg2.Server.Plugins.Packages.Collection.Collection.cachekey`,
         #: a unique key identifying the collection by its *config*,
-        #: which could be shared among multiple clients.
-        self.collections = dict()
+        #: which could be shared among multiple clients.  Its limits
+        #: are set by the ``packages_collections_*`` options in the
+        #: ``[caching]`` section of ``bcfg2.conf``.
+        self.collections = get_cache("packages_collections",
+                                     self.core.setup.cfp, max_entries=100)
 
         #: clients is a cache mapping of hostname ->
         #: :attr:`Bcfg2.Server.Plugins.Packages.Collection.Collection.cachekey`
@@ -108,7 +112,9 @@ class Packages(Bcfg2.Server.Plugin.Plugin,
         #: :class:`Bcfg2.Server.Plugins.Packages.Collection.Collection`
         #: object when one is requested, so each entry is very
         #: short-lived -- it's purged at the end of each client run.
-        self.clients = dict()
+        #: Entries for runs that never end expire after an hour.
+        self.clients = get_cache("packages_clients", self.core.setup.cfp,
+                                 ttl=3600)
         # pylint: enable=C0301
 
     __init__.__doc__ = Bcfg2.Server.Plugin.Plugin.__init__.__doc__
@@ -407,8 +413,8 @@ class Packages(Bcfg2.Server.Plugin.Plugin,
                 collection.setup_data(force_update)
 
         # clear Collection caches
-        self.clients = dict()
-        self.collections = dict()
+        self.clients.expire()
+        self.collections.expire()
 
         for source in self.sources.entries:
             cachefiles.add(source.cachefile)
@@ -487,8 +493,11 @@ class Packages(Bcfg2.Server.Plugin.Plugin,
             return Collection(metadata, [], self.cachepath, self.data,
                               self.core.fam)
 
-        if metadata.hostname in self.clients:
-            return self.collections[self.clients[metadata.hostname]]
+        ckey = self.clients.get(metadata.hostname)
+        if ckey is not None:
+            collection = self.collections.get(ckey)
+            if collection is not None:
+                return collection
 
         sclasses = set()
         relevant = list()
@@ -546,8 +555,7 @@ class Packages(Bcfg2.Server.Plugin.Plugin,
         :param metadata: The client metadata
         :type metadata: Bcfg2.Server.Plugins.Metadata.ClientMetadata
         """
-        if metadata.hostname in self.clients:
-            del self.clients[metadata.hostname]
+        self.clients.expire(metadata.hostname)
 
     def end_statistics(self, metadata):
         """ Hook to clear the cache for this client in :attr:`clients`
@@ -156,6 +156,13 @@ class Pkgmgr(Bcfg2.Server.Plugin.PrioDir):
                     except KeyError:
                         self.Entries[itype] = FuzzyDict([(child,
                                                           self.BindEntry)])
+        self._update_index()
+
+    def _index_key(self, entry):
+        mdata = FuzzyDict.fuzzy.match(entry.get('name'))
+        if mdata:
+            return (entry.tag, mdata.group('name'))
+        return (entry.tag, entry.get('name'))
 
     def BindEntry(self, entry, metadata):
         """Bind data for entry, and remove instances that are not requested."""
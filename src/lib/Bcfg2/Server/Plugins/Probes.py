@@ -125,10 +125,13 @@ class ProbeSet(Bcfg2.Server.Plugin.EntrySet):
         fam.AddMonitor(path, self)
 
     def HandleEvent(self, event):
-        """ handle events on everything but probed.xml """
+        """ handle events on everything but probed.xml.  Returns
+        False for ignored events, so that they do not invalidate
+        cached configurations. """
         if (event.filename != self.path and
             not event.filename.endswith("probed.xml")):
             return self.handle_event(event)
+        return False
 
     def get_probe_data(self, metadata):
         """ Get an XML description of all probes for a client suitable
@@ -256,38 +259,89 @@ class Probes(Bcfg2.Server.Plugin.Probing,
         else:
             return self._load_data_xml()
 
-    def _load_data_xml(self):
-        """ Load probe data from probed.xml """
+    def load_client_data(self, hostname):
+        if self._use_db:
+            return self._load_data_db(hostname)
+        else:
+            return self._load_client_data_xml(hostname)
+    load_client_data.__doc__ = \
+        Bcfg2.Server.Plugin.Probing.load_client_data.__doc__
+
+    def _read_probed_xml(self):
+        """ Parse probed.xml and return the root element, or None if
+        it cannot be read """
         try:
-            data = lxml.etree.parse(os.path.join(self.data, 'probed.xml'),
+            return lxml.etree.parse(os.path.join(self.data, 'probed.xml'),
                                     parser=Bcfg2.Server.XMLParser).getroot()
         except (IOError, lxml.etree.XMLSyntaxError):
             err = sys.exc_info()[1]
             self.logger.error("Failed to read file probed.xml: %s" % err)
+            return None
+
+    def _load_data_xml(self):
+        """ Load probe data from probed.xml """
+        data = self._read_probed_xml()
+        if data is None:
             return
         self.probedata = {}
         self.cgroups = {}
         for client in data.getchildren():
-            self.probedata[client.get('name')] = \
-                ClientProbeDataSet(timestamp=client.get("timestamp"))
-            self.cgroups[client.get('name')] = []
-            for pdata in client:
-                if pdata.tag == 'Probe':
-                    self.probedata[client.get('name')][pdata.get('name')] = \
-                        ProbeData(pdata.get("value"))
-                elif pdata.tag == 'Group':
-                    self.cgroups[client.get('name')].append(pdata.get('name'))
-
-    def _load_data_db(self):
-        """ Load probe data from the database """
-        self.probedata = {}
-        self.cgroups = {}
-        for pdata in ProbesDataModel.objects.all():
+            self._load_client_xml(client)
+
+    def _load_client_data_xml(self, hostname):
+        """ Reload the probe data of a single client from probed.xml.
+        Every server process writes all of the probe data it knows
+        about to probed.xml, so the file may have been written by a
+        process that had not yet seen the latest data for this
+        client; data older than what is already loaded is ignored. """
+        data = self._read_probed_xml()
+        if data is None:
+            return
+        for client in data.getchildren():
+            if client.get("name") != hostname:
+                continue
+            if (hostname in self.probedata and
+                int(float(client.get("timestamp", 0))) <
+                int(float(self.probedata[hostname].timestamp))):
+                self.logger.debug("Ignoring outdated probe data for %s in "
+                                  "probed.xml" % hostname)
+            else:
+                self._load_client_xml(client)
+            return
+
+    def _load_client_xml(self, client):
+        """ Load the probe data for a single client from its
+        ``<Client>`` tag in probed.xml """
+        hostname = client.get('name')
+        self.probedata[hostname] = \
+            ClientProbeDataSet(timestamp=client.get("timestamp"))
+        self.cgroups[hostname] = []
+        for pdata in client:
+            if pdata.tag == 'Probe':
+                self.probedata[hostname][pdata.get('name')] = \
+                    ProbeData(pdata.get("value"))
+            elif pdata.tag == 'Group':
+                self.cgroups[hostname].append(pdata.get('name'))
+
+    def _load_data_db(self, hostname=None):
+        """ Load probe data from the database, either for all clients
+        or only for the given client """
+        pdata_objects = ProbesDataModel.objects.all()
+        pgroup_objects = ProbesGroupsModel.objects.all()
+        if hostname is None:
+            self.probedata = {}
+            self.cgroups = {}
+        else:
+            pdata_objects = pdata_objects.filter(hostname=hostname)
+            pgroup_objects = pgroup_objects.filter(hostname=hostname)
+            self.probedata.pop(hostname, None)
+            self.cgroups[hostname] = []
+        for pdata in pdata_objects:
             if pdata.hostname not in self.probedata:
                 self.probedata[pdata.hostname] = ClientProbeDataSet(
                     timestamp=time.mktime(pdata.timestamp.timetuple()))
             self.probedata[pdata.hostname][pdata.probe] = ProbeData(pdata.data)
-        for pgroup in ProbesGroupsModel.objects.all():
+        for pgroup in pgroup_objects:
             if pgroup.hostname not in self.cgroups:
                 self.cgroups[pgroup.hostname] = []
             self.cgroups[pgroup.hostname].append(pgroup.group)
@@ -299,11 +353,10 @@ class Probes(Bcfg2.Server.Plugin.Probing,
 
     @Bcfg2.Server.Plugin.track_statistics()
     def ReceiveData(self, client, datalist):
-        if self.core.metadata_cache_mode in ['cautious', 'aggressive']:
-            if client.hostname in self.cgroups:
-                olddata = copy.copy(self.cgroups[client.hostname])
-            else:
-                olddata = []
+        if client.hostname in self.cgroups:
+            olddata = copy.copy(self.cgroups[client.hostname])
+        else:
+            olddata = []
 
         cgroups = []
         cprobedata = ClientProbeDataSet()
@@ -312,9 +365,11 @@ class Probes(Bcfg2.Server.Plugin.Probing,
         self.cgroups[client.hostname] = cgroups
         self.probedata[client.hostname] = cprobedata
 
-        if (self.core.metadata_cache_mode in ['cautious', 'aggressive'] and
-            olddata != self.cgroups[client.hostname]):
-            self.core.metadata_cache.expire(client.hostname)
+        if olddata != self.cgroups[client.hostname]:
+            if self.core.metadata_cache_mode in ['cautious', 'aggressive']:
+                self.core.metadata_cache.expire(client.hostname)
+            if hasattr(self.core.metadata, "expire_client_index"):
+                self.core.metadata.expire_client_index(client.hostname)
         self.write_data(client)
     ReceiveData.__doc__ = Bcfg2.Server.Plugin.Probing.ReceiveData.__doc__
 
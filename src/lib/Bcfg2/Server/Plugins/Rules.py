@@ -46,6 +46,11 @@ class Rules(Bcfg2.Server.Plugin.PrioDir):
                     return True
         return False
 
+    def _strict_matching(self, entry):
+        # Path entries and regex rules need the full search in
+        # _matches; anything else is an exact match on the name
+        return entry.tag != "Path" and not self._regex_enabled
+
     @property
     def _regex_enabled(self):
         """ Return True if rules regexes are enabled, False otherwise """
@@ -127,8 +127,6 @@ class SSHbase(Bcfg2.Server.Plugin.Plugin,
         Bcfg2.Server.Plugin.Plugin.__init__(self, core, datastore)
         Bcfg2.Server.Plugin.Generator.__init__(self)
         Bcfg2.Server.Plugin.PullTarget.__init__(self)
-        self.ipcache = {}
-        self.namecache = {}
         self.__skn = False
 
         # keep track of which bogus keys we've warned about, and only
@@ -278,51 +276,30 @@ class SSHbase(Bcfg2.Server.Plugin.Plugin,
                          (event.filename, action))
 
     def get_ipcache_entry(self, client):
-        """Build a cache of dns results."""
-        if client in self.ipcache:
-            if self.ipcache[client]:
-                return self.ipcache[client]
-            else:
-                raise socket.gaierror
-        else:
-            # need to add entry
-            try:
-                ipaddr = socket.gethostbyname(client)
-                self.ipcache[client] = (ipaddr, client)
-                return (ipaddr, client)
-            except socket.gaierror:
-                ipaddr = Popen(["getent", "hosts", client],
-                               stdout=PIPE).stdout.read().strip().split()
-                if ipaddr:
-                    self.ipcache[client] = (ipaddr, client)
-                    return (ipaddr, client)
-                self.ipcache[client] = False
-                self.logger.error("Failed to find IP address for %s" % client)
-                raise socket.gaierror
+        """ Look up the IP address of a client.  Lookups are cached
+        by the :attr:`Bcfg2.Server.Core.BaseCore.resolver`. """
+        try:
+            return (self.core.resolver.gethostbyname(client), client)
+        except socket.gaierror:
+            self.logger.error("Failed to find IP address for %s" % client)
+            raise
 
     def get_namecache_entry(self, cip):
-        """Build a cache of name lookups from client IP addresses."""
-        if cip in self.namecache:
-            # lookup cached name from IP
-            if self.namecache[cip]:
-                return self.namecache[cip]
-            else:
-                raise socket.gaierror
+        """ Look up the names associated with a client IP address.
+        Lookups are cached by the
+        :attr:`Bcfg2.Server.Core.BaseCore.resolver`. """
+        try:
+            rvlookup = self.core.resolver.gethostbyaddr(cip)
+        except socket.herror:
+            self.logger.error("Failed to find any names associated with "
+                              "IP address %s" % cip)
+            raise
+        if rvlookup[0]:
+            rv = [rvlookup[0]]
         else:
-            # add an entry that has not been cached
-            try:
-                rvlookup = socket.gethostbyaddr(cip)
-                if rvlookup[0]:
-                    self.namecache[cip] = [rvlookup[0]]
-                else:
-                    self.namecache[cip] = []
-                self.namecache[cip].extend(rvlookup[1])
-                return self.namecache[cip]
-            except socket.gaierror:
-                self.namecache[cip] = False
-                self.logger.error("Failed to find any names associated with "
-                                  "IP address %s" % cip)
-                raise
+            rv = []
+        rv.extend(rvlookup[1])
+        return rv
 
     def build_skn(self, entry, metadata):
         """This function builds builds a host specific known_hosts file."""
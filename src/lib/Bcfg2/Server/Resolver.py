@@ -0,0 +1,271 @@
+""" A cache of DNS lookups that is shared by the server core and all
+plugins.  Resolving client names and addresses is done on request
+threads, often while authenticating a client, so a slow or broken
+DNS server can stall the whole server.  :class:`Resolver` caches
+both successful and failed lookups for a limited time, and can
+refresh expired entries in the background and give up on lookups
+that take too long. """
+
+import sys
+import time
+import heapq
+import socket
+import logging
+import threading
+import Bcfg2.Statistics
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Resolver(object):
+    """ A thread-safe cache of DNS lookups with per-entry expiration
+    times.
+
+    Each entry expires :attr:`ttl` seconds after it was looked up, or
+    :attr:`negative_ttl` seconds if the lookup failed.  Entries are
+    kept in a heap ordered by expiration time, so expired entries are
+    purged without scanning the whole cache, and when the cache grows
+    beyond :attr:`size` entries, the entries closest to expiring are
+    evicted first.
+
+    If :attr:`refresh` is set, an expired entry is returned as it was
+    while it is looked up again in a background thread, so that only
+    the first lookup of a name or address ever waits on DNS.  If
+    :attr:`timeout` is set, lookups that take longer than that are
+    treated as failures (and are negatively cached once they do
+    finish). """
+
+    def __init__(self, ttl=300, negative_ttl=60, size=10000, timeout=None,
+                 refresh=True):
+        """
+        :param ttl: How long, in seconds, successful lookups are cached
+        :type ttl: float
+        :param negative_ttl: How long, in seconds, failed lookups are
+                             cached
+        :type negative_ttl: float
+        :param size: The maximum number of entries in the cache
+        :type size: int
+        :param timeout: How long, in seconds, to wait for a lookup,
+                        or None to wait as long as it takes
+        :type timeout: float
+        :param refresh: Refresh expired entries in the background
+        :type refresh: bool
+        """
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.size = size
+        self.timeout = timeout
+        self.refresh = refresh
+
+        #: A dict of (<lookup function name>, <argument>) -> (<expiry
+        #: time>, <result>, <exception>)
+        self.entries = dict()
+
+        #: A heap of (<expiry time>, <key>).  A heap item is stale if
+        #: the entry for the key no longer has that expiry time.
+        self.heap = []
+
+        #: A dict of key -> :class:`threading.Event` for lookups that
+        #: are in progress, so that concurrent lookups of the same key
+        #: wait for a single query
+        self.pending = dict()
+
+        #: Counters of cache activity; see :func:`get_stats`
+        self.stats = dict(hits=0, negative_hits=0, stale_hits=0, misses=0,
+                          refreshes=0, timeouts=0, evictions=0)
+        self.lock = threading.Lock()
+
+    def gethostbyaddr(self, address):
+        """ Look up the names of an IP address, like
+        :func:`socket.gethostbyaddr`.
+
+        :param address: The address to look up
+        :type address: string
+        :returns: tuple of (<name>, <list of aliases>, <list of
+                  addresses>)
+        :raises: :exc:`socket.herror`
+        """
+        return self._lookup("gethostbyaddr", address, socket.herror)
+
+    def gethostbyname(self, name):
+        """ Look up the address of a hostname, like
+        :func:`socket.gethostbyname`.  If the name has no IPv4
+        address, its first IPv6 address is returned instead.
+
+        :param name: The hostname to look up
+        :type name: string
+        :returns: string
+        :raises: :exc:`socket.gaierror`
+        """
+        return self._lookup("gethostbyname", name, socket.gaierror)
+
+    def _query(self, func, arg):
+        """ Perform an actual DNS lookup """
+        if func == "gethostbyaddr":
+            return socket.gethostbyaddr(arg)
+        try:
+            return socket.gethostbyname(arg)
+        except socket.gaierror:
+            # gethostbyname() only finds IPv4 addresses
+            err = sys.exc_info()[1]
+            try:
+                return socket.getaddrinfo(arg, None)[0][4][0]
+            except (socket.gaierror, IndexError):
+                raise err
+
+    def _lookup(self, func, arg, error):
+        """ Look up a key in the cache, querying DNS if necessary """
+        key = (func, arg)
+        now = time.time()
+        self.lock.acquire()
+        try:
+            self._purge(now)
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    if entry[2] is None:
+                        self.stats['hits'] += 1
+                    else:
+                        self.stats['negative_hits'] += 1
+                    return self._result(entry, error)
+                elif self.refresh:
+                    self.stats['stale_hits'] += 1
+                    self._start_query(key, background=True)
+                    return self._result(entry, error)
+            self.stats['misses'] += 1
+            done = self._start_query(key,
+                                     background=self.timeout is not None)
+        finally:
+            self.lock.release()
+
+        done.wait(self.timeout)
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            if not done.isSet() or entry is None:
+                self.stats['timeouts'] += 1
+                raise error("Timed out looking up %s" % arg)
+            return self._result(entry, error)
+        finally:
+            self.lock.release()
+
+    def _result(self, entry, error):
+        """ Return the result of a cache entry, or raise the error it
+        holds """
+        if entry[2] is not None:
+            raise error(*entry[2].args)
+        return entry[1]
+
+    def _start_query(self, key, background=False):
+        """ Start a lookup of a key, unless one is already in
+        progress.  Returns a :class:`threading.Event` that is set when
+        the lookup has finished.  Unless ``background`` is set, the
+        lookup is done in the calling thread, and is finished when
+        this returns.  Must be called with :attr:`lock` held. """
+        if key in self.pending:
+            return self.pending[key]
+        done = threading.Event()
+        self.pending[key] = done
+        if key in self.entries:
+            self.stats['refreshes'] += 1
+        if not background:
+            # the lock cannot be held while querying, or a single
+            # slow lookup would block every other lookup
+            self.lock.release()
+            try:
+                self._run_query(key, done)
+            finally:
+                self.lock.acquire()
+        else:
+            thread = threading.Thread(name="Resolver:%s:%s" % key,
+                                      target=self._run_query,
+                                      args=(key, done))
+            thread.setDaemon(True)
+            thread.start()
+        return done
+
+    def _run_query(self, key, done):
+        """ Query DNS for a key and cache the result """
+        start = time.time()
+        entry = None
+        try:
+            try:
+                result = self._query(*key)
+                entry = (time.time() + self.ttl, result, None)
+            except socket.error:
+                err = sys.exc_info()[1]
+                LOGGER.debug("Resolver: %s(%s) failed: %s" % (key[0], key[1],
+                                                              err))
+                entry = (time.time() + self.negative_ttl, None, err)
+        finally:
+            Bcfg2.Statistics.stats.add_value("Resolver:%s" % key[0],
+                                             time.time() - start)
+            self.lock.acquire()
+            try:
+                if entry is not None:
+                    self.entries[key] = entry
+                    heapq.heappush(self.heap, (entry[0], key))
+                    self._evict()
+                del self.pending[key]
+            finally:
+                self.lock.release()
+                done.set()
+
+    def _purge(self, now):
+        """ Remove expired entries from the cache.  If :attr:`refresh`
+        is set, expired entries are kept until they have been expired
+        for :attr:`ttl` seconds, so they can be served while they are
+        refreshed. Must be called with :attr:`lock` held. """
+        if self.refresh:
+            now -= self.ttl
+        while self.heap and self.heap[0][0] <= now:
+            expires, key = heapq.heappop(self.heap)
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == expires:
+                del self.entries[key]
+
+    def _evict(self):
+        """ Evict the entries closest to expiring until the cache is
+        no larger than :attr:`size`.  Must be called with
+        :attr:`lock` held. """
+        while len(self.entries) > self.size and self.heap:
+            expires, key = heapq.heappop(self.heap)
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == expires:
+                del self.entries[key]
+                self.stats['evictions'] += 1
+
+    def expire(self, arg=None):
+        """ Expire all cached lookups, or all lookups of the given
+        name or address.
+
+        :param arg: The name or address to expire lookups of
+        :type arg: string
+        """
+        self.lock.acquire()
+        try:
+            if arg is None:
+                self.entries.clear()
+                self.heap = []
+            else:
+                for func in ["gethostbyaddr", "gethostbyname"]:
+                    self.entries.pop((func, arg), None)
+        finally:
+            self.lock.release()
+
+    def get_stats(self):
+        """ Get counters of cache activity: ``hits``,
+        ``negative_hits`` (cached failed lookups), ``stale_hits``
+        (expired entries served while they were refreshed),
+        ``misses``, ``refreshes``, ``timeouts``, ``evictions``, and
+        ``size`` (the number of entries in the cache).
+
+        :returns: dict of string -> int
+        """
+        self.lock.acquire()
+        try:
+            rv = dict(self.stats)
+            rv['size'] = len(self.entries)
+            return rv
+        finally:
+            self.lock.release()
@@ -1,37 +1,229 @@
 """ Module for tracking execution time statistics from the Bcfg2
 server core.  This data is exposed by
-:func:`Bcfg2.Server.Core.BaseCore.get_statistics`."""
+:func:`Bcfg2.Server.Core.BaseCore.get_statistics`.
+
+Values are recorded into log-bucketed histograms, so percentiles can
+be estimated without keeping every value, and into a series of short
+time slots, so that statistics can also be reported over a sliding
+window of recent time.  Each thread records values into its own set
+of :class:`Statistic` objects without taking a lock; they are merged
+when the statistics are read. """
+
+import math
+import time
+import threading
+
+#: The ratio between the bounds of consecutive histogram buckets.
+#: Percentiles are accurate to within about half of this.
+BUCKET_RATIO = 2 ** 0.125
+
+#: The histogram bucket used for values that are zero or negative
+ZERO_BUCKET = -10000
+
+#: The length, in seconds, of each of the time slots that sliding
+#: windows are made of
+SLOT_LENGTH = 10
+
+#: The sliding windows, in seconds, that statistics are reported for
+WINDOWS = [60, 300, 900]
+
+#: The percentiles that are reported
+PERCENTILES = [50, 90, 99]
+
+
+def get_bucket(value):
+    """ Get the histogram bucket a value belongs in """
+    if value <= 0:
+        return ZERO_BUCKET
+    return int(math.floor(math.log(value) / math.log(BUCKET_RATIO)))
+
+
+def get_percentile(histogram, count, percentile, minimum, maximum):
+    """ Estimate a percentile from a histogram.
+
+    :param histogram: A dict of bucket -> number of values
+    :type histogram: dict
+    :param count: The total number of values in the histogram
+    :type count: int
+    :param percentile: The percentile to get, 0-100
+    :type percentile: int or float
+    :param minimum: The smallest value in the histogram; the estimate
+                    will not be lower than this
+    :type minimum: float
+    :param maximum: The largest value in the histogram; the estimate
+                    will not be higher than this
+    :type maximum: float
+    :returns: float
+    """
+    if not count:
+        return 0.0
+    target = count * percentile / 100.0
+    seen = 0
+    for bucket in sorted(histogram.keys()):
+        seen += histogram[bucket]
+        if seen >= target:
+            if bucket == ZERO_BUCKET:
+                value = 0.0
+            else:
+                value = BUCKET_RATIO ** (bucket + 0.5)
+            return max(minimum, min(maximum, value))
+    return maximum
+
+
+def merge_histogram(dest, src):
+    """ Add the counts in one histogram to another """
+    for bucket, count in list(src.items()):
+        dest[bucket] = dest.get(bucket, 0) + count
+
+
+def _escape_label(value):
+    """ Escape a Prometheus label value """
+    value = value.replace("\\", "\\\\").replace('"', '\\"')
+    return value.replace("\n", "\\n")
 
 
 class Statistic(object):
     """ A single named statistic, tracking minimum, maximum, and
-    average execution time, and number of invocations. """
+    average execution time, number of invocations, and a histogram
+    of values. """
 
-    def __init__(self, name, initial_value):
+    def __init__(self, name, initial_value=None):
         """
         :param name: The name of this statistic
         :type name: string
         :param initial_value: The initial value to be added to this
+                              statistic, or None to create an empty
                               statistic
         :type initial_value: int or float
         """
         self.name = name
-        self.min = float(initial_value)
-        self.max = float(initial_value)
-        self.ave = float(initial_value)
-        self.count = 1
+        self.min = None
+        self.max = None
+        self.sum = 0.0
+        self.count = 0
+
+        #: A dict of histogram bucket -> number of values
+        self.histogram = dict()
+
+        #: A dict of time slot -> [count, sum, histogram] for the
+        #: values added in that slot
+        self.slots = dict()
+        if initial_value is not None:
+            self.add_value(initial_value)
+
+    def _get_ave(self):
+        """ The average of all values """
+        if not self.count:
+            return 0.0
+        return self.sum / self.count
+    ave = property(_get_ave)
 
-    def add_value(self, value):
+    def add_value(self, value, now=None):
         """ Add a value to the statistic, recalculating the various
         metrics.
 
         :param value: The value to add to this statistic
         :type value: int or float
+        :param now: The time the value was recorded at.  Defaults to
+                    the current time.
+        :type now: float
         """
-        self.min = min(self.min, value)
-        self.max = max(self.max, value)
-        self.ave = (((self.ave * (self.count - 1)) + value) / self.count)
+        value = float(value)
+        if self.count:
+            self.min = min(self.min, value)
+            self.max = max(self.max, value)
+        else:
+            self.min = self.max = value
+        self.sum += value
         self.count += 1
+        bucket = get_bucket(value)
+        self.histogram[bucket] = self.histogram.get(bucket, 0) + 1
+
+        if now is None:
+            now = time.time()
+        slot_id = int(now // SLOT_LENGTH)
+        try:
+            slot = self.slots[slot_id]
+        except KeyError:
+            self._expire_slots(slot_id)
+            slot = self.slots[slot_id] = [0, 0.0, dict()]
+        slot[0] += 1
+        slot[1] += value
+        slot[2][bucket] = slot[2].get(bucket, 0) + 1
+
+    def _expire_slots(self, current):
+        """ Forget time slots that have fallen out of all windows """
+        oldest = current - max(WINDOWS) // SLOT_LENGTH
+        for slot_id in list(self.slots.keys()):
+            if slot_id <= oldest:
+                del self.slots[slot_id]
+
+    def merge(self, other):
+        """ Add all of the values in another statistic to this one.
+
+        :param other: The statistic to merge into this one
+        :type other: Bcfg2.Statistics.Statistic
+        """
+        if not other.count:
+            return
+        if self.count:
+            self.min = min(self.min, other.min)
+            self.max = max(self.max, other.max)
+        else:
+            self.min = other.min
+            self.max = other.max
+        self.sum += other.sum
+        self.count += other.count
+        merge_histogram(self.histogram, other.histogram)
+        for slot_id, (count, total, histogram) in list(other.slots.items()):
+            try:
+                slot = self.slots[slot_id]
+            except KeyError:
+                slot = self.slots[slot_id] = [0, 0.0, dict()]
+            slot[0] += count
+            slot[1] += total
+            merge_histogram(slot[2], histogram)
+
+    def percentile(self, percentile):
+        """ Estimate a percentile of all values.
+
+        :param percentile: The percentile to get, 0-100
+        :type percentile: int or float
+        :returns: float
+        """
+        return get_percentile(self.histogram, self.count, percentile,
+                              self.min, self.max)
+
+    def get_window(self, window, now=None):
+        """ Get the count, average, and percentiles of the values
+        added in the last ``window`` seconds.
+
+        :param window: The length of the window, in seconds
+        :type window: int
+        :param now: The time at the end of the window.  Defaults to
+                    the current time.
+        :type now: float
+        :returns: dict with the keys ``count``, ``mean``, and ``pN``
+                  for each of :attr:`PERCENTILES`
+        """
+        if now is None:
+            now = time.time()
+        oldest = int(now // SLOT_LENGTH) - window // SLOT_LENGTH
+        count = 0
+        total = 0.0
+        histogram = dict()
+        for slot_id, slot in list(self.slots.items()):
+            if slot_id > oldest:
+                count += slot[0]
+                total += slot[1]
+                merge_histogram(histogram, slot[2])
+        rv = dict(count=count, mean=0.0)
+        if count:
+            rv['mean'] = total / count
+        for pct in PERCENTILES:
+            rv['p%d' % pct] = get_percentile(histogram, count, pct,
+                                             self.min, self.max)
+        return rv
 
     def get_value(self):
         """ Get a tuple of all the stats tracked on this named item.
@@ -46,12 +238,94 @@ class Statistic(object):
         """
         return (self.name, (self.min, self.max, self.ave, self.count))
 
+    def get_detail(self, now=None):
+        """ Get a dict of all the stats tracked on this named item,
+        including percentiles and sliding windows.
+
+        :param now: The current time.  Defaults to the actual current
+                    time.
+        :type now: float
+        :returns: dict with the keys ``min``, ``max``, ``mean``,
+                  ``sum``, ``count``, ``pN`` for each of
+                  :attr:`PERCENTILES`, and ``windows``, a dict of
+                  window length (as a string) -> the return value of
+                  :func:`get_window`
+        """
+        rv = dict(min=self.min, max=self.max, mean=self.ave, sum=self.sum,
+                  count=self.count, windows=dict())
+        for pct in PERCENTILES:
+            rv['p%d' % pct] = self.percentile(pct)
+        for window in WINDOWS:
+            rv['windows'][str(window)] = self.get_window(window, now=now)
+        return rv
+
 
 class Statistics(object):
-    """ A collection of named :class:`Statistic` objects. """
+    """ A collection of named :class:`Statistic` objects.  Each thread
+    adds values to its own collection, so :func:`add_value` never
+    blocks; the collections are merged by :func:`get_data`. """
 
     def __init__(self):
-        self.data = dict()
+        self.lock = threading.Lock()
+        self._local = threading.local()
+
+        #: A list of tuples of (<thread>, <dict of name ->
+        #: Statistic>) for each thread that has added values
+        self._accumulators = []
+
+        #: A dict of name -> :class:`Statistic` holding the values
+        #: added by threads that have since exited
+        self._retired = dict()
+
+        #: A list of functions that return counters to report along
+        #: with the statistics; see :func:`add_counters`
+        self._counters = []
+
+    def _get_accumulator(self):
+        """ Get the dict of name -> :class:`Statistic` that the
+        current thread adds values to """
+        try:
+            return self._local.data
+        except AttributeError:
+            data = self._local.data = dict()
+            self.lock.acquire()
+            try:
+                # retire the accumulators of threads that have exited
+                # here, too, so that they do not pile up if nothing
+                # ever reads the statistics
+                self._retire()
+                self._accumulators.append((threading.currentThread(),
+                                           data))
+            finally:
+                self.lock.release()
+            return data
+
+    def _retire(self, now=None):
+        """ Merge the values added by threads that have exited into
+        :attr:`_retired` and forget their accumulators.  Nothing is
+        ever added to the retired statistics directly, so their time
+        slots are expired here.  The caller must hold :attr:`lock`.
+
+        :param now: The current time.  Defaults to the actual current
+                    time.
+        :type now: float
+        """
+        live = []
+        for thread, data in self._accumulators:
+            if thread.isAlive():
+                live.append((thread, data))
+                continue
+            for name, stat in list(data.items()):
+                if name not in self._retired:
+                    self._retired[name] = Statistic(name)
+                self._retired[name].merge(stat)
+        self._accumulators = live
+
+        if now is None:
+            now = time.time()
+        current = int(now // SLOT_LENGTH)
+        for stat in self._retired.values():
+            stat._expire_slots(current)  # pylint: disable=W0212
 
     def add_value(self, name, value):
         """ Add a value to the named :class:`Statistic`.  This just
@@ -64,17 +338,106 @@ class Statistics(object):
         :param value: The value to add to the Statistic
         :type value: int or float
         """
-        if name not in self.data:
-            self.data[name] = Statistic(name, value)
-        else:
-            self.data[name].add_value(value)
+        data = self._get_accumulator()
+        try:
+            data[name].add_value(value)
+        except KeyError:
+            data[name] = Statistic(name, value)
+
+    def add_counters(self, func):
+        """ Add a source of counters that are reported along with the
+        statistics.  Unlike values added with :func:`add_value`,
+        counters cost nothing until they are read, so they suit
+        things that happen too often to time, like cache lookups.
+
+        :param func: A function that takes no arguments and returns
+                     a dict of counter name -> int
+        :type func: callable
+        """
+        self._counters.append(func)
+
+    def get_counters(self):
+        """ Get the current values of all counters added with
+        :func:`add_counters`.
+
+        :returns: dict of counter name -> int
+        """
+        rv = dict()
+        for func in self._counters:
+            rv.update(func())
+        return rv
+
+    def get_data(self):
+        """ Merge the values added by all threads.
+
+        :returns: dict of name -> :class:`Statistic`
+        """
+        rv = dict()
+        self.lock.acquire()
+        try:
+            self._retire()
+            for name, stat in self._retired.items():
+                rv[name] = Statistic(name)
+                rv[name].merge(stat)
+            for data in [d for _, d in self._accumulators]:
+                for name, stat in list(data.items()):
+                    if name not in rv:
+                        rv[name] = Statistic(name)
+                    rv[name].merge(stat)
+        finally:
+            self.lock.release()
+        return rv
+    data = property(get_data)
 
     def display(self):
         """ Return a dict of all :class:`Statistic` object values.
         Keys are the statistic names, and values are tuples of the
         statistic metrics as returned by
         :func:`Statistic.get_value`. """
-        return dict([value.get_value() for value in list(self.data.values())])
+        return dict([value.get_value()
+                     for value in list(self.get_data().values())])
+
+    def display_detail(self):
+        """ Return a dict of all :class:`Statistic` object values,
+        including percentiles and sliding windows.  Keys are the
+        statistic names, and values are dicts as returned by
+        :func:`Statistic.get_detail`. """
+        now = time.time()
+        return dict([(name, stat.get_detail(now=now))
+                     for name, stat in self.get_data().items()])
+
+    def prometheus(self, prefix="bcfg2_server"):
+        """ Render all statistics in the Prometheus text exposition
+        format.  Each statistic is rendered as a summary, labeled
+        with the statistic name.
+
+        :param prefix: The prefix for the metric names
+        :type prefix: string
+        :returns: string
+        """
+        metric = "%s_statistic" % prefix
+        lines = ["# HELP %s Bcfg2 server execution statistics" % metric,
+                 "# TYPE %s summary" % metric]
+        data = self.get_data()
+        for name in sorted(data.keys()):
+            stat = data[name]
+            label = _escape_label(name)
+            for pct in PERCENTILES:
+                lines.append('%s{name="%s",quantile="%s"} %r' %
+                             (metric, label, pct / 100.0,
+                              stat.percentile(pct)))
+            lines.append('%s_sum{name="%s"} %r' % (metric, label, stat.sum))
+            lines.append('%s_count{name="%s"} %d' % (metric, label,
+                                                     stat.count))
+        counters = self.get_counters()
+        if counters:
+            metric = "%s_counter" % prefix
+            lines.extend(["# HELP %s Bcfg2 server counters" % metric,
+                          "# TYPE %s counter" % metric])
+            for name in sorted(counters.keys()):
+                lines.append('%s{name="%s"} %d' %
+                             (metric, _escape_label(name), counters[name]))
+        return "\n".join(lines) + "\n"
 
 
 #: A module-level :class:`Statistics` objects used to track all
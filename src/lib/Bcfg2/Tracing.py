@@ -0,0 +1,194 @@
+""" Module for tracing a single client run on the Bcfg2 server.
+Where :mod:`Bcfg2.Statistics` aggregates execution times over all
+client runs, a trace records every timed step of one run, nested as
+they were called.  Traces are written in the Chrome trace event
+format, which can be viewed with ``chrome://tracing`` or Perfetto.
+
+Tracing is enabled per thread: :func:`start` makes a new
+:class:`Trace` current for the calling thread, and :func:`begin` and
+:func:`end` record spans in it.  When no trace is current, they do
+nothing, so instrumented code costs next to nothing when it is not
+being traced. """
+
+import os
+import time
+import threading
+
+try:
+    import json
+    HAS_JSON = True
+except ImportError:
+    try:
+        import simplejson as json
+        HAS_JSON = True
+    except ImportError:
+        HAS_JSON = False
+
+_LOCAL = threading.local()
+
+
+class Trace(object):
+    """ A record of the spans of a single traced operation """
+
+    def __init__(self, name):
+        """
+        :param name: A name for the operation being traced
+        :type name: string
+        """
+        self.name = name
+
+        #: The time the trace was started
+        self.start = time.time()
+
+        #: A list of trace events, in the Chrome trace event format
+        self.events = []
+
+        #: A dict of thread ID -> thread name for every thread that
+        #: has recorded spans in this trace
+        self.threads = dict()
+        self.lock = threading.Lock()
+
+    def add_span(self, name, category, start, end, args=None):
+        """ Record a completed span.
+
+        :param name: The name of the span
+        :type name: string
+        :param category: The category of the span, e.g., ``bind``
+        :type category: string
+        :param start: The time the span started
+        :type start: float
+        :param end: The time the span ended
+        :type end: float
+        :param args: Extra data to record with the span
+        :type args: dict
+        """
+        thread = threading.currentThread()
+        tid = id(thread)
+        event = dict(name=name, cat=category, ph="X", pid=os.getpid(),
+                     tid=tid,
+                     ts=int((start - self.start) * 1000000),
+                     dur=int((end - start) * 1000000))
+        if args:
+            event['args'] = args
+        self.lock.acquire()
+        try:
+            self.events.append(event)
+            if tid not in self.threads:
+                self.threads[tid] = thread.getName()
+        finally:
+            self.lock.release()
+
+    def get_data(self):
+        """ Get the trace as a dict in the Chrome trace event format,
+        ready to be serialized to JSON.
+
+        :returns: dict
+        """
+        events = []
+        for tid, name in self.threads.items():
+            events.append(dict(name="thread_name", ph="M", pid=os.getpid(),
+                               tid=tid, args=dict(name=name)))
+        events.extend(self.events)
+        return dict(traceEvents=events,
+                    displayTimeUnit="ms",
+                    otherData=dict(name=self.name,
+                                   start=time.strftime(
+                                       "%Y-%m-%dT%H:%M:%S",
+                                       time.localtime(self.start))))
+
+    def write(self, path):
+        """ Write the trace to a file in the Chrome trace event
+        format.
+
+        :param path: The path to write the trace to
+        :type path: string
+        """
+        fileobj = open(path, "w")
+        try:
+            fileobj.write(json.dumps(self.get_data()))
+        finally:
+            fileobj.close()
+
+
+def current():
+    """ Get the trace that is current for the calling thread.
+
+    :returns: :class:`Trace`, or None if no trace is current
+    """
+    return getattr(_LOCAL, "trace", None)
+
+
+def start(name):
+    """ Start a new trace and make it current for the calling
+    thread.
+
+    :param name: A name for the operation being traced
+    :type name: string
+    :returns: :class:`Trace`
+    """
+    trace = Trace(name)
+    _LOCAL.trace = trace
+    return trace
+
+
+def stop():
+    """ Stop tracing in the calling thread.
+
+    :returns: :class:`Trace` - the trace that was current
+    """
+    trace = current()
+    _LOCAL.trace = None
+    return trace
+
+
+def begin(name, category="", args=None):
+    """ Begin a span in the current trace.
+
+    :param name: The name of the span
+    :type name: string
+    :param category: The category of the span
+    :type category: string
+    :param args: Extra data to record with the span
+    :type args: dict
+    :returns: An opaque span object to pass to :func:`end`, or None
+              if no trace is current
+    """
+    trace = current()
+    if trace is None:
+        return None
+    return (trace, name, category, args, time.time())
+
+
+def end(span):
+    """ End a span that was begun with :func:`begin`.
+
+    :param span: The span returned by :func:`begin`
+    """
+    if span is not None:
+        trace, name, category, args, started = span
+        trace.add_span(name, category, started, time.time(), args)
+
+
+def wrap(func):
+    """ Wrap a callable so that spans it records go to the trace that
+    is current now, even if it is called in another thread (e.g., by a
+    thread pool).
+
+    :param func: The callable to wrap
+    :type func: callable
+    :returns: callable
+    """
+    trace = current()
+    if trace is None:
+        return func
+
+    def inner(*args, **kwargs):
+        """ Call the wrapped function with the trace current """
+        old = current()
+        _LOCAL.trace = trace
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _LOCAL.trace = old
+
+    return inner
@@ -19,6 +19,17 @@ except ImportError:
 
 DATABASES = dict()
 
+# the cache used by the reporting system.  its limits are set by
+# read_config()
+UNLIMITED = 2 ** 31 - 1
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'TIMEOUT': 300,
+        'OPTIONS': dict(MAX_ENTRIES=300),
+    }
+}
+
 # Django < 1.2 compat
 DATABASE_ENGINE = None
 DATABASE_NAME = None
@@ -57,7 +68,7 @@ def read_config(cfile=DEFAULT_CONFIG, repo=None, quiet=False):
     # pylint: disable=W0603
     global DATABASE_ENGINE, DATABASE_NAME, DATABASE_USER, DATABASE_PASSWORD, \
         DATABASE_HOST, DATABASE_PORT, DEBUG, TEMPLATE_DEBUG, TIME_ZONE, \
-        MEDIA_URL
+        MEDIA_URL, CACHE_BACKEND
     # pylint: enable=W0603
 
     if not os.path.exists(cfile) and os.path.exists(DEFAULT_CONFIG):
@@ -86,6 +97,16 @@ def read_config(cfile=DEFAULT_CONFIG, repo=None, quiet=False):
              HOST=setup['db_host'],
              PORT=setup['db_port'])
 
+    # a limit of 0 means no limit, which django has no way to say
+    cache_ttl = setup['cache_ttl'] or UNLIMITED
+    cache_max_entries = setup['cache_max_entries'] or UNLIMITED
+    if HAS_DJANGO and django.VERSION[0] == 1 and django.VERSION[1] < 3:
+        CACHE_BACKEND = 'locmem:///?timeout=%d&max_entries=%d' % \
+            (cache_ttl, cache_max_entries)
+    else:
+        CACHES['default']['TIMEOUT'] = cache_ttl
+        CACHES['default']['OPTIONS']['MAX_ENTRIES'] = cache_max_entries
+
     # dropping the version check.  This was added in 1.1.2
     TIME_ZONE = setup['time_zone']
 
@@ -142,15 +163,6 @@ ADMIN_MEDIA_PREFIX = '/media/'
 # Make this unique, and don't share it with anybody.
 SECRET_KEY = 'eb5+y%oy-qx*2+62vv=gtnnxg1yig_odu0se5$h0hh#pc*lmo7'
 
-if HAS_DJANGO and django.VERSION[0] == 1 and django.VERSION[1] < 3:
-    CACHE_BACKEND = 'locmem:///'
-else:
-    CACHES = {
-        'default': {
-            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
-        }
-    }
-
 TEMPLATE_LOADERS = (
     'django.template.loaders.filesystem.Loader',
     'django.template.loaders.app_directories.Loader',
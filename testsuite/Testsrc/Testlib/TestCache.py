@@ -0,0 +1,160 @@
+import gc
+import os
+import sys
+import time
+from mock import Mock, patch
+from Bcfg2.Cache import *
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != '/':
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import *
+
+
+class TestCache(Bcfg2TestCase):
+    def test_dict(self):
+        cache = Cache()
+        cache["foo"] = 1
+        cache["bar"] = None
+        self.assertEqual(cache["foo"], 1)
+        self.assertIsNone(cache["bar"])
+        self.assertIn("bar", cache)
+        self.assertNotIn("baz", cache)
+        self.assertRaises(KeyError, cache.__getitem__, "baz")
+        self.assertEqual(cache.get("baz", 2), 2)
+        self.assertItemsEqual(cache.keys(), ["foo", "bar"])
+        self.assertItemsEqual(cache.items(), [("foo", 1), ("bar", None)])
+        self.assertEqual(len(cache), 2)
+
+        self.assertEqual(cache.pop("foo"), 1)
+        self.assertEqual(cache.pop("foo", 3), 3)
+        self.assertRaises(KeyError, cache.pop, "foo")
+        del cache["bar"]
+        self.assertEqual(len(cache), 0)
+
+        stats = cache.get_stats()
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 2)
+
+    def test_max_entries(self):
+        cache = Cache(max_entries=2)
+        cache["foo"] = 1
+        cache["bar"] = 2
+        # using foo makes bar the least recently used entry
+        self.assertEqual(cache["foo"], 1)
+        cache["baz"] = 3
+        self.assertItemsEqual(cache.keys(), ["foo", "baz"])
+        self.assertEqual(cache.get_stats()['evictions'], 1)
+
+    def test_max_bytes(self):
+        cache = Cache(max_bytes=10, sizeof=len)
+        cache["foo"] = "aaaa"
+        cache["bar"] = "bbbb"
+        self.assertEqual(cache.get_stats()['bytes'], 8)
+        cache["baz"] = "cccc"
+        self.assertItemsEqual(cache.keys(), ["bar", "baz"])
+
+        # replacing an entry replaces its size
+        cache["bar"] = "b"
+        self.assertEqual(cache.get_stats()['bytes'], 5)
+
+        # an entry larger than the cache is not kept
+        cache["quux"] = "d" * 11
+        self.assertEqual(len(cache), 0)
+
+    def test_ttl(self):
+        cache = Cache(ttl=10)
+        now = time.time()
+        cache["foo"] = 1
+        cache.set("bar", 2, ttl=100)
+        mock_time = Mock(return_value=now + 11)
+        patcher = patch("time.time", mock_time)
+        patcher.start()
+        try:
+            self.assertNotIn("foo", cache)
+            self.assertEqual(cache.keys(), ["bar"])
+            self.assertEqual(cache["bar"], 2)
+        finally:
+            patcher.stop()
+        self.assertEqual(cache.get_stats()['expirations'], 1)
+
+    def test_expire(self):
+        cache = Cache()
+        cache["foo"] = 1
+        cache["bar"] = 2
+        serial = cache.serial
+        cache.expire("foo")
+        self.assertItemsEqual(cache.keys(), ["bar"])
+        self.assertNotEqual(cache.serial, serial)
+        cache.expire()
+        self.assertEqual(len(cache), 0)
+
+    def test_expire_dependents(self):
+        cache = Cache(max_entries=2)
+        cache.add_dependency("foo", "dep1")
+        cache.add_dependency("bar", "dep1")
+        cache.add_dependency("bar", "dep2")
+        cache["foo"] = 1
+        cache["bar"] = 2
+        self.assertItemsEqual(cache.expire_dependents("dep1"),
+                              ["foo", "bar"])
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.dependents, dict())
+
+        # evicted entries are no longer dependents
+        cache.add_dependency("foo", "dep1")
+        cache["foo"] = 1
+        cache["bar"] = 2
+        cache["baz"] = 3
+        self.assertNotIn("dep1", cache.dependents)
+
+    @patch("Bcfg2.Statistics.stats")
+    def test_counters(self, mock_stats):
+        before = get_counters()
+        cache = Cache(name="test", max_entries=1)
+        cache["foo"] = 1
+        cache.get("foo")
+        cache.get("bar")
+        cache["bar"] = 2
+        # nothing is recorded when the cache is used
+        self.assertFalse(mock_stats.add_value.called)
+
+        def delta(counter):
+            key = "Cache:test:%s" % counter
+            return get_counters()[key] - before.get(key, 0)
+
+        self.assertEqual(delta("hits"), 1)
+        self.assertEqual(delta("misses"), 1)
+        self.assertEqual(delta("evictions"), 1)
+
+        # the counters of caches that no longer exist are kept, and
+        # caches with the same name are counted together
+        del cache
+        gc.collect()
+        cache = Cache(name="test")
+        cache.get("foo")
+        self.assertEqual(delta("misses"), 2)
+        self.assertEqual(delta("hits"), 1)
+
+        # unnamed caches aren't counted
+        counters = get_counters()
+        Cache().get("foo")
+        self.assertEqual(get_counters(), counters)
+
+    def test_get_cache(self):
+        cfp = Mock()
+        options = dict(test_max_entries="10", test_ttl="0")
+        cfp.get.side_effect = \
+            lambda sect, opt, default=None: options.get(opt, default)
+        cache = get_cache("test", cfp, max_bytes=100, ttl=5)
+        self.assertEqual(cache.name, "test")
+        self.assertEqual(cache.max_entries, 10)
+        self.assertEqual(cache.max_bytes, 100)
+        # a limit of 0 is no limit
+        self.assertIsNone(cache.ttl)
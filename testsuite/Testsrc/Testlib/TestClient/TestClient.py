@@ -0,0 +1,110 @@
+import os
+import sys
+import lxml.etree
+from mock import Mock, MagicMock, patch
+import Bcfg2.Proxy
+from Bcfg2.Compat import xmlrpclib
+from Bcfg2.version import __version__
+from Bcfg2.Client.Client import Client
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import *
+
+
+class TestClient(Bcfg2TestCase):
+    def get_obj(self, **kwargs):
+        setup = dict(debug=False, verbose=False, syslog=False, logging=None,
+                     bundle_quick=False, bundle=[], skipbundle=[],
+                     remove=None, file=None, cache=None, probe_exit=True,
+                     server="https://bcfg2.example.com:6789",
+                     profile="", decision="none")
+        setup.update(kwargs)
+
+        @patch("Bcfg2.Logger.setup_logging")
+        def inner(mock_setup_logging):
+            return Client(setup)
+
+        client = inner()
+        client._proxy = Mock()
+        return client
+
+    def test_start_run(self):
+        client = self.get_obj(profile="group1", decision="whitelist")
+        rv = dict(version=True, probes="<probes/>", decisions=[])
+        client.proxy.StartClientRun.return_value = rv
+        self.assertEqual(client.start_run(), rv)
+        client.proxy.StartClientRun.assert_called_with(__version__, "group1",
+                                                       "whitelist")
+
+        client = self.get_obj()
+        client.proxy.StartClientRun.return_value = rv
+        client.start_run()
+        client.proxy.StartClientRun.assert_called_with(__version__, "", "")
+
+    def test_start_run_fallback(self):
+        client = self.get_obj()
+        # servers that do not support StartClientRun
+        for fault in [xmlrpclib.Fault(xmlrpclib.METHOD_NOT_FOUND,
+                                      "Unknown method StartClientRun"),
+                      xmlrpclib.Fault(7, "Unknown method StartClientRun"),
+                      xmlrpclib.Fault(1, 'Method "StartClientRun" is not '
+                                      'supported')]:
+            client.proxy.StartClientRun.side_effect = fault
+            self.assertIsNone(client.start_run())
+
+        # other errors are fatal
+        for err in [xmlrpclib.Fault(1, "Failed to resolve client"),
+                    Bcfg2.Proxy.ProxyError("Server failure")]:
+            client.proxy.StartClientRun.side_effect = err
+            self.assertRaises(SystemExit, client.start_run)
+
+    def test_get_config(self):
+        client = self.get_obj(profile="group1", decision="whitelist")
+        client.run_probes = Mock(return_value=False)
+        client._start_run_compat = Mock()
+        client.proxy.GetConfig.return_value = "<Configuration/>"
+
+        # StartClientRun supplies the probes and the decision list
+        client.proxy.StartClientRun.return_value = \
+            dict(version=True, probes="<probes/>", decisions=["test"])
+        self.assertEqual(client.get_config(), "<Configuration/>")
+        self.assertEqual(client.run_probes.call_args[1]['probes'],
+                         "<probes/>")
+        self.assertEqual(client.setup['decision_list'], ["test"])
+        self.assertFalse(client.proxy.GetDecisionList.called)
+        self.assertFalse(client._start_run_compat.called)
+
+        # the decision list is fetched again after sending probe data
+        client.run_probes.return_value = True
+        client.proxy.GetDecisionList.return_value = ["new"]
+        client.get_config()
+        client.proxy.GetDecisionList.assert_called_with("whitelist")
+        self.assertEqual(client.setup['decision_list'], ["new"])
+
+        # older servers get individual calls
+        client.run_probes.reset_mock()
+        client.proxy.StartClientRun.side_effect = \
+            xmlrpclib.Fault(xmlrpclib.METHOD_NOT_FOUND,
+                            "Unknown method StartClientRun")
+        client.get_config()
+        client._start_run_compat.assert_called_with()
+        self.assertNotIn("probes", client.run_probes.call_args[1])
+
+    def test__start_run_compat(self):
+        client = self.get_obj(profile="group1")
+        client._start_run_compat()
+        client.proxy.AssertProfile.assert_called_with("group1")
+        client.proxy.DeclareVersion.assert_called_with(__version__)
+
+        # servers that cannot declare versions are not an error
+        client.proxy.DeclareVersion.side_effect = \
+            xmlrpclib.Fault(7, "Unknown method DeclareVersion")
+        client._start_run_compat()
@@ -0,0 +1,275 @@
+import os
+import sys
+import zlib
+import errno
+import socket
+from Bcfg2.Compat import httplib, xmlrpclib
+from mock import Mock, MagicMock, patch
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import *
+from Bcfg2.Proxy import *
+from Bcfg2.Proxy import ENCODINGS, ProxyError, DecompressedSizeError, \
+    compress, decompress, get_encoding, method_not_found
+
+
+class TestCompression(Bcfg2TestCase):
+    data = "<methodCall>%s</methodCall>" % ("test" * 1024)
+
+    def test_compress(self):
+        for encoding in ENCODINGS:
+            compressed = compress(self.data, encoding)
+            self.assertLess(len(compressed), len(self.data))
+            self.assertEqual(decompress(compressed, encoding), self.data)
+        self.assertRaises(ValueError, compress, self.data, "br")
+
+    def test_decompress(self):
+        self.assertEqual(decompress(self.data, None), self.data)
+        self.assertEqual(decompress(self.data, "identity"), self.data)
+        self.assertRaises(ValueError, decompress, self.data, "br")
+
+        # raw deflate data without the zlib header
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        raw = compressor.compress(self.data) + compressor.flush()
+        self.assertEqual(decompress(raw, "deflate"), self.data)
+
+        # limits on the size of the decompressed data
+        for encoding in ENCODINGS:
+            compressed = compress(self.data, encoding)
+            self.assertEqual(decompress(compressed, encoding,
+                                        max_length=len(self.data)),
+                             self.data)
+            self.assertRaises(DecompressedSizeError,
+                              decompress, compressed, encoding,
+                              max_length=len(self.data) - 1)
+        self.assertRaises(DecompressedSizeError,
+                          decompress, raw, "deflate",
+                          max_length=len(self.data) - 1)
+
+    def test_get_encoding(self):
+        self.assertIsNone(get_encoding(None))
+        self.assertIsNone(get_encoding(""))
+        self.assertIsNone(get_encoding("identity, br"))
+        self.assertEqual(get_encoding("gzip"), "gzip")
+        self.assertEqual(get_encoding("deflate, gzip"), "gzip")
+        self.assertEqual(get_encoding("Deflate"), "deflate")
+        self.assertEqual(get_encoding("gzip;q=0, deflate;q=0.5"), "deflate")
+        self.assertIsNone(get_encoding("gzip;q=0"))
+
+
+def get_response(status=200, headers=None, will_close=False):
+    """ Get a mock HTTP response to an XML-RPC call """
+    if headers is None:
+        headers = dict()
+    response = Mock()
+    response.status = status
+    response.reason = "OK"
+    response.msg = headers
+    response.will_close = will_close
+    response.getheader.side_effect = \
+        lambda name, default=None: headers.get(name, default)
+    response.read.return_value = xmlrpclib.dumps(("ok",),
+                                                 methodresponse=True)
+    return response
+
+
+def get_connection(*responses):
+    """ Get a mock connection that returns the given responses (or
+    raises the given exceptions) """
+    conn = Mock()
+    conn.getresponse.side_effect = list(responses)
+    return conn
+
+
+class TestXMLRPCTransport(Bcfg2TestCase):
+    host = "bcfg2.example.com:6789"
+    body = xmlrpclib.dumps(("foo",), "test")
+
+    def get_obj(self, **kwargs):
+        return XMLRPCTransport(**kwargs)
+
+    @patch("Bcfg2.Proxy.SSLHTTPConnection")
+    def test_request_keepalive(self, mock_SSLHTTPConnection):
+        conn = get_connection(get_response(), get_response(will_close=True))
+        conn2 = get_connection(get_response())
+        mock_SSLHTTPConnection.side_effect = [conn, conn2]
+        transport = self.get_obj()
+
+        # the connection is reused until the server closes it
+        self.assertEqual(transport.request(self.host, "/RPC2", self.body),
+                         ("ok",))
+        self.assertEqual(transport.request(self.host, "/RPC2", self.body),
+                         ("ok",))
+        self.assertEqual(mock_SSLHTTPConnection.call_count, 1)
+        conn.close.assert_called_with()
+
+        self.assertEqual(transport.request(self.host, "/RPC2", self.body),
+                         ("ok",))
+        self.assertEqual(mock_SSLHTTPConnection.call_count, 2)
+        self.assertFalse(conn2.close.called)
+
+    def get_headers(self, conn):
+        """ Get the headers sent on the given mock connection """
+        return dict([c[0] for c in conn.putheader.call_args_list])
+
+    @patch("Bcfg2.Proxy.SSLHTTPConnection")
+    def test_request_compression(self, mock_SSLHTTPConnection):
+        body = xmlrpclib.dumps(("test" * 1024,), "test")
+        response = get_response(headers={"Accept-Encoding": "deflate, gzip",
+                                         "Content-Encoding": "gzip"})
+        response.read.return_value = \
+            compress(response.read.return_value, "gzip")
+        conn = get_connection(response, get_response())
+        mock_SSLHTTPConnection.return_value = conn
+
+        # requests are not compressed until the server has said that
+        # it accepts compressed requests, but responses are
+        transport = self.get_obj(compress_threshold=0)
+        self.assertEqual(transport.request(self.host, "/RPC2", body),
+                         ("ok",))
+        headers = self.get_headers(conn)
+        self.assertEqual(headers["Accept-Encoding"], ", ".join(ENCODINGS))
+        self.assertNotIn("Content-Encoding", headers)
+        self.assertEqual(transport.request_encoding, "gzip")
+
+        conn.putheader.reset_mock()
+        transport.request(self.host, "/RPC2", body)
+        headers = self.get_headers(conn)
+        self.assertEqual(headers["Content-Encoding"], "gzip")
+        self.assertEqual(decompress(conn.send.call_args[0][0], "gzip"), body)
+
+        # small requests are not compressed
+        conn = get_connection(get_response())
+        mock_SSLHTTPConnection.return_value = conn
+        transport = self.get_obj(compress_threshold=len(body) + 1)
+        transport.request_encoding = "gzip"
+        transport.request(self.host, "/RPC2", body)
+        self.assertNotIn("Content-Encoding", self.get_headers(conn))
+        self.assertEqual(conn.send.call_args[0][0], body)
+
+        # compression can be disabled altogether
+        conn = get_connection(get_response(headers={"Accept-Encoding":
+                                                        "gzip"}))
+        mock_SSLHTTPConnection.return_value = conn
+        transport = self.get_obj()
+        transport.request(self.host, "/RPC2", body)
+        self.assertNotIn("Accept-Encoding", self.get_headers(conn))
+        self.assertIsNone(transport.request_encoding)
+
+    @patch("Bcfg2.Proxy.SSLHTTPConnection")
+    def test_request_stale(self, mock_SSLHTTPConnection):
+        # the server closed an idle connection without a response
+        conn = get_connection(get_response(), httplib.BadStatusLine(""))
+        conn2 = get_connection(get_response())
+        mock_SSLHTTPConnection.side_effect = [conn, conn2]
+        transport = self.get_obj()
+        transport.request(self.host, "/RPC2", self.body)
+        self.assertEqual(transport.request(self.host, "/RPC2", self.body),
+                         ("ok",))
+        self.assertEqual(mock_SSLHTTPConnection.call_count, 2)
+        self.assertEqual(conn2.send.call_count, 1)
+
+        # sending on a connection the server has closed fails
+        for code in [errno.EPIPE, errno.ECONNRESET]:
+            conn = get_connection(get_response())
+            conn2 = get_connection(get_response())
+            mock_SSLHTTPConnection.reset_mock()
+            mock_SSLHTTPConnection.side_effect = [conn, conn2]
+            transport = self.get_obj()
+            transport.request(self.host, "/RPC2", self.body)
+            conn.send.side_effect = socket.error(code, os.strerror(code))
+            self.assertEqual(transport.request(self.host, "/RPC2",
+                                               self.body),
+                             ("ok",))
+            self.assertEqual(mock_SSLHTTPConnection.call_count, 2)
+
+    @patch("Bcfg2.Proxy.SSLHTTPConnection")
+    def test_request_no_retry(self, mock_SSLHTTPConnection):
+        transport = self.get_obj()
+
+        # a new connection is never retried
+        conn = get_connection(httplib.BadStatusLine(""))
+        mock_SSLHTTPConnection.side_effect = [conn, get_connection()]
+        self.assertRaises(ProxyError,
+                          transport.request, self.host, "/RPC2", self.body)
+        self.assertEqual(mock_SSLHTTPConnection.call_count, 1)
+
+        # nor are timeouts or other errors on a reused connection,
+        # since the server may already have handled the request
+        for err in [socket.timeout("timed out"),
+                    socket.error(errno.ECONNRESET, "Connection reset"),
+                    httplib.IncompleteRead("")]:
+            conn = get_connection(get_response(), err)
+            mock_SSLHTTPConnection.reset_mock()
+            mock_SSLHTTPConnection.side_effect = [conn, get_connection()]
+            transport = self.get_obj()
+            transport.request(self.host, "/RPC2", self.body)
+            self.assertRaises(ProxyError,
+                              transport.request, self.host, "/RPC2",
+                              self.body)
+            self.assertEqual(mock_SSLHTTPConnection.call_count, 1)
+            conn.close.assert_called_with()
+
+        conn = get_connection(get_response())
+        mock_SSLHTTPConnection.reset_mock()
+        mock_SSLHTTPConnection.side_effect = [conn, get_connection()]
+        transport = self.get_obj()
+        transport.request(self.host, "/RPC2", self.body)
+        conn.send.side_effect = socket.timeout("timed out")
+        self.assertRaises(ProxyError,
+                          transport.request, self.host, "/RPC2", self.body)
+        self.assertEqual(mock_SSLHTTPConnection.call_count, 1)
+
+
+class TestRetryMethod(Bcfg2TestCase):
+    def get_obj(self, name="test"):
+        return RetryMethod(Mock(), name)
+
+    @patch("time.sleep")
+    @patch("Bcfg2.Proxy._orig_Method")
+    def test__call(self, mock_Method, mock_sleep):
+        method = self.get_obj()
+
+        # faults that mean the server does not have the method are
+        # raised at once, so that clients can fall back to others
+        for fault in [xmlrpclib.Fault(xmlrpclib.METHOD_NOT_FOUND,
+                                      "Unknown method test"),
+                      xmlrpclib.Fault(7, "Unknown method test"),
+                      xmlrpclib.Fault(1, 'Method "test" is not supported')]:
+            mock_Method.reset_mock()
+            mock_Method.side_effect = fault
+            self.assertRaises(xmlrpclib.Fault, method, "foo")
+            self.assertEqual(mock_Method.call_count, 1)
+            self.assertFalse(mock_sleep.called)
+
+        # other faults are retried
+        mock_Method.reset_mock()
+        mock_Method.side_effect = [xmlrpclib.Fault(1, "Failed"), "ok"]
+        self.assertEqual(method("foo"), "ok")
+        self.assertEqual(mock_Method.call_count, 2)
+        mock_Method.assert_called_with(method, "foo")
+
+        mock_Method.reset_mock()
+        mock_Method.side_effect = xmlrpclib.Fault(1, "Failed")
+        self.assertRaises(ProxyError, method, "foo")
+        self.assertEqual(mock_Method.call_count, RetryMethod.max_retries)
+
+
+class TestMethodNotFound(Bcfg2TestCase):
+    def test_method_not_found(self):
+        self.assertTrue(method_not_found(
+                xmlrpclib.Fault(xmlrpclib.METHOD_NOT_FOUND, "Test")))
+        self.assertTrue(method_not_found(
+                xmlrpclib.Fault(7, "Unknown method test")))
+        self.assertTrue(method_not_found(
+                xmlrpclib.Fault(1, 'Method "test" is not supported')))
+        self.assertFalse(method_not_found(
+                xmlrpclib.Fault(7, "Failed to resolve client")))
@@ -0,0 +1,304 @@
+import os
+import sys
+import socket
+import tempfile
+from mock import Mock, MagicMock, patch
+from Bcfg2.Compat import xmlrpclib, StringIO
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import *
+from Bcfg2.SSLServer import *
+
+
+class TestXMLRPCDispatcher(Bcfg2TestCase):
+    address = ["1.2.3.4", 12345]
+
+    def get_obj(self):
+        dispatcher = XMLRPCDispatcher(True, "utf-8")
+        dispatcher.instance = Mock()
+
+        def dispatch(method, params, funcs):
+            if method == "Fail":
+                raise xmlrpclib.Fault(7, "Failed")
+            elif method == "Error":
+                raise ValueError("Error")
+            return [method, list(params)]
+
+        dispatcher.instance._dispatch.side_effect = dispatch
+        return dispatcher
+
+    def dispatch(self, dispatcher, method, *params):
+        """ Make an XML-RPC call and return the unmarshalled result """
+        return xmlrpclib.loads(dispatcher._marshaled_dispatch(
+                self.address, xmlrpclib.dumps(params, method)))[0][0]
+
+    def test__marshaled_dispatch(self):
+        dispatcher = self.get_obj()
+        # the client address is passed to methods of the core, but
+        # not to system.* methods
+        self.assertEqual(self.dispatch(dispatcher, "GetProbes"),
+                         ["GetProbes", [self.address]])
+        self.assertEqual(self.dispatch(dispatcher, "DeclareVersion", "1.3"),
+                         ["DeclareVersion", [self.address, "1.3"]])
+        self.assertEqual(self.dispatch(dispatcher, "system.listMethods"),
+                         ["system.listMethods", []])
+        self.assertRaises(xmlrpclib.Fault,
+                          self.dispatch, dispatcher, "Fail")
+
+    def test__multicall(self):
+        dispatcher = self.get_obj()
+        calls = [dict(methodName="GetProbes", params=[]),
+                 dict(methodName="DeclareVersion", params=["1.3"]),
+                 dict(methodName="Fail", params=[]),
+                 dict(methodName="system.multicall", params=[[]]),
+                 dict(methodName="Error", params=[]),
+                 dict(methodName="system.listMethods", params=[])]
+        results = self.dispatch(dispatcher, "system.multicall", calls)
+
+        # calls are dispatched in order, and failures do not stop
+        # the calls that follow
+        self.assertEqual(len(results), len(calls))
+        self.assertEqual(results[0], [["GetProbes", [self.address]]])
+        self.assertEqual(results[1],
+                         [["DeclareVersion", [self.address, "1.3"]]])
+        self.assertEqual(results[2], dict(faultCode=7,
+                                          faultString="Failed"))
+        self.assertEqual(results[3]['faultCode'],
+                         xmlrpclib.INVALID_METHOD_PARAMS)
+        self.assertEqual(results[4]['faultCode'], 1)
+        self.assertEqual(results[5], [["system.listMethods", []]])
+
+
+class FakeRequestHandler(XMLRPCRequestHandler):
+    """ A request handler that is not connected to a client """
+
+    def __init__(self, body, headers):
+        self.rfile = tempfile.TemporaryFile()
+        self.rfile.write(body)
+        self.rfile.seek(0)
+        self.wfile = StringIO()
+        self.headers = headers
+        self.headers["content-length"] = str(len(body))
+        self.server = Mock()
+        self.server.logRequests = False
+        self.server._marshaled_dispatch.return_value = \
+            xmlrpclib.dumps(("test" * 1024,), methodresponse=1)
+        self.client_address = ("1.2.3.4", 12345)
+        self.request_version = "HTTP/1.0"
+        self.requestline = "POST /RPC2 HTTP/1.0"
+        self.command = "POST"
+
+    def log_message(self, *args):
+        pass
+
+    def get_response(self):
+        """ Get the status, headers, and body of the response """
+        head, body = self.wfile.getvalue().split("\r\n\r\n", 1)
+        lines = head.split("\r\n")
+        headers = dict([line.split(": ", 1) for line in lines[1:]])
+        return int(lines[0].split()[1]), headers, body
+
+
+class TestXMLRPCRequestHandler(Bcfg2TestCase):
+    data = xmlrpclib.dumps(("test" * 1024,), "test")
+
+    def get_obj(self, body=None, compress_threshold=0, **headers):
+        if body is None:
+            body = self.data
+        handler = FakeRequestHandler(body, headers)
+        handler.compress_threshold = compress_threshold
+        return handler
+
+    def test_do_POST(self):
+        handler = self.get_obj()
+        handler.do_POST()
+        handler.server._marshaled_dispatch.assert_called_with(
+            handler.client_address, self.data)
+        status, headers, body = handler.get_response()
+        self.assertEqual(status, 200)
+        self.assertEqual(headers["Accept-Encoding"], ", ".join(ENCODINGS))
+        self.assertNotIn("Content-Encoding", headers)
+        self.assertEqual(body,
+                         handler.server._marshaled_dispatch.return_value)
+
+    def test_do_POST_compressed(self):
+        for encoding in ENCODINGS:
+            # requests are decompressed, and responses compressed
+            # with the encoding the client prefers
+            handler = self.get_obj(compress(self.data, encoding),
+                                   **{"Content-Encoding": encoding,
+                                      "Accept-Encoding": encoding})
+            handler.do_POST()
+            handler.server._marshaled_dispatch.assert_called_with(
+                handler.client_address, self.data)
+            status, headers, body = handler.get_response()
+            self.assertEqual(status, 200)
+            self.assertEqual(headers["Content-Encoding"], encoding)
+            self.assertEqual(int(headers["Content-length"]), len(body))
+            self.assertEqual(decompress(body, encoding),
+                             handler.server._marshaled_dispatch.return_value)
+
+        # small responses are not compressed
+        handler = self.get_obj(compress_threshold=1024 * 1024,
+                               **{"Accept-Encoding": "gzip"})
+        handler.do_POST()
+        self.assertNotIn("Content-Encoding", handler.get_response()[1])
+
+    def test_do_POST_unsupported(self):
+        for encoding in ["br", "compress"]:
+            handler = self.get_obj(**{"Content-Encoding": encoding})
+            handler.do_POST()
+            self.assertEqual(handler.get_response()[0], 415)
+            self.assertFalse(handler.server._marshaled_dispatch.called)
+
+        # compression disabled altogether
+        handler = self.get_obj(compress(self.data, "gzip"),
+                               compress_threshold=-1,
+                               **{"Content-Encoding": "gzip",
+                                  "Accept-Encoding": "gzip"})
+        handler.do_POST()
+        self.assertEqual(handler.get_response()[0], 415)
+        self.assertFalse(handler.server._marshaled_dispatch.called)
+
+        handler = self.get_obj(compress_threshold=-1,
+                               **{"Accept-Encoding": "gzip"})
+        handler.do_POST()
+        status, headers = handler.get_response()[0:2]
+        self.assertEqual(status, 200)
+        self.assertNotIn("Content-Encoding", headers)
+        self.assertNotIn("Accept-Encoding", headers)
+
+    def test_do_POST_too_large(self):
+        handler = self.get_obj(compress(self.data, "gzip"),
+                               **{"Content-Encoding": "gzip"})
+        handler.max_decompressed_size = len(self.data) - 1
+        handler.do_POST()
+        self.assertEqual(handler.get_response()[0], 413)
+        self.assertFalse(handler.server._marshaled_dispatch.called)
+
+
+class TestXMLRPCServer(Bcfg2TestCase):
+    def get_obj(self, workers=0, queue_size=0):
+        server = XMLRPCServer(False, ("127.0.0.1", 0), workers=workers,
+                              queue_size=queue_size)
+        self.servers.append(server)
+        return server
+
+    def setUp(self):
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.server_close()
+
+    def test_max_expensive(self):
+        for workers, max_expensive in [(1, 1), (2, 1), (3, 2), (4, 3),
+                                       (8, 6)]:
+            server = self.get_obj(workers=workers)
+            self.assertEqual(server.max_expensive, max_expensive)
+            self.assertGreaterEqual(server.max_expensive_waiting, 1)
+
+    @patch("Bcfg2.Compat.SocketServer.ThreadingMixIn.process_request")
+    def test_process_request(self, mock_process_request):
+        # without a worker pool, each connection gets a new thread
+        server = self.get_obj()
+        request = Mock()
+        server.process_request(request, ("1.2.3.4", 12345))
+        mock_process_request.assert_called_with(server, request,
+                                                ("1.2.3.4", 12345))
+
+        # with a worker pool, connections are queued until the queue
+        # is full, and then rejected
+        mock_process_request.reset_mock()
+        server = self.get_obj(workers=1, queue_size=2)
+        requests = [Mock(), Mock(), Mock()]
+        for request in requests:
+            server.process_request(request, ("1.2.3.4", 12345))
+        self.assertFalse(mock_process_request.called)
+        self.assertEqual(server.request_queue.qsize(), 2)
+        self.assertTrue(server.busy())
+        for request in requests[:2]:
+            self.assertFalse(request.sendall.called)
+            self.assertFalse(request.close.called)
+        requests[2].sendall.assert_called_with(server._busy_response)
+        requests[2].close.assert_called_with()
+
+        # a client that does not read the response does not keep
+        # the server waiting
+        request = Mock()
+        request.sendall.side_effect = socket.timeout("timed out")
+        server.process_request(request, ("1.2.3.4", 12345))
+        request.settimeout.assert_called_with(server.reject_timeout)
+        request.close.assert_called_with()
+
+    def test__busy_response(self):
+        server = self.get_obj(workers=1)
+        head, body = server._busy_response.split("\r\n\r\n", 1)
+        lines = head.split("\r\n")
+        self.assertEqual(lines[0], "HTTP/1.0 200 OK")
+        self.assertIn("Content-length: %d" % len(body), lines)
+        self.assertIn("Connection: close", lines)
+        try:
+            xmlrpclib.loads(body)
+        except xmlrpclib.Fault:
+            err = sys.exc_info()[1]
+            self.assertEqual(err.faultCode, SERVER_BUSY)
+        else:
+            self.fail("Busy response is not a fault")
+
+    def test__acquire_expensive(self):
+        server = self.get_obj(workers=4)
+        server.expensive_wait = 0
+
+        # while no connections are waiting, expensive calls always run
+        for _ in range(server.workers):
+            server._acquire_expensive("GetConfig")
+        for _ in range(server.workers):
+            server._release_expensive()
+
+        # otherwise, only max_expensive can run at once
+        server.busy = Mock(return_value=True)
+        for _ in range(server.max_expensive):
+            server._acquire_expensive("GetConfig")
+        self.assertRaises(xmlrpclib.Fault,
+                          server._acquire_expensive, "GetConfig")
+        self.assertEqual(server._expensive_waiting, 0)
+
+        # too many waiting calls get a busy fault right away
+        server.expensive_wait = 60
+        server._expensive_waiting = server.max_expensive_waiting
+        try:
+            server._acquire_expensive("GetConfig")
+        except xmlrpclib.Fault:
+            err = sys.exc_info()[1]
+            self.assertEqual(err.faultCode, SERVER_BUSY)
+        else:
+            self.fail("Expensive call was not rejected")
+
+        # a finished call makes room for another one
+        server._expensive_waiting = 0
+        server._release_expensive()
+        server._acquire_expensive("GetConfig")
+        self.assertEqual(server._expensive, server.max_expensive)
+
+    @patch("Bcfg2.SSLServer.XMLRPCDispatcher._dispatch_call")
+    def test__dispatch_call(self, mock_dispatch_call):
+        server = self.get_obj(workers=4)
+        server._acquire_expensive = Mock()
+        server._release_expensive = Mock()
+        self.assertEqual(server._dispatch_call("GetProbes", ()),
+                         mock_dispatch_call.return_value)
+        self.assertFalse(server._acquire_expensive.called)
+
+        mock_dispatch_call.side_effect = ValueError
+        self.assertRaises(ValueError, server._dispatch_call, "GetConfig", ())
+        server._acquire_expensive.assert_called_with("GetConfig")
+        server._release_expensive.assert_called_with()
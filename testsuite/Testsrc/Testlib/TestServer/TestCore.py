@@ -0,0 +1,392 @@
+import os
+import sys
+import time
+import threading
+import lxml.etree
+from mock import Mock, MagicMock, patch
+import Bcfg2.Server.Plugin
+from Bcfg2.Server.Core import *
+from Bcfg2.Server.FileMonitor import Event
+from Bcfg2.Server.Plugins.Metadata import ClientMetadata
+from Bcfg2.Server.Plugins.Probes import ProbeSet
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != '/':
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import *
+
+
+class FakeSetup(dict):
+    """ A Bcfg2 options dict with a fake config file parser """
+
+    def __init__(self, options=None, **kwargs):
+        dict.__init__(self, repo=datastore, debug=False, verbose=False,
+                      syslog=False, logging=None, filemonitor="pseudo",
+                      ignore=[], configfile="/etc/bcfg2.conf", plugins=[],
+                      ca=None, bind_threads=1, daemon=False)
+        self.update(kwargs)
+        #: dict of (<section>, <option>) -> value
+        self.options = options or dict()
+        self.cfp = Mock()
+        self.cfp.get.side_effect = self._get
+        self.cfp.getboolean.side_effect = self._getboolean
+
+    def _get(self, section, option, default=None, **kwargs):
+        return self.options.get((section, option), default)
+
+    def _getboolean(self, section, option, default=None, **kwargs):
+        val = self.options.get((section, option), default)
+        if isinstance(val, str):
+            return val.lower() in ["1", "yes", "true", "on"]
+        return val
+
+
+def get_plugin(name, *interfaces):
+    """ Get a mock plugin that implements the given interfaces """
+    plugin = Mock(spec=list(interfaces) or [Bcfg2.Server.Plugin.Plugin])
+    plugin.__class__ = type(name, tuple(interfaces) or (object,), dict())
+    plugin.name = name
+    plugin.sort_order = 500
+    plugin.experimental = False
+    plugin.deprecated = False
+    plugin.conflicts = []
+    return plugin
+
+
+def get_core(options=None, plugins=None, cls=BaseCore, **kwargs):
+    """ Get a core with the given ``[section]`` options (a dict of
+    (<section>, <option>) -> value) and plugins (a dict of name ->
+    plugin object).  A mock Metadata plugin is added if none is
+    given. """
+    if plugins is None:
+        plugins = dict()
+    if not [p for p in plugins.values()
+            if isinstance(p, Bcfg2.Server.Plugin.Metadata)]:
+        plugins["Metadata"] = get_plugin("Metadata",
+                                         Bcfg2.Server.Plugin.Metadata)
+    setup = FakeSetup(options, plugins=list(plugins.keys()), **kwargs)
+
+    def init_plugin(core, name):
+        core.plugins[name] = plugins[name]
+
+    patchers = [patch("Bcfg2.Logger.setup_logging"),
+                patch("atexit.register"),
+                patch("signal.signal"),
+                patch("Bcfg2.settings.read_config"),
+                patch("Bcfg2.settings.HAS_DJANGO", False),
+                patch("%s.%s.init_plugin" % (cls.__module__, cls.__name__),
+                      init_plugin)]
+    for patcher in patchers:
+        patcher.start()
+    try:
+        return cls(setup)
+    finally:
+        for patcher in patchers:
+            patcher.stop()
+
+
+def get_metadata(hostname, groups=None, profile="group1"):
+    if groups is None:
+        groups = [profile]
+    return ClientMetadata(hostname, profile, set(groups), set(), set(),
+                          set(), dict(), None, None, None, None)
+
+
+class TestThreadPool(Bcfg2TestCase):
+    def test_run(self):
+        pool = ThreadPool(3, name="TestPool")
+        # threads are only started when they are needed
+        pool.run([])
+        self.assertEqual(pool.threads, [])
+
+        results = dict()
+
+        def job(num):
+            time.sleep(0.01)
+            if num == 3:
+                raise ValueError
+            results[num] = threading.currentThread().getName()
+
+        try:
+            pool.run([(job, (num,)) for num in range(10)])
+            # all jobs are finished when run() returns, and errors in
+            # one job do not stop the others
+            self.assertItemsEqual(results.keys(),
+                                  [n for n in range(10) if n != 3])
+            self.assertEqual(len(pool.threads), 3)
+            for name in results.values():
+                self.assertTrue(name.startswith("TestPool-"))
+        finally:
+            pool.shutdown()
+        self.assertEqual(pool.threads, [])
+
+
+class TestBaseCore(Bcfg2TestCase):
+    def test_invalidate_caches(self):
+        core = get_core(options={("caching", "client_config"): "true"})
+        other = get_metadata("other")
+        key = core._config_cache_key(other)
+        config = lxml.etree.Element("Configuration")
+        lxml.etree.SubElement(lxml.etree.SubElement(config, "Bundle"),
+                              "Path", name="/test")
+        core._cache_config("other", config, key, core.config_cache.serial)
+
+        # a client uploads probe data, which rewrites probed.xml.
+        # ProbeSet ignores the event, so the cached configurations
+        # of other clients are still valid.
+        probeset = ProbeSet(datastore, Mock(), "utf-8", "Probes")
+        core.fam.handles[0] = probeset
+        core.fam.handle_one_event(Event(0, "probed.xml", "changed"))
+        self.assertEqual(core._config_cache_key(other), key)
+        self.assertEqual(core.config_cache["other"][0], key)
+
+        # changes to a single entry in a GroupSpool only expire the
+        # configurations that contain it
+        spool = Mock(spec=Bcfg2.Server.Plugin.GroupSpool)
+        spool.HandleEvent.return_value = None
+        core._get_spool_dependency = Mock(return_value=("Path", "/test"))
+        core.fam.handles[1] = spool
+        core.fam.handle_one_event(Event(1, "test", "changed"))
+        self.assertNotIn("other", core.config_cache)
+
+        # events that other handlers don't ignore change the key
+        core._cache_config("other", config, key, core.config_cache.serial)
+        handler = Mock()
+        handler.HandleEvent.return_value = None
+        core.fam.handles[2] = handler
+        core.fam.handle_one_event(Event(2, "foo.xml", "changed"))
+        self.assertNotEqual(core._config_cache_key(other), key)
+
+    def test_build_metadata(self):
+        core = get_core(options={("caching", "client_metadata"): "cautious"})
+        metadata = get_metadata("foo.example.com")
+        metadata.query = Mock()
+        core.metadata.get_initial_metadata = Mock(return_value=metadata)
+        core.metadata.update_client_index = Mock()
+        self.assertIs(core.build_metadata("foo.example.com"), metadata)
+        core.metadata.update_client_index.assert_called_with(
+            "foo.example.com", metadata)
+
+        # cached metadata is not reindexed
+        core.metadata.update_client_index.reset_mock()
+        self.assertIs(core.build_metadata("foo.example.com"), metadata)
+        self.assertFalse(core.metadata.update_client_index.called)
+
+    def test_StartClientRun(self):
+        probes = get_plugin("Probes", Bcfg2.Server.Plugin.Probing)
+        probes.GetProbes = Mock(return_value=[lxml.etree.Element("probe",
+                                                                 name="test")])
+        core = get_core(plugins=dict(Probes=probes))
+        metadata = get_metadata("foo.example.com")
+        core.metadata.resolve_client = Mock(return_value="foo.example.com")
+        core.metadata.set_profile = Mock()
+        core.metadata.set_version = Mock()
+        core.build_metadata = Mock(return_value=metadata)
+        core.GetDecisions = Mock(return_value=[("Path", "/test")])
+        address = ("1.2.3.4", "foo.example.com")
+
+        rv = core.StartClientRun(address, "1.3.0", "group2", "whitelist")
+        core.metadata.resolve_client.assert_called_with(address,
+                                                        cleanup_cache=True)
+        core.metadata.set_profile.assert_called_with("foo.example.com",
+                                                     "group2", address)
+        core.metadata.set_version.assert_called_with("foo.example.com",
+                                                     "1.3.0")
+        # the metadata is only built once
+        core.build_metadata.assert_called_once_with("foo.example.com")
+        probes.GetProbes.assert_called_with(metadata)
+        core.GetDecisions.assert_called_with(metadata, "whitelist")
+        self.assertTrue(rv['version'])
+        self.assertEqual(
+            [p.get("name") for p in lxml.etree.XML(rv['probes'])], ["test"])
+        self.assertEqual(rv['decisions'], [("Path", "/test")])
+
+        # without a profile or a decision mode, and with a failure to
+        # set the version
+        core.metadata.set_profile.reset_mock()
+        core.metadata.set_version.side_effect = \
+            Bcfg2.Server.Plugin.MetadataRuntimeError
+        rv = core.StartClientRun(address, "1.3.0")
+        self.assertFalse(core.metadata.set_profile.called)
+        self.assertFalse(rv['version'])
+        self.assertNotIn('decisions', rv)
+
+        # failures to set the profile are fatal
+        core.metadata.set_profile.side_effect = \
+            Bcfg2.Server.Plugin.MetadataConsistencyError
+        self.assertRaises(xmlrpclib.Fault,
+                          core.StartClientRun, address, "1.3.0", "group2")
+
+    def test__config_cache_key(self):
+        core = get_core()
+        metadata = get_metadata("foo.example.com", groups=["group1", "a"])
+        metadata.Probes = dict(test="test")
+        metadata.connectors = ("Probes",)
+        key = core._config_cache_key(metadata)
+
+        # the key is the same for the same metadata, in any order
+        other = get_metadata("foo.example.com", groups=["a", "group1"])
+        other.Probes = dict(test="test")
+        other.connectors = ("Probes",)
+        self.assertEqual(core._config_cache_key(other), key)
+
+        # ...but different if anything about the client changes
+        other.Probes = dict(test="changed")
+        self.assertNotEqual(core._config_cache_key(other), key)
+        other = get_metadata("foo.example.com", groups=["group1", "b"])
+        self.assertNotEqual(core._config_cache_key(other), key)
+        other = get_metadata("foo.example.com", groups=["group1", "a"],
+                             profile="a")
+        self.assertNotEqual(core._config_cache_key(other), key)
+
+        # ...or if the repository changes
+        core.revision = "12345"
+        self.assertNotEqual(core._config_cache_key(metadata), key)
+        key = core._config_cache_key(metadata)
+        core.generations["Bundler"] = 1
+        self.assertNotEqual(core._config_cache_key(metadata), key)
+
+    def get_build_core(self, enabled=True):
+        """ Get a core whose configuration build steps are mocked,
+        producing a configuration with a single Path entry """
+        core = get_core(options={("caching", "client_config"):
+                                     str(enabled).lower()})
+        core.build_metadata = Mock(return_value=get_metadata("foo"))
+        bundle = lxml.etree.Element("Bundle", name="test")
+        lxml.etree.SubElement(bundle, "Path", name="/test")
+        core.GetStructures = Mock(return_value=[bundle])
+        core.validate_structures = Mock()
+        core.validate_goals = Mock()
+        core.client_run_hook = Mock()
+
+        def bind_structures(structures, metadata, config):
+            for struct in structures:
+                bundle = lxml.etree.SubElement(config, "Bundle",
+                                               name=struct.get("name"))
+                for entry in struct:
+                    lxml.etree.SubElement(bundle, entry.tag,
+                                          name=entry.get("name"),
+                                          type="file")
+
+        core.BindStructures = Mock(side_effect=bind_structures)
+        return core
+
+    def test__build_configuration_cache(self):
+        core = self.get_build_core()
+        config = core.BuildConfiguration("foo")
+        self.assertEqual(core.GetStructures.call_count, 1)
+        self.assertIn("foo", core.config_cache)
+
+        # the second run is served from the cache
+        cached = core.BuildConfiguration("foo")
+        self.assertEqual(core.GetStructures.call_count, 1)
+        self.assertEqual(lxml.etree.tostring(cached),
+                         lxml.etree.tostring(config))
+        # client run hooks still run
+        core.client_run_hook.assert_called_with("end_client_run",
+                                                core.build_metadata())
+
+        # a new revision means the config must be built again
+        core.revision = "12345"
+        config = core.BuildConfiguration("foo")
+        self.assertEqual(core.GetStructures.call_count, 2)
+        self.assertEqual(config.get("revision"), "12345")
+        core.BuildConfiguration("foo")
+        self.assertEqual(core.GetStructures.call_count, 2)
+
+        # an entry changes
+        core.config_cache.expire_dependents(("Path", "/test"))
+        core.BuildConfiguration("foo")
+        self.assertEqual(core.GetStructures.call_count, 3)
+
+    def test__build_configuration_nocache(self):
+        core = self.get_build_core(enabled=False)
+        core.BuildConfiguration("foo")
+        core.BuildConfiguration("foo")
+        self.assertEqual(core.GetStructures.call_count, 2)
+        self.assertNotIn("foo", core.config_cache)
+
+    def test__cache_config(self):
+        core = get_core()
+        config = lxml.etree.Element("Configuration")
+        lxml.etree.SubElement(lxml.etree.SubElement(config, "Bundle"),
+                              "Path", name="/test")
+
+        # configurations are not cached if anything was expired
+        # while they were built
+        serial = core.config_cache.serial
+        core.config_cache["bar"] = ("key", "<Configuration/>")
+        core.config_cache.expire("bar")
+        core._cache_config("foo", config, "key", serial)
+        self.assertNotIn("foo", core.config_cache)
+
+        core._cache_config("foo", config, "key", core.config_cache.serial)
+        self.assertEqual(core.config_cache["foo"],
+                         ("key", lxml.etree.tostring(config)))
+        core.config_cache.expire_dependents(("Path", "/test"))
+        self.assertNotIn("foo", core.config_cache)
+
+    def test_BindStructures(self):
+        def get_structures():
+            rv = []
+            for name in ["bundle1", "bundle2"]:
+                bundle = lxml.etree.Element("Bundle", name=name)
+                for num in range(5):
+                    lxml.etree.SubElement(bundle, "Path",
+                                          name="/%s/%s" % (name, num))
+                lxml.etree.SubElement(bundle, "BoundPath",
+                                      name="/%s/bound" % name, type="file")
+                rv.append(bundle)
+            return rv
+
+        def bind(entry, metadata):
+            if entry.get("name") == "/bundle2/3":
+                raise Bcfg2.Server.Plugin.PluginExecutionError("failed")
+            entry.set("type", "file")
+            entry.set("thread", threading.currentThread().getName())
+
+        metadata = get_metadata("foo")
+        configs = []
+        for threads in [1, 4]:
+            core = get_core(bind_threads=threads)
+            core.Bind = Mock(side_effect=bind)
+            config = lxml.etree.Element("Configuration")
+            try:
+                core.BindStructures(get_structures(), metadata, config)
+            finally:
+                if core.bind_pool is not None:
+                    core.bind_pool.shutdown()
+            # entries that are already bound are not bound again
+            self.assertItemsEqual(
+                [(c[0][0].get("name"), c[0][1])
+                 for c in core.Bind.call_args_list],
+                [("/bundle%s/%s" % (b, n), metadata)
+                 for b in [1, 2] for n in range(5)])
+            entries = config.xpath("//Path")
+            # with a pool, entries are bound on the pool's threads
+            for entry in entries:
+                if entry.get("thread") is not None:
+                    self.assertEqual(
+                        entry.get("thread").startswith("BindThread"),
+                        threads > 1)
+                    del entry.attrib["thread"]
+            configs.append(lxml.etree.tostring(config))
+
+        # the configuration is the same either way, in the same order
+        self.assertEqual(configs[0], configs[1])
+        config = lxml.etree.XML(configs[1])
+        self.assertEqual([b.get("name") for b in config],
+                         ["bundle1", "bundle2"])
+        self.assertEqual([e.get("name") for e in config[1]],
+                         ["/bundle2/%s" % n for n in range(5)] +
+                         ["/bundle2/bound"])
+        self.assertEqual(len(config.xpath("//Path[@type='file']")), 11)
+        self.assertIn("failed",
+                      config.xpath("//Path[@name='/bundle2/3']")[0].get(
+                          "failure"))
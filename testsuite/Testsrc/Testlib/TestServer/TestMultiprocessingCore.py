@@ -0,0 +1,156 @@
+import os
+import sys
+from mock import Mock, patch
+import Bcfg2.Server.Plugin
+from Bcfg2.Compat import Empty
+from Bcfg2.Server.FileMonitor import Event
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != '/':
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import *
+from TestCore import get_core, get_plugin
+
+try:
+    from Bcfg2.Server.BuiltinCore import Core as BuiltinCore
+    from Bcfg2.Server.MultiprocessingCore import Core
+    HAS_MULTIPROCESSING = True
+except ImportError:
+    HAS_MULTIPROCESSING = False
+
+
+class FakeQueue(object):
+    """ A queue that returns the given messages, then sets the
+    terminate event of the given core """
+
+    def __init__(self, core, messages):
+        self.core = core
+        self.messages = list(messages)
+
+    def get(self, block=True, timeout=None):
+        if not self.messages:
+            self.core.terminate.set()
+            raise Empty
+        return self.messages.pop(0)
+
+    def empty(self):
+        return not self.messages
+
+
+if HAS_MULTIPROCESSING or can_skip:
+    class TestCore(Bcfg2TestCase):
+        def get_obj(self, plugins=None):
+            return get_core(plugins=plugins, cls=Core, daemon_uid=0,
+                            daemon_gid=0, umask="0077", children=2)
+
+        @skipUnless(HAS_MULTIPROCESSING,
+                    "Multiprocessing core dependencies not found, skipping")
+        def setUp(self):
+            pass
+
+        def test__intercept_events(self):
+            core = self.get_obj()
+            core.event_queues = [Mock(), Mock()]
+            handler = Mock()
+            core.fam.AddMonitor = Mock(return_value=7)
+            core.fam.handle_one_event = Mock(
+                side_effect=lambda e: core.fam.AddMonitor("/test", handler))
+            core._intercept_events()
+
+            event = Event(1, "test", "created")
+            core.fam.handle_one_event(event)
+            for queue in core.event_queues:
+                queue.put.assert_called_with(("event", event, [7]))
+
+        def test__follow_events(self):
+            core = self.get_obj()
+            core._intercept_events()
+            core._follow_events()
+
+            # new monitors get the handle IDs the parent assigned
+            handler = Mock()
+            core._monitor_ids = [7]
+            self.assertEqual(core.fam.AddMonitor("/test", handler), 7)
+            self.assertEqual(core.fam.handles[7], handler)
+            self.assertEqual(core.fam.AddMonitor("/test2", handler), "/test2")
+
+        def test__child_event_thread(self):
+            core = self.get_obj()
+            event = Event(1, "test", "changed")
+            monitor_ids = []
+            core.fam.handle_one_event = Mock(
+                side_effect=lambda e: monitor_ids.extend(core._monitor_ids))
+            core._reload_client = Mock()
+            core._update_vcs_revision = Mock()
+            core._child_event_thread(
+                FakeQueue(core, [("event", event, [3]),
+                                 ("client", "foo.example.com")]))
+            core.fam.handle_one_event.assert_called_with(event)
+            self.assertEqual(monitor_ids, [3])
+            core._reload_client.assert_called_with("foo.example.com")
+            core._update_vcs_revision.assert_called_with()
+
+        def test__relay_client_updates(self):
+            core = self.get_obj()
+            core.event_queues = [Mock(), Mock(), Mock()]
+            core._reload_client = Mock()
+            core.client_queue = FakeQueue(core, [(1, "foo.example.com")])
+            core._relay_client_updates()
+            core._reload_client.assert_called_with("foo.example.com")
+
+            # the child that received the probe data is skipped
+            core.event_queues[0].put.assert_called_with(("client",
+                                                         "foo.example.com"))
+            self.assertFalse(core.event_queues[1].put.called)
+            core.event_queues[2].put.assert_called_with(("client",
+                                                         "foo.example.com"))
+
+        def test__reload_client(self):
+            probes = get_plugin("Probes", Bcfg2.Server.Plugin.Probing)
+            probes.load_client_data = Mock()
+            broken = get_plugin("Broken", Bcfg2.Server.Plugin.Probing)
+            broken.load_client_data = Mock(side_effect=ValueError)
+            core = self.get_obj(plugins=dict(Probes=probes, Broken=broken))
+            core.metadata.expire_client_index = Mock()
+            for cache in [core.metadata_cache, core.config_cache]:
+                cache["foo.example.com"] = Mock()
+                cache["bar.example.com"] = Mock()
+
+            core._reload_client("foo.example.com")
+            probes.load_client_data.assert_called_with("foo.example.com")
+            broken.load_client_data.assert_called_with("foo.example.com")
+            core.metadata.expire_client_index.assert_called_with(
+                "foo.example.com")
+            for cache in [core.metadata_cache, core.config_cache]:
+                self.assertNotIn("foo.example.com", cache)
+                self.assertIn("bar.example.com", cache)
+
+        def test_RecvProbeData(self):
+            core = self.get_obj()
+            core.resolve_client = Mock(return_value=("foo.example.com", None))
+            core.client_queue = Mock()
+            address = ("1.2.3.4", "foo.example.com")
+
+            patcher = patch.object(BuiltinCore, "RecvProbeData",
+                                   Mock(return_value=True))
+            patcher.start()
+            try:
+                # the parent does not report probe data
+                self.assertTrue(core.RecvProbeData(address, "<probe/>"))
+                BuiltinCore.RecvProbeData.assert_called_with(core, address,
+                                                             "<probe/>")
+                self.assertFalse(core.client_queue.put.called)
+
+                # children report clients that sent probe data
+                core.child_number = 1
+                self.assertTrue(core.RecvProbeData(address, "<probe/>"))
+                core.client_queue.put.assert_called_with(
+                    (1, "foo.example.com"))
+            finally:
+                patcher.stop()
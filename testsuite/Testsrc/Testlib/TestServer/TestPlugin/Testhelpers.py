@@ -735,26 +735,25 @@ class TestStructFile(TestXMLFileBacked):
         for el in standalone:
             self.assertXMLEqual(el, sf._match(el, metadata)[0])
 
-    @patch("Bcfg2.Server.Plugin.helpers.%s._match" % test_obj.__name__)
-    def test_Match(self, mock_match):
-        sf = self.get_obj()
+    def _get_test_metadata(self):
+        """ get metadata that matches the elements of the test data
+        with include="true" """
         metadata = Mock()
+        metadata.groups = ["group1", "subgroup1", "group3"]
+        metadata.hostname = "client3"
+        return metadata
+
+    def test_Match(self):
+        sf = self.get_obj()
+        metadata = self._get_test_metadata()
 
         (xdata, groups, subgroups, children, subchildren, standalone) = \
             self._get_test_data()
         sf.entries.extend(copy.deepcopy(xdata).getchildren())
 
-        def match_rv(el, _):
-            if el.tag not in ['Client', 'Group']:
-                return [el]
-            elif el.get("include") == "true":
-                return el.getchildren()
-            else:
-                return []
-        mock_match.side_effect = match_rv
         actual = sf.Match(metadata)
-        expected = reduce(lambda x, y: x + y,
-                          list(children.values()) + list(subgroups.values()))
+        expected = children[0] + subchildren[0] + standalone[:2] + \
+            children[3] + standalone[2:]
         self.assertEqual(len(actual), len(expected))
         # easiest way to compare the values is actually to make
         # them into an XML document and let assertXMLEqual compare
@@ -765,6 +764,27 @@ class TestStructFile(TestXMLFileBacked):
         xexpected.extend(expected)
         self.assertXMLEqual(xactual, xexpected)
 
+        # a client with the same memberships in the groups named in
+        # the file gets the cached result, as a new copy
+        sf._evaluate = Mock()
+        metadata2 = Mock()
+        metadata2.groups = ["group1", "subgroup1", "group4"]
+        metadata2.hostname = "client3"
+        actual2 = sf.Match(metadata2)
+        self.assertFalse(sf._evaluate.called)
+        self.assertEqual(len(actual2), len(expected))
+        for el in actual2:
+            self.assertNotIn(el, actual)
+        xactual = lxml.etree.Element("Container")
+        xactual.extend(actual2)
+        self.assertXMLEqual(xactual, xexpected)
+
+        # a client that is named in the file does not
+        sf._evaluate.return_value = []
+        metadata2.hostname = "client1"
+        self.assertEqual(sf.Match(metadata2), [])
+        sf._evaluate.assert_called_with(sf._matcher.tree, metadata2)
+
     @patch("Bcfg2.Server.Plugin.helpers.%s._include_element" %
            test_obj.__name__)
     def test__xml_match(self, mock_include):
@@ -791,15 +811,15 @@ class TestStructFile(TestXMLFileBacked):
     @patch("Bcfg2.Server.Plugin.helpers.%s._xml_match" % test_obj.__name__)
     def test_XMLMatch(self, mock_xml_match):
         sf = self.get_obj()
-        metadata = Mock()
+        metadata = self._get_test_metadata()
 
         (sf.xdata, groups, subgroups, children, subchildren, standalone) = \
             self._get_test_data()
 
-        sf.XMLMatch(metadata)
+        rv = sf.XMLMatch(metadata)
         actual = []
         for call in mock_xml_match.call_args_list:
-            actual.append(call[0][0])
+            actual.append(copy.deepcopy(call[0][0]))
             self.assertEqual(call[0][1], metadata)
         expected = list(groups.values()) + standalone
         # easiest way to compare the values is actually to make
@@ -811,6 +831,18 @@ class TestStructFile(TestXMLFileBacked):
         xexpected.extend(expected)
         self.assertXMLEqual(xactual, xexpected)
 
+        # the result is cached, and a new copy is returned
+        mock_xml_match.reset_mock()
+        rv2 = sf.XMLMatch(metadata)
+        self.assertFalse(mock_xml_match.called)
+        self.assertIsNot(rv, rv2)
+        self.assertXMLEqual(rv, rv2)
+
+        # the cache is discarded when the file is reloaded
+        sf.xdata = self._get_test_data()[0]
+        sf.XMLMatch(metadata)
+        self.assertTrue(mock_xml_match.called)
+
 
 class TestINode(Bcfg2TestCase):
     test_obj = INode
@@ -1128,6 +1160,17 @@ class TestXMLSrc(TestXMLFileBacked):
         self.assertEqual(xsrc.__node__.call_args[0][1], dict())
         self.assertEqual(xsrc.pnode, xsrc.__node__.return_value)
         self.assertEqual(xsrc.cache, None)
+        self.assertItemsEqual(xsrc.groups, [])
+        self.assertItemsEqual(xsrc.clients, [])
+
+        grp = lxml.etree.SubElement(xdata, "Group", name="group1")
+        lxml.etree.SubElement(grp, "Client", name="foo.example.com")
+        mock_open.return_value.read.return_value = tostring(xdata)
+        xsrc.match_cache["foo"] = "bar"
+        xsrc.HandleEvent(Mock())
+        self.assertItemsEqual(xsrc.groups, ["group1"])
+        self.assertItemsEqual(xsrc.clients, ["foo.example.com"])
+        self.assertEqual(len(xsrc.match_cache), 0)
 
     @patch("Bcfg2.Server.Plugin.helpers.XMLSrc.HandleEvent")
     def test_Cache(self, mock_HandleEvent):
@@ -1146,10 +1189,40 @@ class TestXMLSrc(TestXMLFileBacked):
         self.assertFalse(xsrc.pnode.Mock.called)
         self.assertEqual(xsrc.cache[0], metadata)
 
+        # the matched entries are cached even when the per-client
+        # cache is reset
         xsrc.cache = ("bogus")
         xsrc.Cache(metadata)
-        xsrc.pnode.Match.assert_called_with(metadata, xsrc.__cacheobj__())
+        self.assertFalse(xsrc.pnode.Match.called)
+        self.assertEqual(xsrc.cache[0], metadata)
+        self.assertEqual(xsrc.cache[1], xsrc.__cacheobj__())
+
+        # clients with the same membership in the groups named in
+        # the file share cached matches
+        xsrc = self.get_obj("/test/foo.xml")
+        xsrc.pnode = Mock()
+        xsrc.groups = frozenset(["group1", "group2"])
+        xsrc.clients = frozenset(["foo.example.com"])
+
+        def get_metadata(hostname, groups):
+            rv = Mock()
+            rv.hostname = hostname
+            rv.groups = groups
+            return rv
+
+        xsrc.Cache(get_metadata("bar.example.com", ["group1", "group3"]))
+        self.assertEqual(xsrc.pnode.Match.call_count, 1)
+        data = xsrc.cache[1]
+        metadata = get_metadata("baz.example.com", ["group1", "group4"])
+        xsrc.Cache(metadata)
+        self.assertEqual(xsrc.pnode.Match.call_count, 1)
         self.assertEqual(xsrc.cache[0], metadata)
+        self.assertIs(xsrc.cache[1], data)
+
+        xsrc.Cache(get_metadata("bar.example.com", ["group1", "group2"]))
+        self.assertEqual(xsrc.pnode.Match.call_count, 2)
+        xsrc.Cache(get_metadata("foo.example.com", ["group1"]))
+        self.assertEqual(xsrc.pnode.Match.call_count, 3)
 
 
 class TestInfoXML(TestXMLSrc):
@@ -1182,9 +1255,11 @@ class TestPrioDir(TestPlugin, TestGenerator, TestXMLDirectoryBacked):
             pd = self.get_obj()
             test1 = Mock()
             test1.items = dict(Path=["/etc/foo.conf", "/etc/bar.conf"])
+            test1.priority = 10
             test2 = Mock()
-            test2.items = dict(Path=["/etc/baz.conf"],
+            test2.items = dict(Path=["/etc/baz.conf", "/etc/bar.conf"],
                                Package=["quux", "xyzzy"])
+            test2.priority = 20
             pd.entries = {"/test1.xml": test1,
                           "/test2.xml": test2}
             pd.HandleEvent(Mock())
@@ -1194,6 +1269,15 @@ class TestPrioDir(TestPlugin, TestGenerator, TestXMLDirectoryBacked):
                                              "/etc/baz.conf": pd.BindEntry},
                                        Package={"quux": pd.BindEntry,
                                                 "xyzzy": pd.BindEntry}))
+            self.assertItemsEqual(pd.index.keys(),
+                                  [("Path", "/etc/foo.conf"),
+                                   ("Path", "/etc/bar.conf"),
+                                   ("Path", "/etc/baz.conf"),
+                                   ("Package", "quux"),
+                                   ("Package", "xyzzy")])
+            self.assertEqual(pd.index[("Path", "/etc/foo.conf")], [test1])
+            self.assertEqual(pd.index[("Path", "/etc/bar.conf")],
+                             [test2, test1])
 
         inner()
 
@@ -1242,6 +1326,8 @@ class TestPrioDir(TestPlugin, TestGenerator, TestXMLDirectoryBacked):
             path = os.path.join(pd.data, name)
             pd.entries[path] = Mock()
             pd.entries[path].priority = prio
+            pd.entries[path].items = dict([(tag, list(entries.keys()))
+                                           for tag, entries in data.items()])
             def do_Cache(metadata):
                 pd.entries[path].cache = (metadata, data)
             pd.entries[path].Cache.side_effect = do_Cache
@@ -1260,30 +1346,56 @@ class TestPrioDir(TestPlugin, TestGenerator, TestXMLDirectoryBacked):
                   dict(Path={'/etc/baz.conf': dict()},
                        Package={'xyzzy': dict()}),
                   prio=20)
+        pd._update_index()
+        test1 = pd.entries[os.path.join(pd.data, 'test1.xml')]
+        test2 = pd.entries[os.path.join(pd.data, 'test2.xml')]
 
-        # test with exactly one match, __children__
-        reset()
-        self.assertItemsEqual(pd.get_attrs(entry, metadata),
-                              dict(attr="attr1"))
-        for src in pd.entries.values():
-            src.Cache.assert_called_with(metadata)
-        self.assertEqual(len(entry.getchildren()), 1)
-        self.assertXMLEqual(entry.getchildren()[0], children[0])
-
-        # test with multiple matches with different priorities, __text__
-        reset()
-        entry = lxml.etree.Element("Path", name="/etc/bar.conf")
-        self.assertItemsEqual(pd.get_attrs(entry, metadata),
-                              dict(attr="attr1"))
-        for src in pd.entries.values():
-            src.Cache.assert_called_with(metadata)
-        self.assertEqual(entry.text, "text")
-
-        # test with multiple matches with identical priorities
-        reset()
-        entry = lxml.etree.Element("Package", name="xyzzy")
-        self.assertRaises(PluginExecutionError,
-                          pd.get_attrs, entry, metadata)
+        def inner(cached):
+            # test with exactly one match, __children__
+            reset()
+            entry = lxml.etree.Element("Path", name="/etc/foo.conf")
+            self.assertItemsEqual(pd.get_attrs(entry, metadata),
+                                  dict(attr="attr1"))
+            for src in cached([test1]):
+                src.Cache.assert_called_with(metadata)
+            self.assertEqual(len(entry.getchildren()), 1)
+            self.assertXMLEqual(entry.getchildren()[0], children[0])
+
+            # test with multiple matches with different priorities,
+            # __text__
+            reset()
+            entry = lxml.etree.Element("Path", name="/etc/bar.conf")
+            self.assertItemsEqual(pd.get_attrs(entry, metadata),
+                                  dict(attr="attr1"))
+            for src in cached([test2]):
+                src.Cache.assert_called_with(metadata)
+            self.assertEqual(entry.text, "text")
+
+            # test with multiple matches with identical priorities
+            reset()
+            entry = lxml.etree.Element("Package", name="xyzzy")
+            self.assertRaises(PluginExecutionError,
+                              pd.get_attrs, entry, metadata)
+
+            # test with an entry that no source contains
+            reset()
+            entry = lxml.etree.Element("Path", name="/etc/quux.conf")
+            self.assertRaises(PluginExecutionError,
+                              pd.get_attrs, entry, metadata)
+
+        if pd._strict_matching(entry):
+            # with strict matching, only the sources that contain the
+            # entry are searched, and lower-priority sources are
+            # skipped once a match is found
+            inner(lambda srcs: srcs)
+            reset()
+            pd.get_attrs(lxml.etree.Element("Path", name="/etc/bar.conf"),
+                         metadata)
+            self.assertFalse(test1.Cache.called)
+
+        # with _matches overridden, every source is searched
+        pd._matches = Mock(side_effect=lambda e, m, r: e.get("name") in r)
+        inner(lambda srcs: pd.entries.values())
 
 
 class TestSpecificity(Bcfg2TestCase):
@@ -1459,6 +1571,58 @@ class TestEntrySet(TestDebuggable):
         for i in items.values():
             i.specific.matches.assert_called_with(metadata)
 
+    def test_get_matching_index(self):
+        eset = self.get_obj()
+        items = dict()
+        for name, spec in [("all", Specificity(all=True)),
+                           ("foo", Specificity(hostname="foo")),
+                           ("bar", Specificity(hostname="bar")),
+                           ("g1", Specificity(group="group1", prio=10)),
+                           ("g2", Specificity(group="group2", prio=20)),
+                           ("g3", Specificity(group="group3", prio=30))]:
+            items[name] = Mock()
+            items[name].specific = spec
+        eset.entries = items
+
+        def get_metadata(hostname, groups):
+            rv = Mock()
+            rv.hostname = hostname
+            rv.groups = groups
+            return rv
+
+        # entries are returned from most to least specific
+        self.assertEqual(eset.get_matching(get_metadata("foo",
+                                                        ["group1", "group2",
+                                                         "group4"])),
+                         [items["foo"], items["g2"], items["g1"],
+                          items["all"]])
+        self.assertEqual(eset.get_matching(get_metadata("baz", ["group3"])),
+                         [items["g3"], items["all"]])
+        self.assertEqual(eset.best_matching(get_metadata("baz", ["group3"])),
+                         items["g3"])
+        self.assertEqual(eset.best_matching(get_metadata("baz", []),
+                                            [items["all"], items["g1"]]),
+                         items["g1"])
+
+        # clients with the same signature share the cached result,
+        # but get their own copy of it
+        rv = eset.get_matching(get_metadata("quux", ["group3", "group5"]))
+        self.assertEqual(rv, [items["g3"], items["all"]])
+        rv.pop()
+        self.assertEqual(eset.get_matching(get_metadata("baz", ["group3"])),
+                         [items["g3"], items["all"]])
+        cache = eset._get_index().cache
+        self.assertEqual(len(cache), 2)
+
+        # the index is rebuilt when the entries change
+        items["g4"] = Mock()
+        items["g4"].specific = Specificity(group="group3", prio=40)
+        eset.entries["g4"] = items["g4"]
+        self.assertEqual(eset.get_matching(get_metadata("baz", ["group3"])),
+                         [items["g4"], items["g3"], items["all"]])
+        del eset.entries["all"]
+        self.assertEqual(eset.get_matching(get_metadata("baz", [])), [])
+
     def test_best_matching(self):
         eset = self.get_obj()
         eset.get_matching = Mock()
@@ -2,11 +2,12 @@ import os
 import sys
 import errno
 import lxml.etree
+import Bcfg2.Cache
 import Bcfg2.Options
 from Bcfg2.Compat import walk_packages
 from mock import Mock, MagicMock, patch
 from Bcfg2.Server.Plugins.Cfg import *
-from Bcfg2.Server.Plugin import PluginExecutionError
+from Bcfg2.Server.Plugin import PluginExecutionError, Specificity
 
 # add all parent testsuite directories to sys.path to allow (most)
 # relative imports in python 2.4
@@ -132,6 +133,159 @@ class TestCfgGenerator(TestCfgBaseFileMatcher):
         self.assertEqual(cg.data, cg.get_data(Mock(), Mock()))
 
 
+class FakeMetadata(object):
+    """ a minimal client metadata object for the render cache tests """
+    def __init__(self, hostname, groups, probes=None):
+        self.hostname = hostname
+        self.groups = set(groups)
+        self.Probes = probes or dict()
+        self.query = Mock()
+
+    def inGroup(self, group):
+        return group in self.groups
+
+
+class TestMetadataRecorder(Bcfg2TestCase):
+    def get_obj(self, metadata):
+        log = Bcfg2.Server.Plugins.Cfg._AccessLog()
+        return MetadataRecorder(metadata, (), log), log
+
+    def test_record(self):
+        metadata = FakeMetadata("foo.example.com", ["a", "b"],
+                                dict(arch="x86_64"))
+        recorder, log = self.get_obj(metadata)
+        self.assertEqual(recorder.hostname, "foo.example.com")
+        self.assertIn("a", recorder.groups)
+        self.assertNotIn("c", recorder.groups)
+        self.assertTrue(recorder.inGroup("b"))
+        self.assertEqual(recorder.Probes["arch"], "x86_64")
+        self.assertRaises(KeyError, recorder.Probes.__getitem__, "os")
+        self.assertRaises(AttributeError, getattr, recorder, "bogus")
+        self.assertTrue(log.recordable)
+        self.assertItemsEqual(
+            log.accesses,
+            [((('attr', 'hostname'),), "foo.example.com"),
+             ((('attr', 'groups'), ('contains', 'a')), True),
+             ((('attr', 'groups'), ('contains', 'c')), False),
+             ((('attr', 'inGroup'), ('call', ('b',))), True),
+             ((('attr', 'Probes'), ('getitem', 'arch')), "x86_64"),
+             ((('attr', 'Probes'), ('getitem', 'os')),
+              ('tuple', ('raise', 'KeyError'))),
+             ((('attr', 'bogus'),), ('tuple', ('raise', 'AttributeError')))])
+
+        # every recorded value is found again by following its path
+        for path, value in log.accesses:
+            self.assertEqual(
+                Bcfg2.Server.Plugins.Cfg._evaluate_path(metadata, path),
+                value)
+
+    def test_read(self):
+        metadata = FakeMetadata("foo.example.com", ["a", "b"])
+        recorder, log = self.get_obj(metadata)
+        self.assertItemsEqual(list(recorder.groups), ["a", "b"])
+        self.assertEqual(recorder.groups & set(["b", "c"]), set(["b"]))
+        self.assertEqual(len(recorder.Probes), 0)
+        self.assertTrue(log.recordable)
+        self.assertItemsEqual(
+            log.accesses,
+            [((('attr', 'groups'), ('read',)), frozenset(["a", "b"])),
+             ((('attr', 'Probes'), ('read',)), ('dict', frozenset()))])
+
+    def test_unrecordable(self):
+        recorder, log = self.get_obj(FakeMetadata("foo.example.com", []))
+        recorder.query.names_in_group("a")
+        self.assertFalse(log.recordable)
+
+
+class TestCfgRenderCache(Bcfg2TestCase):
+    test_obj = CfgRenderCache
+
+    def setUp(self):
+        self.patcher = patch("Bcfg2.Server.Plugins.Cfg.RENDER_CACHE",
+                             Bcfg2.Cache.Cache())
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def get_obj(self, name=None):
+        if name is None:
+            name = os.path.join(datastore, "test.txt.genshi")
+        return self.test_obj(name)
+
+    def test_render_groups(self):
+        rc = self.get_obj()
+        data = "template"
+        render = Mock(side_effect=lambda m: str("web" in m.groups))
+        foo = FakeMetadata("foo.example.com", ["web", "linux"])
+        bar = FakeMetadata("bar.example.com", ["web"])
+        baz = FakeMetadata("baz.example.com", ["linux"])
+
+        self.assertEqual(rc.render(render, data, "/test.txt", foo), "True")
+        self.assertEqual(render.call_count, 1)
+        # bar only differs in ways the template does not look at
+        self.assertEqual(rc.render(render, data, "/test.txt", bar), "True")
+        self.assertEqual(render.call_count, 1)
+        self.assertEqual(rc.render(render, data, "/test.txt", baz), "False")
+        self.assertEqual(render.call_count, 2)
+        self.assertEqual(rc.render(render, data, "/test.txt", foo), "True")
+        self.assertEqual(render.call_count, 2)
+
+        # output is cached separately for each entry
+        self.assertEqual(rc.render(render, data, "/other.txt", foo), "True")
+        self.assertEqual(render.call_count, 3)
+
+        # a new template is rendered again
+        self.assertEqual(rc.render(render, "template2", "/test.txt", foo),
+                         "True")
+        self.assertEqual(render.call_count, 4)
+        self.assertEqual(len(Bcfg2.Server.Plugins.Cfg.RENDER_CACHE), 1)
+
+    def test_render_hostname(self):
+        rc = self.get_obj()
+        data = "template"
+        render = Mock(side_effect=lambda m: m.hostname)
+        foo = FakeMetadata("foo.example.com", ["web"])
+        bar = FakeMetadata("bar.example.com", ["web"])
+        self.assertEqual(rc.render(render, data, "/test.txt", foo),
+                         "foo.example.com")
+        self.assertEqual(rc.render(render, data, "/test.txt", bar),
+                         "bar.example.com")
+        self.assertEqual(rc.render(render, data, "/test.txt", foo),
+                         "foo.example.com")
+        self.assertEqual(render.call_count, 2)
+
+    def test_render_uncached(self):
+        foo = FakeMetadata("foo.example.com", ["web"])
+
+        # templates can opt out of the cache
+        rc = self.get_obj()
+        data = "%s\ntemplate" % CfgRenderCache.nocache
+        render = Mock(return_value="output")
+        rc.render(render, data, "/test.txt", foo)
+        rc.render(render, data, "/test.txt", foo)
+        self.assertEqual(render.call_count, 2)
+
+        # templates that read values that cannot be recorded are not
+        # cached
+        rc = self.get_obj()
+        data = "template"
+        render = Mock(side_effect=lambda m: str(m.query.all()))
+        rc.render(render, data, "/test.txt", foo)
+        self.assertFalse(rc.enabled)
+        rc.render(render, data, "/test.txt", foo)
+        self.assertEqual(render.call_count, 2)
+
+        # nothing is cached if the render cache is disabled
+        Bcfg2.Server.Plugins.Cfg.RENDER_CACHE = None
+        rc = self.get_obj()
+        render = Mock(return_value="output")
+        rc.render(render, data, "/test.txt", foo)
+        rc.render(render, data, "/test.txt", foo)
+        self.assertEqual(render.call_count, 2)
+        render.assert_called_with(foo)
+
+
 class TestCfgFilter(TestCfgBaseFileMatcher):
     test_obj = CfgFilter
 
@@ -400,6 +554,11 @@ class TestCfgEntrySet(TestEntrySet):
                          eset.get_handlers.return_value)
         eset.get_handlers.assert_called_with(metadata, CfgGenerator)
 
+    def test_get_matching_index(self):
+        # get_matching() is implemented with get_handlers() on
+        # CfgEntrySet objects
+        pass
+
     @patch("Bcfg2.Server.Plugin.EntrySet.entry_init")
     def test_entry_init(self, mock_entry_init):
         eset = self.get_obj()
@@ -600,6 +759,62 @@ class TestCfgEntrySet(TestEntrySet):
             if entry.specific is not None:
                 self.assertFalse(entry.specific.matches.called)
 
+    def test_get_handlers_index(self):
+        eset = self.get_obj()
+        eset.entries['info'] = CfgInfo("info")
+        eset.entries['test'] = CfgGenerator("test",
+                                            Specificity(all=True), None)
+        eset.entries['test.G10_group1'] = \
+            CfgGenerator("test.G10_group1",
+                         Specificity(group="group1", prio=10), None)
+        eset.entries['test.G20_group2'] = \
+            CfgGenerator("test.G20_group2",
+                         Specificity(group="group2", prio=20), None)
+        eset.entries['test.H_foo'] = \
+            CfgGenerator("test.H_foo", Specificity(hostname="foo"), None)
+        eset.entries['test.G10_group1.filter'] = \
+            CfgFilter("test.G10_group1.filter",
+                      Specificity(group="group1", prio=10), None)
+
+        def get_metadata(hostname, groups):
+            rv = Mock()
+            rv.hostname = hostname
+            rv.groups = groups
+            return rv
+
+        # handlers are returned from most to least specific
+        metadata = get_metadata("foo", ["group1", "group2"])
+        self.assertEqual(eset.get_handlers(metadata, CfgGenerator),
+                         [eset.entries['test.H_foo'],
+                          eset.entries['test.G20_group2'],
+                          eset.entries['test.G10_group1'],
+                          eset.entries['test']])
+        self.assertEqual(eset.get_handlers(metadata, CfgInfo),
+                         [eset.entries['info']])
+        self.assertEqual(eset.get_handlers(metadata, CfgFilter),
+                         [eset.entries['test.G10_group1.filter']])
+        self.assertEqual(eset.get_handlers(metadata, CfgVerifier), [])
+
+        metadata = get_metadata("bar", ["group1", "group3"])
+        self.assertEqual(eset.get_handlers(metadata, CfgGenerator),
+                         [eset.entries['test.G10_group1'],
+                          eset.entries['test']])
+        self.assertEqual(eset.best_matching(metadata,
+                                            [eset.entries['test'],
+                                             eset.entries['test.G10_group1']]),
+                         eset.entries['test.G10_group1'])
+
+        # results are cached per handler type and group signature
+        cache = eset._get_handler_index().cache
+        self.assertEqual(len(cache), 5)
+        eset.get_handlers(get_metadata("baz", ["group1"]), CfgGenerator)
+        self.assertEqual(len(cache), 5)
+
+        # the index is rebuilt when the handlers change
+        del eset.entries['test.G10_group1']
+        self.assertEqual(eset.get_handlers(metadata, CfgGenerator),
+                         [eset.entries['test']])
+
     def test_bind_info_to_entry(self):
         default_info = Bcfg2.Server.Plugins.Cfg.DEFAULT_INFO
         eset = self.get_obj()
@@ -754,6 +969,7 @@ class TestCfg(TestGroupSpool, TestPullTarget):
         if core is None:
             core = Mock()
         core.setup = MagicMock()
+        core.setup.cfp.getboolean.return_value = False
         return TestGroupSpool.get_obj(self, core=core)
 
     @patch("Bcfg2.Server.Plugin.GroupSpool.__init__")
@@ -761,6 +977,7 @@ class TestCfg(TestGroupSpool, TestPullTarget):
     def test__init(self, mock_pulltarget_init, mock_groupspool_init):
         core = Mock()
         core.setup = MagicMock()
+        core.setup.cfp.getboolean.return_value = False
         cfg = self.test_obj(core, datastore)
         mock_pulltarget_init.assert_called_with(cfg)
         mock_groupspool_init.assert_called_with(cfg, core, datastore)
@@ -778,6 +995,26 @@ class TestCfg(TestGroupSpool, TestPullTarget):
         mock_groupspool_init.assert_called_with(cfg, core, datastore)
         self.assertFalse(core.setup.add_option.called)
         self.assertFalse(core.setup.reparse.called)
+        self.assertIsNone(Bcfg2.Server.Plugins.Cfg.RENDER_CACHE)
+
+    @patch("Bcfg2.Server.Plugin.GroupSpool.__init__", Mock())
+    @patch("Bcfg2.Server.Plugin.PullTarget.__init__", Mock())
+    @patch("Bcfg2.Server.Plugins.Cfg.get_cache")
+    def test__init_render_cache(self, mock_get_cache):
+        core = Mock()
+        core.setup = MagicMock()
+        core.setup.cfp.getboolean.return_value = True
+        try:
+            self.test_obj(core, datastore)
+            core.setup.cfp.getboolean.assert_called_with("cfg",
+                                                         "render_cache",
+                                                         default=False)
+            mock_get_cache.assert_called_with("cfg_render", core.setup.cfp,
+                                              max_bytes=64 * 1024 * 1024)
+            self.assertEqual(Bcfg2.Server.Plugins.Cfg.RENDER_CACHE,
+                             mock_get_cache.return_value)
+        finally:
+            Bcfg2.Server.Plugins.Cfg.RENDER_CACHE = None
 
     def test_has_generator(self):
         cfg = self.get_obj()
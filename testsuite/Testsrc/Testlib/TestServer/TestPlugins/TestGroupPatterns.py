@@ -2,6 +2,7 @@ import os
 import sys
 import lxml.etree
 import Bcfg2.Server.Plugin
+from Bcfg2.Cache import Cache
 from mock import Mock, MagicMock, patch
 from Bcfg2.Server.Plugins.GroupPatterns import *
 
@@ -135,8 +136,18 @@ class TestPatternFile(TestXMLFileBacked):
 </GroupPatterns>"""
 
         core.metadata_cache_mode = 'aggressive'
+        core.metadata_cache = Cache()
+        for client in ["foo1", "bar1"]:
+            core.metadata_cache[client] = Mock()
+            core.metadata_cache[client].hostname = client
+        old = Mock()
+        old.process = lambda n: (n == "foo1" and ["test3"]) or None
+        pf.patterns = [old]
+        mock_PatternMap.return_value.process = \
+            lambda n: (n.startswith("foo") and ["test1"]) or None
         pf.Index()
-        core.metadata_cache.expire.assert_called_with()
+        # only the client whose groups changed is expired
+        self.assertItemsEqual(core.metadata_cache.keys(), ["bar1"])
         self.assertItemsEqual(mock_PatternMap.call_args_list,
                               [call("foo.*", None, ["test1", "test2"]),
                                call(None, "foo[[1-5]]", ["test3"])])
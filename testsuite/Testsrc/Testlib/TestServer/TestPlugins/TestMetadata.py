@@ -2,10 +2,16 @@ import os
 import sys
 import copy
 import time
+import random
 import socket
+import shutil
+import tempfile
 import lxml.etree
 import Bcfg2.Server
 import Bcfg2.Server.Plugin
+from Bcfg2.Cache import Cache
+from Bcfg2.Compat import cPickle
+from Bcfg2.Server.Resolver import Resolver
 from Bcfg2.Server.Plugins.Metadata import *
 from mock import Mock, MagicMock, patch
 
@@ -88,18 +94,112 @@ def get_groups_test_tree():
 </Groups>''').getroottree()
 
 
+def get_random_groups_tree(rand, count):
+    """ generate a groups.xml with nested, negated, and conflicting
+    groups """
+    root = lxml.etree.Element("Groups")
+    for i in range(count):
+        grp = lxml.etree.SubElement(root, "Group", name="group%d" % i)
+        if rand.random() < 0.3:
+            grp.set("category", "category%d" % rand.randint(0, 2))
+    for i in range(count * 2):
+        parent = root
+        for _ in range(rand.randint(1, 2)):
+            if rand.random() < 0.1:
+                parent = lxml.etree.SubElement(
+                    parent, "Client", name="client%d" % rand.randint(0, 2))
+            else:
+                parent = lxml.etree.SubElement(
+                    parent, "Group",
+                    name="group%d" % rand.randint(0, count - 1))
+            if rand.random() < 0.3:
+                parent.set("negate", "true")
+        grp = lxml.etree.SubElement(
+            parent, "Group", name="group%d" % rand.randint(0, count - 1))
+        if rand.random() < 0.2:
+            grp.set("negate", "true")
+    return root.getroottree()
+
+
+def get_legacy_merge_groups(groups, xdata):
+    """ get a function that evaluates group membership the way the
+    Metadata plugin used to, with predicates built from nested closures
+    and a loop over all of them until the groups stop changing.  the
+    predicates are evaluated in document order. """
+    def get_condition(element):
+        negate = element.get('negate', 'false').lower() == 'true'
+        pname = element.get("name")
+        if element.tag == 'Group':
+            return lambda c, g, _: negate != (pname in g)
+        elif element.tag == 'Client':
+            return lambda c, g, _: negate != (pname == c)
+
+    def get_category_condition(category):
+        return lambda c, g, categories: category not in categories
+
+    def aggregate_conditions(conditions):
+        return lambda client, grps, cats: \
+            all(cond(client, grps, cats) for cond in conditions)
+
+    group_membership = []
+    negated_groups = []
+    for el in xdata.xpath("//Groups/Group//*") + \
+            xdata.xpath("//Groups/Client//*"):
+        if ((el.tag != 'Group' and el.tag != 'Client') or
+            el.getchildren()):
+            continue
+        conditions = []
+        for parent in el.iterancestors():
+            cond = get_condition(parent)
+            if cond:
+                conditions.append(cond)
+        group = groups[el.get("name")]
+        if el.get("negate", "false").lower() == "true":
+            negated_groups.append((aggregate_conditions(conditions), group))
+        else:
+            if group.category:
+                conditions.append(get_category_condition(group.category))
+            group_membership.append((aggregate_conditions(conditions),
+                                     group))
+
+    def merge_groups(client, grps, categories):
+        numgroups = -1
+        while numgroups != len(grps):
+            numgroups = len(grps)
+            for predicate, group in group_membership:
+                if group.name in grps:
+                    continue
+                if predicate(client, grps, categories):
+                    grps.add(group.name)
+                    if group.category:
+                        categories[group.category] = group.name
+            for predicate, group in negated_groups:
+                if group.name not in grps:
+                    continue
+                if predicate(client, grps, categories):
+                    grps.remove(group.name)
+                    if group.category:
+                        # this used to raise KeyError if the category
+                        # was not set
+                        categories.pop(group.category, None)
+        return (grps, categories)
+    return merge_groups
+
+
 def get_metadata_object(core=None, watch_clients=False, use_db=False):
     if core is None:
         core = Mock()
         core.setup = MagicMock()
         core.metadata_cache = MagicMock()
+        core.connectors = []
+        core.resolver = Resolver()
     core.setup.cfp.getboolean = Mock(return_value=use_db)
     return Metadata(core, datastore, watch_clients=watch_clients)
 
 
 class TestMetadataDB(DBModelTestCase):
     if HAS_DJANGO:
-        models = [MetadataClientModel]
+        models = [MetadataClientModel, MetadataGenerationModel]
 
 
 if HAS_DJANGO or can_skip:
@@ -195,6 +295,110 @@ if HAS_DJANGO or can_skip:
             self.assertIn(new, v)
             self.assertIsNone(v[new])
 
+        def test_write_behind(self):
+            v = self.get_obj()
+            v.write_behind = True
+            v["client1"] = "1.3.1"
+            v["client__write_behind"] = "1.3.1"
+            self.assertEqual(v["client1"], "1.3.1")
+            self.assertIn("client__write_behind", v)
+            self.assertEqual(
+                MetadataClientModel.objects.get(hostname="client1").version,
+                "1.2.0")
+            self.assertRaises(
+                MetadataClientModel.DoesNotExist,
+                MetadataClientModel.objects.get,
+                hostname="client__write_behind")
+
+            v.flush()
+            self.assertEqual(v.dirty, dict())
+            for client in ["client1", "client__write_behind"]:
+                self.assertEqual(
+                    MetadataClientModel.objects.get(hostname=client).version,
+                    "1.3.1")
+
+        def test_reload(self):
+            v1 = self.get_obj()
+            v2 = self.get_obj()
+            v1.check_interval = v2.check_interval = 0
+            v1["client2"] = "1.3.1"
+            self.assertEqual(v2["client2"], "1.3.1")
+
+            # changes are only noticed every check_interval seconds
+            v2.check_interval = 3600
+            v1["client3"] = "1.3.1"
+            self.assertEqual(v2["client3"], "1.3.0pre1")
+
+
+class TestMetadataJournal(Bcfg2TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        open(os.path.join(self.tmpdir, "clients.xml"), "w").write(
+            lxml.etree.tostring(
+                get_clients_test_tree().getroot()).decode('UTF-8'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def get_config(self):
+        config = Mock()
+        config.basedir = self.tmpdir
+        config.basefile = "clients.xml"
+        config.extras = []
+        config.basedata = get_clients_test_tree()
+        config.data = get_clients_test_tree()
+        return config
+
+    def test_record(self):
+        config = self.get_config()
+        journal = MetadataJournal(config)
+        journal.record("Update",
+                       lxml.etree.Element("Client", name="client1",
+                                          version="1.3.0"))
+        journal.record("Add", lxml.etree.Element("Client", name="new1",
+                                                 profile="group1"))
+        journal.record("Remove", lxml.etree.Element("Client", name="client2"))
+        for tree in [config.basedata, config.data]:
+            self.assertEqual(
+                tree.xpath("//Client[@name='client1']")[0].get("version"),
+                "1.3.0")
+            self.assertEqual(len(tree.xpath("//Client[@name='new1']")), 1)
+            self.assertEqual(tree.xpath("//Client[@name='client2']"), [])
+        self.assertFalse(config.write_xml.called)
+
+        # replay the journal, as after a crash
+        config = self.get_config()
+        open(journal.path, "a").write("<Update><Client name=\"cli")
+        journal = MetadataJournal(config)
+        journal.replay()
+        self.assertEqual(
+            config.data.xpath("//Client[@name='client1']")[0].get("version"),
+            "1.3.0")
+        self.assertEqual(len(config.data.xpath("//Client[@name='new1']")), 1)
+        self.assertEqual(config.data.xpath("//Client[@name='client2']"), [])
+
+    def test_flush(self):
+        config = self.get_config()
+        journal = MetadataJournal(config)
+        journal.flush()
+        self.assertFalse(config.write_xml.called)
+
+        for version in ["1.3.0", "1.3.1"]:
+            journal.record("Update",
+                           lxml.etree.Element("Client", name="client1",
+                                              version=version))
+        journal.record("Add", lxml.etree.Element("Client", name="new1"))
+        journal.flush()
+        # all changes are written at once
+        self.assertEqual(config.write_xml.call_count, 1)
+        fname, tree = config.write_xml.call_args[0]
+        self.assertEqual(fname, os.path.join(self.tmpdir, "clients.xml"))
+        self.assertEqual(
+            tree.xpath("//Client[@name='client1']")[0].get("version"),
+            "1.3.1")
+        self.assertEqual(len(tree.xpath("//Client[@name='new1']")), 1)
+        self.assertEqual(journal.read(), [])
+
 
 class TestXMLMetadataConfig(TestXMLFileBacked):
     test_obj = XMLMetadataConfig
@@ -290,7 +494,8 @@ class TestXMLMetadataConfig(TestXMLFileBacked):
                                       parser=Bcfg2.Server.XMLParser)
         self.assertFalse(mock_parse.return_value.xinclude.called)
         self.assertEqual(config.data, mock_parse.return_value)
-        self.assertIsNotNone(config.basedata)
+        # without XIncludes, the data is not copied
+        self.assertIs(config.basedata, config.data)
 
         reset()
         mock_parse.side_effect = lxml.etree.XMLSyntaxError(None, None, None,
@@ -315,6 +520,7 @@ class TestXMLMetadataConfig(TestXMLFileBacked):
         mock_parse.return_value.xinclude.assert_any_call()
         self.assertEqual(config.data, mock_parse.return_value)
         self.assertIsNotNone(config.basedata)
+        self.assertIsNot(config.basedata, config.data)
 
 
     @patch("Bcfg2.Server.Plugins.Metadata.XMLMetadataConfig.write_xml")
@@ -453,6 +659,18 @@ class TestXMLMetadataConfig(TestXMLFileBacked):
         self.assertTrue(config.HandleEvent(evt))
         mock_load_xml.assert_called_with()
 
+        # events caused by the server's own writes are ignored
+        mock_load_xml.reset_mock()
+        config.get_stamp = Mock(return_value=(1, 2, 3))
+        config.written[evt.filename] = (1, 2, 3)
+        self.assertFalse(config.HandleEvent(evt))
+        self.assertFalse(mock_load_xml.called)
+
+        # ...until the file is changed by someone else
+        config.get_stamp.return_value = (1, 2, 4)
+        self.assertTrue(config.HandleEvent(evt))
+        mock_load_xml.assert_called_with()
+
 
 class TestClientMetadata(Bcfg2TestCase):
     def test_inGroup(self):
@@ -461,6 +679,280 @@ class TestClientMetadata(Bcfg2TestCase):
         self.assertTrue(cm.inGroup("group1"))
         self.assertFalse(cm.inGroup("group3"))
 
+    def test_pickle(self):
+        query = Mock()
+        cm = ClientMetadata("client1", "group1", set(["group1", "group2"]),
+                            set(["bundle1"]), set(), set(["1.2.3.4"]),
+                            dict(category1="group1"), None, None, "1.3.0",
+                            query)
+        cm.Probes = dict(foo="bar")
+        cm2 = cPickle.loads(cPickle.dumps(cm, 2))
+        self.assertIsNone(cm2.query)
+        for attr in ["hostname", "profile", "groups", "bundles", "addresses",
+                     "categories", "version", "version_info", "Probes"]:
+            self.assertEqual(getattr(cm, attr), getattr(cm2, attr))
+        self.assertIs(cm.groups, cm2.groups)
+
+    def test_interning(self):
+        cm1 = ClientMetadata("client1", "group1", ["group1", "group2"],
+                             ["bundle1"], [], ["1.2.3.4"],
+                             dict(category1="group1"), None, None, None,
+                             None)
+        cm2 = ClientMetadata("client2", "group1", set(["group2", "group1"]),
+                             set(["bundle1"]), set(), set(["1.2.3.5"]),
+                             dict(category1="group1"), None, None, None,
+                             None)
+        self.assertIs(cm1.groups, cm2.groups)
+        self.assertIs(cm1.bundles, cm2.bundles)
+        self.assertIs(cm1.categories, cm2.categories)
+        self.assertIs(cm1.aliases, cm2.aliases)
+        self.assertItemsEqual(cm1.groups, ["group1", "group2"])
+
+        # shared sets cannot be modified in place
+        self.assertFalse(hasattr(cm1.groups, "add"))
+        self.assertRaises(TypeError, cm1.categories.__setitem__,
+                          "category2", "group2")
+
+        # changing a copy does not change the original
+        cm3 = cm1.copy()
+        cm1.Probes = dict(foo="bar")
+        cm3.groups = cm1.groups.union(["group3"])
+        cm3.Probes = dict(foo="baz")
+        self.assertItemsEqual(cm1.groups, ["group1", "group2"])
+        self.assertItemsEqual(cm3.groups, ["group1", "group2", "group3"])
+        self.assertEqual(cm1.Probes, dict(foo="bar"))
+        self.assertEqual(cm3.hostname, "client1")
+
+
+class TestSessionCache(Bcfg2TestCase):
+    def test_expire(self):
+        cache = SessionCache(ttl=90)
+        now = time.time()
+        cache[('1.2.3.4', 1)] = (now - 100, 'client1')
+        cache[('1.2.3.4', 2)] = (now, 'client1')
+        cache[('1.2.3.5', 1)] = (now - 100, 'client2')
+        # renewed sessions are not expired
+        cache[('1.2.3.5', 1)] = (now - 10, 'client2')
+        cache.expire(now)
+        self.assertItemsEqual(cache.keys(), [('1.2.3.4', 2), ('1.2.3.5', 1)])
+        self.assertEqual(len(cache.heap), 2)
+
+
+class TestClientIndex(Bcfg2TestCase):
+    def get_obj(self, clients=None, get_stamp=None, get_enabled=None):
+        if clients is None:
+            clients = dict(client1=("group1", ["group1", "group2"],
+                                    ["bundle1"]),
+                           client2=("group1", ["group1"], ["bundle1",
+                                                            "bundle2"]),
+                           client3=("group3", ["group3", "group2"], []))
+        self.clients = clients
+
+        def build_metadata(client):
+            profile, groups, bundles = self.clients[client]
+            return ClientMetadata(client, profile, set(groups), set(bundles),
+                                  [], [], dict(), None, None, None, None)
+
+        self.build_metadata = Mock(side_effect=build_metadata)
+        return ClientIndex(self.build_metadata,
+                           lambda: list(self.clients.keys()),
+                           get_stamp=get_stamp, get_enabled=get_enabled)
+
+    def test_query(self):
+        index = self.get_obj()
+        self.assertItemsEqual(index.get_clients_by_groups(["group2"]),
+                              ["client1", "client3"])
+        self.assertItemsEqual(index.get_clients_by_groups(["group1",
+                                                           "group2"]),
+                              ["client1"])
+        self.assertItemsEqual(index.get_clients_by_groups([]),
+                              ["client1", "client2", "client3"])
+        self.assertItemsEqual(index.get_clients_by_groups(["group4"]), [])
+        self.assertItemsEqual(index.get_clients_by_bundles(["bundle1"]),
+                              ["client1", "client2"])
+        self.assertItemsEqual(index.get_clients_by_profiles(["group1",
+                                                             "group3"]),
+                              ["client1", "client2", "client3"])
+        self.assertItemsEqual(index.get_clients_by_profiles([]), [])
+        # metadata is only built once for each client
+        self.assertEqual(self.build_metadata.call_count, 3)
+        self.assertIs(index.snapshot(), index.snapshot())
+
+    def test_expire(self):
+        index = self.get_obj()
+        index.snapshot()
+        self.clients['client1'] = ("group3", ["group3"], [])
+        self.assertItemsEqual(index.get_clients_by_profiles(["group3"]),
+                              ["client3"])
+        index.expire("client1")
+        self.assertItemsEqual(index.get_clients_by_profiles(["group3"]),
+                              ["client1", "client3"])
+        self.assertNotIn("client1", index.by_group.get("group1", []))
+        self.assertEqual(self.build_metadata.call_count, 4)
+
+        # removed and added clients are noticed without expiring them
+        del self.clients['client3']
+        self.clients['client4'] = ("group3", ["group3"], [])
+        index.expire("client2")
+        self.assertItemsEqual(index.get_clients_by_profiles(["group3"]),
+                              ["client1", "client4"])
+
+        index.expire()
+        self.assertEqual(index.metadata, dict())
+        self.assertEqual(index.by_group, dict())
+
+    def test_stamp(self):
+        stamp = [1]
+        index = self.get_obj(get_stamp=lambda: stamp[0])
+        index.snapshot()
+        index.snapshot()
+        self.assertEqual(self.build_metadata.call_count, 3)
+        stamp[0] = 2
+        index.snapshot()
+        self.assertEqual(self.build_metadata.call_count, 6)
+
+    def test_expire_while_building(self):
+        index = self.get_obj()
+        build_metadata = self.build_metadata.side_effect
+
+        def expire_and_build(client):
+            index.expire()
+            return build_metadata(client)
+
+        self.build_metadata.side_effect = expire_and_build
+        self.assertItemsEqual(index.get_clients_by_groups(["group2"]),
+                              ["client1", "client3"])
+        # metadata that may be stale is not indexed
+        self.assertEqual(index.metadata, dict())
+        self.assertIsNone(index._snapshot)
+
+    def test_expire_client_while_building(self):
+        index = self.get_obj()
+        build_metadata = self.build_metadata.side_effect
+        expired = []
+
+        def expire_and_build(client):
+            if not expired:
+                index.expire("client2")
+                expired.append("client2")
+            return build_metadata(client)
+
+        self.build_metadata.side_effect = expire_and_build
+        index.snapshot()
+        # only the client that was expired is left for the next query
+        self.assertItemsEqual(index.metadata.keys(), ["client1", "client3"])
+        self.assertIsNone(index._snapshot)
+        self.build_metadata.reset_mock()
+        self.assertIs(index.snapshot(), index._snapshot)
+        self.build_metadata.assert_called_once_with("client2")
+
+    def test_update(self):
+        index = self.get_obj()
+        snapshot = index.snapshot()
+
+        # unchanged groups, bundles, and profile keep the snapshot
+        index.update("client1", self.build_metadata("client1"))
+        self.assertIs(index.snapshot(), snapshot)
+
+        self.clients['client1'] = ("group3", ["group3"], [])
+        index.update("client1", self.build_metadata("client1"))
+        self.assertIsNone(index._snapshot)
+        self.assertItemsEqual(index.get_clients_by_profiles(["group3"]),
+                              ["client1", "client3"])
+        self.assertNotIn("client1", index.by_group.get("group1", []))
+        self.assertEqual(self.build_metadata.call_count, 5)
+
+        # clients that are not indexed are left alone
+        self.clients['client4'] = ("group3", ["group3"], [])
+        index.update("client4", self.build_metadata("client4"))
+        self.assertNotIn("client4", index.metadata)
+
+    def test_disabled(self):
+        index = self.get_obj(get_enabled=lambda: False)
+        self.assertItemsEqual(index.get_clients_by_groups(["group2"]),
+                              ["client1", "client3"])
+        self.assertItemsEqual(index.get_clients_by_profiles(["group1"]),
+                              ["client1", "client2"])
+        # nothing is indexed, so metadata is built for every query
+        self.assertEqual(self.build_metadata.call_count, 6)
+        index.update("client1", self.build_metadata("client1"))
+        self.assertEqual(index.metadata, dict())
+        self.assertIsNone(index._snapshot)
+
+
+class TestMetadataGroupRule(Bcfg2TestCase):
+    def test__call(self):
+        xdata = lxml.etree.XML("""
+<Groups>
+  <Group name="group1">
+    <Group name="group2" negate="true">
+      <Client name="client1">
+        <Group name="group3"/>
+      </Client>
+    </Group>
+  </Group>
+</Groups>""")
+        rule = MetadataGroupRule(MetadataGroup("group3"),
+                                 xdata.xpath("//Group[@name='group3']")[0])
+        self.assertItemsEqual(rule.groups, ["group1"])
+        self.assertItemsEqual(rule.negated_groups, ["group2"])
+        self.assertItemsEqual(rule.clients, ["client1"])
+        self.assertTrue(rule("client1", set(["group1"])))
+        self.assertFalse(rule("client1", set(["group1", "group2"])))
+        self.assertFalse(rule("client1", set()))
+        self.assertFalse(rule("client2", set(["group1"])))
+
+
+class TestMetadataGroupRules(Bcfg2TestCase):
+    def test_append(self):
+        xdata = lxml.etree.XML("""
+<Groups>
+  <Group name="group1">
+    <Group name="group2" negate="true">
+      <Group name="group3"/>
+    </Group>
+    <Group name="group1" negate="true"/>
+  </Group>
+  <Client name="client1">
+    <Group name="group4"/>
+  </Client>
+  <Client name="client1">
+    <Client name="client2">
+      <Group name="group4"/>
+    </Client>
+  </Client>
+  <Group name="group4"/>
+</Groups>""")
+        groups = dict(group1=MetadataGroup("group1"),
+                      group3=MetadataGroup("group3", category="cat1"),
+                      group4=MetadataGroup("group4"))
+        rules = MetadataGroupRules()
+        rule1 = rules.append(groups["group3"], xdata[0][0][0])
+        rule2 = rules.append(groups["group1"], xdata[0][1])
+        rule3 = rules.append(groups["group4"], xdata[1][0])
+        rule4 = rules.append(groups["group4"], xdata[2][0][0])
+        rule5 = rules.append(groups["group4"], xdata[3])
+        self.assertEqual(rules.add, [rule1, rule3, rule4, rule5])
+        self.assertEqual(rules.remove, [rule2])
+        self.assertEqual([r.position for r in rules.add], [0, 1, 2, 3])
+        self.assertEqual(rules.get(False, 1), rule3)
+        self.assertEqual(rules.get(True, 0), rule2)
+        self.assertTrue(rule2.negate)
+
+        # rule4 can never match, so it is never triggered
+        self.assertItemsEqual(rules.on_add.keys(), ["group1"])
+        self.assertItemsEqual(rules.on_add["group1"], [rule1, rule2])
+        self.assertItemsEqual(rules.on_remove.keys(),
+                              ["group2", "group3", "group4"])
+        self.assertItemsEqual(rules.on_remove["group2"], [rule1])
+        self.assertItemsEqual(rules.on_remove["group3"], [rule1])
+        self.assertItemsEqual(rules.on_remove["group4"], [rule3, rule5])
+        self.assertEqual(rules.on_category, dict(cat1=[rule1]))
+        self.assertEqual(rules.untriggered, [rule5])
+        self.assertEqual(rules.by_client, dict(client1=[rule3]))
+        self.assertItemsEqual(rules.get_group_names(),
+                              ["group1", "group3", "group4"])
+
 
 class TestMetadata(_TestMetadata, TestStatistics, TestDatabaseBacked):
     test_obj = Metadata
@@ -721,6 +1213,15 @@ class TestMetadata(_TestMetadata, TestStatistics, TestDatabaseBacked):
         self.assertEqual(grp.get("foo"), "bar")
         self.assertTrue(metadata.clients_xml.write_xml.called)
 
+        # identity indexes are updated without waiting for clients.xml
+        # to be re-read
+        metadata.update_client("client1", dict(uuid="uuid2",
+                                               address="1.2.3.9"))
+        self.assertEqual(metadata.uuid["uuid2"], "client1")
+        self.assertEqual(metadata.ruuid["client1"], "uuid2")
+        self.assertIn("client1", metadata.addresses["1.2.3.9"])
+        self.assertIn("1.2.3.9", metadata.raddresses["client1"])
+
         new = self.get_nonexistent_client(metadata)
         self.assertRaises(Bcfg2.Server.Plugin.MetadataConsistencyError,
                           metadata.update_client,
@@ -738,6 +1239,28 @@ class TestMetadata(_TestMetadata, TestStatistics, TestDatabaseBacked):
         metadata.HandleEvent(evt)
         return metadata
 
+    @patch("Bcfg2.Server.Plugins.Metadata.XMLMetadataConfig.load_xml", Mock())
+    def test_HandleEvent(self):
+        metadata = self.get_obj()
+        handler = Mock()
+        for handles in list(metadata.handlers.keys()):
+            metadata.handlers[handles] = handler
+        evt = Mock()
+        evt.code2str = Mock(return_value="changed")
+
+        # events that reload a data file are reported as handled
+        evt.filename = os.path.join(datastore, "Metadata", "groups.xml")
+        self.assertNotEqual(metadata.HandleEvent(evt), False)
+        handler.assert_called_with(evt)
+
+        # events on other files, like the clients.xml journal, are
+        # reported as ignored, so they don't invalidate cached configs
+        handler.reset_mock()
+        evt.filename = os.path.join(datastore, "Metadata",
+                                    "clients.xml.journal")
+        self.assertFalse(metadata.HandleEvent(evt))
+        self.assertFalse(handler.called)
+
     def test_handle_clients_xml_event(self):
         metadata = self.get_obj()
         metadata.profiles = ["group1", "group2"]
@@ -760,10 +1283,13 @@ class TestMetadata(_TestMetadata, TestStatistics, TestDatabaseBacked):
             raliases[alias.getparent().get("name")].add(alias.get("name"))
         self.assertItemsEqual(metadata.raliases, raliases)
 
+        secure = get_clients_test_tree().findall("//Client[@secure='true']")
         self.assertEqual(metadata.secure,
-                         [c.get("name")
-                          for c in get_clients_test_tree().findall("//Client[@secure='true']")])
-        self.assertEqual(metadata.floating, ["client1", "client10"])
+                         set([c.get("name") for c in secure]))
+        self.assertEqual(metadata.floating, set(["client1", "client10"]))
+
+        self.assertEqual(metadata.uuid, dict(uuid1="client3"))
+        self.assertEqual(metadata.ruuid, dict(client3="uuid1"))
 
         addresses = dict([(c.get("address"), [])
                            for c in get_clients_test_tree().findall("//*[@address]")])
@@ -785,6 +1311,28 @@ class TestMetadata(_TestMetadata, TestStatistics, TestDatabaseBacked):
         self.assertItemsEqual(metadata.raddresses, raddresses)
         self.assertTrue(metadata.states['clients.xml'])
 
+    @patch("Bcfg2.Server.Plugins.Metadata.XMLMetadataConfig.load_xml", Mock())
+    def test_handle_clients_xml_event_cache(self):
+        metadata = self.load_clients_data(metadata=self.load_groups_data())
+        metadata.core.metadata_cache = Cache()
+        metadata.core.metadata_cache["client1"] = Mock()
+        metadata.core.metadata_cache["client2"] = Mock()
+        metadata.core.metadata_cache["alias1"] = Mock()
+
+        # unchanged clients.xml doesn't expire anything
+        self.load_clients_data(metadata=metadata)
+        self.assertItemsEqual(metadata.core.metadata_cache.keys(),
+                              ["client1", "client2", "alias1"])
+
+        # changing client1 and client3 expires client1 and the
+        # alias of client3, but not client2
+        xdata = copy.deepcopy(get_clients_test_tree())
+        xdata.find("//Client[@name='client1']").set("profile", "group2")
+        xdata.find("//Client[@name='client3']").set("secure", "true")
+        self.load_clients_data(metadata=metadata, xdata=xdata)
+        self.assertItemsEqual(metadata.core.metadata_cache.keys(),
+                              ["client2"])
+
     def load_groups_data(self, metadata=None, xdata=None):
         if metadata is None:
             metadata = self.get_obj()
@@ -828,13 +1376,48 @@ class TestMetadata(_TestMetadata, TestStatistics, TestDatabaseBacked):
                     negated_groups.append(group.get("name"))
                 else:
                     all_groups.append(group.get("name"))
-        self.assertItemsEqual([g.name
-                               for g in metadata.group_membership.values()],
+        self.assertItemsEqual([r.group.name
+                               for r in metadata.group_rules.add],
                               all_groups)
-        self.assertItemsEqual([g.name
-                               for g in metadata.negated_groups.values()],
+        self.assertItemsEqual([r.group.name
+                               for r in metadata.group_rules.remove],
                               negated_groups)
 
+    @patch("Bcfg2.Server.Plugins.Metadata.XMLMetadataConfig.load_xml", Mock())
+    def test_handle_groups_xml_event_cache(self):
+        metadata = self.load_groups_data()
+        metadata.core.metadata_cache = Cache()
+        for client, groups in [("client1", ["group1"]),
+                               ("client2", ["group2", "group1"]),
+                               ("client3", ["group1", "group7"])]:
+            imd = Mock()
+            imd.groups = frozenset(groups)
+            metadata.core.metadata_cache[client] = imd
+
+        # unchanged groups.xml doesn't expire anything
+        xdata = metadata.groups_xml.data
+        self.load_groups_data(metadata=metadata, xdata=copy.deepcopy(xdata))
+        self.assertItemsEqual(metadata.core.metadata_cache.keys(),
+                              ["client1", "client2", "client3"])
+
+        # changing only the declaration of a group expires only the
+        # members of that group
+        xdata = copy.deepcopy(xdata)
+        lxml.etree.SubElement(xdata.find("//Group[@name='group7']"),
+                              "Bundle", name="bundle4")
+        self.load_groups_data(metadata=metadata, xdata=xdata)
+        self.assertItemsEqual(metadata.groups['group7'].bundles,
+                              ["bundle3", "bundle4"])
+        self.assertItemsEqual(metadata.core.metadata_cache.keys(),
+                              ["client1", "client2"])
+
+        # changing a group membership rule expires everything
+        xdata = copy.deepcopy(xdata)
+        lxml.etree.SubElement(xdata.find("//Group[@name='group7']"),
+                              "Group", name="group5")
+        self.load_groups_data(metadata=metadata, xdata=xdata)
+        self.assertItemsEqual(metadata.core.metadata_cache.keys(), [])
+
     @patch("Bcfg2.Server.Plugins.Metadata.XMLMetadataConfig.load_xml", Mock())
     def test_set_profile(self):
         metadata = self.get_obj()
@@ -1027,6 +1610,78 @@ class TestMetadata(_TestMetadata, TestStatistics, TestDatabaseBacked):
                          (set(["group1", "group8", "group9", "group10"]),
                           dict(group1="category1")))
 
+        # groups that were added because of a group that is later
+        # negated are kept, and groups are re-evaluated until the
+        # client's groups stop changing
+        xdata = lxml.etree.XML("""
+<Groups>
+  <Group name="base"/>
+  <Group name="group1" category="category1"/>
+  <Group name="group2" category="category1"/>
+  <Group name="group3"/>
+  <Group name="group4"/>
+  <Group name="group5"/>
+  <Group name="group6"/>
+  <Group name="group4">
+    <Group name="group5"/>
+  </Group>
+  <Group name="base">
+    <Group name="group1"/>
+  </Group>
+  <Group name="group1">
+    <Group name="group3"/>
+  </Group>
+  <Group name="group3">
+    <Group name="group4"/>
+  </Group>
+  <Group name="group6">
+    <Group name="group1" negate="true"/>
+  </Group>
+  <Group name="group1" negate="true">
+    <Group name="group2"/>
+  </Group>
+</Groups>""").getroottree()
+        self.load_groups_data(metadata=metadata, xdata=xdata)
+        legacy = get_legacy_merge_groups(metadata.groups, xdata)
+        self.assertEqual(metadata._merge_groups("client1", set(["base"])),
+                         (set(["base", "group1", "group3", "group4",
+                               "group5"]),
+                          dict(category1="group1")))
+        self.assertEqual(metadata._merge_groups("client1",
+                                                set(["base", "group6"])),
+                         (set(["base", "group3", "group4", "group5",
+                               "group6"]),
+                          dict()))
+        for initial in [["base"], ["base", "group6"], ["group6"],
+                        ["group1", "group6"], ["group3"]]:
+            self.assertEqual(
+                metadata._merge_groups("client1", set(initial)),
+                legacy("client1", set(initial), dict()))
+
+    @patch("Bcfg2.Server.Plugins.Metadata.XMLMetadataConfig.load_xml", Mock())
+    def test_merge_groups_legacy(self):
+        # group membership is the same as with the fixpoint loop over
+        # every rule that Metadata used to use, on random groups.xml
+        # files with chains of negated groups and categories
+        metadata = self.get_obj()
+        rand = random.Random(0)
+        for _ in range(20):
+            xdata = get_random_groups_tree(rand, 15)
+            self.load_groups_data(metadata=metadata, xdata=xdata)
+            legacy = get_legacy_merge_groups(metadata.groups, xdata)
+            for i in range(10):
+                client = "client%d" % rand.randint(0, 2)
+                initial = rand.sample(sorted(metadata.groups.keys()), 2)
+                categories = dict()
+                for gname in initial:
+                    category = metadata.groups[gname].category
+                    if category:
+                        categories.setdefault(category, gname)
+                self.assertEqual(
+                    metadata._merge_groups(client, set(initial),
+                                           dict(categories)),
+                    legacy(client, set(initial), dict(categories)))
+
     @patch("Bcfg2.Server.Plugins.Metadata.XMLMetadataConfig.load_xml", Mock())
     def test_get_all_group_names(self):
         metadata = self.load_groups_data()
@@ -1076,10 +1731,14 @@ class TestMetadata(_TestMetadata, TestStatistics, TestDatabaseBacked):
         metadata.merge_additional_groups(imd, ["group4"])
         self.assertEqual(imd.groups, oldgroups)
 
-        # test adding a private group
+        # test adding a private group.  public="false" only keeps
+        # clients from asserting a group as their profile; connectors
+        # can still add it
         oldgroups = imd.groups
         metadata.merge_additional_groups(imd, ["group3"])
-        self.assertEqual(imd.groups, oldgroups)
+        self.assertEqual(imd.groups, oldgroups.union(["group3"]))
+        self.assertItemsEqual(oldgroups,
+                              metadata.get_initial_metadata("client2").groups)
 
         # test adding groups with bundles
         oldgroups = imd.groups
@@ -1503,6 +2162,9 @@ class TestMetadata_NoClientsXML(TestMetadataBase):
     def test_handle_clients_xml_event(self):
         pass
 
+    def test_handle_clients_xml_event_cache(self):
+        pass
+
 
 class TestMetadata_ClientsXML(TestMetadataBase):
     """ test Metadata with a clients.xml.  """
@@ -116,13 +116,14 @@ class TestProbeSet(TestEntrySet):
         # test that events on the data store itself are skipped
         evt = Mock()
         evt.filename = datastore
-        ps.HandleEvent(evt)
+        self.assertFalse(ps.HandleEvent(evt))
         self.assertFalse(ps.handle_event.called)
 
-        # test that events on probed.xml are skipped
+        # test that events on probed.xml are skipped, and reported
+        # as ignored so that they don't invalidate cached configs
         evt.reset_mock()
         evt.filename = "probed.xml"
-        ps.HandleEvent(evt)
+        self.assertFalse(ps.HandleEvent(evt))
         self.assertFalse(ps.handle_event.called)
 
         # test that other events are processed appropriately
@@ -438,6 +439,40 @@ text
         self.assertItemsEqual(probes.probedata, self.get_test_probedata())
         self.assertItemsEqual(probes.cgroups, self.get_test_cgroups())
 
+    @patch("%s.open" % builtins)
+    @patch("lxml.etree.parse")
+    def test__load_client_data_xml(self, mock_parse, mock_open):
+        probes = self.get_probes_object(use_db=False)
+        probes.probedata = self.get_test_probedata()
+        probes.cgroups = self.get_test_cgroups()
+        probes._write_data_xml(None)
+        xdata = \
+            lxml.etree.XML(str(mock_open.return_value.write.call_args[0][0]))
+        mock_parse.return_value = xdata.getroottree()
+        cname = "foo.example.com"
+
+        # data in probed.xml replaces older data for the client
+        probes.probedata[cname] = ClientProbeDataSet(timestamp=0)
+        probes.cgroups[cname] = []
+        probes.load_client_data(cname)
+        self.assertItemsEqual(probes.probedata[cname],
+                              self.get_test_probedata()[cname])
+        self.assertItemsEqual(probes.cgroups[cname],
+                              self.get_test_cgroups()[cname])
+
+        # ...but not data that is newer than the file
+        probes.probedata[cname] = \
+            ClientProbeDataSet(timestamp=time.time() + 60)
+        probes.cgroups[cname] = ["new"]
+        probes.load_client_data(cname)
+        self.assertEqual(probes.probedata[cname], dict())
+        self.assertEqual(probes.cgroups[cname], ["new"])
+
+        # other clients are not touched
+        del probes.probedata["bar.example.com"]
+        probes.load_client_data(cname)
+        self.assertNotIn("bar.example.com", probes.probedata)
+
     @skipUnless(HAS_DJANGO, "Django not found, skipping")
     def test__load_data_db(self):
         syncdb(TestProbesDB)
@@ -464,6 +499,29 @@ text
             else:
                 self.assertEqual(groups, [])
 
+    @skipUnless(HAS_DJANGO, "Django not found, skipping")
+    def test__load_data_db_client(self):
+        syncdb(TestProbesDB)
+        probes = self.get_probes_object(use_db=True)
+        probes.probedata = self.get_test_probedata()
+        probes.cgroups = self.get_test_cgroups()
+        for cname in probes.probedata.keys():
+            client = Mock()
+            client.hostname = cname
+            probes._write_data_db(client)
+
+        cname = "foo.example.com"
+        probes.probedata = dict()
+        probes.cgroups = {cname: ["old"]}
+        probes.load_client_data(cname)
+        self.assertItemsEqual(probes.probedata,
+                              dict([(cname,
+                                     self.get_test_probedata()[cname])]))
+        self.assertItemsEqual(probes.probedata[cname],
+                              self.get_test_probedata()[cname])
+        self.assertItemsEqual(probes.cgroups[cname],
+                              self.get_test_cgroups()[cname])
+
     @patch("Bcfg2.Server.Plugins.Probes.ProbeSet.get_probe_data")
     def test_GetProbes(self, mock_get_probe_data):
         probes = self.get_probes_object()
@@ -114,6 +114,22 @@ class TestRules(TestPrioDir):
         mock_matches.assert_called_with(r, entry, metadata, rules)
         self.assertIn("/etc/.*\.conf", r._regex_cache.keys())
 
+    def test__strict_matching(self):
+        r = self.get_obj()
+        path = lxml.etree.Element("Path", name="/etc/foo.conf")
+        svc = lxml.etree.Element("Service", name="foo")
+        self.set_regex_enabled(r, True)
+        self.assertFalse(r._strict_matching(path))
+        self.assertFalse(r._strict_matching(svc))
+
+        self.set_regex_enabled(r, False)
+        self.assertFalse(r._strict_matching(path))
+        if r._regex_enabled:
+            # regex matching cannot be disabled in this implementation
+            self.assertFalse(r._strict_matching(svc))
+        else:
+            self.assertTrue(r._strict_matching(svc))
+
     def set_regex_enabled(self, rules_obj, state):
         """ set the state of regex_enabled for this implementation of
         Rules """
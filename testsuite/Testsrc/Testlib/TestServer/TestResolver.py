@@ -0,0 +1,110 @@
+import os
+import sys
+import time
+import socket
+import threading
+from mock import Mock, patch
+from Bcfg2.Server.Resolver import *
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != '/':
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import *
+
+
+class TestResolver(Bcfg2TestCase):
+    @patch("socket.gethostbyaddr")
+    def test_gethostbyaddr(self, mock_gethostbyaddr):
+        resolver = Resolver(refresh=False)
+        mock_gethostbyaddr.return_value = ("foo", [], ["1.2.3.4"])
+        self.assertEqual(resolver.gethostbyaddr("1.2.3.4"),
+                         ("foo", [], ["1.2.3.4"]))
+        self.assertEqual(resolver.gethostbyaddr("1.2.3.4"),
+                         ("foo", [], ["1.2.3.4"]))
+        mock_gethostbyaddr.assert_called_once_with("1.2.3.4")
+
+        # failed lookups are cached, too
+        mock_gethostbyaddr.side_effect = socket.herror
+        self.assertRaises(socket.herror, resolver.gethostbyaddr, "1.2.3.5")
+        self.assertRaises(socket.herror, resolver.gethostbyaddr, "1.2.3.5")
+        self.assertEqual(mock_gethostbyaddr.call_count, 2)
+
+        stats = resolver.get_stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['negative_hits'], 1)
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['size'], 2)
+
+        resolver.expire("1.2.3.4")
+        mock_gethostbyaddr.side_effect = None
+        resolver.gethostbyaddr("1.2.3.4")
+        self.assertEqual(mock_gethostbyaddr.call_count, 3)
+
+    @patch("socket.gethostbyname")
+    def test_expiry(self, mock_gethostbyname):
+        resolver = Resolver(ttl=10, refresh=False)
+        mock_gethostbyname.return_value = "1.2.3.4"
+        now = time.time()
+        resolver.gethostbyname("foo")
+
+        # an expired entry is looked up again
+        mock_time = Mock(return_value=now + 11)
+        patcher = patch("time.time", mock_time)
+        patcher.start()
+        try:
+            resolver.gethostbyname("foo")
+        finally:
+            patcher.stop()
+        self.assertEqual(mock_gethostbyname.call_count, 2)
+
+        # the cache is bounded
+        resolver.size = 2
+        resolver.gethostbyname("bar")
+        resolver.gethostbyname("baz")
+        self.assertEqual(len(resolver.entries), 2)
+        self.assertEqual(resolver.get_stats()['evictions'], 1)
+
+    @patch("socket.gethostbyname")
+    def test_refresh(self, mock_gethostbyname):
+        resolver = Resolver(ttl=10)
+        mock_gethostbyname.return_value = "1.2.3.4"
+        resolver.gethostbyname("foo")
+
+        # an expired entry is returned while it is refreshed
+        mock_gethostbyname.return_value = "1.2.3.5"
+        key = ("gethostbyname", "foo")
+        entry = resolver.entries[key]
+        resolver.entries[key] = (entry[0] - 11, entry[1], entry[2])
+        self.assertEqual(resolver.gethostbyname("foo"), "1.2.3.4")
+        for thread in threading.enumerate():
+            if thread.getName().startswith("Resolver:"):
+                thread.join()
+        self.assertEqual(resolver.gethostbyname("foo"), "1.2.3.5")
+        self.assertEqual(resolver.get_stats()['refreshes'], 1)
+
+    @patch("socket.gethostbyaddr")
+    def test_timeout(self, mock_gethostbyaddr):
+        resolver = Resolver(timeout=0.01)
+        finish = threading.Event()
+
+        def slow_lookup(address):
+            finish.wait()
+            return ("foo", [], [address])
+
+        mock_gethostbyaddr.side_effect = slow_lookup
+        self.assertRaises(socket.herror, resolver.gethostbyaddr, "1.2.3.4")
+        self.assertEqual(resolver.get_stats()['timeouts'], 1)
+        finish.set()
+        for thread in threading.enumerate():
+            if thread.getName().startswith("Resolver:"):
+                thread.join()
+        # the slow lookup was cached once it finished
+        self.assertEqual(resolver.gethostbyaddr("1.2.3.4"),
+                         ("foo", [], ["1.2.3.4"]))
+        self.assertEqual(mock_gethostbyaddr.call_count, 1)
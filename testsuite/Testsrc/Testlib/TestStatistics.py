@@ -0,0 +1,148 @@
+import os
+import sys
+import threading
+from Bcfg2.Statistics import *
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != '/':
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import *
+
+
+class TestStatistic(Bcfg2TestCase):
+    def test_add_value(self):
+        stat = Statistic("foo", 1)
+        self.assertEqual(stat.get_value(), ("foo", (1.0, 1.0, 1.0, 1)))
+        stat.add_value(3)
+        stat.add_value(2)
+        self.assertEqual(stat.get_value(), ("foo", (1.0, 3.0, 2.0, 3)))
+
+    def test_percentile(self):
+        stat = Statistic("foo")
+        for i in range(1, 1001):
+            stat.add_value(i / 1000.0)
+        for pct in [50, 90, 99]:
+            self.assertAlmostEqual(stat.percentile(pct), pct / 100.0,
+                                   delta=pct / 100.0 * (BUCKET_RATIO - 1))
+        self.assertEqual(stat.percentile(100), 1.0)
+
+        stat.add_value(0)
+        self.assertEqual(stat.percentile(0), 0.0)
+
+    def test_get_window(self):
+        stat = Statistic("foo")
+        stat.add_value(1, now=1000)
+        stat.add_value(5, now=1200)
+        stat.add_value(3, now=1290)
+        window = stat.get_window(60, now=1300)
+        self.assertEqual(window['count'], 1)
+        self.assertEqual(window['mean'], 3.0)
+        window = stat.get_window(300, now=1300)
+        self.assertEqual(window['count'], 2)
+        self.assertEqual(window['mean'], 4.0)
+        self.assertEqual(stat.count, 3)
+
+        # slots that have fallen out of every window are dropped
+        stat.add_value(1, now=1000 + max(WINDOWS) + SLOT_LENGTH)
+        self.assertEqual(stat.get_window(max(WINDOWS), now=2000)['count'],
+                         3)
+
+    def test_merge(self):
+        stat1 = Statistic("foo", 1)
+        stat2 = Statistic("foo", 5)
+        stat2.add_value(3)
+        stat1.merge(stat2)
+        self.assertEqual(stat1.get_value(), ("foo", (1.0, 5.0, 3.0, 3)))
+        self.assertEqual(sum(stat1.histogram.values()), 3)
+        self.assertEqual(stat1.get_window(60)['count'], 3)
+
+
+class TestStatistics(Bcfg2TestCase):
+    def test_add_value(self):
+        stats = Statistics()
+
+        def add():
+            for i in range(100):
+                stats.add_value("foo", 1)
+
+        threads = [threading.Thread(target=add) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        add()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(stats.display(), dict(foo=(1.0, 1.0, 1.0, 600)))
+        # values from threads that have exited are kept
+        stats.add_value("bar", 2)
+        self.assertEqual(stats.display(), dict(foo=(1.0, 1.0, 1.0, 600),
+                                               bar=(2.0, 2.0, 2.0, 1)))
+        self.assertEqual(len(stats._accumulators), 1)
+
+    def test_retire(self):
+        stats = Statistics()
+
+        def add():
+            stats.add_value("foo", 1)
+
+        # accumulators of exited threads are retired as new threads
+        # add values, even if nothing reads the statistics
+        for i in range(200):
+            thread = threading.Thread(target=add)
+            thread.start()
+            thread.join()
+            self.assertTrue(len(stats._accumulators) <= 2)
+        self.assertEqual(stats.display(), dict(foo=(1.0, 1.0, 1.0, 200)))
+
+    def test_retire_expire(self):
+        stats = Statistics()
+        old = Statistic("foo")
+        old.add_value(1, now=1000)
+        old.add_value(3, now=1000 + SLOT_LENGTH)
+        stats._retired["foo"] = old
+
+        # time slots of retired statistics expire, but their totals
+        # are kept
+        stats._retire(now=1000 + max(WINDOWS) - 1)
+        self.assertEqual(len(stats._retired["foo"].slots), 2)
+        stats._retire(now=1000 + max(WINDOWS) + SLOT_LENGTH)
+        self.assertEqual(stats._retired["foo"].slots, dict())
+        self.assertEqual(stats.display(), dict(foo=(1.0, 3.0, 2.0, 2)))
+
+    def test_display_detail(self):
+        stats = Statistics()
+        stats.add_value("foo", 1)
+        detail = stats.display_detail()["foo"]
+        self.assertEqual(detail['count'], 1)
+        self.assertEqual(detail['p99'], 1.0)
+        self.assertItemsEqual(detail['windows'].keys(),
+                              [str(w) for w in WINDOWS])
+
+    def test_prometheus(self):
+        stats = Statistics()
+        stats.add_value('Foo:"bar"', 2)
+        text = stats.prometheus()
+        self.assertIn('bcfg2_server_statistic_count{name="Foo:\\"bar\\""} 1',
+                      text)
+        self.assertIn('bcfg2_server_statistic{name="Foo:\\"bar\\"",'
+                      'quantile="0.5"} 2.0', text)
+
+    def test_counters(self):
+        stats = Statistics()
+        self.assertEqual(stats.get_counters(), dict())
+        self.assertNotIn("bcfg2_server_counter", stats.prometheus())
+
+        stats.add_counters(lambda: dict(foo=1))
+        stats.add_counters(lambda: {'bar:"baz"': 2})
+        self.assertEqual(stats.get_counters(), {'foo': 1, 'bar:"baz"': 2})
+        # counters aren't statistics
+        self.assertEqual(stats.display(), dict())
+        text = stats.prometheus()
+        self.assertIn('# TYPE bcfg2_server_counter counter', text)
+        self.assertIn('bcfg2_server_counter{name="foo"} 1', text)
+        self.assertIn('bcfg2_server_counter{name="bar:\\"baz\\""} 2', text)
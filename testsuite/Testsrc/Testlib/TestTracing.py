@@ -0,0 +1,71 @@
+import os
+import sys
+import threading
+import Bcfg2.Tracing
+from Bcfg2.Tracing import *
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != '/':
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import *
+
+
+class TestTracing(Bcfg2TestCase):
+    def tearDown(self):
+        stop()
+
+    def test_no_trace(self):
+        self.assertIsNone(current())
+        self.assertIsNone(begin("foo"))
+        end(None)
+        func = lambda: None
+        self.assertIs(wrap(func), func)
+
+    def test_spans(self):
+        trace = start("test")
+        self.assertIs(current(), trace)
+        outer = begin("outer", "call", dict(client="foo"))
+        inner = begin("inner", "bind")
+        end(inner)
+        end(outer)
+        self.assertIs(stop(), trace)
+        self.assertIsNone(current())
+
+        self.assertEqual([e['name'] for e in trace.events],
+                         ["inner", "outer"])
+        inner, outer = trace.events
+        self.assertEqual(outer['ph'], "X")
+        self.assertEqual(outer['args'], dict(client="foo"))
+        self.assertNotIn('args', inner)
+        self.assertTrue(outer['ts'] <= inner['ts'])
+        self.assertTrue(outer['ts'] + outer['dur'] >=
+                        inner['ts'] + inner['dur'])
+
+    def test_wrap(self):
+        trace = start("test")
+
+        def record():
+            end(begin("threaded"))
+
+        thread = threading.Thread(target=wrap(record))
+        thread.start()
+        thread.join()
+        # without wrap(), the thread has no current trace
+        thread = threading.Thread(target=record)
+        thread.start()
+        thread.join()
+        stop()
+
+        self.assertEqual([e['name'] for e in trace.events], ["threaded"])
+        self.assertNotEqual(trace.events[0]['tid'],
+                            id(threading.currentThread()))
+        data = trace.get_data()
+        self.assertEqual(data['otherData']['name'], "test")
+        self.assertEqual(len([e for e in data['traceEvents']
+                              if e['ph'] == "M"]), 1)
@@ -0,0 +1,248 @@
+#!/usr/bin/python -Ott
+""" Benchmark group membership evaluation in the Metadata plugin,
+comparing its fixpoint loop over indexed rules against the old
+fixpoint loop, which evaluated every predicate on each pass """
+
+import sys
+import time
+import random
+import logging
+import lxml.etree
+import Bcfg2.Logger
+import Bcfg2.Options
+import Bcfg2.Server.Core
+
+
+def get_legacy_predicates(groups, xdata):
+    """ Build the predicates that the Metadata plugin used to build
+    from groups.xml.  Returns a tuple of (<list of (predicate, group)
+    tuples>, <list of (negated predicate, group) tuples>), in document
+    order.  (The Metadata plugin kept them in dicts, so it evaluated
+    them in an arbitrary order.) """
+
+    def get_condition(element):
+        """ Return a predicate for a Group or Client element """
+        negate = element.get('negate', 'false').lower() == 'true'
+        pname = element.get("name")
+        if element.tag == 'Group':
+            return lambda c, g, _: negate != (pname in g)
+        elif element.tag == 'Client':
+            return lambda c, g, _: negate != (pname == c)
+
+    def get_category_condition(category):
+        """ Return a predicate that is False if the client is already
+        a member of a group in the given category """
+        return lambda c, g, categories: category not in categories
+
+    def aggregate_conditions(conditions):
+        """ Aggregate conditions into a single predicate """
+        return lambda client, grps, cats: \
+            all(cond(client, grps, cats) for cond in conditions)
+
+    group_membership = []
+    negated_groups = []
+    for el in xdata.xpath("//Groups/Group//*") + \
+            xdata.xpath("//Groups/Client//*"):
+        if ((el.tag != 'Group' and el.tag != 'Client') or
+            el.getchildren()):
+            continue
+        conditions = []
+        for parent in el.iterancestors():
+            cond = get_condition(parent)
+            if cond:
+                conditions.append(cond)
+        gname = el.get("name")
+        if el.get("negate", "false").lower() == "true":
+            negated_groups.append((aggregate_conditions(conditions),
+                                   groups[gname]))
+        else:
+            if groups[gname].category:
+                conditions.append(
+                    get_category_condition(groups[gname].category))
+            group_membership.append((aggregate_conditions(conditions),
+                                     groups[gname]))
+    return (group_membership, negated_groups)
+
+
+def legacy_merge_groups(group_membership, negated_groups, client, groups,
+                        categories):
+    """ The fixpoint loop that the Metadata plugin used to evaluate
+    group membership with, which evaluates every predicate on each
+    pass """
+    numgroups = -1
+    while numgroups != len(groups):
+        numgroups = len(groups)
+        for predicate, group in group_membership:
+            if group.name in groups:
+                continue
+            if predicate(client, groups, categories):
+                groups.add(group.name)
+                if group.category:
+                    categories[group.category] = group.name
+        for predicate, group in negated_groups:
+            if group.name not in groups:
+                continue
+            if predicate(client, groups, categories):
+                groups.remove(group.name)
+                if group.category:
+                    categories.pop(group.category, None)
+    return (groups, categories)
+
+
+def generate_groups(count, seed):
+    """ Generate a groups.xml with the given number of conditional
+    groups.  Each conditional group is nested under another group,
+    and some also under a negated group or a Client tag.  The nested
+    declarations are shuffled, so that groups are often declared
+    before the groups their conditions refer to. """
+    rand = random.Random(seed)
+    root = lxml.etree.Element("Groups")
+    base = max(count // 10, 1)
+    for i in range(base):
+        lxml.etree.SubElement(root, "Group", name="base%d" % i,
+                              profile="true")
+    decls = []
+    for i in range(count):
+        name = "group%d" % i
+        if rand.random() < 0.05:
+            category = "category%d" % rand.randint(0, 9)
+        else:
+            category = None
+        decl = lxml.etree.Element("Group", name=name)
+        if category:
+            decl.set("category", category)
+        decls.append(decl)
+
+        if i and rand.random() < 0.7:
+            parent = "group%d" % rand.randint(0, i - 1)
+        else:
+            parent = "base%d" % rand.randint(0, base - 1)
+        cond = lxml.etree.Element("Group", name=parent)
+        inner = cond
+        if rand.random() < 0.2:
+            inner = lxml.etree.SubElement(
+                inner, "Group", name="base%d" % rand.randint(0, base - 1),
+                negate="true")
+        if rand.random() < 0.05:
+            inner = lxml.etree.SubElement(
+                inner, "Client", name="client%d" % rand.randint(0, 99))
+        lxml.etree.SubElement(inner, "Group", name=name)
+        if rand.random() < 0.02:
+            lxml.etree.SubElement(inner, "Group",
+                                  name="group%d" % rand.randint(0, count - 1),
+                                  negate="true")
+        decls.append(cond)
+    rand.shuffle(decls)
+    root.extend(decls)
+    return root.getroottree()
+
+
+def main():
+    optinfo = \
+        dict(groups=Bcfg2.Options.Option("Benchmark a generated groups.xml "
+                                         "with this many conditional groups "
+                                         "instead of the repository's",
+                                         cmd="--groups",
+                                         odesc="<count>",
+                                         long_arg=True,
+                                         default=None,
+                                         cook=int),
+             clients=Bcfg2.Options.Option("Number of clients to benchmark "
+                                          "with a generated groups.xml",
+                                          cmd="--clients",
+                                          odesc="<count>",
+                                          long_arg=True,
+                                          default=100,
+                                          cook=int),
+             runs=Bcfg2.Options.Option("Number of times to evaluate group "
+                                       "membership for each client",
+                                       cmd="--runs",
+                                       odesc="<count>",
+                                       long_arg=True,
+                                       default=5,
+                                       cook=int),
+             )
+    optinfo.update(Bcfg2.Options.CLI_COMMON_OPTIONS)
+    optinfo.update(Bcfg2.Options.SERVER_COMMON_OPTIONS)
+    setup = Bcfg2.Options.OptionParser(optinfo)
+    setup.parse(sys.argv[1:])
+
+    if setup['debug']:
+        level = logging.DEBUG
+    elif setup['verbose']:
+        level = logging.INFO
+    else:
+        level = logging.WARNING
+    Bcfg2.Logger.setup_logging("bcfg2-benchmark-groups",
+                               to_console=setup['verbose'] or setup['debug'],
+                               to_syslog=False,
+                               to_file=setup['logging'],
+                               level=level)
+    logger = logging.getLogger(sys.argv[0])
+
+    core = Bcfg2.Server.Core.BaseCore(setup)
+    logger.info("Bcfg2 server core loaded")
+    core.fam.handle_events_in_interval(0.1)
+    logger.debug("Repository events processed")
+    metadata = core.metadata
+
+    if setup['groups']:
+        xdata = generate_groups(setup['groups'], 0)
+        metadata.groups_xml.xdata = xdata
+        start = time.time()
+        metadata._handle_groups_xml_event(None)
+        print("Compiled %d group rules in %.03f seconds" %
+              (len(metadata.group_rules.add) +
+               len(metadata.group_rules.remove),
+               time.time() - start))
+        rand = random.Random(0)
+        base = [g for g in metadata.groups if g.startswith("base")]
+        clients = []
+        for i in range(setup['clients']):
+            clients.append(("client%d" % i,
+                            set(rand.sample(base, min(len(base), 2)))))
+    else:
+        xdata = metadata.groups_xml.xdata
+        clients = []
+        for client in metadata.clients:
+            imd = metadata.get_initial_metadata(client)
+            clients.append((client, set([imd.profile])))
+
+    legacy = get_legacy_predicates(metadata.groups, xdata)
+
+    # category suppression warnings would swamp the output
+    metadata.logger.setLevel(logging.ERROR)
+
+    legacy_time = 0.0
+    indexed_time = 0.0
+    mismatches = 0
+    for client, initial in clients:
+        for _ in range(setup['runs']):
+            start = time.time()
+            old = legacy_merge_groups(legacy[0], legacy[1], client,
+                                      set(initial), dict())
+            legacy_time += time.time() - start
+
+            start = time.time()
+            new = metadata._merge_groups(client, set(initial), dict())
+            indexed_time += time.time() - start
+        if old[0] != new[0]:
+            mismatches += 1
+            logger.info("%s: legacy: %s; indexed: %s" %
+                        (client, sorted(old[0] - new[0]),
+                         sorted(new[0] - old[0])))
+
+    evaluations = len(clients) * setup['runs']
+    print("%-12s%12s%16s" % ("Method", "Total", "Per client"))
+    for name, total in [("legacy", legacy_time),
+                        ("indexed", indexed_time)]:
+        print("%-12s%12.03f%16.06f" % (name, total, total / evaluations))
+    if indexed_time:
+        print("Speedup: %.1fx" % (legacy_time / indexed_time))
+    if mismatches:
+        print("Group membership differed for %d of %d clients.  Run with "
+              "-v for details." % (mismatches, len(clients)))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
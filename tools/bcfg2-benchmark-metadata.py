@@ -0,0 +1,126 @@
+#!/usr/bin/python -Ott
+""" Benchmark the memory used by client metadata objects for a large
+number of synthetic clients, comparing interned ClientMetadata
+objects against the old representation, in which every client had
+its own mutable sets """
+
+import sys
+import time
+import random
+import Bcfg2.Options
+from Bcfg2.Server.Plugins.Metadata import ClientMetadata, INTERNED
+
+
+class LegacyClientMetadata(object):
+    """ The layout that ClientMetadata objects used to have: a plain
+    object with a __dict__ and its own copy of every set """
+
+    # pylint: disable=R0913
+    def __init__(self, client, profile, groups, bundles, aliases, addresses,
+                 categories, uuid, password, version, query):
+        self.hostname = client
+        self.profile = profile
+        self.bundles = set(bundles)
+        self.aliases = set(aliases)
+        self.addresses = set(addresses)
+        self.groups = set(groups)
+        self.categories = dict(categories)
+        self.uuid = uuid
+        self.password = password
+        self.connectors = []
+        self.version = version
+        self.version_info = None
+        self.query = query
+    # pylint: enable=R0913
+
+
+def get_size(objects):
+    """ Get the total size, in bytes, of the given objects and
+    everything they refer to.  Objects that are shared are only
+    counted once. """
+    seen = set()
+    pending = list(objects)
+    total = 0
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            pending.extend(obj.keys())
+            pending.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            pending.extend(obj)
+        if hasattr(obj, "__dict__"):
+            pending.append(obj.__dict__)
+        for attr in getattr(obj.__class__, "__slots__", []):
+            if attr != "__dict__" and hasattr(obj, attr):
+                pending.append(getattr(obj, attr))
+    return total
+
+
+def generate_clients(cls, count, profiles, seed):
+    """ Generate metadata objects for the given number of synthetic
+    clients.  Each client is in one of the given number of profiles,
+    and each profile implies a fixed set of groups and bundles, as
+    is typical of real deployments. """
+    rand = random.Random(seed)
+    groups = ["group%d" % i for i in range(profiles * 4)]
+    bundles = ["bundle%d" % i for i in range(profiles * 2)]
+    combos = []
+    for i in range(profiles):
+        combos.append(("profile%d" % i,
+                       rand.sample(groups, 12) + ["profile%d" % i],
+                       rand.sample(bundles, 20),
+                       dict(os="os%d" % (i % 4))))
+    rv = []
+    for i in range(count):
+        profile, cgroups, cbundles, categories = rand.choice(combos)
+        # groups are normally read from XML, so every client gets
+        # its own copies of the strings and sets
+        rv.append(cls("client%d.example.com" % i, profile,
+                      set([str(g) for g in cgroups]),
+                      set([str(b) for b in cbundles]),
+                      set(), set(["10.%d.%d.%d" % (i >> 16, (i >> 8) % 256,
+                                                   i % 256)]),
+                      dict(categories), None, None, "1.3.1", None))
+    return rv
+
+
+def main():
+    optinfo = \
+        dict(clients=Bcfg2.Options.Option("Number of synthetic clients",
+                                          cmd="--clients",
+                                          odesc="<count>",
+                                          long_arg=True,
+                                          default=50000,
+                                          cook=int),
+             profiles=Bcfg2.Options.Option("Number of distinct profiles, "
+                                           "each with its own groups and "
+                                           "bundles",
+                                           cmd="--profiles",
+                                           odesc="<count>",
+                                           long_arg=True,
+                                           default=50,
+                                           cook=int))
+    setup = Bcfg2.Options.OptionParser(optinfo)
+    setup.parse(sys.argv[1:])
+
+    print("%-12s%14s%16s%12s" % ("Method", "Total (MB)", "Per client (B)",
+                                 "Build (s)"))
+    for name, cls in [("legacy", LegacyClientMetadata),
+                      ("interned", ClientMetadata)]:
+        start = time.time()
+        clients = generate_clients(cls, setup['clients'], setup['profiles'],
+                                   0)
+        elapsed = time.time() - start
+        size = get_size(clients)
+        print("%-12s%14.01f%16d%12.02f" % (name, size / 1048576.0,
+                                           size // len(clients), elapsed))
+        del clients
+    print("Interned sets and dicts: %d" % len(INTERNED))
+
+
+if __name__ == "__main__":
+    sys.exit(main())